@@ -0,0 +1,337 @@
+"""Admission control: per-group concurrency limits and per-user rate limits.
+
+Expensive endpoints are put in groups (ADMISSION_GROUPS), each with a cap
+on requests in flight. A request over the cap waits in a bounded queue for
+up to `timeout` seconds; if the queue is full, or the wait runs out, it is
+shed at once with a 503 and a Retry-After header, so slow pages can't take
+every worker and starve the cheap ones.
+
+Write endpoints decorated with `rate_limited` draw from a per-user token
+bucket (RATE_LIMITS) and get a 429 with Retry-After when it is empty.
+
+All state lives in shared memory created when the app is created. With
+gunicorn's preload_app the forked workers share it, so the limits hold
+across the whole server rather than per worker; without preload each
+worker enforces them on its own. Concurrency slots are recorded by pid,
+so those of a worker that dies mid-request are reclaimed.
+"""
+
+import functools
+import math
+import multiprocessing
+import os
+import time
+import zlib
+
+from flask import Response, current_app, g, request
+
+DEFAULT_GROUPS = {
+    'lists': dict(
+        endpoints=[
+            'warbler.list_users',
+            'warbler.show_following',
+            'warbler.show_followers',
+            'warbler.show_likes',
+            'warbler.show_suggestions',
+            'warbler.show_tag',
+            'warbler.show_mentions',
+        ],
+        limit=4,
+        queue_size=8,
+        timeout=2.0,
+    ),
+    'exports': dict(
+        endpoints=[
+            'warbler.export_data',
+        ],
+        limit=2,
+        queue_size=0,
+        timeout=0,
+    ),
+    'imports': dict(
+        endpoints=[
+            'warbler.import_messages',
+        ],
+        limit=1,
+        queue_size=0,
+        timeout=0,
+    ),
+}
+
+# endpoint -> (tokens per second, burst)
+DEFAULT_RATE_LIMITS = {
+    'warbler.add_message': (1 / 6, 10),
+    'warbler.like_add': (1.0, 30),
+    'warbler.start_following': (0.5, 20),
+    'warbler.import_messages': (1 / 600, 5),
+}
+
+DEFAULT_RETRY_AFTER = 1
+DEFAULT_BUCKET_SLOTS = 4096
+
+# How often a queued request checks for a free slot.
+POLL_SECONDS = 0.005
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class ConcurrencyLimiter:
+    """At most `limit` holders at once, with up to `queue_size` waiting.
+
+    Each slot records the pid holding it. A worker killed mid-request
+    (a gunicorn timeout, say) never releases its slots, so when the
+    limiter is full, slots held by pids that no longer exist are taken
+    back. Waiting requests poll for a free slot every POLL_SECONDS.
+    """
+
+    def __init__(self, limit, queue_size=0, timeout=1.0):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        # The pid holding each slot, or 0.
+        self._holders = multiprocessing.Array('i', limit)
+        self._waiting = multiprocessing.Value('i', 0)
+        self._admitted = multiprocessing.Value('q', 0)
+        self._queued = multiprocessing.Value('q', 0)
+        self._shed = multiprocessing.Value('q', 0)
+        self._reclaimed = multiprocessing.Value('q', 0)
+
+    @staticmethod
+    def _add(counter, amount=1):
+        with counter.get_lock():
+            counter.value += amount
+
+    def _take(self):
+        """Take a free slot, or one whose holder has died."""
+
+        holders = self._holders
+        with holders.get_lock():
+            free = [i for i, pid in enumerate(holders) if not pid]
+            if not free:
+                free = [i for i, pid in enumerate(holders)
+                        if not _alive(pid)]
+                for i in free:
+                    holders[i] = 0
+                if free:
+                    self._add(self._reclaimed, len(free))
+            if not free:
+                return False
+            holders[free[0]] = os.getpid()
+            return True
+
+    def _wait(self):
+        deadline = time.monotonic() + self.timeout
+        while time.monotonic() < deadline:
+            time.sleep(POLL_SECONDS)
+            if self._take():
+                return True
+        return False
+
+    def acquire(self):
+        """Take a slot, waiting if allowed. Returns False if shed."""
+
+        if not self._take():
+            with self._waiting.get_lock():
+                if self._waiting.value >= self.queue_size:
+                    self._add(self._shed)
+                    return False
+                self._waiting.value += 1
+
+            self._add(self._queued)
+            try:
+                got_slot = self._wait()
+            finally:
+                self._add(self._waiting, -1)
+
+            if not got_slot:
+                self._add(self._shed)
+                return False
+
+        self._add(self._admitted)
+        return True
+
+    def release(self):
+        """Give back one of this process's slots."""
+
+        holders, pid = self._holders, os.getpid()
+        with holders.get_lock():
+            for i, holder in enumerate(holders):
+                if holder == pid:
+                    holders[i] = 0
+                    return
+
+    def snapshot(self):
+        return dict(
+            limit=self.limit,
+            queue_size=self.queue_size,
+            in_flight=sum(1 for pid in self._holders if pid),
+            waiting=self._waiting.value,
+            admitted=self._admitted.value,
+            queued=self._queued.value,
+            shed=self._shed.value,
+            reclaimed=self._reclaimed.value,
+        )
+
+
+class TokenBuckets:
+    """Token buckets keyed by user, in a fixed table of shared slots.
+
+    Each key hashes to one of `slots` buckets that refill at `rate` tokens
+    a second up to `burst`. Two keys that land in the same slot share a
+    bucket, which can only make the limit stricter for them.
+    """
+
+    def __init__(self, rate, burst, slots=DEFAULT_BUCKET_SLOTS):
+        self.rate = rate
+        self.burst = burst
+        self.slots = slots
+        # (tokens, last refill) per slot; a refill time of 0 means unused.
+        self._state = multiprocessing.Array('d', 2 * slots)
+        self._allowed = multiprocessing.Value('q', 0)
+        self._limited = multiprocessing.Value('q', 0)
+
+    def _slot(self, key):
+        return zlib.crc32(str(key).encode()) % self.slots
+
+    def take(self, key, now=None):
+        """Take a token for `key`.
+
+        Returns 0 if one was available, otherwise the seconds until one
+        will be.
+        """
+
+        now = time.monotonic() if now is None else now
+        i = 2 * self._slot(key)
+
+        with self._state.get_lock():
+            tokens, updated = self._state[i], self._state[i + 1]
+            if updated == 0:
+                tokens = self.burst
+            else:
+                tokens = min(self.burst, tokens + (now - updated) * self.rate)
+
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0
+            else:
+                wait = (1 - tokens) / self.rate
+
+            self._state[i], self._state[i + 1] = tokens, now
+
+        counter = self._limited if wait else self._allowed
+        with counter.get_lock():
+            counter.value += 1
+
+        return wait
+
+    def snapshot(self):
+        return dict(
+            rate=self.rate,
+            burst=self.burst,
+            allowed=self._allowed.value,
+            limited=self._limited.value,
+        )
+
+
+class Admission:
+    """The limiters for one app, built from its config."""
+
+    def __init__(self, groups, rate_limits, retry_after):
+        self.retry_after = retry_after
+        self.groups = {
+            name: ConcurrencyLimiter(
+                group['limit'], group['queue_size'], group['timeout'])
+            for name, group in groups.items()
+        }
+        self.group_for = {
+            endpoint: name
+            for name, group in groups.items()
+            for endpoint in group['endpoints']
+        }
+        self.buckets = {
+            endpoint: TokenBuckets(rate, burst)
+            for endpoint, (rate, burst) in rate_limits.items()
+        }
+
+    def snapshot(self):
+        return dict(
+            groups={name: limiter.snapshot()
+                    for name, limiter in self.groups.items()},
+            rate_limits={endpoint: buckets.snapshot()
+                         for endpoint, buckets in self.buckets.items()},
+        )
+
+
+def init_app(app):
+    """Set up admission control for `app`, if ADMISSION_ENABLED."""
+
+    if not app.config['ADMISSION_ENABLED']:
+        return
+
+    app.extensions['admission'] = Admission(
+        app.config['ADMISSION_GROUPS'],
+        app.config['RATE_LIMITS'],
+        app.config['ADMISSION_RETRY_AFTER'],
+    )
+    app.before_request(_admit)
+    # Teardown runs after a streamed body is sent, so the slot is held
+    # until the page is finished.
+    app.teardown_request(_release)
+
+
+def refuse(status, message, retry_after):
+    return Response(
+        message,
+        status=status,
+        mimetype='text/plain',
+        headers={'Retry-After': str(max(1, math.ceil(retry_after)))},
+    )
+
+
+def _admit():
+    admission = current_app.extensions['admission']
+    name = admission.group_for.get(request.endpoint)
+    if name is None:
+        return None
+
+    limiter = admission.groups[name]
+    if not limiter.acquire():
+        return refuse(
+            503, "Server busy, please try again shortly.",
+            admission.retry_after)
+
+    g.admission_slot = limiter
+    return None
+
+
+def _release(exc):
+    limiter = g.pop('admission_slot', None)
+    if limiter is not None:
+        limiter.release()
+
+
+def rate_limited(view):
+    """Limit how often each user can POST to the decorated view."""
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        admission = current_app.extensions.get('admission')
+        buckets = admission and admission.buckets.get(request.endpoint)
+
+        if buckets and request.method == 'POST' and g.user:
+            wait = buckets.take(g.user.id)
+            if wait:
+                return refuse(
+                    429, "Too many requests, please slow down.", wait)
+
+        return view(*args, **kwargs)
+
+    return wrapper
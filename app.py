@@ -1,33 +1,257 @@
+"""Warbler: a small Twitter clone built on Flask."""
+
 import os
-from dotenv import load_dotenv
+import tempfile
+from itertools import islice
 
-from flask import Flask, render_template, request, flash, redirect, session, g
-from flask_debugtoolbar import DebugToolbarExtension
+import click
+from dotenv import load_dotenv
+from flask import (
+    Blueprint, Flask, Response, abort, current_app, get_flashed_messages,
+    render_template, send_file, send_from_directory, stream_template,
+    stream_with_context, request, flash, redirect, session, g)
+from jinja2 import FileSystemBytecodeCache
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
+
+from forms import (
+    UserAddForm, LoginForm, MessageForm, MessageImportForm, LazyCsrfForm,
+    ProfileEditForm)
+from models import (
+    db, connect_db, User, Message, Recommendation,
+    DEFAULT_HEADER_IMAGE_URL, DEFAULT_IMAGE_URL)
+import admission
+import availability
+from admission import rate_limited
+import archive
+import bulk_import
+import cache
+import compression
+from deletion import tombstone_user
+import export
+from follow_graph import follow_graph
+import jobs
+import notifications
+import profiler
+import read_models
+import resilience
+import sharding
+import spam
+from trending import trending
 
-from forms import UserAddForm, LoginForm, MessageForm, CsrfForm, ProfileEditForm
-from models import db, connect_db, User, Message, DEFAULT_HEADER_IMAGE_URL, DEFAULT_IMAGE_URL
+CURR_USER_KEY = "curr_user"
+TRENDING_PAGE_SIZE = 50
 
-load_dotenv()
+# Messages per page on the timeline, profile and likes pages. Pages are
+# keyed by message id: ?before=<id> shows the page older than that id.
+MESSAGES_PAGE_SIZE = 100
 
-CURR_USER_KEY = "curr_user"
+# Rows fetched per round trip, and bytes of HTML per write, on list pages.
+STREAM_CHUNK_SIZE = 100
+STREAM_BUFFER_SIZE = 16 * 1024
+
+bp = Blueprint('warbler', __name__, cli_group=None)
+
+
+##############################################################################
+# Application factory
+
+
+def create_app(config=None):
+    """Create and configure the Warbler app.
+
+    Settings come from the environment (and a .env file), then `config`, a
+    mapping of overrides. Nothing here opens a database connection: the
+    engine's pool connects on first use, so an app created in a gunicorn
+    master with --preload is safe to fork (see gunicorn.conf.py).
+    """
+
+    load_dotenv()
+
+    app = Flask(__name__)
+
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL')
+    app.config['SQLALCHEMY_ECHO'] = False
+    app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY')
+    app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get(
+        'BCRYPT_LOG_ROUNDS', 12))
+    app.config['DEBUG_TB_ENABLED'] = False
+    app.config['WARM_UP_TEMPLATES'] = True
+    app.config['JINJA_BYTECODE_CACHE_DIR'] = os.environ.get(
+        'JINJA_BYTECODE_CACHE_DIR')
+    app.config['PROFILER_SAMPLE_RATE'] = float(
+        os.environ.get('PROFILER_SAMPLE_RATE', 0))
+    app.config['PROFILER_TOKEN'] = os.environ.get('PROFILER_TOKEN')
+    app.config['PROFILER_DIR'] = os.environ.get(
+        'PROFILER_DIR',
+        os.path.join(tempfile.gettempdir(), 'warbler-profiles'))
+    app.config['PROFILER_INTERVAL'] = profiler.DEFAULT_INTERVAL
+    app.config['PROFILER_KEEP'] = profiler.DEFAULT_KEEP
+    app.config['COMPRESSION_ENABLED'] = True
+    app.config['ADMISSION_ENABLED'] = True
+    app.config['ADMISSION_GROUPS'] = admission.DEFAULT_GROUPS
+    app.config['ADMISSION_RETRY_AFTER'] = admission.DEFAULT_RETRY_AFTER
+    app.config['RATE_LIMITS'] = admission.DEFAULT_RATE_LIMITS
+    app.config['STATEMENT_TIMEOUT_MS'] = int(os.environ.get(
+        'STATEMENT_TIMEOUT_MS', resilience.DEFAULT_STATEMENT_TIMEOUT_MS))
+    app.config['STATEMENT_TIMEOUTS'] = resilience.DEFAULT_STATEMENT_TIMEOUTS
+    app.config['FALLBACK_ENDPOINTS'] = resilience.DEFAULT_FALLBACK_ENDPOINTS
+    app.config['BREAKER_THRESHOLD'] = resilience.DEFAULT_BREAKER_THRESHOLD
+    app.config['BREAKER_RESET_SECONDS'] = \
+        resilience.DEFAULT_BREAKER_RESET_SECONDS
+    app.config['RENDER_CACHE_SIZE'] = resilience.DEFAULT_RENDER_CACHE_SIZE
+    app.config['FAULT_SLOW_QUERY_SECONDS'] = float(
+        os.environ.get('FAULT_SLOW_QUERY_SECONDS', 0))
+    app.config['EXPORT_DIR'] = os.environ.get(
+        'EXPORT_DIR', os.path.join(tempfile.gettempdir(), 'warbler-exports'))
+    app.config['EXPORT_EXPIRE_SECONDS'] = int(os.environ.get(
+        'EXPORT_EXPIRE_SECONDS', export.DEFAULT_EXPIRE_SECONDS))
+    app.config['IMPORT_MAX_BYTES'] = int(os.environ.get(
+        'IMPORT_MAX_BYTES', 10 * 2**20))
+    app.config['MESSAGE_ARCHIVE_DIR'] = os.environ.get('MESSAGE_ARCHIVE_DIR')
+    app.config['MESSAGE_ARCHIVE_CACHE_SIZE'] = archive.DEFAULT_CACHE_SIZE
+    app.config['SPAM_FILTER_ENABLED'] = True
+    app.config['SPAM_WINDOW'] = int(os.environ.get(
+        'SPAM_WINDOW', spam.DEFAULT_WINDOW))
+    app.config['SPAM_THRESHOLD'] = float(os.environ.get(
+        'SPAM_THRESHOLD', spam.DEFAULT_THRESHOLD))
+    app.config['SPAM_MAX_DUPLICATES'] = int(os.environ.get(
+        'SPAM_MAX_DUPLICATES', spam.DEFAULT_MAX_DUPLICATES))
+    app.config['SPAM_MIN_LENGTH'] = spam.DEFAULT_MIN_LENGTH
+    app.config['SPAM_BANDS'] = spam.DEFAULT_BANDS
+    app.config['SPAM_ROWS'] = spam.DEFAULT_ROWS
+    app.config['SPAM_REFRESH_SECONDS'] = spam.DEFAULT_REFRESH_SECONDS
+    app.config['AVAILABILITY_FILTER_ENABLED'] = True
+    app.config['AVAILABILITY_CAPACITY'] = int(os.environ.get(
+        'AVAILABILITY_CAPACITY', availability.DEFAULT_CAPACITY))
+    app.config['AVAILABILITY_ERROR_RATE'] = availability.DEFAULT_ERROR_RATE
+    app.config['AVAILABILITY_REFRESH_SECONDS'] = (
+        availability.DEFAULT_REFRESH_SECONDS)
+    app.config['AVAILABILITY_REBUILD_SECONDS'] = (
+        availability.DEFAULT_REBUILD_SECONDS)
+    app.config['CACHE_ENABLED'] = True
+    app.config['CACHE_L1_SIZE'] = cache.DEFAULT_L1_SIZE
+    app.config['CACHE_TTL'] = float(os.environ.get(
+        'CACHE_TTL', cache.DEFAULT_TTL))
+    app.config['CACHE_BETA'] = cache.DEFAULT_BETA
+    app.config['CACHE_DIR'] = os.environ.get('CACHE_DIR')
+    app.config['CACHE_TAG_SLOTS'] = cache.DEFAULT_TAG_SLOTS
+    app.config['TRENDING_ENABLED'] = True
+    app.config['SUGGESTIONS_ENABLED'] = True
+    app.config['SHARD_URLS'] = [
+        url for url in os.environ.get('SHARD_URLS', '').split(',') if url]
+    app.config['COMPRESSION_MIN_SIZE'] = compression.DEFAULT_MIN_SIZE
+    app.config['COMPRESSION_GZIP_LEVEL'] = int(os.environ.get(
+        'COMPRESSION_GZIP_LEVEL', compression.DEFAULT_GZIP_LEVEL))
+    app.config['COMPRESSION_BROTLI_QUALITY'] = int(os.environ.get(
+        'COMPRESSION_BROTLI_QUALITY', compression.DEFAULT_BROTLI_QUALITY))
+
+    if config:
+        app.config.from_mapping(config)
+
+    sharding.init_app(app)
+    connect_db(app)
+    profiler.init_app(app)
+    admission.init_app(app)
+    resilience.init_app(app, CURR_USER_KEY)
+    archive.init_app(app)
+    spam.init_app(app)
+    availability.init_app(app)
+    cache.init_app(app)
+    app.register_blueprint(bp)
+
+    if app.config['JINJA_BYTECODE_CACHE_DIR']:
+        cache_dir = app.config['JINJA_BYTECODE_CACHE_DIR']
+        os.makedirs(cache_dir, exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(cache_dir)
+
+    if app.config['COMPRESSION_ENABLED']:
+        app.wsgi_app = compression.CompressionMiddleware(
+            app.wsgi_app,
+            min_size=app.config['COMPRESSION_MIN_SIZE'],
+            gzip_level=app.config['COMPRESSION_GZIP_LEVEL'],
+            brotli_quality=app.config['COMPRESSION_BROTLI_QUALITY'],
+        )
+
+    if app.config['DEBUG_TB_ENABLED']:
+        from flask_debugtoolbar import DebugToolbarExtension
+
+        DebugToolbarExtension(app)
+
+    if app.config['WARM_UP_TEMPLATES']:
+        warm_up_templates(app)
+
+    return app
+
+
+def warm_up_templates(app):
+    """Compile every template now rather than on its first request.
+
+    With a bytecode cache configured, templates already in the cache are
+    loaded from it instead of being compiled again, and the rest are added
+    to it. Returns the number of templates loaded.
+    """
+
+    names = app.jinja_env.list_templates()
+    for name in names:
+        app.jinja_env.get_template(name)
+    return len(names)
+
+
+def stream_page(template_name, **context):
+    """Render `template_name` as a streamed response.
+
+    The page is sent in pieces of about STREAM_BUFFER_SIZE bytes as the
+    template renders, so rows from a `yield_per` query are fetched,
+    rendered and flushed a chunk at a time.
+    """
+
+    # Pop flashed messages now: the session is saved before the body is
+    # streamed, so anything popped while rendering would come back later.
+    get_flashed_messages()
+
+    def buffered(chunks):
+        pending = []
+        size = 0
+        for chunk in chunks:
+            pending.append(chunk)
+            size += len(chunk)
+            if size >= STREAM_BUFFER_SIZE:
+                yield "".join(pending)
+                pending = []
+                size = 0
+        if pending:
+            yield "".join(pending)
+
+    return Response(buffered(stream_template(template_name, **context)))
+
+
+def checked_in_chunks(rows, among, chunk_size=STREAM_CHUNK_SIZE):
+    """(`rows` again, a set of the ids among them that `among` picks).
+
+    The set only ever holds the answer for the chunk of rows being
+    rendered: each chunk's ids are passed to `among` just before it is
+    yielded. A streamed page can check, say, which users on it the viewer
+    follows without loading everyone they follow.
+    """
 
-app = Flask(__name__)
+    found = set()
 
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ['DATABASE_URL']
-app.config['SQLALCHEMY_ECHO'] = False
-# app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
-app.config['SECRET_KEY'] = os.environ['SECRET_KEY']
-# toolbar = DebugToolbarExtension(app)
+    def chunks():
+        rows_left = iter(rows)
+        while chunk := list(islice(rows_left, chunk_size)):
+            found.clear()
+            found.update(among([row.id for row in chunk]))
+            yield from chunk
 
-connect_db(app)
+    return chunks(), found
 
 
 ##############################################################################
 # User signup/login/logout
 
 
-@app.before_request
+@bp.before_app_request
 def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
 
@@ -38,11 +262,11 @@ def add_user_to_g():
         g.user = None
 
 
-@app.before_request
+@bp.before_app_request
 def form_protection():
-    """Creates Csrf form protection"""
+    """Creates Csrf form protection (built lazily, on first use)"""
 
-    g.csrf_form = CsrfForm()
+    g.csrf_form = LazyCsrfForm()
 
 
 def do_login(user):
@@ -58,7 +282,7 @@ def do_logout():
         del session[CURR_USER_KEY]
 
 
-@app.route('/signup', methods=["GET", "POST"])
+@bp.route('/signup', methods=["GET", "POST"])
 def signup():
     """Handle user signup.
 
@@ -75,6 +299,14 @@ def signup():
     form = UserAddForm()
 
     if form.validate_on_submit():
+        # Check before User.signup() spends a bcrypt hash on a collision.
+        taken = availability.taken(
+            db.session, form.username.data, form.email.data)
+        if taken:
+            flash(f"{' and '.join(sorted(taken)).capitalize()} already taken",
+                  'danger')
+            return render_template('users/signup.html', form=form)
+
         try:
             user = User.signup(
                 username=form.username.data,
@@ -88,6 +320,9 @@ def signup():
             flash("Username already taken", 'danger')
             return render_template('users/signup.html', form=form)
 
+        available = availability.current()
+        if available:
+            available.added(user.id, user.username, user.email)
         do_login(user)
 
         return redirect("/")
@@ -96,7 +331,7 @@ def signup():
         return render_template('users/signup.html', form=form)
 
 
-@app.route('/login', methods=["GET", "POST"])
+@bp.route('/login', methods=["GET", "POST"])
 def login():
     """Handle user login and redirect to homepage on success."""
 
@@ -118,7 +353,7 @@ def login():
     return render_template('users/login.html', form=form)
 
 
-@app.post('/logout')
+@bp.post('/logout')
 def logout():
     """Handle logout of user and redirect to homepage."""
 
@@ -137,7 +372,7 @@ def logout():
 ##############################################################################
 # General user routes:
 
-@app.get('/users')
+@bp.get('/users')
 def list_users():
     """Page with listing of users.
 
@@ -150,15 +385,21 @@ def list_users():
 
     search = request.args.get('q')
 
-    if not search:
-        users = User.query.all()
-    else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+    users = User.query.order_by(User.id)
+    if search:
+        users = users.filter(User.username.like(f"%{search}%"))
+
+    users, following_ids = checked_in_chunks(
+        users.yield_per(STREAM_CHUNK_SIZE), g.user.following_among)
 
-    return render_template('users/index.html', users=users)
+    return stream_page(
+        'users/index.html',
+        users=users,
+        following_ids=following_ids,
+    )
 
 
-@app.get('/users/<int:user_id>')
+@bp.get('/users/<int:user_id>')
 def show_user(user_id):
     """Show user profile."""
 
@@ -166,12 +407,52 @@ def show_user(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-
-    return render_template('users/show.html', user=user)
-
-
-@app.get('/users/<int:user_id>/following')
+    user = cache.cached(
+        ('profile', user_id),
+        lambda: _profile(user_id),
+        tags=cache.profile_tags(user_id),
+    )
+    if user is None:
+        abort(404)
+
+    recommendations = []
+    if current_app.config['SUGGESTIONS_ENABLED']:
+        recommendations = (
+            Recommendation
+            .query
+            .filter_by(user_id=g.user.id)
+            .order_by(Recommendation.rank)
+            .options(joinedload(Recommendation.recommended_user))
+            .all())
+
+    shards = sharding.current()
+    messages = shards.user_messages(
+        db.session,
+        user.id,
+        limit=MESSAGES_PAGE_SIZE,
+        before=request.args.get('before', type=int),
+        archive=current_app.extensions.get('message_archive'),
+    )
+
+    return render_template(
+        'users/show.html',
+        user=user,
+        messages=messages,
+        page_size=MESSAGES_PAGE_SIZE,
+        liked_ids=shards.liked_among(
+            db.session, g.user.id, [msg.id for msg in messages]),
+        recommendations=recommendations,
+    )
+
+
+def _profile(user_id):
+    """The Profile of user `user_id`, or None if there's no such user."""
+
+    user = User.query.get(user_id)
+    return read_models.Profile.of(user) if user is not None else None
+
+
+@bp.get('/users/<int:user_id>/following')
 def show_following(user_id):
     """Show list of people this user is following."""
 
@@ -180,10 +461,20 @@ def show_following(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    following, following_ids = checked_in_chunks(
+        sharding.current().following_users(
+            db.session, user.id, chunk_size=STREAM_CHUNK_SIZE),
+        g.user.following_among)
 
+    return stream_page(
+        'users/following.html',
+        user=user,
+        following=following,
+        following_ids=following_ids,
+    )
 
-@app.get('/users/<int:user_id>/followers')
+
+@bp.get('/users/<int:user_id>/followers')
 def show_followers(user_id):
     """Show list of followers of this user."""
 
@@ -192,10 +483,42 @@ def show_followers(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    followers, following_ids = checked_in_chunks(
+        sharding.current().follower_users(
+            db.session, user.id, chunk_size=STREAM_CHUNK_SIZE),
+        g.user.following_among)
+
+    return stream_page(
+        'users/followers.html',
+        user=user,
+        followers=followers,
+        following_ids=following_ids,
+    )
+
 
+@bp.get('/users/<int:user_id>/suggestions')
+def show_suggestions(user_id):
+    """Show users this user might want to follow, based on who the people
+    they follow are following."""
 
-@app.post('/users/follow/<int:follow_id>')
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    if not current_app.config['SUGGESTIONS_ENABLED']:
+        abort(404)
+
+    user = User.query.get_or_404(user_id)
+
+    scores = dict(follow_graph.get(db.session).suggestions(user.id))
+    users = User.query.filter(User.id.in_(scores)).all()
+    users.sort(key=lambda u: (-scores[u.id], u.id))
+
+    return render_template('users/suggestions.html', user=user, users=users)
+
+
+@bp.post('/users/follow/<int:follow_id>')
+@rate_limited
 def start_following(follow_id):
     """Add a follow for the currently-logged-in user.
 
@@ -206,13 +529,16 @@ def start_following(follow_id):
         return redirect("/")
 
     followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
+    sharding.current().follow(db.session, g.user.id, followed_user.id)
+    notifications.followed(db.session, followed_user.id, g.user.id)
     db.session.commit()
+    if current_app.config['SUGGESTIONS_ENABLED']:
+        follow_graph.add_follow(g.user.id, followed_user.id)
 
     return redirect(f"/users/{g.user.id}/following")
 
 
-@app.post('/users/stop-following/<int:follow_id>')
+@bp.post('/users/stop-following/<int:follow_id>')
 def stop_following(follow_id):
     """Have currently-logged-in-user stop following this user.
 
@@ -223,13 +549,15 @@ def stop_following(follow_id):
         return redirect("/")
 
     followed_user = User.query.get_or_404(follow_id)
-    g.user.following.remove(followed_user)
+    sharding.current().unfollow(db.session, g.user.id, followed_user.id)
     db.session.commit()
+    if current_app.config['SUGGESTIONS_ENABLED']:
+        follow_graph.remove_follow(g.user.id, followed_user.id)
 
     return redirect(f"/users/{g.user.id}/following")
 
 
-@app.route('/users/profile', methods=["GET", "POST"])
+@bp.route('/users/profile', methods=["GET", "POST"])
 def profile():
     """Update profile for current user."""
 
@@ -238,8 +566,12 @@ def profile():
         return redirect("/")
 
     form = ProfileEditForm(obj=g.user)
+    export_ready = export.prepared(
+        current_app.config['EXPORT_DIR'], g.user.id,
+        current_app.config['EXPORT_EXPIRE_SECONDS']) is not None
 
     if form.validate_on_submit():
+        old = (g.user.username, g.user.email)
         g.user.username = form.username.data
         g.user.email = form.email.data
         g.user.image_url = form.image_url.data or DEFAULT_IMAGE_URL
@@ -253,19 +585,92 @@ def profile():
 
         if authenticated_user:
             db.session.commit()
+            available = availability.current()
+            if available:
+                available.changed(
+                    g.user.id, old, (g.user.username, g.user.email))
             return redirect(f"/users/{g.user.id}")
 
         else:
             flash("Invalid credentials.", 'danger')
-            return render_template("users/edit.html", form=form)
+            return render_template(
+                "users/edit.html", form=form, export_ready=export_ready)
     else:
-        return render_template("users/edit.html", form=form)
+        return render_template(
+            "users/edit.html", form=form, export_ready=export_ready)
+
+
+@bp.route('/users/export', methods=["GET", "POST"])
+def export_data():
+    """Download a ZIP of the current user's data.
+
+    GET streams it as it's built. POST has a background job write it to a
+    file instead, for /users/export/download.
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    if request.method == 'POST':
+        if not g.csrf_form.validate_on_submit():
+            flash("Access unauthorized.", "danger")
+            return redirect("/")
 
+        jobs.enqueue(db.session, 'export_user', {'user_id': g.user.id})
+        db.session.commit()
+        flash("Your export is being prepared; download it from your "
+              "profile page once it's ready.", "success")
+        return redirect("/users/profile")
+
+    chunks = export.stream(db.session, g.user.id,
+                           current_app.extensions.get('message_archive'))
+    resp = Response(stream_with_context(chunks), mimetype='application/zip')
+    resp.headers.set(
+        'Content-Disposition', 'attachment',
+        **export.filenames(export.download_name(g.user.username)))
+    return resp
+
+
+@bp.get('/users/export/download')
+def download_export():
+    """Download the export written by the job, with Range support."""
 
-@app.post('/users/delete')
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    path = export.prepared(current_app.config['EXPORT_DIR'], g.user.id,
+                           current_app.config['EXPORT_EXPIRE_SECONDS'])
+    if path is None:
+        abort(404)
+
+    return send_file(path, mimetype='application/zip', as_attachment=True,
+                     download_name=export.download_name(g.user.username),
+                     conditional=True)
+
+
+@bp.get('/users/available')
+def check_available():
+    """Are ?username= and ?email= free to sign up with?
+
+    Answers {"username": true, "email": false} for whichever were given.
+    """
+
+    username = request.args.get('username', '').strip()
+    email = request.args.get('email', '').strip()
+    taken = availability.taken(db.session, username, email)
+
+    fields = {'username': username, 'email': email}
+    return {field: field not in taken
+            for field, value in fields.items() if value}
+
+
+@bp.post('/users/delete')
 def delete_user():
     """Delete user.
 
+    The user disappears at once; their rows are purged in the background.
     Redirect to signup page.
     """
 
@@ -275,15 +680,14 @@ def delete_user():
 
     do_logout()
 
-    Message.query.filter_by(user_id=g.user.id).delete()
-    db.session.delete(g.user)
+    tombstone_user(db.session, g.user.id)
     db.session.commit()
     flash("User Deleted!", "danger")
 
     return redirect("/signup")
 
 
-@app.get('/users/<int:user_id>/likes')
+@bp.get('/users/<int:user_id>/likes')
 def show_likes(user_id):
     """Show list of liked messages of this user."""
 
@@ -292,10 +696,74 @@ def show_likes(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/likes.html', user=user)
 
+    shards = sharding.current()
+    messages, liked_ids = checked_in_chunks(
+        shards.liked_messages(
+            db.session,
+            user.id,
+            STREAM_CHUNK_SIZE,
+            limit=MESSAGES_PAGE_SIZE,
+            before=request.args.get('before', type=int),
+            archive=current_app.extensions.get('message_archive'),
+        ),
+        lambda message_ids: shards.liked_among(
+            db.session, g.user.id, message_ids))
+
+    return stream_page(
+        'users/likes.html',
+        user=user,
+        messages=messages,
+        page_size=MESSAGES_PAGE_SIZE,
+        liked_ids=liked_ids,
+    )
+
+
+@bp.get('/notifications')
+def show_notifications():
+    """Show the current user's notifications, and mark them read."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    items = notifications.inbox(db.session, g.user.id)
+    notifications.mark_read(db.session, g.user.id)
+    db.session.commit()
+
+    return render_template('users/notifications.html', items=items)
+
+
+@bp.get('/users/<int:user_id>/mentions')
+def show_mentions(user_id):
+    """Show messages that mention this user, newest first."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
 
-@app.post('/users/like/<int:message_id>')
+    user = User.query.get_or_404(user_id)
+
+    shards = sharding.current()
+    messages = shards.mentioning_messages(
+        db.session,
+        user.id,
+        limit=MESSAGES_PAGE_SIZE,
+        before=request.args.get('before', type=int),
+    )
+
+    return render_template(
+        'users/mentions.html',
+        user=user,
+        messages=messages,
+        page_size=MESSAGES_PAGE_SIZE,
+        liked_ids=shards.liked_among(
+            db.session, g.user.id, [msg.id for msg in messages]),
+    )
+
+
+@bp.post('/users/like/<int:message_id>')
+@rate_limited
 def like_add(message_id):
     """Likes a message and adds that message to likes.
     Redirects to likes page for the current user.
@@ -305,14 +773,22 @@ def like_add(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    liked_message = Message.query.get_or_404(message_id)
-    g.user.liked_messages.append(liked_message)
+    shards = sharding.current()
+    liked_message = shards.message(db.session, message_id)
+    if liked_message is None:
+        abort(404)
+
+    liked_at = shards.like(db.session, g.user.id, liked_message.id)
+    notifications.liked(
+        db.session, liked_message.user.id, g.user.id, liked_message.id)
     db.session.commit()
+    if current_app.config['TRENDING_ENABLED']:
+        trending.add_like(liked_message.id, liked_at)
 
     return redirect(f"/users/{g.user.id}/likes")
 
 
-@app.post('/users/unlike/<int:message_id>')
+@bp.post('/users/unlike/<int:message_id>')
 def like_remove(message_id):
     """Likes a message and adds that message to likes.
     Redirects to likes page for the current user.
@@ -322,9 +798,14 @@ def like_remove(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    unliked_message = Message.query.get_or_404(message_id)
-    g.user.liked_messages.remove(unliked_message)
+    shards = sharding.current()
+    if shards.message(db.session, message_id) is None:
+        abort(404)
+
+    liked_at = shards.unlike(db.session, g.user.id, message_id)
     db.session.commit()
+    if liked_at and current_app.config['TRENDING_ENABLED']:
+        trending.remove_like(message_id, liked_at)
 
     return redirect(f"/users/{g.user.id}/likes")
 
@@ -332,7 +813,8 @@ def like_remove(message_id):
 # Messages routes:
 
 
-@app.route('/messages/new', methods=["GET", "POST"])
+@bp.route('/messages/new', methods=["GET", "POST"])
+@rate_limited
 def add_message():
     """Add a message:
 
@@ -346,16 +828,68 @@ def add_message():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
+        spam_filter = spam.current()
+        if spam_filter and spam_filter.is_spam(db.session, form.text.data):
+            flash("That message is too much like ones posted recently.",
+                  "danger")
+            return render_template('messages/create.html', form=form)
+
+        message_id = sharding.current().add_message(
+            db.session, g.user.id, form.text.data)
+        notifications.mentioned(
+            db.session, g.user.id, message_id, form.text.data)
         db.session.commit()
+        if spam_filter:
+            spam_filter.add(message_id, form.text.data)
 
         return redirect(f"/users/{g.user.id}")
 
     return render_template('messages/create.html', form=form)
 
 
-@app.get('/messages/<int:message_id>')
+@bp.route('/messages/import', methods=["GET", "POST"])
+@rate_limited
+def import_messages():
+    """Import messages, with their timestamps, from an NDJSON or CSV file.
+
+    Show form if GET. If the whole file is valid, import it and redirect to
+    user page; otherwise show the first problems found.
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    max_bytes = current_app.config['IMPORT_MAX_BYTES']
+    if (request.content_length or 0) > max_bytes:
+        flash(f"Files can be at most {max_bytes // 2**20} MiB; use "
+              "`flask import-messages` for bigger ones.", "danger")
+        return redirect("/messages/import")
+
+    form = MessageImportForm()
+
+    if form.validate_on_submit():
+        upload = form.file.data
+        format = bulk_import.format_for(upload.filename)
+        not_before = bulk_import.not_before(
+            current_app.extensions.get('message_archive'))
+
+        count, oldest, errors = bulk_import.validate(
+            upload.stream, format, not_before)
+        if errors:
+            return render_template(
+                'messages/import.html', form=form, errors=errors)
+
+        upload.stream.seek(0)
+        bulk_import.import_messages(
+            db.session, g.user.id, upload.stream, format, oldest, not_before)
+        flash(f"Imported {count} messages.", "success")
+        return redirect(f"/users/{g.user.id}")
+
+    return render_template('messages/import.html', form=form, errors=[])
+
+
+@bp.get('/messages/<int:message_id>')
 def show_message(message_id):
     """Show a message."""
 
@@ -363,11 +897,77 @@ def show_message(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = Message.query.get_or_404(message_id)
-    return render_template('messages/show.html', message=msg)
+    shards = sharding.current()
+    msg = cache.cached(
+        ('message', message_id),
+        lambda: shards.message(db.session, message_id),
+        tags=[f"message:{message_id}"],
+        value_tags=lambda msg: [f"user:{msg.user.id}"] if msg else [],
+    )
+    if msg is None:
+        abort(404)
+
+    return render_template(
+        'messages/show.html',
+        message=msg,
+        liked=bool(shards.liked_among(db.session, g.user.id, [msg.id])),
+        following_ids=g.user.following_among([msg.user.id]),
+    )
+
+
+@bp.get('/tags/<tag>')
+def show_tag(tag):
+    """Show messages tagged #tag, newest first."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    shards = sharding.current()
+    messages = shards.tagged_messages(
+        db.session,
+        tag,
+        limit=MESSAGES_PAGE_SIZE,
+        before=request.args.get('before', type=int),
+    )
+
+    return render_template(
+        'messages/tag.html',
+        tag=tag.lower(),
+        messages=messages,
+        page_size=MESSAGES_PAGE_SIZE,
+        liked_ids=shards.liked_among(
+            db.session, g.user.id, [msg.id for msg in messages]),
+    )
+
+
+@bp.get('/trending')
+def show_trending():
+    """Show the messages with the most like activity in the last day.
+
+    The ranking comes from the in-memory trending index; only the messages
+    on the page are loaded from the database.
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
 
+    if not current_app.config['TRENDING_ENABLED']:
+        abort(404)
 
-@app.post('/messages/<int:message_id>/delete')
+    top = trending.get(db.session).cached_top(TRENDING_PAGE_SIZE)
+    top_ids = [message_id for message_id, _ in top]
+
+    found = {msg.id: msg
+             for msg in Message.query.filter(Message.id.in_(top_ids))}
+    messages = [found[message_id] for message_id in top_ids
+                if message_id in found]
+
+    return render_template('messages/trending.html', messages=messages)
+
+
+@bp.post('/messages/<int:message_id>/delete')
 def delete_message(message_id):
     """Delete a message.
 
@@ -378,53 +978,342 @@ def delete_message(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = Message.query.get_or_404(message_id)
+    shards = sharding.current()
+    msg = shards.message(db.session, message_id)
+    if msg is None:
+        abort(404)
 
-    if msg.user_id != g.user.id:
+    if msg.user.id != g.user.id:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    db.session.delete(msg)
+    shards.delete_message(db.session, msg.id, g.user.id)
     db.session.commit()
+    if current_app.config['TRENDING_ENABLED']:
+        trending.discard(msg.id)
 
     return redirect(f"/users/{g.user.id}")
 
 
+##############################################################################
+# Admin pages
+
+
+@bp.get('/admin/profiles')
+def list_profiles():
+    """Show the slowest profiled requests (see profiler.py)."""
+
+    if not g.user or not g.user.is_admin:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    profiles = profiler.slowest(current_app.config['PROFILER_DIR'])
+    return render_template('admin/profiles.html', profiles=profiles)
+
+
+@bp.get('/admin/metrics')
+def show_metrics():
+    """This process's operational counters, as JSON."""
+
+    if not g.user or not g.user.is_admin:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    metrics = {
+        'compression': compression.stats.snapshot(),
+    }
+    for name in ('admission', 'resilience', 'spam', 'availability',
+                 'cache'):
+        if name in current_app.extensions:
+            metrics[name] = current_app.extensions[name].snapshot()
+    return metrics
+
+
+@bp.get('/admin/profiles/<name>')
+def download_profile(name):
+    """Download a captured profile's collapsed-stack or speedscope file."""
+
+    if not g.user or not g.user.is_admin:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    if not name.endswith((".collapsed", ".speedscope.json")):
+        abort(404)
+
+    return send_from_directory(
+        current_app.config['PROFILER_DIR'], name, as_attachment=True)
+
+
 ##############################################################################
 # Homepage and error pages
 
 
-@app.get('/')
+@bp.get('/')
 def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of self & followed_users
+    - logged in: 100 most recent messages of self & followed_users, or
+      the 100 before message ?before=<id>
     """
 
-    form = CsrfForm()
-
     if g.user:
-        following_ids = [
-            following.id for following in g.user.following] + [g.user.id]
-
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(following_ids))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
-
-        return render_template('home.html', messages=messages, form=form)
+        shards = sharding.current()
+        user_id = g.user.id
+        before = request.args.get('before', type=int)
+        messages = cache.cached(
+            ('timeline', user_id, before),
+            lambda: shards.timeline(
+                db.session,
+                user_id,
+                limit=MESSAGES_PAGE_SIZE,
+                before=before,
+            ),
+            tags=lambda: cache.timeline_tags(
+                user_id, shards.following_ids(db.session, user_id)),
+        )
+        resilience.remember_timeline(user_id, messages)
+        liked_ids = shards.liked_among(
+            db.session, g.user.id, [msg.id for msg in messages])
+
+        return render_template(
+            'home.html',
+            messages=messages,
+            liked_ids=liked_ids,
+            page_size=MESSAGES_PAGE_SIZE,
+        )
 
     else:
         return render_template('home-anon.html')
 
 
-@app.after_request
+@bp.get('/health')
+def show_health():
+    """Database breaker state and fallback counts, as JSON.
+
+    Answered without touching the database, so it works while it's down.
+    """
+
+    return current_app.extensions['resilience'].snapshot()
+
+
+@bp.after_app_request
 def add_header(response):
     """Add non-caching headers on every request."""
 
     # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Cache-Control
     response.cache_control.no_store = True
     return response
+
+
+##############################################################################
+# CLI commands
+
+
+@bp.cli.command('recommend')
+@click.option('--top-k', default=10, help="Suggestions to keep per user.")
+@click.option('--workers', type=int, default=None,
+              help="Worker processes (default: one per CPU).")
+def recommend_command(top_k, workers):
+    """Recompute "who to follow" suggestions for every user."""
+
+    if not current_app.config['SUGGESTIONS_ENABLED']:
+        raise click.ClickException("SUGGESTIONS_ENABLED is off.")
+
+    from recommendations import run_job
+
+    written = run_job(db.session, k=top_k, workers=workers)
+    click.echo(f"Wrote {written} recommendations.")
+
+
+@bp.cli.command('compile-templates')
+def compile_templates_command():
+    """Fill the Jinja bytecode cache with every template."""
+
+    cache_dir = current_app.config['JINJA_BYTECODE_CACHE_DIR']
+    if not cache_dir:
+        raise click.ClickException("JINJA_BYTECODE_CACHE_DIR is not set.")
+
+    count = warm_up_templates(current_app)
+    click.echo(f"Compiled {count} templates into {cache_dir}.")
+
+
+@bp.cli.command('migrate-message-ids')
+@click.option('--batch-size', default=10_000,
+              help="Messages renumbered per statement batch.")
+def migrate_message_ids_command(batch_size):
+    """Give pre-existing messages time-ordered snowflake ids."""
+
+    from id_migration import migrate_message_ids
+
+    count = migrate_message_ids(db.session, batch_size=batch_size)
+    trending.clear()
+    click.echo(f"Renumbered {count} messages.")
+
+
+@bp.cli.command('partition-messages')
+def partition_messages_command():
+    """Convert the messages table to monthly partitions (Postgres)."""
+
+    if sharding.current().sharded:
+        raise click.ClickException(
+            "Partitioning doesn't support SHARD_URLS.")
+
+    from partitions import partition_messages
+
+    count = partition_messages(db.session)
+    click.echo(f"Created {count} partitions.")
+
+
+@bp.cli.command('maintain-partitions')
+def maintain_partitions_command():
+    """Create upcoming monthly partitions and schedule doing it daily."""
+
+    import tasks
+
+    created = tasks.maintain_partitions(db.session)
+    click.echo(f"Created {len(created)} partitions.")
+
+
+@bp.cli.command('prune-notifications')
+def prune_notifications_command():
+    """Delete old read notifications and schedule doing it daily."""
+
+    import tasks
+
+    pruned = tasks.prune_notifications(db.session)
+    click.echo(f"Deleted {pruned} notifications.")
+
+
+@bp.cli.command('archive-messages')
+@click.option('--keep-months', default=archive.DEFAULT_KEEP_MONTHS,
+              help="Months of messages to keep in the database.")
+@click.option('--directory', default=None,
+              help="Where to write them (default: MESSAGE_ARCHIVE_DIR).")
+def archive_messages_command(keep_months, directory):
+    """Move old months of messages to compressed archive files."""
+
+    if sharding.current().sharded:
+        raise click.ClickException("Archiving doesn't support SHARD_URLS.")
+
+    directory = directory or current_app.config['MESSAGE_ARCHIVE_DIR']
+    if not directory:
+        raise click.ClickException("MESSAGE_ARCHIVE_DIR is not set.")
+
+    archived = archive.archive_months(
+        db.session, directory, keep_months=keep_months)
+    for month, count in archived.items():
+        click.echo(f"{month:%Y-%m}: archived {count} messages.")
+
+
+@bp.cli.command('import-messages')
+@click.argument('user_id', type=int)
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--chunk-size', default=bulk_import.DEFAULT_CHUNK_SIZE,
+              help="Messages written per transaction.")
+def import_messages_command(user_id, path, chunk_size):
+    """Import a user's messages from an NDJSON or CSV file."""
+
+    format = bulk_import.format_for(path)
+    if format is None:
+        raise click.ClickException("PATH must be .ndjson, .jsonl or .csv.")
+    if db.session.get(User, user_id) is None:
+        raise click.ClickException(f"No user {user_id}.")
+    not_before = bulk_import.not_before(
+        current_app.extensions.get('message_archive'))
+
+    with open(path, 'rb') as file:
+        count, oldest, errors = bulk_import.validate(file, format, not_before)
+        for number, error in errors:
+            click.echo(f"line {number}: {error}", err=True)
+        if errors:
+            raise click.ClickException("Nothing imported.")
+
+        file.seek(0)
+        bulk_import.import_messages(
+            db.session, user_id, file, format, oldest, not_before,
+            chunk_size=chunk_size,
+            progress=lambda done: click.echo(f"{done}/{count} messages"))
+
+    click.echo(f"Imported {count} messages.")
+
+
+@bp.cli.command('backfill-tags')
+@click.option('--after', default=0,
+              help="Only index messages with ids after this one.")
+@click.option('--batch-size', default=5_000,
+              help="Messages read and written per batch.")
+@click.option('--workers', default=None, type=int,
+              help="Extraction processes (default: one per CPU).")
+def backfill_tags_command(after, batch_size, workers):
+    """Index the hashtags and mentions of existing messages."""
+
+    if sharding.current().sharded:
+        raise click.ClickException(
+            "The tag backfill doesn't support SHARD_URLS.")
+
+    import tags
+
+    def progress(count, last_id):
+        click.echo(f"{count} messages, up to id {last_id}")
+
+    count, last_id = tags.backfill(
+        db.session, after, batch_size, workers, progress)
+    click.echo(f"Indexed {count} messages.")
+
+
+@bp.cli.command('init-shards')
+def init_shards_command():
+    """Create the message, like and follow tables on every shard."""
+
+    shards = sharding.current()
+    if not shards.sharded:
+        raise click.ClickException("SHARD_URLS is not set.")
+
+    shards.create_all()
+    click.echo(f"Set up {len(shards)} shards.")
+
+
+@bp.cli.command('move-user')
+@click.argument('user_id', type=int)
+@click.argument('shard', type=int)
+def move_user_command(user_id, shard):
+    """Move a user's messages, likes and follows to another shard."""
+
+    try:
+        moved = sharding.current().move_user(db.session, user_id, shard)
+    except ValueError as exc:
+        raise click.ClickException(str(exc))
+
+    click.echo(f"Moved {moved} rows.")
+    for shard, counts in enumerate(sharding.current().counts()):
+        click.echo(f"shard {shard}: " + ", ".join(
+            f"{count} {table}" for table, count in counts.items()))
+
+
+@bp.cli.command('worker')
+@click.option('--burst', is_flag=True,
+              help="Exit once the queue is empty instead of polling.")
+@click.option('--poll-interval', default=1.0,
+              help="Seconds to wait between polls of an empty queue.")
+def worker_command(burst, poll_interval):
+    """Run queued background jobs."""
+
+    import tasks  # registers the job handlers
+
+    if db.engine.dialect.name == 'sqlite':
+        click.echo("SQLite cannot lock rows: run only one worker.")
+
+    count = jobs.work(db.session, burst=burst, poll_interval=poll_interval)
+    click.echo(f"Ran {count} jobs.")
+
+
+@bp.cli.command('job-stats')
+def job_stats_command():
+    """Show job counts and run times by kind and status."""
+
+    for row in jobs.stats(db.session):
+        avg_ms = f"{row['avg_ms']:.1f}" if row['avg_ms'] is not None else "-"
+        max_ms = f"{row['max_ms']:.1f}" if row['max_ms'] is not None else "-"
+        click.echo(f"{row['kind']:<20} {row['status']:<8} {row['count']:>8} "
+                   f"avg {avg_ms:>8} ms  max {max_ms:>8} ms")
@@ -0,0 +1,287 @@
+"""Cold storage for old months of messages.
+
+Almost every read is of recent messages, so months older than a cutoff
+are moved out of the database into compressed files, one per month:
+messages-YYYY-MM.npz in the archive directory. Each holds that month's
+messages and the likes on them, column by column:
+
+- id, user_id: int64, sorted by id
+- timestamp: datetime64[us]
+- text, text_offsets: the texts as one UTF-8 byte array; message i is
+  text[text_offsets[i]:text_offsets[i + 1]]
+- like_user_id, like_message_id: int64; like_timestamp: datetime64[us]
+
+written with `np.savez_compressed`, so each column is zlib-compressed
+separately and can be loaded on its own.
+
+`archive_months()` writes the files and then drops the rows: on Postgres
+by detaching and dropping the month's partition (see partitions.py), with
+no DELETE to vacuum up after; elsewhere with a DELETE.
+
+`MessageArchive` reads them back. The profile and likes pages pass one to
+`read_models.user_messages()` / `liked_messages()`, which page into the
+archive once the database runs out of older messages. Archived messages
+are read-only: they can't be liked, deleted or shown on their own page,
+and their tags and mentions (tags.py) are dropped with them.
+Authors are looked up in `users` as pages are read, so tombstoned and
+purged users' archived messages are left out like their live ones.
+"""
+
+import os
+import re
+from array import array
+from datetime import datetime
+from functools import lru_cache
+
+import numpy as np
+from sqlalchemy import delete, func, select
+
+import partitions
+from models import Likes, Mention, Message, MessageTag
+from read_models import with_authors
+from snowflake import MIN_SNOWFLAKE
+
+DEFAULT_KEEP_MONTHS = 12
+DEFAULT_CACHE_SIZE = 4
+
+# Rows fetched per round trip while writing a month.
+CHUNK_SIZE = 10_000
+
+likes = Likes.__table__
+mentions = Mention.__table__
+message_tags = MessageTag.__table__
+messages = Message.__table__
+
+FILE_PATTERN = re.compile(r"messages-(\d{4})-(\d{2})\.npz$")
+
+
+def archive_path(directory, month):
+    return os.path.join(directory, f"messages-{month:%Y-%m}.npz")
+
+
+def _write_month(conn, path, low, high):
+    """Write messages with ids in [low, high) and their likes to `path`.
+
+    Returns the number of messages written; if none, writes no file.
+    """
+
+    ids, user_ids, timestamps = array('q'), array('q'), []
+    texts = []
+    rows = conn.execute(
+        select(messages.c.id, messages.c.user_id, messages.c.timestamp,
+               messages.c.text)
+        .where(messages.c.id >= low, messages.c.id < high)
+        .order_by(messages.c.id),
+        execution_options={'yield_per': CHUNK_SIZE})
+    for id, user_id, timestamp, text in rows:
+        ids.append(id)
+        user_ids.append(user_id)
+        timestamps.append(timestamp)
+        texts.append(text.encode())
+
+    if not ids:
+        return 0
+
+    like_rows = conn.execute(
+        select(likes.c.user_id, likes.c.message_id, likes.c.timestamp)
+        .where(likes.c.message_id >= low, likes.c.message_id < high),
+        execution_options={'yield_per': CHUNK_SIZE}).all()
+
+    text_offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+    np.cumsum([len(text) for text in texts], out=text_offsets[1:])
+
+    # Write under a temporary name so a reader never sees half a file.
+    temp_path = path + ".tmp"
+    with open(temp_path, 'wb') as file:
+        np.savez_compressed(
+            file,
+            id=np.frombuffer(ids, dtype=np.int64),
+            user_id=np.frombuffer(user_ids, dtype=np.int64),
+            timestamp=np.array(timestamps, dtype='datetime64[us]'),
+            text=np.frombuffer(b"".join(texts), dtype=np.uint8),
+            text_offsets=text_offsets,
+            like_user_id=np.array([row[0] for row in like_rows],
+                                  dtype=np.int64),
+            like_message_id=np.array([row[1] for row in like_rows],
+                                     dtype=np.int64),
+            like_timestamp=np.array([row[2] for row in like_rows],
+                                    dtype='datetime64[us]'),
+        )
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, path)
+
+    return len(ids)
+
+
+def archive_months(session, directory, keep_months=DEFAULT_KEEP_MONTHS,
+                   now=None):
+    """Archive every month older than the last `keep_months`, oldest first.
+
+    Each month is written to its file and then removed from the database
+    in its own transaction. Returns {month start: messages archived} for
+    the months that had any.
+    """
+
+    os.makedirs(directory, exist_ok=True)
+    cutoff = partitions.add_months(
+        partitions.month_start(now or datetime.utcnow()), -keep_months)
+
+    conn = session.connection()
+    oldest = conn.execute(
+        select(func.min(messages.c.id))
+        .where(messages.c.id >= MIN_SNOWFLAKE)).scalar()
+    months = {month for month in partitions.list_partitions(conn)
+              if month < cutoff}
+    month = partitions.month_of(oldest) if oldest is not None else cutoff
+    while month < cutoff:
+        months.add(month)
+        month = partitions.add_months(month, 1)
+
+    archived = {}
+    for month in sorted(months):
+        low, high = partitions.month_bounds(month)
+        count = _write_month(conn, archive_path(directory, month), low, high)
+
+        for table in (likes, message_tags, mentions):
+            conn.execute(delete(table).where(table.c.message_id >= low,
+                                             table.c.message_id < high))
+        if not partitions.drop_partition(conn, month):
+            conn.execute(delete(messages).where(messages.c.id >= low,
+                                                messages.c.id < high))
+        session.commit()
+
+        if count:
+            archived[month] = count
+        conn = session.connection()
+
+    return archived
+
+
+class MessageArchive:
+    """Reads archived months for the profile and likes pages.
+
+    The last `cache_size` months read are kept in memory, decompressed.
+    """
+
+    def __init__(self, directory, cache_size=DEFAULT_CACHE_SIZE):
+        self.directory = directory
+        # Keyed on the file's mtime too, so a rewritten month is reread.
+        self._load = lru_cache(maxsize=cache_size)(_load_month)
+
+    def months(self):
+        """[(month start, path)] of the archived months, newest first."""
+
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+
+        found = []
+        for name in names:
+            match = FILE_PATTERN.match(name)
+            if match:
+                month = datetime(int(match[1]), int(match[2]), 1)
+                found.append((month, os.path.join(self.directory, name)))
+
+        return sorted(found, reverse=True)
+
+    def _columns(self, path):
+        return self._load(path, os.stat(path).st_mtime_ns)
+
+    def _newest_first(self, before):
+        """Months that may hold ids below `before`, with their columns."""
+
+        for month, path in self.months():
+            low, _ = partitions.month_bounds(month)
+            if before is not None and low >= before:
+                continue
+            yield self._columns(path)
+
+    def user_messages(self, session, user_id, limit, before=None):
+        """Like `read_models.user_messages()`, for archived messages."""
+
+        found = []
+        for columns in self._newest_first(before):
+            mask = columns['user_id'] == user_id
+            if before is not None:
+                mask &= columns['id'] < before
+
+            positions = np.flatnonzero(mask)[::-1]
+            found += _rows(columns, positions[:limit - len(found)])
+            if len(found) >= limit:
+                break
+
+        return with_authors(session, found)
+
+    def liked_messages(self, session, user_id, limit=None, before=None):
+        """Like `read_models.liked_messages()`, for archived messages."""
+
+        found = []
+        for columns in self._newest_first(before):
+            mask = columns['like_user_id'] == user_id
+            if before is not None:
+                mask &= columns['like_message_id'] < before
+
+            liked_ids = np.sort(columns['like_message_id'][mask])[::-1]
+            positions = np.searchsorted(columns['id'], liked_ids)
+            if limit is not None:
+                positions = positions[:limit - len(found)]
+            found += _rows(columns, positions)
+            if limit is not None and len(found) >= limit:
+                break
+
+        return with_authors(session, found)
+
+    def user_message_rows(self, user_id):
+        """Yield (id, timestamp, text) of `user_id`'s archived messages.
+
+        Oldest first, reading a month at a time.
+        """
+
+        for _, path in reversed(self.months()):
+            columns = self._columns(path)
+            positions = np.flatnonzero(columns['user_id'] == user_id)
+            for id, text, timestamp, _ in _rows(columns, positions):
+                yield id, timestamp, text
+
+    def user_like_rows(self, user_id):
+        """Yield (message_id, timestamp) of `user_id`'s archived likes.
+
+        Oldest month first.
+        """
+
+        for _, path in reversed(self.months()):
+            columns = self._columns(path)
+            mask = columns['like_user_id'] == user_id
+            yield from zip(columns['like_message_id'][mask].tolist(),
+                           columns['like_timestamp'][mask].tolist())
+
+
+def _load_month(path, mtime):
+    with np.load(path) as data:
+        return {name: data[name] for name in data.files}
+
+
+def _rows(columns, positions):
+    """(id, text, timestamp, user_id) for the rows at `positions`."""
+
+    ids, user_ids = columns['id'], columns['user_id']
+    timestamps = columns['timestamp']
+    text, offsets = columns['text'], columns['text_offsets']
+
+    return [(int(ids[i]),
+             text[offsets[i]:offsets[i + 1]].tobytes().decode(),
+             timestamps[i].item(),
+             int(user_ids[i]))
+            for i in positions]
+
+
+def init_app(app):
+    """Read archived messages on `app`'s pages, if MESSAGE_ARCHIVE_DIR."""
+
+    if app.config['MESSAGE_ARCHIVE_DIR']:
+        app.extensions['message_archive'] = MessageArchive(
+            app.config['MESSAGE_ARCHIVE_DIR'],
+            app.config['MESSAGE_ARCHIVE_CACHE_SIZE'],
+        )
@@ -0,0 +1,367 @@
+"""Username and email availability, answered from a Bloom filter.
+
+Signing up used to hash the password with bcrypt, then learn from the
+unique constraint at commit that the username was taken: a full bcrypt
+computation and a round trip wasted on every collision. Now signup()
+asks `taken()` first, as does /users/available, which a form can call
+as you type:
+
+- Every username and email in `users` is a key in a counting Bloom
+  filter. A key that isn't there is certainly free (in this process's
+  view; see below), and is answered without touching the database.
+- A key that is there may be a false positive (about `error_rate` of
+  free keys are), so it's confirmed with one indexed query.
+
+The filter keeps a small counter per position rather than a bit, so a
+key can be taken out again: signup adds the new user's keys and a
+profile edit moves them. Counters stop at 255 and are then never
+decremented, which only leaves positives that the query weeds out.
+
+Each process has its own filter, built from `users` on first use; every
+`refresh_seconds` it adds the users that signed up in other processes.
+Renames made by other processes, and users purged by the job worker,
+are only seen when the filter is rebuilt, which happens on a background
+thread every `rebuild_seconds`. Until then a name that was taken by a
+rename elsewhere gets through the filter, and the unique constraint
+catches it at commit as before; a name freed elsewhere still looks
+taken to the filter, and the query finds it free. Signup stays exact
+either way; the endpoint can call a name free that isn't for a while.
+"""
+
+import hashlib
+import logging
+import math
+import threading
+import time
+
+import numpy as np
+from flask import current_app
+from sqlalchemy import or_, select
+
+from models import db, User
+
+logger = logging.getLogger(__name__)
+
+users = User.__table__
+
+DEFAULT_CAPACITY = 100_000
+DEFAULT_ERROR_RATE = 0.01
+DEFAULT_REFRESH_SECONDS = 5
+DEFAULT_REBUILD_SECONDS = 3600
+
+MAX_COUNT = 255
+
+
+def _hashes(key):
+    """Two 64-bit hashes of `key`, the second odd."""
+
+    digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+    return (int.from_bytes(digest[:8], 'little'),
+            int.from_bytes(digest[8:], 'little') | 1)
+
+
+class CountingBloomFilter:
+    """A Bloom filter of `capacity` keys with 8-bit counters."""
+
+    def __init__(self, capacity=DEFAULT_CAPACITY,
+                 error_rate=DEFAULT_ERROR_RATE):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(64, math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, round(self.size / capacity * math.log(2)))
+        self._counters = np.zeros(self.size, dtype=np.uint8)
+        self._view = memoryview(self._counters)
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, key):
+        counters = self._view
+        return all(counters[position] for position in self._positions(key))
+
+    @property
+    def nbytes(self):
+        return self._counters.nbytes
+
+    def _positions(self, key):
+        # Double hashing: k positions from two hashes.
+        first, second = _hashes(key)
+        return [(first + i * second) % self.size
+                for i in range(self.num_hashes)]
+
+    def add(self, key):
+        counters = self._view
+        for position in self._positions(key):
+            if counters[position] < MAX_COUNT:
+                counters[position] += 1
+        self.count += 1
+
+    def remove(self, key):
+        """Take out `key`, which must have been added."""
+
+        counters = self._view
+        for position in self._positions(key):
+            if 0 < counters[position] < MAX_COUNT:
+                counters[position] -= 1
+        self.count -= 1
+
+    def add_many(self, keys):
+        """Add `keys` at once: one counting pass over all their positions."""
+
+        hashes = np.array([_hashes(key) for key in keys], dtype=np.uint64)
+        if not len(hashes):
+            return
+
+        steps = np.arange(self.num_hashes, dtype=np.uint64)
+        # The same positions as _positions(), reducing each part first
+        # so nothing overflows 64 bits.
+        size = np.uint64(self.size)
+        positions = ((hashes[:, :1] % size) +
+                     (hashes[:, 1:] % size) * steps % size) % size
+        added = np.bincount(positions.ravel().astype(np.intp),
+                            minlength=self.size)
+        self._counters[:] = np.minimum(
+            self._counters.astype(np.intp) + added, MAX_COUNT)
+        self.count += len(hashes)
+
+
+def _username_key(username):
+    return f"u:{username}"
+
+
+def _email_key(email):
+    return f"e:{email}"
+
+
+def _confirm(session, username=None, email=None):
+    """Which of `username` and `email` are taken, asking the database."""
+
+    conditions = []
+    if username:
+        conditions.append(users.c.username == username)
+    if email:
+        conditions.append(users.c.email == email)
+    if not conditions:
+        return set()
+
+    taken = set()
+    for found_username, found_email in session.execute(
+            select(users.c.username, users.c.email)
+            .where(or_(*conditions))
+            .execution_options(include_deleted=True)):
+        if username and found_username == username:
+            taken.add('username')
+        if email and found_email == email:
+            taken.add('email')
+    return taken
+
+
+class Availability:
+    """An app's filter of taken usernames and emails."""
+
+    def __init__(self, capacity=DEFAULT_CAPACITY,
+                 error_rate=DEFAULT_ERROR_RATE,
+                 refresh_seconds=DEFAULT_REFRESH_SECONDS,
+                 rebuild_seconds=DEFAULT_REBUILD_SECONDS):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.refresh_seconds = refresh_seconds
+        self.rebuild_seconds = rebuild_seconds
+        self._filter = None
+        self._last_id = 0
+        # Users this process added that a refresh hasn't passed yet.
+        self._added = set()
+        self._refreshed_at = 0
+        self._built_at = 0
+        self._rebuilding = False
+        self._lock = threading.Lock()
+        self.checks = 0
+        self.maybe_taken = 0
+        self.false_positives = 0
+
+    def _scan(self, session, bloom, after, skip=()):
+        """Add users with ids above `after`, except `skip`, to `bloom`.
+
+        Returns the largest id seen, or `after` if there were none.
+        """
+
+        rows = session.execute(
+            select(users.c.id, users.c.username, users.c.email)
+            .where(users.c.id > after)
+            .order_by(users.c.id)).all()
+
+        bloom.add_many([key for id, username, email in rows
+                        if id not in skip
+                        for key in (_username_key(username),
+                                    _email_key(email))])
+        return rows[-1].id if rows else after
+
+    def _load(self, session):
+        self._last_id = self._scan(
+            session, self._filter, self._last_id, self._added)
+        self._added = {id for id in self._added if id > self._last_id}
+        self._refreshed_at = time.monotonic()
+
+    def _build(self, session):
+        """A new filter of every user, and the largest id in it."""
+
+        # Two keys per user, with room to double: the largest id stands
+        # in for the number of users.
+        count = session.execute(
+            select(users.c.id).order_by(users.c.id.desc()).limit(1)
+        ).scalar() or 0
+        bloom = CountingBloomFilter(
+            max(self.capacity, 4 * count), self.error_rate)
+        return bloom, self._scan(session, bloom, 0)
+
+    def _swap(self, bloom, last_id):
+        """Start using `bloom`. Call with the lock held."""
+
+        self._filter = bloom
+        self._last_id = last_id
+        # Users added since are above last_id, so the next refresh adds
+        # them from the table.
+        self._added = set()
+        self._refreshed_at = self._built_at = time.monotonic()
+
+    def get(self, session):
+        """The filter: built on first use or when full, refreshed when due.
+
+        Call with the lock held. A rebuild, when due, starts in the
+        background; the current filter is used until it is done.
+        """
+
+        if self._filter is None or len(self._filter) > self._filter.capacity:
+            self._swap(*self._build(session))
+        elif time.monotonic() - self._refreshed_at > self.refresh_seconds:
+            self._load(session)
+
+        if (time.monotonic() - self._built_at > self.rebuild_seconds and
+                not self._rebuilding):
+            self._rebuilding = True
+            threading.Thread(
+                target=self._rebuild,
+                args=(current_app._get_current_object(),),
+                name='availability', daemon=True).start()
+
+        return self._filter
+
+    def _rebuild(self, app):
+        try:
+            with app.app_context():
+                try:
+                    self.rebuild(db.session)
+                finally:
+                    db.session.remove()
+        except Exception:
+            logger.exception("Rebuilding the availability filter failed")
+            with self._lock:
+                self._built_at = time.monotonic()
+        finally:
+            self._rebuilding = False
+
+    def rebuild(self, session):
+        """Build a fresh filter from `users` and start using it.
+
+        Drops names that other processes renamed away from or purged.
+        """
+
+        bloom, last_id = self._build(session)
+        with self._lock:
+            self._swap(bloom, last_id)
+
+    def taken(self, session, username=None, email=None):
+        """The set of fields ('username', 'email') already taken."""
+
+        wanted = {}
+        if username:
+            wanted['username'] = _username_key(username)
+        if email:
+            wanted['email'] = _email_key(email)
+
+        with self._lock:
+            bloom = self.get(session)
+            maybe = {field for field, key in wanted.items() if key in bloom}
+            self.checks += 1
+
+        if not maybe:
+            return set()
+
+        taken = _confirm(
+            session,
+            username if 'username' in maybe else None,
+            email if 'email' in maybe else None)
+
+        self.maybe_taken += 1
+        if maybe - taken:
+            self.false_positives += 1
+        return taken
+
+    def added(self, user_id, username, email):
+        """Record a user just signed up by this process."""
+
+        with self._lock:
+            if self._filter is not None and user_id > self._last_id:
+                self._added.add(user_id)
+                self._filter.add(_username_key(username))
+                self._filter.add(_email_key(email))
+
+    def _has(self, user_id):
+        """Are `user_id`'s keys in the filter? Call with the lock held.
+
+        Removing keys that were never added would take other keys out.
+        """
+
+        return self._filter is not None and (
+            user_id <= self._last_id or user_id in self._added)
+
+    def changed(self, user_id, old, new):
+        """Record a profile edit: (username, email) pairs before and after."""
+
+        with self._lock:
+            if not self._has(user_id):
+                return
+            for make_key, before, after in zip(
+                    (_username_key, _email_key), old, new):
+                if before != after:
+                    self._filter.remove(make_key(before))
+                    self._filter.add(make_key(after))
+
+    def snapshot(self):
+        bloom = self._filter
+        return {
+            'checks': self.checks,
+            'maybe_taken': self.maybe_taken,
+            'false_positives': self.false_positives,
+            'keys': len(bloom) if bloom is not None else 0,
+            'bytes': bloom.nbytes if bloom is not None else 0,
+        }
+
+
+def current():
+    """The current app's Availability, or None if it is off."""
+
+    return current_app.extensions.get('availability')
+
+
+def taken(session, username=None, email=None):
+    """Which of `username` and `email` are taken, via the filter if on."""
+
+    available = current()
+    if available is None:
+        return _confirm(session, username, email)
+    return available.taken(session, username, email)
+
+
+def init_app(app):
+    if not app.config['AVAILABILITY_FILTER_ENABLED']:
+        return
+
+    app.extensions['availability'] = Availability(
+        capacity=app.config['AVAILABILITY_CAPACITY'],
+        error_rate=app.config['AVAILABILITY_ERROR_RATE'],
+        refresh_seconds=app.config['AVAILABILITY_REFRESH_SECONDS'],
+        rebuild_seconds=app.config['AVAILABILITY_REBUILD_SECONDS'],
+    )
@@ -0,0 +1,119 @@
+"""Benchmark a hot key expiring in every worker at once.
+
+Forks `workers` processes with `threads` threads each, all asking for
+one popular key whose value takes LOAD_SECONDS to load (a stand-in for
+the profile query) and lives TTL seconds, for `seconds` seconds. Runs
+it three times:
+
+- with a plain per-process dict of values and expiry times, as a cache
+  without stampede protection would be,
+- with `cache.Cache`: single flight, early refresh and shared leases
+  (the tag table and leases are created before the fork, as init_app
+  creates them before gunicorn forks its workers), and
+- the same with a `DirectoryCache` L2 in a temporary directory, so a
+  value one worker refreshed is picked up by the others.
+
+Reports requests served, loads run, and request latency (median, 99.9th
+percentile and worst) for each.
+
+run like:
+
+    python -m benchmarks.bench_cache [workers] [threads] [seconds]
+"""
+
+import multiprocessing
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+import cache
+
+LOAD_SECONDS = 0.05
+TTL = 1.0
+KEY = ('profile', 1)
+
+
+def load(loads):
+    with loads.get_lock():
+        loads.value += 1
+    time.sleep(LOAD_SECONDS)
+    return "profile"
+
+
+class PlainCache:
+    """Values and expiry times in a dict: every miss loads."""
+
+    def __init__(self):
+        self.entries = {}
+
+    def get(self, key, load):
+        found = self.entries.get(key)
+        if found is not None and found[1] > time.time():
+            return found[0]
+        value = load()
+        self.entries[key] = (value, time.time() + TTL)
+        return value
+
+
+def worker(make_cache, threads, seconds, loads, results):
+    store = make_cache()
+    latencies = []
+
+    def run():
+        until = time.monotonic() + seconds
+        while time.monotonic() < until:
+            started = time.perf_counter()
+            store.get(KEY, lambda: load(loads))
+            latencies.append(time.perf_counter() - started)
+            time.sleep(0.001)
+
+    pool = [threading.Thread(target=run) for _ in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    results.put(latencies)
+
+
+def run(name, make_cache, workers, threads, seconds):
+    context = multiprocessing.get_context('fork')
+    loads = context.Value('q', 0)
+    results = context.Queue()
+    processes = [context.Process(target=worker, args=(
+        make_cache, threads, seconds, loads, results))
+        for _ in range(workers)]
+    for process in processes:
+        process.start()
+    latencies = sorted(
+        latency for _ in processes for latency in results.get())
+    for process in processes:
+        process.join()
+
+    print(f"{name:>8}: {len(latencies):>7,} requests, "
+          f"{loads.value:>4} loads, "
+          f"median {statistics.median(latencies) * 1000:.3f} ms, "
+          f"p99.9 {latencies[int(len(latencies) * 0.999)] * 1000:.1f} ms, "
+          f"max {latencies[-1] * 1000:.1f} ms")
+
+
+def main(workers=4, threads=8, seconds=5):
+    print(f"{workers} workers x {threads} threads, {seconds}s, "
+          f"load {LOAD_SECONDS * 1000:.0f} ms, ttl {TTL:.0f}s")
+
+    run("plain", PlainCache, workers, threads, seconds)
+
+    versions, leases = cache.TagVersions(), cache.Leases()
+    run("cache", lambda: cache.Cache(ttl=TTL, versions=versions,
+                                     leases=leases),
+        workers, threads, seconds)
+
+    with tempfile.TemporaryDirectory() as directory:
+        run("cache+l2", lambda: cache.Cache(
+            ttl=TTL, l2=cache.DirectoryCache(directory), versions=versions,
+            leases=leases), workers, threads, seconds)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,93 @@
+"""Benchmark response compression on `/` with 100 messages.
+
+For no compression, gzip at a few levels and (if installed) brotli at a few
+qualities: body size on the wire, mean request latency, and CPU time spent
+compressing per request.
+
+run like:
+
+    python -m benchmarks.bench_compression [requests]
+"""
+
+import sys
+import time
+
+import app
+import compression
+from models import db, Follow, Message, User
+
+NUM_MESSAGES = 100
+
+SETTINGS = [
+    ('identity', {}),
+    ('gzip', {'gzip_level': 1}),
+    ('gzip', {'gzip_level': 6}),
+    ('gzip', {'gzip_level': 9}),
+    ('br', {'brotli_quality': 1}),
+    ('br', {'brotli_quality': 4}),
+    ('br', {'brotli_quality': 11}),
+]
+
+
+def setup():
+    flask_app = app.create_app({
+        'SQLALCHEMY_DATABASE_URI': "sqlite://",
+        'SECRET_KEY': "bench",
+        'COMPRESSION_ENABLED': False,
+    })
+
+    with flask_app.app_context():
+        db.create_all()
+        users = [User(username=f"user{i}", email=f"user{i}@example.com",
+                      password="x")
+                 for i in range(10)]
+        db.session.add_all(users)
+        db.session.flush()
+        db.session.add_all(
+            Message(text=f"message number {i} from the benchmark",
+                    user_id=users[i % 10].id)
+            for i in range(NUM_MESSAGES))
+        db.session.add_all(
+            Follow(user_following_id=users[0].id,
+                   user_being_followed_id=user.id)
+            for user in users[1:])
+        db.session.commit()
+        user_id = users[0].id
+
+    return flask_app, user_id
+
+
+def main(requests=50):
+    flask_app, user_id = setup()
+    wsgi_app = flask_app.wsgi_app
+
+    print(f"GET / with {NUM_MESSAGES} messages (mean of {requests})")
+    print(f"{'encoding':<16} {'bytes':>8} {'ms':>8} {'cpu ms':>8}")
+
+    for encoding, options in SETTINGS:
+        if encoding == 'br' and compression.brotli is None:
+            continue
+
+        stats = compression.CompressionStats()
+        flask_app.wsgi_app = compression.CompressionMiddleware(
+            wsgi_app, stats=stats, **options)
+
+        with flask_app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[app.CURR_USER_KEY] = user_id
+            headers = {'Accept-Encoding': encoding}
+            size = len(client.get('/', headers=headers).data)
+            stats.clear()
+
+            start = time.perf_counter()
+            for _ in range(requests):
+                client.get('/', headers=headers)
+            elapsed = (time.perf_counter() - start) / requests
+
+        label = encoding + ''.join(f" {value}" for value in options.values())
+        cpu_ms = stats.snapshot()['cpu_ms'] / requests
+        print(f"{label:<16} {size:>8} {elapsed * 1000:>8.2f} {cpu_ms:>8.3f}")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
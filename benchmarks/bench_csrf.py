@@ -0,0 +1,81 @@
+"""Benchmark lazy CSRF handling on the pages with a form per row.
+
+Compares LazyCsrfForm with the old behavior (a CsrfForm built in
+before_request for every request, its hidden field re-rendered for every
+row) on `/` with 100 messages and `/users` with 100 users.
+
+run like:
+
+    python -m benchmarks.bench_csrf [requests]
+"""
+
+import sys
+import time
+
+import app
+from forms import CsrfForm, LazyCsrfForm
+from models import db, Follow, Message, User
+
+NUM_ROWS = 100
+
+
+class EagerCsrfForm(CsrfForm):
+    """The old behavior: built up front, hidden field rendered every call."""
+
+
+def setup():
+    flask_app = app.create_app({
+        'SQLALCHEMY_DATABASE_URI': "sqlite://",
+        'SECRET_KEY': "bench",
+    })
+
+    with flask_app.app_context():
+        db.create_all()
+        users = [User(username=f"user{i}", email=f"user{i}@example.com",
+                      password="x")
+                 for i in range(NUM_ROWS)]
+        db.session.add_all(users)
+        db.session.flush()
+        db.session.add_all(
+            Message(text=f"message {i}", user_id=users[i % 10].id)
+            for i in range(NUM_ROWS))
+        db.session.add_all(
+            Follow(user_following_id=users[0].id,
+                   user_being_followed_id=users[i].id)
+            for i in range(1, 10))
+        db.session.commit()
+        user_id = users[0].id
+
+    return flask_app, user_id
+
+
+def time_route(flask_app, user_id, route, requests):
+    with flask_app.test_client() as client:
+        with client.session_transaction() as sess:
+            sess[app.CURR_USER_KEY] = user_id
+        client.get(route)
+
+        start = time.perf_counter()
+        for _ in range(requests):
+            client.get(route)
+        return (time.perf_counter() - start) / requests
+
+
+def main(requests=50):
+    flask_app, user_id = setup()
+
+    print(f"ms per request (mean of {requests})")
+    print(f"{'route':<10} {'eager':>8} {'lazy':>8} {'saved':>8}")
+
+    for route in ('/', '/users'):
+        app.LazyCsrfForm = EagerCsrfForm
+        eager = time_route(flask_app, user_id, route, requests)
+        app.LazyCsrfForm = LazyCsrfForm
+        lazy = time_route(flask_app, user_id, route, requests)
+
+        print(f"{route:<10} {eager * 1000:>8.2f} {lazy * 1000:>8.2f} "
+              f"{(1 - lazy / eager) * 100:>7.0f}%")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,94 @@
+"""Benchmark streaming data exports: memory against account size.
+
+For accounts of increasing size (messages, and as many likes), streams
+the export and reports its size, throughput and the peak memory Python
+allocated while building it (tracemalloc). The peak should stay flat as
+the account grows.
+
+run like:
+
+    python -m benchmarks.bench_export [largest_account]
+"""
+
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+from sqlalchemy import insert
+
+import app
+import export
+from models import db, Likes, Message, User
+from snowflake import BackfillIds
+
+messages = Message.__table__
+likes = Likes.__table__
+
+INSERT_BATCH = 10_000
+
+
+def setup(directory, sizes):
+    flask_app = app.create_app({
+        'SQLALCHEMY_DATABASE_URI':
+            f"sqlite:///{os.path.join(directory, 'bench.db')}",
+        'SECRET_KEY': "bench",
+        'WARM_UP_TEMPLATES': False,
+    })
+    flask_app.app_context().push()
+    db.create_all()
+
+    users = [User(username=f"user{size}", email=f"user{size}@example.com",
+                  password="x")
+             for size in sizes]
+    db.session.add_all(users)
+    db.session.flush()
+
+    make_id = BackfillIds()
+    start = datetime(2023, 1, 1)
+    for user, size in zip(users, sizes):
+        for low in range(0, size, INSERT_BATCH):
+            rows = []
+            for i in range(low, min(size, low + INSERT_BATCH)):
+                timestamp = start + timedelta(seconds=i)
+                rows.append(dict(id=make_id(timestamp),
+                                 text=f"message {i} " + "x" * 100,
+                                 timestamp=timestamp, user_id=user.id))
+            db.session.execute(insert(messages), rows)
+            db.session.execute(insert(likes), [
+                dict(user_id=user.id, message_id=row['id'],
+                     timestamp=row['timestamp']) for row in rows])
+    db.session.commit()
+
+    return [user.id for user in users]
+
+
+def measure(user_id):
+    start = time.perf_counter()
+    size = sum(map(len, export.stream(db.session, user_id)))
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    for _ in export.stream(db.session, user_id):
+        pass
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return size, elapsed, peak
+
+
+def main(largest=200_000):
+    sizes = [largest // 100, largest // 10, largest]
+    with tempfile.TemporaryDirectory() as directory:
+        user_ids = setup(directory, sizes)
+        for size, user_id in zip(sizes, user_ids):
+            zip_size, elapsed, peak = measure(user_id)
+            print(f"{size:>9} messages: {zip_size / 2**20:7.1f} MiB zip in "
+                  f"{elapsed:6.2f}s ({size / elapsed:9.0f} messages/s), "
+                  f"peak {peak / 2**20:5.1f} MiB")
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,74 @@
+"""Benchmark the in-memory follow graph.
+
+Builds a random graph, then reports build time, bytes per edge, query
+latency for the follow-graph queries, and how long folding a batch of
+follows back into the CSR arrays takes.
+
+run like:
+
+    python -m benchmarks.bench_follow_graph [num_users] [edges_per_user]
+"""
+
+import sys
+import time
+from random import Random
+
+from follow_graph import FollowGraph
+
+
+def random_edges(num_users, edges_per_user, seed=0):
+    """Yield (followed, follower) pairs in primary key order."""
+
+    rng = Random(seed)
+    by_followed = {}
+    for follower in range(1, num_users + 1):
+        for followed in rng.sample(range(1, num_users + 1), edges_per_user):
+            if followed != follower:
+                by_followed.setdefault(followed, []).append(follower)
+
+    for followed in sorted(by_followed):
+        for follower in sorted(by_followed[followed]):
+            yield followed, follower
+
+
+def timed(label, fn, repeat):
+    start = time.perf_counter()
+    for i in range(repeat):
+        fn(i)
+    elapsed = time.perf_counter() - start
+    print(f"{label:<24} {elapsed / repeat * 1e6:10.1f} us/op")
+
+
+def main(num_users=100_000, edges_per_user=50):
+    edges = list(random_edges(num_users, edges_per_user))
+
+    start = time.perf_counter()
+    graph = FollowGraph.from_sorted_edges(edges)
+    build = time.perf_counter() - start
+
+    print(f"users: {num_users}  edges: {graph.num_edges}")
+    print(f"build: {build:.2f}s")
+    print(f"memory: {graph.nbytes() / 2**20:.1f} MiB "
+          f"({graph.nbytes() / graph.num_edges:.1f} bytes/edge)")
+
+    rng = Random(1)
+    ids = [rng.randint(1, num_users) for _ in range(1000)]
+
+    timed("is_following", lambda i: graph.is_following(ids[i], ids[-i]), 1000)
+    timed("mutual_follows", lambda i: graph.mutual_follows(ids[i]), 1000)
+    timed("followers_you_know",
+          lambda i: graph.followers_you_know(ids[i], ids[-i]), 1000)
+    timed("suggestions", lambda i: graph.suggestions(ids[i]), 100)
+    timed("add_follow", lambda i: graph.add_follow(ids[i], ids[-i]), 1000)
+
+    for i in range(5000):
+        graph.add_follow(rng.randint(1, num_users), rng.randint(1, num_users))
+    pending = graph.pending
+    start = time.perf_counter()
+    graph.compact()
+    print(f"compact: {time.perf_counter() - start:.2f}s "
+          f"({pending} pending changes)")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,98 @@
+"""Benchmark bulk message import against posting one message at a time.
+
+Builds an NDJSON file of messages (some with tags and mentions), then
+writes it as one user's messages twice: through
+`ShardSet.add_message()` and a commit per message, as /messages/new
+does, and through `bulk_import`. Reports messages per second for each.
+On Postgres the bulk path uses COPY.
+
+run like:
+
+    python -m benchmarks.bench_import [messages] [database_url]
+"""
+
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import app
+import bulk_import
+import sharding
+from models import db, User
+
+# The one-at-a-time path is slow; time it on a sample this big.
+SINGLE_SAMPLE = 5_000
+
+
+def make_file(count):
+    start = datetime(2023, 1, 1)
+    lines = []
+    for i in range(count):
+        text = f"message {i} " + ("#benchmark " if i % 10 == 0 else "") + \
+            ("@reader " if i % 25 == 0 else "") + "x" * 60
+        timestamp = (start + timedelta(seconds=i)).isoformat()
+        lines.append(json.dumps({'text': text, 'timestamp': timestamp}))
+    return ("\n".join(lines) + "\n").encode()
+
+
+def setup(database_url):
+    flask_app = app.create_app({
+        'SQLALCHEMY_DATABASE_URI': database_url,
+        'SECRET_KEY': "bench",
+        'WARM_UP_TEMPLATES': False,
+    })
+    flask_app.app_context().push()
+    db.drop_all()
+    db.create_all()
+
+    users = [User(username=name, email=f"{name}@example.com", password="x")
+             for name in ("single", "bulk", "reader")]
+    db.session.add_all(users)
+    db.session.commit()
+    return [user.id for user in users[:2]]
+
+
+def one_at_a_time(user_id, data):
+    shards = sharding.current()
+    records = [json.loads(line) for line in data.splitlines()]
+
+    start = time.perf_counter()
+    for record in records:
+        shards.add_message(db.session, user_id, record['text'])
+        db.session.commit()
+    return len(records) / (time.perf_counter() - start)
+
+
+def bulk(user_id, data):
+    file = io.BytesIO(data)
+
+    start = time.perf_counter()
+    count, oldest, errors = bulk_import.validate(file, bulk_import.NDJSON)
+    assert not errors, errors
+    file.seek(0)
+    bulk_import.import_messages(
+        db.session, user_id, file, bulk_import.NDJSON, oldest)
+    return count / (time.perf_counter() - start)
+
+
+def main(count=100_000, database_url=None):
+    count = int(count)
+    with tempfile.TemporaryDirectory() as directory:
+        database_url = database_url or \
+            f"sqlite:///{os.path.join(directory, 'bench.db')}"
+        single_id, bulk_id = setup(database_url)
+
+        data = make_file(count)
+        sample = b"\n".join(data.splitlines()[:SINGLE_SAMPLE])
+        print(f"one at a time: {one_at_a_time(single_id, sample):9.0f} "
+              f"messages/s ({min(count, SINGLE_SAMPLE)} messages)")
+        print(f"bulk import:   {bulk(bulk_id, data):9.0f} "
+              f"messages/s ({count} messages)")
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
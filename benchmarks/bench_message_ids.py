@@ -0,0 +1,129 @@
+"""Benchmark paging a profile by snowflake id against paging by timestamp.
+
+One user's messages, newest first, 100 per page, three ways:
+
+- by timestamp with OFFSET, as before snowflake ids, with no index on
+  timestamp
+- the same with a (user_id, timestamp) index
+- by id with `WHERE id < :before` (`read_models.user_messages()`), which
+  walks the (user_id, id) index
+
+for the first page and for a page deep into the history. Reports mean
+latency per page.
+
+run like:
+
+    python -m benchmarks.bench_message_ids [num_messages] [repeats]
+"""
+
+import sys
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import Index, insert, select
+
+import app
+import read_models
+from models import db, Message, User
+from snowflake import BackfillIds
+
+PAGE_SIZE = 100
+NUM_AUTHORS = 10
+
+messages = Message.__table__
+
+
+def setup(num_messages):
+    flask_app = app.create_app({
+        'SQLALCHEMY_DATABASE_URI': "sqlite://",
+        'SECRET_KEY': "bench",
+    })
+    flask_app.app_context().push()
+
+    db.create_all()
+    users = [User(username=f"user{i}", email=f"user{i}@example.com",
+                  password="x")
+             for i in range(NUM_AUTHORS)]
+    db.session.add_all(users)
+    db.session.flush()
+
+    make_id = BackfillIds()
+    start = datetime(2023, 1, 1)
+    rows = []
+    for i in range(num_messages):
+        timestamp = start + timedelta(seconds=i)
+        rows.append(dict(id=make_id(timestamp), text=f"message {i}",
+                         timestamp=timestamp,
+                         user_id=users[i % NUM_AUTHORS].id))
+    db.session.execute(insert(messages), rows)
+    db.session.commit()
+
+    return users[0].id
+
+
+def timestamp_page(user_id, page):
+    stmt = (select(messages.c.id, messages.c.text, messages.c.timestamp)
+            .where(messages.c.user_id == user_id)
+            .order_by(messages.c.timestamp.desc())
+            .limit(PAGE_SIZE)
+            .offset(page * PAGE_SIZE))
+    return db.session.connection().execute(stmt).all()
+
+
+def keyset_before(user_id, page):
+    """The `before` id a reader paging from the top would have at `page`."""
+
+    if page == 0:
+        return None
+
+    stmt = (select(messages.c.id)
+            .where(messages.c.user_id == user_id)
+            .order_by(messages.c.id.desc())
+            .offset(page * PAGE_SIZE - 1)
+            .limit(1))
+    return db.session.connection().execute(stmt).scalar()
+
+
+def measure(load, repeats):
+    load()
+
+    start = time.perf_counter()
+    for _ in range(repeats):
+        rows = load()
+    assert len(rows) == PAGE_SIZE
+
+    return (time.perf_counter() - start) / repeats
+
+
+def main(num_messages=200_000, repeats=20):
+    user_id = setup(num_messages)
+    deep = num_messages // NUM_AUTHORS // PAGE_SIZE - 1
+
+    results = {}
+    for page in (0, deep):
+        results[page] = [measure(lambda: timestamp_page(user_id, page),
+                                 repeats)]
+
+    index = Index('ix_bench_user_id_timestamp',
+                  messages.c.user_id, messages.c.timestamp)
+    index.create(db.session.connection())
+    db.session.commit()
+
+    for page in (0, deep):
+        before = keyset_before(user_id, page)
+        results[page] += [
+            measure(lambda: timestamp_page(user_id, page), repeats),
+            measure(lambda: read_models.user_messages(
+                db.session, user_id, limit=PAGE_SIZE, before=before),
+                repeats),
+        ]
+
+    print(f"{num_messages} messages, {PAGE_SIZE} per page, "
+          f"ms (mean of {repeats})")
+    print(f"{'page':>6} {'timestamp':>10} {'ts index':>10} {'id keyset':>10}")
+    for page, times in results.items():
+        print(f"{page:>6} " + " ".join(f"{t * 1000:>10.2f}" for t in times))
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,181 @@
+"""Benchmark monthly message partitions against one unpartitioned table.
+
+Needs Postgres: uses DATABASE_URL (default postgresql:///warbler_bench),
+and drops and recreates its tables. Fills the partitioned `messages` table
+and an unpartitioned copy, messages_flat, with the same rows spread over
+`months` months, then measures on each:
+
+- hot reads: a user's newest page of messages, and a homepage timeline
+  for a user following 50 others (mean ms), both as a plain
+  ORDER BY id DESC LIMIT and looking in `read_models.RECENT_WINDOW` first
+  as read_models does
+- vacuum after churn: deleting 5% of the current month's messages, then
+  VACUUM of the whole flat table against VACUUM of the current partition
+- retiring the oldest month: DELETE plus VACUUM on the flat table against
+  detaching and dropping its partition
+
+run like:
+
+    python -m benchmarks.bench_partitions [num_messages] [months] [repeats]
+"""
+
+import os
+import sys
+import time
+from datetime import datetime
+
+import app
+import partitions
+import read_models
+import snowflake
+from models import db
+
+NUM_USERS = 1_000
+FOLLOWS = 50
+PAGE_SIZE = 100
+
+USER_PAGE = """
+    SELECT id, text, timestamp FROM {table}
+    WHERE user_id = %(user_id)s {window}
+    ORDER BY id DESC LIMIT {limit}
+"""
+
+TIMELINE = """
+    SELECT id, text, timestamp FROM {table}
+    WHERE (user_id = %(user_id)s OR user_id IN (
+        SELECT user_being_followed_id FROM follows
+        WHERE user_following_id = %(user_id)s)) {window}
+    ORDER BY id DESC LIMIT {limit}
+"""
+
+
+def setup(num_messages, months):
+    flask_app = app.create_app({
+        'SQLALCHEMY_DATABASE_URI': os.environ.get(
+            'DATABASE_URL', "postgresql:///warbler_bench"),
+        'SECRET_KEY': "bench",
+        'WARM_UP_TEMPLATES': False,
+    })
+    flask_app.app_context().push()
+
+    db.drop_all()
+    with db.engine.begin() as conn:
+        conn.exec_driver_sql("DROP TABLE IF EXISTS messages_flat")
+    db.create_all()
+
+    this_month = partitions.month_start(datetime.utcnow())
+    first = partitions.add_months(this_month, -(months - 1))
+    span_ms = (datetime.utcnow() - first).total_seconds() * 1000
+
+    with db.engine.begin() as conn:
+        partitions.ensure_partitions(conn, since=first)
+
+        conn.exec_driver_sql(
+            "INSERT INTO users (id, email, username, image_url, "
+            "header_image_url, bio, location, password, is_admin) "
+            "SELECT i, 'u' || i || '@example.com', 'user' || i, '', '', '', "
+            "'', 'x', false FROM generate_series(1, %(users)s) i",
+            dict(users=NUM_USERS))
+        conn.exec_driver_sql(
+            "INSERT INTO follows (user_following_id, user_being_followed_id) "
+            "SELECT 1, i FROM generate_series(2, %(follows)s + 1) i",
+            dict(follows=FOLLOWS))
+
+        # One message per `step` ms from `first` to now, ids made from the
+        # timestamps as BackfillIds would.
+        conn.exec_driver_sql(
+            "INSERT INTO messages (id, text, timestamp, user_id) "
+            "SELECT (((extract(epoch FROM ts) * 1000)::bigint - %(epoch)s) "
+            "        << %(shift)s) | (%(worker)s << %(sequence_bits)s), "
+            "       'message ' || i, ts, 1 + i %% %(users)s "
+            "FROM generate_series(0, %(n)s - 1) i, "
+            "LATERAL (SELECT %(first)s::timestamp "
+            "         + make_interval(secs => i * %(step)s / 1000.0)) t(ts)",
+            dict(epoch=snowflake.EPOCH_MS,
+                 shift=snowflake.WORKER_BITS + snowflake.SEQUENCE_BITS,
+                 worker=snowflake.BACKFILL_WORKER_ID,
+                 sequence_bits=snowflake.SEQUENCE_BITS,
+                 users=NUM_USERS, n=num_messages, first=first,
+                 step=span_ms / num_messages))
+
+        conn.exec_driver_sql(
+            "CREATE TABLE messages_flat "
+            "(LIKE messages INCLUDING DEFAULTS)")
+        conn.exec_driver_sql(
+            "INSERT INTO messages_flat SELECT * FROM messages ORDER BY id")
+        conn.exec_driver_sql(
+            "ALTER TABLE messages_flat ADD PRIMARY KEY (id)")
+        conn.exec_driver_sql(
+            "CREATE INDEX ix_messages_flat_user_id_id "
+            "ON messages_flat (user_id, id)")
+
+    with autocommit() as conn:
+        conn.exec_driver_sql("VACUUM ANALYZE")
+
+    return this_month, first
+
+
+def autocommit():
+    return db.engine.connect().execution_options(isolation_level="AUTOCOMMIT")
+
+
+def timed(conn, sql, params=None):
+    start = time.perf_counter()
+    conn.exec_driver_sql(sql, params or {})
+    return (time.perf_counter() - start) * 1000
+
+
+def read_latency(query, table, window, repeats):
+    sql = query.format(table=table, window=window, limit=PAGE_SIZE)
+    with db.engine.connect() as conn:
+        total = 0
+        for i in range(repeats):
+            total += timed(conn, sql, dict(user_id=1 + i % NUM_USERS))
+    return total / repeats
+
+
+def main(num_messages=1_000_000, months=24, repeats=200):
+    this_month, first = setup(num_messages, months)
+    hot = partitions.partition_name(this_month)
+    low, high = partitions.month_bounds(this_month)
+    old_low, old_high = partitions.month_bounds(first)
+
+    print(f"{num_messages} messages over {months} months, "
+          f"ms (reads: mean of {repeats})")
+    print(f"{'':<28} {'flat':>10} {'partitioned':>12}")
+
+    recent = snowflake.compose(snowflake.to_ms(
+        datetime.utcnow() - read_models.RECENT_WINDOW), 0, 0)
+    for name, query in (("user page", USER_PAGE), ("timeline", TIMELINE)):
+        for label, window in (("", ""),
+                              (", recent window", f"AND id >= {recent}")):
+            flat = read_latency(query, "messages_flat", window, repeats)
+            parted = read_latency(query, "messages", window, repeats)
+            print(f"{name + label:<28} {flat:>10.2f} {parted:>12.2f}")
+
+    with autocommit() as conn:
+        churn = ("DELETE FROM {table} WHERE id >= %(low)s AND id < %(high)s "
+                 "AND (id >> %(shift)s) %% 20 = 0")
+        for table in ("messages_flat", "messages"):
+            conn.exec_driver_sql(
+                churn.format(table=table),
+                dict(low=low, high=high,
+                     shift=snowflake.WORKER_BITS + snowflake.SEQUENCE_BITS))
+        flat = timed(conn, "VACUUM messages_flat")
+        parted = timed(conn, f"VACUUM {hot}")
+        print(f"{'vacuum after churn':<28} {flat:>10.2f} {parted:>12.2f}")
+
+        flat = timed(conn,
+                     "DELETE FROM messages_flat "
+                     "WHERE id >= %(low)s AND id < %(high)s",
+                     dict(low=old_low, high=old_high))
+        flat += timed(conn, "VACUUM messages_flat")
+        start = time.perf_counter()
+        with db.engine.begin() as tx:
+            partitions.drop_partition(tx, first)
+        parted = (time.perf_counter() - start) * 1000
+        print(f"{'retire oldest month':<28} {flat:>10.2f} {parted:>12.2f}")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
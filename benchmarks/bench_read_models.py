@@ -0,0 +1,114 @@
+"""Benchmark timeline read models against full ORM entities.
+
+Loads a homepage timeline page of 100 and 1,000 messages both ways: the
+old ORM query (Message entities, each author loaded through `msg.user`)
+and `read_models.timeline()`, touching the same attributes the template
+prints. Reports mean latency and the peak memory allocated while building
+one page (tracemalloc).
+
+run like:
+
+    python -m benchmarks.bench_read_models [repeats]
+"""
+
+import sys
+import time
+import tracemalloc
+
+import app
+import read_models
+from models import db, Follow, Message, User
+
+NUM_USERS = 50
+PAGE_SIZES = (100, 1_000)
+
+
+def setup():
+    flask_app = app.create_app({
+        'SQLALCHEMY_DATABASE_URI': "sqlite://",
+        'SECRET_KEY': "bench",
+    })
+    flask_app.app_context().push()
+
+    db.create_all()
+    users = [User(username=f"user{i}", email=f"user{i}@example.com",
+                  password="x")
+             for i in range(NUM_USERS)]
+    db.session.add_all(users)
+    db.session.flush()
+    db.session.add_all(
+        Follow(user_following_id=users[0].id,
+               user_being_followed_id=user.id)
+        for user in users[1:])
+    db.session.add_all(
+        Message(text=f"message {i}", user_id=users[i % NUM_USERS].id)
+        for i in range(max(PAGE_SIZES) * 2))
+    db.session.commit()
+
+    return users[0].id
+
+
+def orm_page(user_id, size):
+    user = db.session.get(User, user_id)
+    following_ids = [following.id for following in user.following] + [user_id]
+
+    messages = (Message
+                .query
+                .filter(Message.user_id.in_(following_ids))
+                .order_by(Message.timestamp.desc())
+                .limit(size)
+                .all())
+
+    return [(msg.id, msg.text, msg.timestamp, msg.user.id,
+             msg.user.username, msg.user.image_url)
+            for msg in messages]
+
+
+def core_page(user_id, size):
+    messages = read_models.timeline(db.session, user_id, limit=size)
+
+    return [(msg.id, msg.text, msg.timestamp, msg.user.id,
+             msg.user.username, msg.user.image_url)
+            for msg in messages]
+
+
+def measure(load, user_id, size, repeats):
+    """(mean seconds, peak bytes) to build a page, from a fresh session."""
+
+    db.session.remove()
+    load(user_id, size)
+
+    total = 0
+    for _ in range(repeats):
+        db.session.remove()
+        start = time.perf_counter()
+        load(user_id, size)
+        total += time.perf_counter() - start
+
+    db.session.remove()
+    tracemalloc.start()
+    page = load(user_id, size)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert len(page) == size
+
+    return total / repeats, peak
+
+
+def main(repeats=20):
+    user_id = setup()
+
+    print(f"timeline page, ms (mean of {repeats}) and peak KiB")
+    print(f"{'rows':>6} {'orm ms':>8} {'core ms':>8} "
+          f"{'orm KiB':>9} {'core KiB':>9}")
+
+    for size in PAGE_SIZES:
+        orm_time, orm_peak = measure(orm_page, user_id, size, repeats)
+        core_time, core_peak = measure(core_page, user_id, size, repeats)
+
+        print(f"{size:>6} {orm_time * 1000:>8.2f} {core_time * 1000:>8.2f} "
+              f"{orm_peak / 1024:>9.0f} {core_peak / 1024:>9.0f}")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,63 @@
+"""Benchmark the recommendation job's runtime against edge count.
+
+Generates random follow and like graphs of increasing size and times the
+scoring step (everything but the database reads and writes).
+
+run like:
+
+    python -m benchmarks.bench_recommendations [workers]
+"""
+
+import sys
+import time
+
+import numpy as np
+
+from recommendations import build_matrix, compute_recommendations
+
+# (users, follows per user, likes per user)
+SIZES = [
+    (10_000, 10, 10),
+    (20_000, 20, 10),
+    (50_000, 20, 20),
+    (100_000, 20, 20),
+]
+
+NUM_MESSAGES_PER_USER = 5
+
+
+def random_matrices(num_users, follows_per_user, likes_per_user, seed=0):
+    rng = np.random.default_rng(seed)
+    num_messages = num_users * NUM_MESSAGES_PER_USER
+
+    followers = np.repeat(np.arange(num_users), follows_per_user)
+    followed = rng.integers(0, num_users, len(followers))
+    likers = np.repeat(np.arange(num_users), likes_per_user)
+    liked = rng.integers(0, num_messages, len(likers))
+
+    return (
+        build_matrix(followers, followed, (num_users, num_users)),
+        build_matrix(likers, liked, (num_users, num_messages)),
+    )
+
+
+def main(workers=None):
+    print(f"{'users':>8} {'follows':>10} {'likes':>10} {'seconds':>8} "
+          f"{'edges/s':>10}")
+
+    for num_users, follows_per_user, likes_per_user in SIZES:
+        follows, likes = random_matrices(
+            num_users, follows_per_user, likes_per_user)
+
+        start = time.perf_counter()
+        for _ in compute_recommendations(follows, likes, workers=workers):
+            pass
+        elapsed = time.perf_counter() - start
+
+        edges = follows.nnz + likes.nnz
+        print(f"{num_users:>8} {follows.nnz:>10} {likes.nnz:>10} "
+              f"{elapsed:>8.2f} {edges / elapsed:>10.0f}")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
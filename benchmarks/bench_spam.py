@@ -0,0 +1,113 @@
+"""Benchmark near-duplicate screening with a full window.
+
+Fills a `spam.NearDuplicateIndex` with synthetic messages (random words,
+plus campaigns of near-identical variations of a few texts), then screens
+new posts and reports:
+
+- indexing rate and the index's memory
+- screening latency (signature, LSH lookup and confirmation), median
+  and 99th percentile
+- recall: new variations of a campaign caught, and false positives: new
+  unrelated texts flagged
+- a linear scan comparing each post with every signature, for scale
+
+run like:
+
+    python -m benchmarks.bench_spam [num_messages] [num_queries]
+"""
+
+import statistics
+import sys
+import time
+from random import Random
+
+import numpy as np
+
+import spam
+
+NUM_WORDS = 20_000
+NUM_CAMPAIGNS = 50
+CAMPAIGN_SHARE = 0.01
+LINEAR_QUERIES = 20
+
+
+def vocabulary(rng):
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    return ["".join(rng.choice(letters) for _ in range(rng.randint(2, 9)))
+            for _ in range(NUM_WORDS)]
+
+
+def random_text(rng, words):
+    return " ".join(rng.choice(words) for _ in range(rng.randint(6, 30)))
+
+
+def variation(rng, words, text):
+    """`text` with a word swapped and a suffix, as bots post it."""
+
+    parts = text.split()
+    parts[rng.randrange(len(parts))] = rng.choice(words)
+    return " ".join(parts) + f" {rng.randint(0, 999)}"
+
+
+def fill(index, rng, words, campaigns, num_messages):
+    start = time.perf_counter()
+    for _ in range(num_messages):
+        if rng.random() < CAMPAIGN_SHARE:
+            text = variation(rng, words, rng.choice(campaigns))
+        else:
+            text = random_text(rng, words)
+        index.add(index.signature(text))
+    return time.perf_counter() - start
+
+
+def screen(index, texts):
+    timings = []
+    flagged = 0
+    for text in texts:
+        start = time.perf_counter()
+        found = index.duplicates(index.signature(text))
+        timings.append(time.perf_counter() - start)
+        flagged += found > 0
+    return timings, flagged
+
+
+def linear_scan(index, texts):
+    start = time.perf_counter()
+    for text in texts:
+        signature = index.signature(text).astype(np.uint8)
+        (index._signatures == signature).sum(axis=1)
+    return (time.perf_counter() - start) / len(texts)
+
+
+def report(label, timings, flagged):
+    micros = sorted(t * 1e6 for t in timings)
+    p99 = micros[int(len(micros) * 0.99)]
+    print(f"{label:<22} median {statistics.median(micros):7.1f} us  "
+          f"p99 {p99:7.1f} us  flagged {flagged / len(timings):6.1%}")
+
+
+def main(num_messages=1_000_000, num_queries=10_000):
+    rng = Random(0)
+    words = vocabulary(rng)
+    campaigns = [random_text(rng, words) for _ in range(NUM_CAMPAIGNS)]
+
+    index = spam.NearDuplicateIndex(window=num_messages)
+    elapsed = fill(index, rng, words, campaigns, num_messages)
+    print(f"indexed {len(index)} messages in {elapsed:.1f}s "
+          f"({elapsed / num_messages * 1e6:.1f} us each), "
+          f"{index.nbytes / 2**20:.0f} MiB "
+          f"({index.nbytes / index.window:.0f} bytes each)")
+
+    variations = [variation(rng, words, rng.choice(campaigns))
+                  for _ in range(num_queries)]
+    unrelated = [random_text(rng, words) for _ in range(num_queries)]
+
+    report("campaign variations", *screen(index, variations))
+    report("unrelated texts", *screen(index, unrelated))
+
+    per_query = linear_scan(index, unrelated[:LINEAR_QUERIES])
+    print(f"{'linear scan':<22} mean   {per_query * 1e6:9.1f} us")
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
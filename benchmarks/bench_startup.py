@@ -0,0 +1,66 @@
+"""Benchmark cold start: importing the app, creating it, first request.
+
+Each measurement runs in a fresh interpreter so nothing is already
+imported or compiled.
+
+run like:
+
+    python -m benchmarks.bench_startup [runs]
+"""
+
+import json
+import statistics
+import subprocess
+import sys
+
+PROBE = """
+import json, time
+
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+
+flask_app = app.create_app({
+    'SQLALCHEMY_DATABASE_URI': 'sqlite://',
+    'SECRET_KEY': 'bench',
+    'WARM_UP_TEMPLATES': %(warm_up)s,
+})
+created = time.perf_counter()
+
+with flask_app.test_client() as client:
+    client.get('/login')
+first = time.perf_counter()
+
+with flask_app.test_client() as client:
+    client.get('/signup')
+second = time.perf_counter()
+
+print(json.dumps({
+    'import': imported - start,
+    'create_app': created - imported,
+    'first request': first - created,
+    'next new page': second - first,
+}))
+"""
+
+
+def measure(warm_up, runs):
+    samples = []
+    for _ in range(runs):
+        out = subprocess.run(
+            [sys.executable, '-c', PROBE % {'warm_up': warm_up}],
+            capture_output=True, text=True, check=True)
+        samples.append(json.loads(out.stdout))
+    return {key: statistics.median(s[key] for s in samples)
+            for key in samples[0]}
+
+
+def main(runs=5):
+    for warm_up in (False, True):
+        print(f"WARM_UP_TEMPLATES={warm_up} (median of {runs} runs)")
+        for phase, seconds in measure(warm_up, runs).items():
+            print(f"  {phase:<16} {seconds * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
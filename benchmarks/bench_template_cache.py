@@ -0,0 +1,96 @@
+"""Benchmark first-request latency per route, bytecode cache cold vs warm.
+
+Each run starts a fresh interpreter with template warm-up turned off, so
+every route's first hit has to load its templates: compiled from source
+when the cache is cold, read back from the cache when it is warm.
+
+run like:
+
+    python -m benchmarks.bench_template_cache [runs]
+"""
+
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+# /signup logs the user out, so the anonymous pages go last.
+ROUTES = [
+    '/',
+    '/users',
+    '/users/1',
+    '/users/1/following',
+    '/users/1/followers',
+    '/users/1/likes',
+    '/users/1/suggestions',
+    '/messages/new',
+    '/messages/1',
+    '/trending',
+    '/login',
+    '/signup',
+]
+
+PROBE = """
+import json, sys, time
+
+import app
+from models import db, Message, User
+
+flask_app = app.create_app({
+    'SQLALCHEMY_DATABASE_URI': %(db_url)r,
+    'SECRET_KEY': 'bench',
+    'WARM_UP_TEMPLATES': False,
+    'JINJA_BYTECODE_CACHE_DIR': %(cache_dir)r,
+})
+
+with flask_app.app_context():
+    db.create_all()
+    if not User.query.count():
+        user = User.signup('bench', 'bench@example.com', 'password')
+        db.session.flush()
+        db.session.add(Message(text='hello', user_id=user.id))
+        db.session.commit()
+
+timings = {}
+with flask_app.test_client() as client:
+    with client.session_transaction() as sess:
+        sess[app.CURR_USER_KEY] = 1
+    for route in %(routes)r:
+        start = time.perf_counter()
+        client.get(route)
+        timings[route] = time.perf_counter() - start
+
+print(json.dumps(timings))
+"""
+
+
+def first_hits(db_url, cache_dir):
+    out = subprocess.run(
+        [sys.executable, '-c', PROBE % dict(
+            db_url=db_url, cache_dir=cache_dir, routes=ROUTES)],
+        capture_output=True, text=True, check=True)
+    return json.loads(out.stdout)
+
+
+def main(runs=5):
+    with tempfile.TemporaryDirectory() as tmp:
+        db_url = f"sqlite:///{os.path.join(tmp, 'bench.db')}"
+        cold, warm = [], []
+
+        for i in range(runs):
+            cache_dir = os.path.join(tmp, f"cache-{i}")
+            cold.append(first_hits(db_url, cache_dir))
+            warm.append(first_hits(db_url, cache_dir))
+
+    print(f"first request per route, ms (median of {runs} runs)")
+    print(f"{'route':<24} {'cold':>8} {'warm':>8}")
+    for route in ROUTES:
+        cold_ms = statistics.median(run[route] for run in cold) * 1000
+        warm_ms = statistics.median(run[route] for run in warm) * 1000
+        print(f"{route:<24} {cold_ms:>8.1f} {warm_ms:>8.1f}")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
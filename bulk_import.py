@@ -0,0 +1,266 @@
+"""Bulk message import: many messages with their original timestamps.
+
+Posting through add_message() is one form, one insert and one commit
+per message. Moving an account over from elsewhere, or replaying an
+archive, goes through here instead (/messages/import, or `flask
+import-messages` for big files), from either of:
+
+- NDJSON: one {"text": ..., "timestamp": ...} object per line
+- CSV: a header row naming `text` and `timestamp` columns, then a row
+  per message
+
+Timestamps are ISO 8601, UTC unless they carry an offset, and at least
+MIN_AGE old: imports are for history, and recent messages are posted
+through add_message(), screened for spam and rate limited.
+
+`validate()` reads the file once, a row at a time, and checks every row
+before anything is written: text present and short enough, timestamp
+parseable, at least MIN_AGE old, and not before what message ids can hold
+(snowflake.EPOCH_MS) or before the newest archived month (archive.py
+would write over that month's file). `import_messages()` then reads it
+again and writes DEFAULT_CHUNK_SIZE messages at a time: ids from
+`snowflake.BackfillIds`, one bulk insert (COPY on Postgres), one pass
+over the chunk's tags and mentions, one commit.
+
+Ids come from the timestamps, so two imports with messages in the same
+millisecond would make the same id; each chunk checks its ids against
+the database and moves any already taken to the next free sequence
+number. Imported messages are old news: they aren't screened for spam
+and don't notify the users they mention, but they are added to this
+process's spam index, so new posts copying them are caught. The import
+route is rate limited per user (admission.py). Importing a file twice
+imports its messages twice.
+"""
+
+import csv
+import io
+import json
+from datetime import datetime, timedelta, timezone
+
+import partitions
+import sharding
+import snowflake
+import spam
+from models import Message
+
+DEFAULT_CHUNK_SIZE = 5_000
+MAX_ERRORS = 20
+MAX_TEXT_LENGTH = Message.__table__.c.text.type.length
+MIN_AGE = timedelta(days=1)
+
+NDJSON = 'ndjson'
+CSV = 'csv'
+FORMATS = {'.ndjson': NDJSON, '.jsonl': NDJSON, '.csv': CSV}
+
+EARLIEST = datetime.utcfromtimestamp(snowflake.EPOCH_MS / 1000)
+
+
+def format_for(filename):
+    """NDJSON or CSV from `filename`'s extension, or None."""
+
+    for extension, format in FORMATS.items():
+        if filename.lower().endswith(extension):
+            return format
+    return None
+
+
+def not_before(message_archive):
+    """The earliest timestamp an import may use, given `message_archive`.
+
+    Messages can't go into months already archived: archiving the month
+    again would replace its file with just them.
+    """
+
+    if message_archive is None:
+        return None
+    months = message_archive.months()
+    if not months:
+        return None
+    newest, _ = months[0]
+    return partitions.add_months(newest, 1)
+
+
+def _records(file, format):
+    """Yield (line number, record or None) from binary `file`.
+
+    A record is a dict with 'text' and 'timestamp' keys, or None for a
+    line that couldn't be read as one.
+    """
+
+    text = io.TextIOWrapper(file, encoding='utf-8', newline='')
+    try:
+        if format == CSV:
+            reader = csv.DictReader(text)
+            for record in reader:
+                yield reader.line_num, record
+            return
+
+        for number, line in enumerate(text, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = None
+            yield number, record if isinstance(record, dict) else None
+    finally:
+        # Leave `file` open for the caller.
+        text.detach()
+
+
+def _parse_timestamp(value):
+    if not isinstance(value, str):
+        raise ValueError
+    parsed = datetime.fromisoformat(value.strip())
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def _rows(file, format, not_before, now):
+    """Yield (line number, text, timestamp, error) for each message."""
+
+    earliest = max(EARLIEST, not_before or EARLIEST)
+
+    for number, record in _records(file, format):
+        if record is None:
+            yield number, None, None, "not a message record"
+            continue
+
+        text = record.get('text')
+        if not isinstance(text, str) or not text.strip():
+            yield number, None, None, "no text"
+            continue
+        if len(text) > MAX_TEXT_LENGTH:
+            yield number, None, None, (
+                f"text longer than {MAX_TEXT_LENGTH} characters")
+            continue
+
+        try:
+            timestamp = _parse_timestamp(record.get('timestamp'))
+        except ValueError:
+            yield number, None, None, "timestamp isn't ISO 8601"
+            continue
+        if timestamp > now:
+            yield number, None, None, "timestamp is in the future"
+            continue
+        if timestamp > now - MIN_AGE:
+            yield number, None, None, (
+                "timestamp is less than a day old; post recent messages "
+                "instead")
+            continue
+        if timestamp < earliest:
+            yield number, None, None, (
+                f"timestamp is before {earliest:%Y-%m-%d}")
+            continue
+
+        yield number, text, timestamp, None
+
+
+def validate(file, format, not_before=None, now=None):
+    """Check every row of `file`. Returns (count, oldest, errors).
+
+    `errors` is the first MAX_ERRORS of [(line number, problem)];
+    `oldest` is the earliest timestamp, or None if there are no rows.
+    """
+
+    count = 0
+    oldest = None
+    errors = []
+
+    for number, _, timestamp, error in _rows(
+            file, format, not_before, now or datetime.utcnow()):
+        if error is not None:
+            if len(errors) < MAX_ERRORS:
+                errors.append((number, error))
+            continue
+
+        count += 1
+        if oldest is None or timestamp < oldest:
+            oldest = timestamp
+
+    return count, oldest, errors
+
+
+def _next_id(message_id):
+    """The backfill id after `message_id`."""
+
+    ms, _, sequence = snowflake.decompose(message_id)
+    if sequence == snowflake.MAX_SEQUENCE:
+        ms, sequence = ms + 1, -1
+    return snowflake.compose(ms, snowflake.BACKFILL_WORKER_ID, sequence + 1)
+
+
+def _assign_ids(session, shards, timestamps):
+    """Ids for a chunk's `timestamps`, none already in use."""
+
+    make_id = snowflake.BackfillIds()
+    order = sorted(range(len(timestamps)), key=timestamps.__getitem__)
+    ids = [None] * len(timestamps)
+    for i in order:
+        ids[i] = make_id(timestamps[i])
+
+    used = set(ids)
+    taken = shards.existing_message_ids(session, ids)
+    while taken:
+        moved = []
+        for i, message_id in enumerate(ids):
+            if message_id in taken:
+                while message_id in used or message_id in taken:
+                    message_id = _next_id(message_id)
+                used.add(message_id)
+                ids[i] = message_id
+                moved.append(message_id)
+        taken = shards.existing_message_ids(session, moved)
+
+    return ids
+
+
+def _chunks(rows, chunk_size):
+    chunk = []
+    for _, text, timestamp, error in rows:
+        if error is not None:
+            raise ValueError("import the file only after validate() passes")
+        chunk.append((timestamp, text))
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def import_messages(session, user_id, file, format, oldest=None,
+                    not_before=None, now=None,
+                    chunk_size=DEFAULT_CHUNK_SIZE, progress=None):
+    """Write `file`'s messages as `user_id`'s. Returns how many.
+
+    Run validate() on the file first and pass its `oldest`, which makes
+    sure month partitions exist back that far. Commits after each chunk;
+    `progress`, if given, is called with the count so far.
+    """
+
+    shards = sharding.current()
+    spam_filter = spam.current()
+    if oldest is not None:
+        partitions.ensure_partitions(session.connection(), since=oldest)
+        session.commit()
+
+    count = 0
+    for chunk in _chunks(
+            _rows(file, format, not_before, now or datetime.utcnow()),
+            chunk_size):
+        ids = _assign_ids(session, shards,
+                          [timestamp for timestamp, _ in chunk])
+        shards.add_messages(session, user_id, [
+            (message_id, timestamp, text)
+            for message_id, (timestamp, text) in zip(ids, chunk)])
+        session.commit()
+        if spam_filter:
+            for message_id, (_, text) in zip(ids, chunk):
+                spam_filter.add(message_id, text)
+
+        count += len(chunk)
+        if progress is not None:
+            progress(count)
+
+    return count
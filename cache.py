@@ -0,0 +1,687 @@
+"""A two-level cache for hot reads: profiles, messages and timelines.
+
+`cached(key, load, tags)` returns the cached value for `key` (a tuple
+whose first item names the kind of value, like ('profile', 5)), or calls
+`load()` and keeps what it returns:
+
+- L1 is each process's own LRU of up to CACHE_L1_SIZE entries.
+- L2, if CACHE_DIR is set, is a `DirectoryCache` shared by the workers
+  on a server, so a value loaded by one is there for the others. Anything
+  with get(key), set(key, value, ex=seconds) and delete(key) taking
+  string keys and bytes values will do as an L2 (a redis.Redis client
+  has that shape), as long as only one server's workers share it: see
+  tag versions below.
+
+Entries live for CACHE_TTL seconds. Three things keep a popular entry's
+expiry from sending every request, in every worker, to the database at
+once:
+
+- Single flight: concurrent misses on a key in one process wait for one
+  `load()` and share its result (or its exception).
+- Early refresh: a hit may refresh the entry before it expires, with a
+  probability that rises as expiry nears and with how long the value
+  took to load ("XFetch", Vattani et al. 2015; CACHE_BETA above 1
+  refreshes earlier). Requests spread over time pick different moments,
+  so one of them usually refreshes it while the rest still hit.
+- Leases: a refresh, early or on expiry, takes a lease on the key in
+  shared memory first. Requests that find the lease taken, in any
+  worker, keep serving the entry they have until it's replaced.
+
+Each entry has tags naming the rows it was built from. When those rows
+change, the tags are invalidated and every entry carrying one is a miss
+from then on, in every worker and in L2:
+
+    user:<id>       the user's row (name, avatar, bio, ...)
+    posts:<id>      which messages the user has written
+    follows:<id>    who the user follows
+    followers:<id>  who follows the user
+    likes:<id>      which messages the user has liked
+    message:<id>    the message's row
+
+Tags are noted as the session flushes User, Message, Follow and Likes
+objects (and changes to the follow and like collections), and as
+sharding.py and deletion.py write those tables with `changed()`. They
+are invalidated when the session commits, and forgotten if it rolls
+back. Invalidating bumps a version number per tag in a fixed table of
+shared slots (like admission.py's token buckets), and an entry is only
+good while the versions of its tags are the ones it was loaded under.
+Two tags that share a slot invalidate each other's entries, which costs
+a miss but never serves anything stale. The table is one server's
+shared memory: with several servers, give each its own L2 and a TTL
+you're happy to be stale for, since writes on one server aren't seen by
+the others' caches before then.
+
+Hits, misses and refreshes per kind of key, and histograms of lookup,
+load and wait times, are in `Cache.snapshot()`, shown at /admin/metrics.
+"""
+
+import bisect
+import hashlib
+import math
+import multiprocessing
+import os
+import pickle
+import random
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from dataclasses import dataclass
+from itertools import chain
+
+import numpy as np
+from flask import current_app, has_app_context
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+from models import Follow, Likes, Message, User
+
+DEFAULT_L1_SIZE = 10_000
+DEFAULT_TTL = 60
+DEFAULT_BETA = 1.0
+DEFAULT_TAG_SLOTS = 65_536
+DEFAULT_LEASE_SLOTS = 16_384
+DEFAULT_LEASE_SECONDS = 10
+DEFAULT_SWEEP_EVERY = 1_000
+
+# Upper bounds of the latency histograms' buckets, in milliseconds.
+LATENCY_BUCKETS_MS = (
+    0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250,
+    500, 1000)
+
+# Where a session keeps the tags to invalidate when it commits.
+PENDING_TAGS = 'cache_tags'
+
+
+def _slot(name, slots):
+    return zlib.crc32(name.encode()) % slots
+
+
+class LocalCache:
+    """An LRU of up to `max_entries` entries, safe to share by threads."""
+
+    def __init__(self, max_entries=DEFAULT_L1_SIZE):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class DirectoryCache:
+    """An L2 for the workers on one server: a file per key in `directory`.
+
+    Entries are written to a temporary file and renamed into place, so
+    readers never see half of one. Expired files are removed when read,
+    and by a sweep of the directory every `sweep_every` writes.
+    """
+
+    def __init__(self, directory, sweep_every=DEFAULT_SWEEP_EVERY):
+        self.directory = directory
+        self.sweep_every = sweep_every
+        self._writes = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        name = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(self.directory, f"{name}.entry")
+
+    @staticmethod
+    def _read(path, size=-1):
+        # The expiry time, then the value.
+        try:
+            with open(path, 'rb') as file:
+                data = file.read(size)
+        except FileNotFoundError:
+            return None, None
+        if len(data) < 8:
+            return None, None
+        [expires] = struct.unpack_from('!d', data)
+        return expires, data[8:]
+
+    def get(self, key):
+        path = self._path(key)
+        expires, value = self._read(path)
+        if expires is None:
+            return None
+        if expires <= time.time():
+            self._remove(path)
+            return None
+        return value
+
+    def set(self, key, value, ex=None):
+        expires = time.time() + ex if ex else math.inf
+        fd, temp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, 'wb') as file:
+            file.write(struct.pack('!d', expires))
+            file.write(value)
+        os.replace(temp, self._path(key))
+
+        self._writes += 1
+        if self._writes % self.sweep_every == 0:
+            self.sweep()
+
+    def delete(self, key):
+        self._remove(self._path(key))
+
+    def sweep(self, now=None):
+        """Remove expired entries. Returns how many there were."""
+
+        now = time.time() if now is None else now
+        removed = 0
+        for item in os.scandir(self.directory):
+            if not item.name.endswith(".entry"):
+                continue
+            expires, _ = self._read(item.path, 8)
+            if expires is not None and expires <= now:
+                self._remove(item.path)
+                removed += 1
+        return removed
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+class TagVersions:
+    """A version number per tag, in a fixed table of shared slots.
+
+    The table is shared memory created with the app, so forked workers
+    share it. Versions are read without a lock. The last slot counts
+    invalidations, to tell whether any happened in a span of time.
+    """
+
+    def __init__(self, slots=DEFAULT_TAG_SLOTS):
+        self.slots = slots
+        # Tells this table's entries from ones in L2 left by a previous
+        # server run, whose table counted from zero too.
+        self.epoch = time.time_ns()
+        self._lock = multiprocessing.Lock()
+        self._table = multiprocessing.RawArray('q', slots + 1)
+        self._versions = np.frombuffer(self._table, dtype=np.int64)
+
+    def slots_for(self, tags):
+        return np.unique(np.fromiter(
+            (_slot(tag, self.slots) for tag in tags), dtype=np.int64))
+
+    def read(self, slots):
+        return self._versions[slots]
+
+    def unchanged(self, slots, versions):
+        return np.array_equal(self._versions[slots], versions)
+
+    @property
+    def generation(self):
+        return int(self._versions[self.slots])
+
+    def bump(self, tags):
+        slots = self.slots_for(tags)
+        with self._lock:
+            self._versions[slots] += 1
+            self._versions[self.slots] += 1
+
+
+class Leases:
+    """Which keys are being refreshed: a deadline per slot of shared memory.
+
+    Two keys in the same slot share a lease, which only means one of
+    them is served from its old entry a little longer.
+    """
+
+    def __init__(self, slots=DEFAULT_LEASE_SLOTS):
+        self.slots = slots
+        self._lock = multiprocessing.Lock()
+        self._deadlines = multiprocessing.RawArray('d', slots)
+
+    def claim(self, name, now, seconds):
+        """Take the lease on `name` for `seconds`. False if it's taken."""
+
+        i = _slot(name, self.slots)
+        with self._lock:
+            if self._deadlines[i] > now:
+                return False
+            self._deadlines[i] = now + seconds
+            return True
+
+    def release(self, name):
+        i = _slot(name, self.slots)
+        with self._lock:
+            self._deadlines[i] = 0
+
+
+class Histogram:
+    """Counts of values in fixed buckets, with their total."""
+
+    def __init__(self, bounds=LATENCY_BUCKETS_MS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.total = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.total += value
+
+    def snapshot(self):
+        buckets = {str(bound): count
+                   for bound, count in zip(self.bounds, self.counts)}
+        buckets['inf'] = self.counts[-1]
+        count = sum(self.counts)
+        return dict(
+            count=count,
+            mean=self.total / count if count else None,
+            buckets=buckets,
+        )
+
+
+COUNTERS = (
+    'requests', 'l1_hits', 'l2_hits', 'stale_hits', 'coalesced', 'loads',
+    'early_refreshes', 'invalidated', 'errors')
+
+HISTOGRAMS = ('hit', 'load', 'wait')
+
+
+class CacheStats:
+    """Counters and latency histograms per kind of key, safe to share."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._kinds = {}
+
+    def _kind(self, kind):
+        found = self._kinds.get(kind)
+        if found is None:
+            found = self._kinds[kind] = (
+                dict.fromkeys(COUNTERS, 0),
+                {name: Histogram() for name in HISTOGRAMS})
+        return found
+
+    def count(self, kind, counter):
+        with self._lock:
+            self._kind(kind)[0][counter] += 1
+
+    def observe(self, kind, histogram, seconds):
+        with self._lock:
+            self._kind(kind)[1][histogram].observe(seconds * 1000)
+
+    def snapshot(self):
+        """Per kind: the counters, hit ratios and latencies in ms."""
+
+        with self._lock:
+            found = {}
+            for kind, (counts, histograms) in self._kinds.items():
+                requests = counts['requests']
+                found[kind] = dict(
+                    counts,
+                    hit_ratio=(1 - counts['loads'] / requests
+                               if requests else None),
+                    l1_hit_ratio=(counts['l1_hits'] / requests
+                                  if requests else None),
+                    latency_ms={name: histogram.snapshot()
+                                for name, histogram in histograms.items()},
+                )
+            return found
+
+
+@dataclass(frozen=True, slots=True)
+class Entry:
+    """A cached value, with what's needed to tell when it's out of date."""
+
+    value: object
+    expires: float
+    # Seconds load() took, for early refresh.
+    delta: float
+    epoch: int
+    slots: np.ndarray
+    versions: np.ndarray
+
+
+class _Flight:
+    """A load in progress, for requests for the same key to wait on."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class Cache:
+    """An L1 LRU over an optional shared L2, invalidated by tags."""
+
+    def __init__(self, l1_size=DEFAULT_L1_SIZE, ttl=DEFAULT_TTL,
+                 beta=DEFAULT_BETA, l2=None, versions=None, leases=None,
+                 lease_seconds=DEFAULT_LEASE_SECONDS, clock=time.time,
+                 random=random.random):
+        self.ttl = ttl
+        self.beta = beta
+        self.lease_seconds = lease_seconds
+        self.local = LocalCache(l1_size)
+        self.shared = l2
+        self.versions = TagVersions() if versions is None else versions
+        self.leases = Leases() if leases is None else leases
+        self.stats = CacheStats()
+        self.clock = clock
+        self.random = random
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def get(self, key, load, tags=(), value_tags=None, ttl=None):
+        """The value for `key`, from the cache or else from `load()`.
+
+        `tags` name what the value is built from: a list, or a function
+        returning one, called only on a miss and before `load()`.
+        `value_tags`, if given, is a function of the loaded value for
+        tags only known from it; a value is then not kept if anything
+        was invalidated while it loaded.
+        """
+
+        kind = key[0]
+        started = time.perf_counter()
+        now = self.clock()
+        self.stats.count(kind, 'requests')
+
+        entry, level, fresh = self._lookup(key, kind, now)
+        if entry is None:
+            return self._load(key, kind, load, tags, value_tags, ttl)
+
+        if fresh:
+            self.stats.count(kind, level)
+            self.stats.observe(kind, 'hit', time.perf_counter() - started)
+            return entry.value
+
+        name = repr(key)
+        if not self.leases.claim(name, now, self.lease_seconds):
+            # Someone is refreshing it: this one will do until they have.
+            self.stats.count(kind, 'stale_hits')
+            self.stats.observe(kind, 'hit', time.perf_counter() - started)
+            return entry.value
+
+        if now < entry.expires:
+            self.stats.count(kind, 'early_refreshes')
+        try:
+            return self._load(key, kind, load, tags, value_tags, ttl)
+        finally:
+            self.leases.release(name)
+
+    def invalidate(self, tags):
+        """Make every entry tagged with any of `tags` a miss."""
+
+        self.versions.bump(tags)
+
+    def clear(self):
+        """Empty L1. L2 entries are left to expire."""
+
+        self.local.clear()
+
+    def snapshot(self):
+        return dict(
+            kinds=self.stats.snapshot(),
+            l1_entries=len(self.local),
+            l2=type(self.shared).__name__ if self.shared else None,
+            invalidations=self.versions.generation,
+        )
+
+    def _valid(self, entry):
+        return (entry.epoch == self.versions.epoch and
+                self.versions.unchanged(entry.slots, entry.versions))
+
+    def _fresh(self, entry, now):
+        # Refresh early with a probability that grows as expiry nears.
+        jitter = entry.delta * self.beta * -math.log(1.0 - self.random())
+        return now + jitter < entry.expires
+
+    def _lookup(self, key, kind, now):
+        """The best entry for `key`, where it was found, and if it's fresh.
+
+        L2 is asked when L1's entry is missing or due for a refresh, since
+        another worker may have loaded or refreshed the value since.
+        """
+
+        entry = self.local.get(key)
+        if entry is not None and not self._valid(entry):
+            self.stats.count(kind, 'invalidated')
+            self.local.delete(key)
+            entry = None
+
+        if entry is not None and self._fresh(entry, now):
+            return entry, 'l1_hits', True
+
+        if self.shared is not None:
+            shared = self._shared_get(key, kind)
+            if shared is not None and (entry is None or
+                                       shared.expires > entry.expires):
+                self.local.put(key, shared)
+                return shared, 'l2_hits', self._fresh(shared, now)
+
+        return entry, 'l1_hits', False
+
+    def _shared_get(self, key, kind):
+        # L2 trouble must never break a page: it's just a miss.
+        try:
+            data = self.shared.get(repr(key))
+            entry = pickle.loads(data) if data is not None else None
+        except Exception:
+            self.stats.count(kind, 'errors')
+            return None
+
+        if entry is not None and not self._valid(entry):
+            self.stats.count(kind, 'invalidated')
+            return None
+        return entry
+
+    def _shared_set(self, key, kind, entry, ttl):
+        try:
+            self.shared.set(repr(key), pickle.dumps(entry),
+                            ex=max(1, math.ceil(ttl)))
+        except Exception:
+            self.stats.count(kind, 'errors')
+
+    def _load(self, key, kind, load, tags, value_tags, ttl):
+        """Load `key`, or wait for the load already running in this process."""
+
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if not leader:
+            started = time.perf_counter()
+            flight.done.wait()
+            self.stats.count(kind, 'coalesced')
+            self.stats.observe(kind, 'wait', time.perf_counter() - started)
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = self._fill(key, kind, load, tags, value_tags, ttl)
+            return flight.value
+        except Exception as exc:
+            flight.error = exc
+            self.stats.count(kind, 'errors')
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def _fill(self, key, kind, load, tags, value_tags, ttl):
+        ttl = self.ttl if ttl is None else ttl
+        if callable(tags):
+            tags = tags()
+
+        # Versions are read before loading: an invalidation during the
+        # load leaves the entry out of date, not wrongly current.
+        slots = self.versions.slots_for(tags)
+        versions = self.versions.read(slots)
+        generation = self.versions.generation
+
+        started = time.perf_counter()
+        value = load()
+        delta = time.perf_counter() - started
+        self.stats.count(kind, 'loads')
+        self.stats.observe(kind, 'load', delta)
+
+        if value_tags is not None:
+            if self.versions.generation != generation:
+                return value
+            slots = np.union1d(slots, self.versions.slots_for(
+                value_tags(value)))
+            versions = self.versions.read(slots)
+
+        entry = Entry(value, self.clock() + ttl, delta, self.versions.epoch,
+                      slots, versions)
+        self.local.put(key, entry)
+        if self.shared is not None:
+            self._shared_set(key, kind, entry, ttl)
+        return value
+
+
+def current():
+    """The current app's Cache, or None if caching is off."""
+
+    return current_app.extensions.get('cache')
+
+
+def cached(key, load, tags=(), value_tags=None, ttl=None):
+    """`Cache.get()` on the current app's cache; just `load()` without."""
+
+    cache = current() if has_app_context() else None
+    if cache is None:
+        return load()
+    return cache.get(key, load, tags, value_tags, ttl)
+
+
+##############################################################################
+# Tags
+
+
+def profile_tags(user_id):
+    """What a user's profile header shows: their row and counts."""
+
+    return [f"user:{user_id}", f"posts:{user_id}", f"follows:{user_id}",
+            f"followers:{user_id}", f"likes:{user_id}"]
+
+
+def timeline_tags(user_id, followed_ids):
+    """What a user's home timeline is built from."""
+
+    return [f"follows:{user_id}"] + [
+        tag for id in (user_id, *followed_ids)
+        for tag in (f"user:{id}", f"posts:{id}")]
+
+
+def changed(session, *tags):
+    """Invalidate `tags` when `session` commits; not if it rolls back."""
+
+    session.info.setdefault(PENDING_TAGS, set()).update(tags)
+
+
+def _collection_changes(obj, name):
+    history = inspect(obj).attrs[name].history
+    return chain(history.added, history.deleted)
+
+
+def tags_of(obj):
+    """Tags for a changed ORM object: its row, and its changed collections."""
+
+    if isinstance(obj, User):
+        yield f"user:{obj.id}"
+        for other in _collection_changes(obj, 'following'):
+            yield from (f"follows:{obj.id}", f"followers:{other.id}")
+        for other in _collection_changes(obj, 'followers'):
+            yield from (f"followers:{obj.id}", f"follows:{other.id}")
+        if any(_collection_changes(obj, 'liked_messages')):
+            yield f"likes:{obj.id}"
+
+    elif isinstance(obj, Message):
+        yield from (f"message:{obj.id}", f"posts:{obj.user_id}")
+        for other in _collection_changes(obj, 'users_liked_message'):
+            yield f"likes:{other.id}"
+
+    elif isinstance(obj, Follow):
+        yield from (f"follows:{obj.user_following_id}",
+                    f"followers:{obj.user_being_followed_id}")
+
+    elif isinstance(obj, Likes):
+        yield f"likes:{obj.user_id}"
+
+
+@event.listens_for(Session, 'after_flush')
+def _note_flushed(session, flush_context):
+    """Note the tags of the objects just flushed, for the commit."""
+
+    # new, dirty and deleted still hold what was flushed, with history.
+    tags = [tag for obj in chain(session.new, session.dirty, session.deleted)
+            for tag in tags_of(obj)]
+    if tags:
+        changed(session, *tags)
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_committed(session):
+    tags = session.info.pop(PENDING_TAGS, None)
+    if tags and has_app_context():
+        cache = current()
+        if cache is not None:
+            cache.invalidate(tags)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _forget_rolled_back(session, previous_transaction):
+    # A savepoint's changes may be few of those pending; invalidating
+    # them anyway at the commit costs misses, not stale pages.
+    if not previous_transaction.nested:
+        session.info.pop(PENDING_TAGS, None)
+
+
+##############################################################################
+# Flask hooks
+
+
+def init_app(app):
+    """Create the app's cache, in memory shared by workers forked later."""
+
+    if not app.config['CACHE_ENABLED']:
+        return
+
+    cache_dir = app.config['CACHE_DIR']
+    app.extensions['cache'] = Cache(
+        l1_size=app.config['CACHE_L1_SIZE'],
+        ttl=app.config['CACHE_TTL'],
+        beta=app.config['CACHE_BETA'],
+        l2=DirectoryCache(cache_dir) if cache_dir else None,
+        versions=TagVersions(app.config['CACHE_TAG_SLOTS']),
+    )
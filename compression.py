@@ -0,0 +1,274 @@
+"""Response compression as WSGI middleware.
+
+Responses are compressed with brotli (when the `brotli` package is
+installed) or gzip, whichever the client prefers, when:
+
+- the content type is one that compresses well (see COMPRESSIBLE_TYPES;
+  images, archives and other already-compressed formats are left alone),
+- the body is at least `min_size` bytes, and
+- the response isn't already encoded, partial, or marked no-transform.
+
+Streamed responses (no Content-Length) are buffered only until `min_size`
+bytes have arrived; from then on each chunk is compressed and flushed as
+it comes, so the client still gets the page progressively.
+
+Bytes in and out and the CPU time spent compressing are counted in a
+`CompressionStats`.
+"""
+
+import threading
+import time
+import zlib
+
+from werkzeug.http import parse_accept_header
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - optional dependency
+    brotli = None
+
+DEFAULT_MIN_SIZE = 500
+DEFAULT_GZIP_LEVEL = 6
+DEFAULT_BROTLI_QUALITY = 4
+
+COMPRESSIBLE_TYPES = frozenset({
+    'application/javascript',
+    'application/json',
+    'application/x-ndjson',
+    'application/xml',
+    'image/svg+xml',
+    'text/css',
+    'text/csv',
+    'text/html',
+    'text/javascript',
+    'text/plain',
+    'text/xml',
+})
+
+
+class CompressionStats:
+    """Counters for the compression middleware, safe to share by threads."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self.compressed = {}
+            self.skipped = 0
+            self.bytes_in = 0
+            self.bytes_out = 0
+            self.cpu_seconds = 0.0
+
+    def record(self, encoding, bytes_in, bytes_out, cpu_seconds):
+        with self._lock:
+            self.compressed[encoding] = self.compressed.get(encoding, 0) + 1
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+            self.cpu_seconds += cpu_seconds
+
+    def record_skip(self):
+        with self._lock:
+            self.skipped += 1
+
+    def snapshot(self):
+        """The counters as a dict, with bytes saved and compression ratio."""
+
+        with self._lock:
+            return dict(
+                compressed=dict(self.compressed),
+                skipped=self.skipped,
+                bytes_in=self.bytes_in,
+                bytes_out=self.bytes_out,
+                bytes_saved=self.bytes_in - self.bytes_out,
+                ratio=(self.bytes_out / self.bytes_in
+                       if self.bytes_in else None),
+                cpu_ms=self.cpu_seconds * 1000,
+            )
+
+
+stats = CompressionStats()
+
+
+def _gzip_compressor(level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return (compressor.compress,
+            lambda: compressor.flush(zlib.Z_SYNC_FLUSH),
+            compressor.flush)
+
+
+def _brotli_compressor(quality):
+    compressor = brotli.Compressor(quality=quality)
+    return compressor.process, compressor.flush, compressor.finish
+
+
+class CompressionMiddleware:
+    """Compress `app`'s responses; see the module docstring."""
+
+    def __init__(self, app, min_size=DEFAULT_MIN_SIZE,
+                 gzip_level=DEFAULT_GZIP_LEVEL,
+                 brotli_quality=DEFAULT_BROTLI_QUALITY,
+                 types=COMPRESSIBLE_TYPES, stats=stats):
+        self.app = app
+        self.min_size = min_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.types = types
+        self.stats = stats
+
+    def choose_encoding(self, accept_encoding):
+        """'br', 'gzip' or None for an Accept-Encoding header value.
+
+        The encoding with the highest q-value wins, brotli on a tie; one
+        with q=0 is never used.
+        """
+
+        if not accept_encoding:
+            return None
+
+        accept = parse_accept_header(accept_encoding)
+        offered = ['br', 'gzip'] if brotli is not None else ['gzip']
+        best = max(offered, key=accept.quality)
+        return best if accept.quality(best) > 0 else None
+
+    def _compressor(self, encoding):
+        if encoding == 'br':
+            return _brotli_compressor(self.brotli_quality)
+        return _gzip_compressor(self.gzip_level)
+
+    def _should_compress(self, status, headers):
+        """Whether headers alone allow compression (size is checked later)."""
+
+        code = int(status.split(None, 1)[0])
+        if code < 200 or code in (204, 206, 304):
+            return False
+
+        found = {name.lower(): value for name, value in headers}
+        if 'content-encoding' in found or 'content-range' in found:
+            return False
+        if 'no-transform' in found.get('cache-control', ''):
+            return False
+
+        content_type = found.get('content-type', '')
+        if content_type.split(';', 1)[0].strip().lower() not in self.types:
+            return False
+
+        length = found.get('content-length')
+        return length is None or int(length) >= self.min_size
+
+    def __call__(self, environ, start_response):
+        encoding = self.choose_encoding(environ.get('HTTP_ACCEPT_ENCODING'))
+        if encoding is None or environ.get('REQUEST_METHOD') == 'HEAD':
+            return self.app(environ, start_response)
+
+        return self._respond(environ, start_response, encoding)
+
+    def _respond(self, environ, start_response, encoding):
+        captured = {}
+
+        def capture(status, headers, exc_info=None):
+            captured.update(status=status, headers=headers)
+            return start_response(status, headers, exc_info) \
+                if exc_info else _no_write
+
+        body = self.app(environ, capture)
+        try:
+            chunks = iter(body)
+            pending = []
+            while 'status' not in captured:
+                pending.append(next(chunks))
+
+            status, headers = captured['status'], captured['headers']
+            if not self._should_compress(status, headers):
+                self.stats.record_skip()
+                start_response(status, headers)
+                yield from pending
+                yield from chunks
+                return
+
+            # Wait for min_size bytes: a short body goes out as it is.
+            size = sum(len(chunk) for chunk in pending)
+            finished = False
+            while size < self.min_size:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    finished = True
+                    break
+                pending.append(chunk)
+                size += len(chunk)
+
+            if finished:
+                self.stats.record_skip()
+                start_response(status, headers)
+                yield from pending
+                return
+
+            start_response(status, _encoded_headers(headers, encoding))
+            yield from self._compress(encoding, pending, chunks)
+
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+
+    def _compress(self, encoding, pending, chunks):
+        compress, flush, finish = self._compressor(encoding)
+        bytes_in = bytes_out = 0
+        cpu = 0.0
+
+        try:
+            for chunk in _chain(pending, chunks):
+                start = time.thread_time()
+                out = compress(chunk) + flush()
+                cpu += time.thread_time() - start
+                bytes_in += len(chunk)
+                bytes_out += len(out)
+                if out:
+                    yield out
+
+            start = time.thread_time()
+            out = finish()
+            cpu += time.thread_time() - start
+            bytes_out += len(out)
+            yield out
+
+        finally:
+            self.stats.record(encoding, bytes_in, bytes_out, cpu)
+
+
+def _chain(pending, chunks):
+    """`pending` then `chunks`, joining `pending` into one chunk."""
+
+    if pending:
+        yield b"".join(pending)
+    for chunk in chunks:
+        if chunk:
+            yield chunk
+
+
+def _encoded_headers(headers, encoding):
+    """`headers` for the compressed body."""
+
+    out = []
+    vary = None
+    for name, value in headers:
+        lower = name.lower()
+        if lower == 'content-length':
+            continue
+        if lower == 'vary':
+            vary = value
+            continue
+        out.append((name, value))
+
+    if vary is None:
+        vary = 'Accept-Encoding'
+    elif 'accept-encoding' not in vary.lower():
+        vary = f"{vary}, Accept-Encoding"
+
+    out.append(('Vary', vary))
+    out.append(('Content-Encoding', encoding))
+    return out
+
+
+def _no_write(data):
+    raise RuntimeError("write() is not supported under compression")
@@ -0,0 +1,159 @@
+"""Account deletion in bounded batches.
+
+Deleting a large account in one transaction means one huge statement per
+table (plus the ORM loading every relationship to cascade) and locks held
+for the whole time. Instead:
+
+1. `tombstone_user()` sets `users.deleted_at`. From then on the user and
+   their messages are left out of every ORM query (see
+   `models.hide_deleted_users`), so they vanish at once.
+2. `purge_user()`, run from the job queue, deletes the user's follows,
+   likes, likes on their messages, recommendations, mentions of them, the
+   tags and mentions in their messages, and their messages, a batch
+   at a time with a commit after each batch, then the same from every
+   shard (see sharding.py), then the user row itself.
+
+Progress is recorded in the `deletions` table. If a purge is interrupted
+it picks up at the phase it was in; every phase only deletes rows that
+are still there, so repeating part of one is harmless.
+"""
+
+from datetime import datetime
+
+from sqlalchemy import delete, or_, select, tuple_, update
+
+import cache
+import jobs
+import sharding
+from models import (
+    Deletion, Follow, Likes, Mention, Message, MessageTag, Recommendation,
+    User)
+
+DEFAULT_BATCH_SIZE = 1_000
+
+follows = Follow.__table__
+likes = Likes.__table__
+mentions = Mention.__table__
+message_tags = MessageTag.__table__
+messages = Message.__table__
+recommendations = Recommendation.__table__
+users = User.__table__
+
+
+def _phases(user_id):
+    """(name, table, key columns, condition) for each purge phase, in order."""
+
+    return [
+        ('follows_out', follows,
+         [follows.c.user_being_followed_id, follows.c.user_following_id],
+         follows.c.user_following_id == user_id),
+        ('follows_in', follows,
+         [follows.c.user_being_followed_id, follows.c.user_following_id],
+         follows.c.user_being_followed_id == user_id),
+        ('likes', likes,
+         [likes.c.user_id, likes.c.message_id],
+         likes.c.user_id == user_id),
+        ('likes_on_messages', likes,
+         [likes.c.user_id, likes.c.message_id],
+         likes.c.message_id.in_(
+             select(messages.c.id).where(messages.c.user_id == user_id))),
+        ('recommendations', recommendations,
+         [recommendations.c.user_id, recommendations.c.rank],
+         or_(recommendations.c.user_id == user_id,
+             recommendations.c.recommended_user_id == user_id)),
+        ('mentions', mentions,
+         [mentions.c.user_id, mentions.c.message_id],
+         mentions.c.user_id == user_id),
+        ('tags_in_messages', message_tags,
+         [message_tags.c.tag, message_tags.c.message_id],
+         message_tags.c.message_id.in_(
+             select(messages.c.id).where(messages.c.user_id == user_id))),
+        ('mentions_in_messages', mentions,
+         [mentions.c.user_id, mentions.c.message_id],
+         mentions.c.message_id.in_(
+             select(messages.c.id).where(messages.c.user_id == user_id))),
+        ('messages', messages,
+         [messages.c.id],
+         messages.c.user_id == user_id),
+    ]
+
+
+PHASE_NAMES = [name for name, *_ in _phases(0)] + ['shards', 'user', 'done']
+
+
+def tombstone_user(session, user_id):
+    """Hide `user_id` everywhere now and queue the purge of their rows.
+
+    The caller commits.
+    """
+
+    session.execute(
+        update(users)
+        .where(users.c.id == user_id)
+        .values(deleted_at=datetime.utcnow()))
+    cache.changed(session, f"user:{user_id}")
+
+    jobs.enqueue(
+        session,
+        'delete_user',
+        {'user_id': user_id},
+        idempotency_key=f"delete_user:{user_id}",
+    )
+
+
+def _delete_batches(session, table, key_columns, condition, batch_size,
+                    progress):
+    """Delete rows matching `condition`, `batch_size` at a time."""
+
+    while True:
+        keys = session.execute(
+            select(*key_columns).where(condition).limit(batch_size)).all()
+        if not keys:
+            return
+
+        if len(key_columns) == 1:
+            in_batch = key_columns[0].in_([key for key, in keys])
+        else:
+            in_batch = tuple_(*key_columns).in_(keys)
+
+        result = session.execute(delete(table).where(in_batch))
+        progress.rows_deleted += result.rowcount
+        session.commit()
+
+
+def purge_user(session, user_id, batch_size=DEFAULT_BATCH_SIZE):
+    """Delete everything belonging to `user_id`, then the user.
+
+    Returns the `Deletion` progress record.
+    """
+
+    progress = session.get(Deletion, user_id)
+    if progress is None:
+        progress = Deletion(user_id=user_id, phase=PHASE_NAMES[0])
+        session.add(progress)
+        session.commit()
+
+    for name, table, key_columns, condition in _phases(user_id):
+        if PHASE_NAMES.index(progress.phase) > PHASE_NAMES.index(name):
+            continue
+
+        progress.phase = name
+        session.commit()
+        _delete_batches(session, table, key_columns, condition, batch_size,
+                        progress)
+
+    if PHASE_NAMES.index(progress.phase) <= PHASE_NAMES.index('shards'):
+        progress.phase = 'shards'
+        session.commit()
+        progress.rows_deleted += sharding.current().purge_user(
+            session, user_id, batch_size)
+
+    if progress.phase != 'done':
+        progress.phase = 'user'
+        result = session.execute(delete(users).where(users.c.id == user_id))
+        progress.rows_deleted += result.rowcount
+        progress.phase = 'done'
+        progress.finished_at = datetime.utcnow()
+        session.commit()
+
+    return progress
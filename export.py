@@ -0,0 +1,277 @@
+"""Personal data export: a ZIP of everything in a user's account.
+
+The archive holds:
+
+- profile.json: the user row, less the password hash
+- messages.ndjson: {"id", "timestamp", "text"} per message, oldest first,
+  archived months (archive.py) before the database's
+- likes.ndjson: {"message_id", "timestamp"} per like, the same way
+- following.csv, followers.csv: user_id,username
+
+It is built as it's sent. Rows are read CHUNK_SIZE at a time through
+server-side cursors (`ShardSet.stream()`), written into the ZIP as they
+come, and the compressed bytes handed on whenever BUFFER_SIZE have piled
+up. ZIP entries carry their sizes after the data (zipfile does this when
+it can't seek back), so nothing needs the whole file: memory stays flat
+however big the account is.
+
+GET /users/export streams the ZIP straight to the browser. POST asks for
+the `export_user` job to write it to EXPORT_DIR instead, and
+/users/export/download then serves that file with Range support, so a
+download that breaks off can pick up where it stopped. The web and
+worker processes must share EXPORT_DIR, which is created readable by its
+owner only. A prepared export is deleted once it is EXPORT_EXPIRE_SECONDS
+old (by the `expire_export` job, or when next looked for), and when the
+account is purged.
+"""
+
+import csv
+import io
+import json
+import os
+import time
+import unicodedata
+import zipfile
+from urllib.parse import quote
+
+from sqlalchemy import select
+
+import sharding
+from models import Follow, Likes, Message, User
+
+CHUNK_SIZE = 1_000
+BUFFER_SIZE = 64 * 1024
+DEFAULT_EXPIRE_SECONDS = 7 * 24 * 60 * 60
+
+follows = Follow.__table__
+likes = Likes.__table__
+messages = Message.__table__
+users = User.__table__
+
+PROFILE_COLUMNS = ['id', 'username', 'email', 'image_url',
+                   'header_image_url', 'bio', 'location']
+
+
+def export_path(directory, user_id):
+    return os.path.join(directory, f"export-{user_id}.zip")
+
+
+def remove(directory, user_id):
+    """Delete `user_id`'s prepared export, if there is one."""
+
+    path = export_path(directory, user_id)
+    for name in (path, path + ".tmp"):
+        try:
+            os.remove(name)
+        except FileNotFoundError:
+            pass
+
+
+def expire(directory, user_id, expire_seconds):
+    """Delete `user_id`'s export if it's `expire_seconds` old.
+
+    Returns whether it did.
+    """
+
+    try:
+        age = time.time() - os.path.getmtime(export_path(directory, user_id))
+    except FileNotFoundError:
+        return False
+
+    if age < expire_seconds:
+        return False
+    remove(directory, user_id)
+    return True
+
+
+def prepared(directory, user_id, expire_seconds):
+    """The path of `user_id`'s unexpired export, or None."""
+
+    expire(directory, user_id, expire_seconds)
+    path = export_path(directory, user_id)
+    return path if os.path.exists(path) else None
+
+
+def download_name(username):
+    return f"warbler-{username}.zip"
+
+
+def filenames(name):
+    """Content-Disposition parameters for a download called `name`.
+
+    As send_file() sets them: `filename`, plus an RFC 5987 `filename*`
+    with an ASCII fallback in `filename` when `name` isn't ASCII.
+    """
+
+    try:
+        name.encode('ascii')
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize('NFKD', name)
+        simple = simple.encode('ascii', 'ignore').decode('ascii')
+        # safe = RFC 5987 attr-char
+        quoted = quote(name, safe="!#$&+-.^_`|~")
+        return {'filename': simple, 'filename*': f"UTF-8''{quoted}"}
+    return {'filename': name}
+
+
+class _Sink:
+    """A write-only file that collects what's written until taken."""
+
+    def __init__(self):
+        self._pending = []
+        self.size = 0
+
+    def write(self, data):
+        self._pending.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b"".join(self._pending)
+        self._pending = []
+        self.size = 0
+        return data
+
+
+def _ndjson(chunks, fields):
+    for rows in chunks:
+        yield "".join(
+            json.dumps(dict(zip(fields, row)), default=str) + "\n"
+            for row in rows).encode()
+
+
+def _csv(chunks, header):
+    text = io.StringIO()
+    writer = csv.writer(text)
+    writer.writerow(header)
+    for rows in chunks:
+        writer.writerows(rows)
+        yield text.getvalue().encode()
+        text.seek(0)
+        text.truncate()
+    yield text.getvalue().encode()
+
+
+def _in_chunks(rows, chunk_size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _with_usernames(session, id_chunks):
+    """(user_id, username) for each chunk of user ids, live users only."""
+
+    for ids in id_chunks:
+        names = dict(session.execute(
+            select(users.c.id, users.c.username)
+            .where(users.c.id.in_([id for id, in ids]))
+            .where(users.c.deleted_at.is_(None))).all())
+        yield [(id, names[id]) for id, in ids if id in names]
+
+
+def _files(session, user_id, archive, chunk_size):
+    """(name, chunks of bytes) for each file in `user_id`'s export."""
+
+    shards = sharding.current()
+    owner = shards.shard_for(session, user_id)
+
+    profile = session.execute(
+        select(*(users.c[name] for name in PROFILE_COLUMNS))
+        .where(users.c.id == user_id)).one()
+    yield 'profile.json', [
+        json.dumps(dict(profile._mapping), indent=2).encode()]
+
+    def message_rows():
+        if archive is not None:
+            yield from _in_chunks(
+                archive.user_message_rows(user_id), chunk_size)
+        yield from shards.stream(
+            session, owner,
+            select(messages.c.id, messages.c.timestamp, messages.c.text)
+            .where(messages.c.user_id == user_id)
+            .order_by(messages.c.id),
+            chunk_size)
+
+    def like_rows():
+        if archive is not None:
+            yield from _in_chunks(archive.user_like_rows(user_id), chunk_size)
+        yield from shards.stream(
+            session, owner,
+            select(likes.c.message_id, likes.c.timestamp)
+            .where(likes.c.user_id == user_id)
+            .order_by(likes.c.message_id),
+            chunk_size)
+
+    yield 'messages.ndjson', _ndjson(
+        message_rows(), ['id', 'timestamp', 'text'])
+    yield 'likes.ndjson', _ndjson(like_rows(), ['message_id', 'timestamp'])
+
+    # Follows live on the follower's shard: the followers are everywhere.
+    following = shards.stream(
+        session, owner,
+        select(follows.c.user_being_followed_id)
+        .where(follows.c.user_following_id == user_id)
+        .order_by(follows.c.user_being_followed_id),
+        chunk_size)
+    yield 'following.csv', _csv(
+        _with_usernames(session, following), ['user_id', 'username'])
+
+    followers = (
+        rows
+        for shard in range(len(shards))
+        for rows in shards.stream(
+            session, shard,
+            select(follows.c.user_following_id)
+            .where(follows.c.user_being_followed_id == user_id)
+            .order_by(follows.c.user_following_id),
+            chunk_size))
+    yield 'followers.csv', _csv(
+        _with_usernames(session, followers), ['user_id', 'username'])
+
+
+def stream(session, user_id, archive=None, chunk_size=CHUNK_SIZE):
+    """Yield `user_id`'s export ZIP, a piece of about BUFFER_SIZE at a time.
+
+    `archive` is the app's MessageArchive, if messages are archived.
+    """
+
+    sink = _Sink()
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        for name, chunks in _files(session, user_id, archive, chunk_size):
+            with zip_file.open(name, 'w', force_zip64=True) as entry:
+                for data in chunks:
+                    entry.write(data)
+                    if sink.size >= BUFFER_SIZE:
+                        yield sink.take()
+    yield sink.take()
+
+
+def write(session, user_id, directory, archive=None):
+    """Write `user_id`'s export to its file in `directory`. Returns the path.
+
+    Written under a temporary name, so a download never sees half a file.
+    """
+
+    # Exports are personal data, and the default directory is under the
+    # shared temporary directory.
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    os.chmod(directory, 0o700)
+    path = export_path(directory, user_id)
+    temp_path = path + ".tmp"
+
+    with open(temp_path, 'wb') as file:
+        for data in stream(session, user_id, archive):
+            file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, path)
+
+    return path
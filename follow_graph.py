@@ -0,0 +1,427 @@
+"""In-memory follow graph for Warbler.
+
+The `follows` table is loaded into two compressed sparse row (CSR)
+structures -- one keyed by follower ("following" lists), one keyed by the
+followed user ("followers" lists). Each structure is a pair of flat numpy
+arrays: an offsets array indexed by user id and a neighbors array holding
+every row back to back, sorted ascending. That costs 4 bytes per edge per
+direction, plus 8 bytes per user id for the offsets. Building them is a
+few vectorised passes (a count, a cumulative sum and a stable sort).
+
+Follows and unfollows made after the snapshot is built are kept in small
+per-user overlays. `FollowGraphCache` folds them back into fresh CSR
+arrays on a background thread once there are COMPACT_THRESHOLD of them,
+and reloads the graph from the database there every `max_age` seconds;
+requests never wait for either.
+"""
+
+import logging
+import threading
+import time
+from functools import partial
+from itertools import chain
+
+import numpy as np
+from flask import current_app
+
+from models import db, Follow
+
+logger = logging.getLogger(__name__)
+
+# 4-byte signed ints for user ids (matches Integer columns), 8-byte signed
+# ints for offsets so edge counts can pass 2**31.
+ID_DTYPE = np.int32
+OFFSET_DTYPE = np.int64
+
+# Fold overlays back into the CSR arrays once this many edges are pending.
+COMPACT_THRESHOLD = 10_000
+
+
+def intersect_sorted(a, b):
+    """Return the sorted intersection of two ascending sequences.
+
+    A linear merge: O(len(a) + len(b)).
+    """
+
+    result = []
+    i = j = 0
+    len_a, len_b = len(a), len(b)
+
+    while i < len_a and j < len_b:
+        x, y = a[i], b[j]
+        if x == y:
+            result.append(x)
+            i += 1
+            j += 1
+        elif x < y:
+            i += 1
+        else:
+            j += 1
+
+    return result
+
+
+def _build_csr(keys, values, size, presorted=False):
+    """Build (offsets, neighbors) arrays from parallel key/value arrays.
+
+    Rows come out sorted. Pass `presorted` if the input is already ordered
+    by key, then value, to skip sorting it.
+    """
+
+    offsets = np.zeros(size + 1, dtype=OFFSET_DTYPE)
+    np.cumsum(np.bincount(keys, minlength=size), out=offsets[1:])
+    if presorted:
+        neighbors = np.array(values, dtype=ID_DTYPE)
+    else:
+        # One sort on key << 32 | value orders rows and their contents.
+        pairs = np.sort((keys.astype(np.int64) << 32) | values)
+        neighbors = (pairs & 0xFFFFFFFF).astype(ID_DTYPE)
+    return offsets, neighbors
+
+
+def _pairs(overlay):
+    """{key: set of values} as sorted int64 keys (key << 32 | value)."""
+
+    pairs = np.fromiter(
+        ((key << 32) | value
+         for key, values in overlay.items() for value in values),
+        dtype=np.int64)
+    pairs.sort()
+    return pairs
+
+
+class _Adjacency:
+    """One direction of the graph: a CSR snapshot plus pending changes."""
+
+    def __init__(self, offsets, neighbors):
+        self.offsets = offsets
+        self.neighbors = neighbors
+        self.added = {}
+        self.removed = {}
+        self.pending = 0
+
+    def _base_row(self, user_id):
+        if user_id < 0 or user_id + 1 >= len(self.offsets):
+            return self.neighbors[0:0]
+        start, end = self.offsets[user_id], self.offsets[user_id + 1]
+        return self.neighbors[start:end]
+
+    def row(self, user_id):
+        """Sorted neighbors of `user_id`, including pending changes."""
+
+        base = self._base_row(user_id)
+        added = self.added.get(user_id)
+        removed = self.removed.get(user_id)
+
+        if not added and not removed:
+            return base
+
+        merged = set(base.tolist())
+        if removed:
+            merged -= removed
+        if added:
+            merged |= added
+        return np.array(sorted(merged), dtype=ID_DTYPE)
+
+    def contains(self, user_id, other_id):
+        if other_id in self.added.get(user_id, ()):
+            return True
+        if other_id in self.removed.get(user_id, ()):
+            return False
+        base = self._base_row(user_id)
+        i = np.searchsorted(base, other_id)
+        return bool(i < len(base) and base[i] == other_id)
+
+    def add(self, user_id, other_id):
+        self.removed.get(user_id, set()).discard(other_id)
+        if not self.contains(user_id, other_id):
+            self.added.setdefault(user_id, set()).add(other_id)
+            self.pending += 1
+
+    def remove(self, user_id, other_id):
+        self.added.get(user_id, set()).discard(other_id)
+        if self.contains(user_id, other_id):
+            self.removed.setdefault(user_id, set()).add(other_id)
+            self.pending += 1
+
+    def nbytes(self):
+        return self.offsets.nbytes + self.neighbors.nbytes
+
+
+class FollowGraph:
+    """Snapshot of who-follows-whom, answering set queries in O(degree)."""
+
+    def __init__(self, followers=(), followed=()):
+        """Build from parallel sequences of follower and followed user ids.
+
+        Edges are sorted first, so any input order is accepted.
+        """
+
+        followers = np.asarray(followers, dtype=ID_DTYPE)
+        followed = np.asarray(followed, dtype=ID_DTYPE)
+        order = np.lexsort((followers, followed))
+        self._build(followers[order], followed[order])
+
+    def _build(self, followers, followed):
+        """Build both directions from edges ordered by (followed, follower)."""
+
+        size = max(followers.max(initial=-1), followed.max(initial=-1)) + 1
+
+        # Rows keyed by followed user are the input as it stands.
+        self._in = _Adjacency(
+            *_build_csr(followed, followers, size, presorted=True))
+        self._out = _Adjacency(*_build_csr(followers, followed, size))
+        self.num_edges = len(followers)
+        self.built_at = time.monotonic()
+
+    @classmethod
+    def from_sorted_edges(cls, edges):
+        """Build from (followed, follower) pairs already in that order.
+
+        This is the order of the `follows` primary key, so rows can stream
+        straight from an index scan without sorting.
+        """
+
+        graph = cls.__new__(cls)
+        edges = np.fromiter(chain.from_iterable(edges), dtype=ID_DTYPE)
+        graph._build(edges[1::2], edges[0::2])
+        return graph
+
+    @classmethod
+    def from_db(cls, session):
+        """Load the whole `follows` table using `session`."""
+
+        rows = (session
+                .query(Follow.user_being_followed_id, Follow.user_following_id)
+                .order_by(Follow.user_being_followed_id,
+                          Follow.user_following_id)
+                .yield_per(10_000))
+        return cls.from_sorted_edges(rows)
+
+    ##########################################################################
+    # Queries
+
+    def following(self, user_id):
+        """Sorted ids of users that `user_id` follows."""
+
+        return self._out.row(user_id)
+
+    def followers(self, user_id):
+        """Sorted ids of users following `user_id`."""
+
+        return self._in.row(user_id)
+
+    def is_following(self, user_id, other_id):
+        """Does `user_id` follow `other_id`?"""
+
+        return self._out.contains(user_id, other_id)
+
+    def mutual_follows(self, user_id):
+        """Users that `user_id` follows and who follow them back."""
+
+        return np.intersect1d(self.following(user_id),
+                              self.followers(user_id),
+                              assume_unique=True).tolist()
+
+    def followers_you_know(self, viewer_id, user_id):
+        """Followers of `user_id` that `viewer_id` follows."""
+
+        return np.intersect1d(self.following(viewer_id),
+                              self.followers(user_id),
+                              assume_unique=True).tolist()
+
+    def suggestions(self, user_id, limit=10):
+        """Suggest users to follow, ranked by number of shared connections.
+
+        Counts friends-of-friends: users followed by the people `user_id`
+        follows, skipping `user_id` and anyone they already follow. Returns
+        up to `limit` (user_id, score) pairs, highest score first, ties
+        broken by lower user id.
+        """
+
+        following = self.following(user_id)
+        if not len(following):
+            return []
+
+        candidates, counts = np.unique(
+            np.concatenate([self.following(friend_id)
+                            for friend_id in following.tolist()]),
+            return_counts=True)
+
+        keep = ~np.isin(candidates, following) & (candidates != user_id)
+        candidates, counts = candidates[keep], counts[keep]
+        top = np.lexsort((candidates, -counts))[:limit]
+        return list(zip(candidates[top].tolist(), counts[top].tolist()))
+
+    ##########################################################################
+    # Updates
+
+    def add_follow(self, follower_id, followed_id):
+        """Record that `follower_id` started following `followed_id`."""
+
+        self._out.add(follower_id, followed_id)
+        self._in.add(followed_id, follower_id)
+
+    def remove_follow(self, follower_id, followed_id):
+        """Record that `follower_id` stopped following `followed_id`."""
+
+        self._out.remove(follower_id, followed_id)
+        self._in.remove(followed_id, follower_id)
+
+    @property
+    def pending(self):
+        """Changes not yet folded into the CSR arrays."""
+
+        return self._out.pending
+
+    def compactor(self):
+        """A function returning this graph with pending changes folded in.
+
+        The pending changes are copied now. The function only reads those
+        copies and the CSR arrays, which never change in place, so it can
+        run on another thread while this graph takes more changes.
+        """
+
+        offsets, neighbors = self._in.offsets, self._in.neighbors
+        added, removed = _pairs(self._in.added), _pairs(self._in.removed)
+        built_at = self.built_at
+
+        def compacted():
+            # Every edge as followed << 32 | follower, in that order.
+            followed = np.repeat(
+                np.arange(len(offsets) - 1, dtype=np.int64), np.diff(offsets))
+            edges = (followed << 32) | neighbors.astype(np.int64)
+            if len(removed):
+                edges = edges[~np.isin(edges, removed)]
+            # Nearly sorted already, which a stable sort (timsort) is fast on.
+            edges = np.concatenate([edges, added])
+            edges.sort(kind='stable')
+            edges = edges[np.concatenate([[True], edges[1:] != edges[:-1]])]
+
+            graph = FollowGraph.__new__(FollowGraph)
+            graph._build((edges & 0xFFFFFFFF).astype(ID_DTYPE),
+                         (edges >> 32).astype(ID_DTYPE))
+            # Still only as fresh as the database load it came from.
+            graph.built_at = built_at
+            return graph
+
+        return compacted
+
+    def compact(self):
+        """Fold pending changes into fresh CSR arrays."""
+
+        graph = self.compactor()()
+        self._in, self._out = graph._in, graph._out
+        self.num_edges = graph.num_edges
+
+    def nbytes(self):
+        """Approximate memory held by the CSR arrays, in bytes."""
+
+        return self._in.nbytes() + self._out.nbytes()
+
+
+class FollowGraphCache:
+    """Process-wide, lazily loaded follow graph.
+
+    Each worker process keeps its own copy and applies its own follows and
+    unfollows incrementally. Changes made by other workers show up when the
+    snapshot is reloaded, at most `max_age` seconds after it was loaded.
+
+    Only the first load happens in a request. Reloads and compactions run
+    on a background thread while requests keep using the current graph;
+    changes made meanwhile are replayed onto the new one before it
+    replaces it.
+    """
+
+    def __init__(self, max_age=300):
+        self.max_age = max_age
+        self._graph = None
+        self._lock = threading.Lock()
+        # Changes made while a new graph is built, or None if none is.
+        self._replay = None
+
+    def get(self, session):
+        """Return the current graph, loading it from `session` the first
+        time and starting a reload in the background if it is stale."""
+
+        graph = self._graph
+        if graph is None:
+            with self._lock:
+                if self._graph is None:
+                    self._graph = FollowGraph.from_db(session)
+                return self._graph
+
+        if time.monotonic() - graph.built_at > self.max_age:
+            app = current_app._get_current_object()
+            self._rebuild(lambda: partial(self._load, app))
+        return graph
+
+    @staticmethod
+    def _load(app):
+        with app.app_context():
+            try:
+                return FollowGraph.from_db(db.session)
+            finally:
+                db.session.remove()
+
+    def _rebuild(self, prepare):
+        """Build a new graph on a background thread, if none is building.
+
+        `prepare()` runs with the lock held and returns the function that
+        builds the graph.
+        """
+
+        with self._lock:
+            if self._replay is not None or self._graph is None:
+                return
+            self._replay = []
+            build = prepare()
+
+        def run():
+            try:
+                graph = build()
+            except Exception:
+                logger.exception("Rebuilding the follow graph failed")
+                graph = None
+
+            with self._lock:
+                if graph is not None and self._graph is not None:
+                    for change, follower_id, followed_id in self._replay:
+                        getattr(graph, change)(follower_id, followed_id)
+                    self._graph = graph
+                self._replay = None
+
+        threading.Thread(target=run, name='follow-graph', daemon=True).start()
+
+    def _change(self, change, follower_id, followed_id):
+        with self._lock:
+            graph = self._graph
+            if graph is None:
+                return
+            getattr(graph, change)(follower_id, followed_id)
+            if self._replay is not None:
+                self._replay.append((change, follower_id, followed_id))
+
+        if graph.pending >= COMPACT_THRESHOLD:
+            self._rebuild(lambda: self._graph.compactor())
+
+    def add_follow(self, follower_id, followed_id):
+        self._change('add_follow', follower_id, followed_id)
+
+    def remove_follow(self, follower_id, followed_id):
+        self._change('remove_follow', follower_id, followed_id)
+
+    def wait(self):
+        """Wait for a background rebuild to finish. For tests."""
+
+        while self._replay is not None:
+            time.sleep(0.001)
+
+    def clear(self):
+        """Drop the snapshot; the next `get()` reloads it."""
+
+        with self._lock:
+            self._graph = None
+
+
+follow_graph = FollowGraphCache()
@@ -1,7 +1,12 @@
+from flask import request
 from flask_wtf import FlaskForm
+from flask_wtf.file import FileAllowed, FileField, FileRequired
 from wtforms import StringField, PasswordField, TextAreaField
 from wtforms.validators import InputRequired, Email, Length, URL, Optional
 
+# Methods Flask-WTF treats as form submissions.
+SUBMIT_METHODS = {"POST", "PUT", "PATCH", "DELETE"}
+
 
 class MessageForm(FlaskForm):
     """Form for adding/editing messages."""
@@ -9,6 +14,15 @@ class MessageForm(FlaskForm):
     text = TextAreaField('text', validators=[InputRequired()])
 
 
+class MessageImportForm(FlaskForm):
+    """Form for importing messages from an NDJSON or CSV file."""
+
+    file = FileField('file', validators=[
+        FileRequired(),
+        FileAllowed(['ndjson', 'jsonl', 'csv'], "NDJSON or CSV files only"),
+    ])
+
+
 class UserAddForm(FlaskForm):
     """Form for adding users."""
 
@@ -49,6 +63,38 @@ class LoginForm(FlaskForm):
 class CsrfForm(FlaskForm):
     """For actions where we want CSRF protection, but don't need any fields."""
 
+
+class LazyCsrfForm:
+    """Per-request stand-in for CsrfForm that does no work until needed.
+
+    The form (and its token) is only built the first time a template asks
+    for the hidden field or a route validates a submission; the rendered
+    hidden field is cached, so pages with a form on every row generate and
+    render the token once. Requests that aren't submissions (GET, HEAD,
+    OPTIONS) never build the form to validate it.
+    """
+
+    def __init__(self):
+        self._form = None
+        self._hidden_tag = None
+
+    @property
+    def form(self):
+        if self._form is None:
+            self._form = CsrfForm()
+        return self._form
+
+    def hidden_tag(self):
+        if self._hidden_tag is None:
+            self._hidden_tag = self.form.hidden_tag()
+        return self._hidden_tag
+
+    def validate_on_submit(self):
+        if request.method not in SUBMIT_METHODS:
+            return False
+        return self.form.validate_on_submit()
+
+
 class ProfileEditForm(UserAddForm):
     """For editing the user profile of the signed in user"""
 
@@ -0,0 +1,55 @@
+"""Gunicorn settings for Warbler.
+
+run like:
+
+    gunicorn "app:create_app()"
+
+The app is created (and its templates compiled) once in the master, then
+forked into the workers.
+"""
+
+preload_app = True
+
+
+def pre_fork(server, worker):
+    """Give the new worker the lowest snowflake slot no live worker holds."""
+
+    taken = {getattr(live, 'snowflake_slot', None)
+             for live in server.WORKERS.values()}
+    slot = 0
+    while slot in taken:
+        slot += 1
+    worker.snowflake_slot = slot
+
+
+def post_fork(server, worker):
+    """Set up a freshly forked worker.
+
+    Its message ids get their own worker id: the slot from pre_fork,
+    offset by SNOWFLAKE_WORKER_BASE, which must stay below
+    snowflake.PID_WORKER_BASE.
+
+    Database connections inherited from the master are dropped. Creating
+    the app does not connect, but anything the master ran against the
+    database would otherwise leave pooled connections shared between
+    processes. Each worker opens its own on first use.
+    """
+
+    import os
+
+    import snowflake
+    from models import db
+
+    base = int(os.environ.get('SNOWFLAKE_WORKER_BASE', 0))
+    worker_id = base + worker.snowflake_slot
+    if worker_id >= snowflake.PID_WORKER_BASE:
+        # Those are for pid-derived ids: sharing one risks duplicates.
+        raise ValueError(
+            f"snowflake worker id {worker_id} must be below "
+            f"{snowflake.PID_WORKER_BASE}")
+    snowflake.generator.set_worker_id(worker_id)
+
+    app = server.app.wsgi()
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
@@ -0,0 +1,146 @@
+"""Move existing messages from autoincrement ids to snowflake ids.
+
+Databases created before message ids were snowflakes (see snowflake.py)
+have small sequential ids. `migrate_message_ids()` gives every such
+message a snowflake made from its timestamp, oldest first, and rewrites
+the likes, tags, mentions and notifications that point at it, so ORDER
+BY id is chronological for old messages as well as new ones.
+
+Messages dated before EPOCH_MS (plus the few minutes whose ids would
+still be below MIN_SNOWFLAKE) get ids as if written at the first moment
+that isn't, in timestamp order, so they still sort first and chronologically.
+
+On Postgres it also widens messages.id and likes.message_id to BIGINT and
+drops the old id sequence. It runs in a single transaction; stop the app
+while it runs.
+"""
+
+from datetime import datetime, timedelta
+
+from sqlalchemy import (
+    String, bindparam, cast, delete, func, insert, select, update)
+
+from models import Likes, Mention, Message, MessageTag, Notification
+from partitions import (
+    add_foreign_keys, drop_foreign_keys, message_foreign_keys)
+from snowflake import EPOCH_MS, MIN_SNOWFLAKE, MIN_SNOWFLAKE_MS, BackfillIds
+
+DEFAULT_BATCH_SIZE = 10_000
+
+likes = Likes.__table__
+mentions = Mention.__table__
+message_tags = MessageTag.__table__
+messages = Message.__table__
+notifications = Notification.__table__
+
+# Timestamps before this are renumbered as if made at it.
+EARLIEST = datetime.utcfromtimestamp(
+    EPOCH_MS / 1000) + timedelta(milliseconds=MIN_SNOWFLAKE_MS)
+
+
+def _widen_postgres(conn):
+    """Drop the foreign keys to messages.id and widen the ids.
+
+    Returns the foreign keys, for `_restore_postgres`.
+    """
+
+    foreign_keys = message_foreign_keys(conn)
+    drop_foreign_keys(conn, foreign_keys)
+
+    id_type = conn.exec_driver_sql(
+        "SELECT data_type FROM information_schema.columns "
+        "WHERE table_name = 'messages' AND column_name = 'id'").scalar()
+    # Already BIGINT if created since; a partitioned table's can't change.
+    if id_type != 'bigint':
+        conn.exec_driver_sql(
+            "ALTER TABLE messages ALTER COLUMN id DROP DEFAULT")
+        conn.exec_driver_sql(
+            "ALTER TABLE messages ALTER COLUMN id TYPE BIGINT")
+        conn.exec_driver_sql(
+            "ALTER TABLE likes ALTER COLUMN message_id TYPE BIGINT")
+    conn.exec_driver_sql("DROP SEQUENCE IF EXISTS messages_id_seq")
+    conn.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_messages_user_id_id "
+        "ON messages (user_id, id)")
+    return foreign_keys
+
+
+def _restore_postgres(conn, foreign_keys):
+    add_foreign_keys(conn, foreign_keys)
+
+
+def migrate_message_ids(session, batch_size=DEFAULT_BATCH_SIZE):
+    """Renumber pre-snowflake messages. Returns how many were renumbered.
+
+    Safe to run again: messages that already have snowflake ids are left
+    alone.
+    """
+
+    conn = session.connection()
+    dialect = conn.dialect.name
+
+    # Only ids up to the newest old one are renumbered: a new id is never
+    # mistaken for an old one, so the loop below always ends.
+    newest = conn.execute(
+        select(func.max(messages.c.id))
+        .where(messages.c.id < MIN_SNOWFLAKE)).scalar()
+    if newest is None:
+        return 0
+
+    if dialect == 'postgresql':
+        foreign_keys = _widen_postgres(conn)
+
+    make_id = BackfillIds()
+    renumbered = 0
+
+    # Each message is copied to its new id, the rows pointing at it moved
+    # over, and the old row deleted, so foreign keys hold at every step.
+    others = [col for col in messages.c if col.key != 'id']
+    copy_messages = insert(messages).from_select(
+        ['id', *(col.key for col in others)],
+        select(bindparam('new_id', type_=messages.c.id.type), *others)
+        .where(messages.c.id == bindparam('old_id')))
+    move_likes = (update(likes)
+                  .where(likes.c.message_id == bindparam('old_id'))
+                  .values(message_id=bindparam('new_id')))
+    move_tags = (update(message_tags)
+                 .where(message_tags.c.message_id == bindparam('old_id'))
+                 .values(message_id=bindparam('new_id')))
+    move_mentions = (update(mentions)
+                     .where(mentions.c.message_id == bindparam('old_id'))
+                     .values(message_id=bindparam('new_id')))
+    # The group key names the message too ("like:<id>"; see notifications).
+    move_notifications = (
+        update(notifications)
+        .where(notifications.c.message_id == bindparam('old_id'))
+        .values(message_id=bindparam('new_id'),
+                group_key=notifications.c.kind + ':' +
+                cast(bindparam('new_id'), String)))
+    delete_messages = delete(messages).where(
+        messages.c.id == bindparam('old_id'))
+
+    while True:
+        # Renumbered messages drop out of this query, so each batch picks
+        # up where the last left off.
+        batch = conn.execute(
+            select(messages.c.id, messages.c.timestamp)
+            .where(messages.c.id <= newest)
+            .order_by(messages.c.timestamp, messages.c.id)
+            .limit(batch_size)).all()
+        if not batch:
+            break
+
+        ids = [dict(old_id=old_id, new_id=make_id(max(timestamp, EARLIEST)))
+               for old_id, timestamp in batch]
+        conn.execute(copy_messages, ids)
+        for move in (move_likes, move_tags, move_mentions,
+                     move_notifications):
+            conn.execute(move, ids)
+        conn.execute(delete_messages, ids)
+        renumbered += len(ids)
+
+    if dialect == 'postgresql':
+        _restore_postgres(conn, foreign_keys)
+
+    session.commit()
+    return renumbered
@@ -0,0 +1,191 @@
+"""Background job queue stored in the application database.
+
+Routes call `enqueue()` to record work in the `jobs` table and return
+straight away; a worker process (`flask worker`) claims jobs and runs the
+handler registered for each job's kind.
+
+On Postgres, workers claim jobs with SELECT ... FOR UPDATE SKIP LOCKED, so
+any number of workers can poll the same table. SQLite has no row locks, so
+there jobs are claimed without locking and only one worker should run.
+
+Failed jobs are retried with exponential backoff up to `max_attempts`
+times. Each job records when it started and finished and how long it ran.
+"""
+
+import logging
+import time
+import traceback
+from datetime import datetime, timedelta
+
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+
+from models import Job
+
+logger = logging.getLogger(__name__)
+
+# Jobs left 'running' this long (a worker died mid-job) are claimed again.
+STALE_AFTER = timedelta(minutes=15)
+
+RETRY_BASE_SECONDS = 2
+
+handlers = {}
+
+
+def job_handler(kind):
+    """Register the decorated function as the handler for `kind` jobs.
+
+    Handlers are called as handler(session, **payload) and should commit
+    their own work. They must be safe to run more than once.
+    """
+
+    def register(fn):
+        handlers[kind] = fn
+        return fn
+
+    return register
+
+
+def enqueue(session, kind, payload=None, idempotency_key=None,
+            max_attempts=5, run_at=None):
+    """Queue a `kind` job with `payload` and return it.
+
+    If a job with the same `idempotency_key` was already queued, that job is
+    returned instead and nothing new is queued. The caller commits.
+    """
+
+    if idempotency_key is not None:
+        existing = (session
+                    .query(Job)
+                    .filter_by(idempotency_key=idempotency_key)
+                    .one_or_none())
+        if existing is not None:
+            return existing
+
+    job = Job(
+        kind=kind,
+        payload=payload or {},
+        idempotency_key=idempotency_key,
+        max_attempts=max_attempts,
+        run_at=run_at or datetime.utcnow(),
+    )
+
+    try:
+        with session.begin_nested():
+            session.add(job)
+    except IntegrityError:
+        # Lost a race with another request using the same key.
+        return (session
+                .query(Job)
+                .filter_by(idempotency_key=idempotency_key)
+                .one())
+
+    return job
+
+
+def _claim(session):
+    """Mark the next runnable job as running and return it, or None."""
+
+    now = datetime.utcnow()
+    query = (session
+             .query(Job)
+             .filter(
+                 ((Job.status == 'queued') & (Job.run_at <= now)) |
+                 ((Job.status == 'running') &
+                  (Job.started_at < now - STALE_AFTER)))
+             .order_by(Job.run_at)
+             .limit(1))
+
+    if session.get_bind().dialect.name == 'postgresql':
+        query = query.with_for_update(skip_locked=True)
+
+    job = query.one_or_none()
+    if job is None:
+        session.rollback()
+        return None
+
+    job.status = 'running'
+    job.attempts += 1
+    job.started_at = now
+    session.commit()
+    return job
+
+
+def run_one(session):
+    """Claim and run a single job. Returns the job, or None if idle."""
+
+    job = _claim(session)
+    if job is None:
+        return None
+
+    job_id, kind, payload = job.id, job.kind, dict(job.payload)
+    start = time.perf_counter()
+
+    try:
+        handler = handlers[kind]
+        handler(session, **payload)
+    except Exception:
+        session.rollback()
+        job = session.get(Job, job_id)
+        job.last_error = traceback.format_exc()
+        if job.attempts < job.max_attempts:
+            job.status = 'queued'
+            job.run_at = datetime.utcnow() + timedelta(
+                seconds=RETRY_BASE_SECONDS ** job.attempts)
+        else:
+            job.status = 'failed'
+        logger.exception("Job %s (%s) failed on attempt %s",
+                         job_id, kind, job.attempts)
+    else:
+        job = session.get(Job, job_id)
+        job.status = 'done'
+        job.last_error = None
+
+    job.finished_at = datetime.utcnow()
+    job.duration_ms = (time.perf_counter() - start) * 1000
+    session.commit()
+
+    logger.info("Job %s (%s) %s in %.1f ms",
+                job_id, kind, job.status, job.duration_ms)
+    return job
+
+
+def work(session, burst=False, poll_interval=1.0):
+    """Run jobs until stopped.
+
+    With `burst`, return once no runnable job is left instead of polling.
+    Returns the number of jobs run.
+    """
+
+    count = 0
+    while True:
+        job = run_one(session)
+        if job is not None:
+            count += 1
+        elif burst:
+            return count
+        else:
+            time.sleep(poll_interval)
+
+
+def stats(session):
+    """Per-kind, per-status job counts and run times.
+
+    Returns a list of dicts with kind, status, count, avg_ms and max_ms.
+    """
+
+    rows = (session
+            .query(Job.kind,
+                   Job.status,
+                   func.count(Job.id),
+                   func.avg(Job.duration_ms),
+                   func.max(Job.duration_ms))
+            .group_by(Job.kind, Job.status)
+            .order_by(Job.kind, Job.status)
+            .all())
+
+    return [
+        dict(kind=kind, status=status, count=count,
+             avg_ms=avg_ms, max_ms=max_ms)
+        for kind, status, count, avg_ms, max_ms in rows
+    ]
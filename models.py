@@ -2,8 +2,14 @@
 
 from datetime import datetime
 
+from flask import current_app, has_app_context
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.orm import Session, with_loader_criteria
+
+import partitions
+import snowflake
 
 bcrypt = Bcrypt()
 db = SQLAlchemy()
@@ -18,6 +24,20 @@ DEFAULT_HEADER_IMAGE_URL = (
     "mat&fit=crop&w=2070&q=80")
 
 
+def _shards():
+    """The app's ShardSet, if rows are spread over several databases.
+
+    See sharding.py: the message, like and follow methods on User ask it
+    instead of the main database then.
+    """
+
+    if not has_app_context():
+        return None
+
+    shards = current_app.extensions.get('shards')
+    return shards if shards is not None and shards.sharded else None
+
+
 class Follow(db.Model):
     """Connection of a follower <-> followed_user."""
 
@@ -48,11 +68,18 @@ class Likes(db.Model):
     )
 
     message_id = db.Column(
-        db.Integer,
+        db.BigInteger,
         db.ForeignKey("messages.id", ondelete="cascade"),
         primary_key=True
     )
 
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        index=True,
+    )
+
 
 class User(db.Model):
     """User in the system."""
@@ -106,6 +133,17 @@ class User(db.Model):
         nullable=False,
     )
 
+    is_admin = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=False,
+    )
+
+    deleted_at = db.Column(
+        db.DateTime,
+        index=True,
+    )
+
     messages = db.relationship('Message', backref="user")
 
     followers = db.relationship(
@@ -168,16 +206,83 @@ class User(db.Model):
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
+        if _shards():
+            return other_user.is_following(self)
+
         found_user_list = [
             user for user in self.followers if user == other_user]
         return len(found_user_list) == 1
 
     def is_following(self, other_user):
-        """Is this user following `other_user`?"""
+        """Is this user following `other_user` (a User or a Profile)?"""
 
-        found_user_list = [
-            user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return other_user.id in self.following_among([other_user.id])
+
+    def count_messages(self):
+        """Number of messages this user has written."""
+
+        shards = _shards()
+        if shards:
+            return shards.count_messages(db.session, self.id)
+
+        return Message.query.filter_by(user_id=self.id).count()
+
+    def count_following(self):
+        """Number of users this user follows."""
+
+        shards = _shards()
+        if shards:
+            return shards.count_following(db.session, self.id)
+
+        return (User.query
+                .join(Follow, Follow.user_being_followed_id == User.id)
+                .filter(Follow.user_following_id == self.id)
+                .count())
+
+    def count_followers(self):
+        """Number of users following this user."""
+
+        shards = _shards()
+        if shards:
+            return shards.count_followers(db.session, self.id)
+
+        return (User.query
+                .join(Follow, Follow.user_following_id == User.id)
+                .filter(Follow.user_being_followed_id == self.id)
+                .count())
+
+    def count_likes(self):
+        """Number of messages this user has liked."""
+
+        shards = _shards()
+        if shards:
+            return shards.count_likes(db.session, self.id)
+
+        return (Message.query
+                .join(Likes, Likes.message_id == Message.id)
+                .filter(Likes.user_id == self.id)
+                .count())
+
+    def count_unread_notifications(self):
+        """Number of unread notifications, from one primary key lookup."""
+
+        return db.session.execute(
+            db.select(Inbox.unread).where(Inbox.user_id == self.id)
+        ).scalar() or 0
+
+    def following_among(self, user_ids):
+        """The subset of `user_ids` this user follows."""
+
+        shards = _shards()
+        if shards:
+            return shards.following_among(db.session, self.id, user_ids)
+
+        return {
+            user_id for user_id, in db.session
+            .query(Follow.user_being_followed_id)
+            .filter(Follow.user_following_id == self.id)
+            .filter(Follow.user_being_followed_id.in_(user_ids))
+        }
 
 
 class Message(db.Model):
@@ -185,10 +290,12 @@ class Message(db.Model):
 
     __tablename__ = 'messages'
 
+    # Time-ordered snowflake ids: ORDER BY id is chronological.
     id = db.Column(
-        db.Integer,
+        db.BigInteger,
         primary_key=True,
-        autoincrement=True,
+        autoincrement=False,
+        default=snowflake.next_id,
     )
 
     text = db.Column(
@@ -208,6 +315,13 @@ class Message(db.Model):
         nullable=False,
     )
 
+    __table_args__ = (
+        # A user's messages, newest first, for profiles and timelines.
+        db.Index('ix_messages_user_id_id', 'user_id', 'id'),
+        # Monthly partitions by id on Postgres; see partitions.py.
+        {'postgresql_partition_by': 'RANGE (id)'},
+    )
+
     def is_liked_by(self, other_user):
         """Is this message liked by user?"""
 
@@ -216,12 +330,367 @@ class Message(db.Model):
         return len(liked_user_list) == 1
 
 
+event.listen(
+    Message.__table__, 'after_create', partitions.create_initial_partitions)
+
+
+class MessageTag(db.Model):
+    """A #tag in a message (see tags.py). Stored lowercased."""
+
+    __tablename__ = 'message_tags'
+
+    # Primary key order is the index the tag pages read: one tag's
+    # messages, newest first.
+    tag = db.Column(
+        db.String(100),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.BigInteger,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+        index=True,
+    )
+
+
+class Mention(db.Model):
+    """An @mention of a user in a message (see tags.py)."""
+
+    __tablename__ = 'mentions'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.BigInteger,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+        index=True,
+    )
+
+
+class Notification(db.Model):
+    """Likes, follows or a mention for a user; see notifications.py.
+
+    While unread, later events with the same `group_key` are folded into
+    the row: `actor_id` is the latest actor, `actor_count` how many
+    different ones (see `NotificationActor`).
+    """
+
+    __tablename__ = 'notifications'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=True,
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    kind = db.Column(
+        db.String(10),
+        nullable=False,
+    )
+
+    group_key = db.Column(
+        db.String(40),
+        nullable=False,
+    )
+
+    # Not a foreign key: the message may be on a shard or archived.
+    message_id = db.Column(
+        db.BigInteger,
+    )
+
+    actor_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='set null'),
+    )
+
+    actor_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    read_at = db.Column(
+        db.DateTime,
+    )
+
+    __table_args__ = (
+        # A user's inbox, newest first.
+        db.Index('ix_notifications_user_id_updated_at',
+                 'user_id', 'updated_at'),
+        # At most one unread notification per group to coalesce into.
+        db.Index('uq_notifications_unread_group',
+                 'user_id', 'group_key',
+                 unique=True,
+                 postgresql_where=db.text('read_at IS NULL'),
+                 sqlite_where=db.text('read_at IS NULL')),
+    )
+
+
+class NotificationActor(db.Model):
+    """A user folded into a notification, so each is counted once."""
+
+    __tablename__ = 'notification_actors'
+
+    notification_id = db.Column(
+        db.Integer,
+        db.ForeignKey('notifications.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    actor_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+
+class Inbox(db.Model):
+    """A user's count of unread notifications, for the navbar badge."""
+
+    __tablename__ = 'inboxes'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    unread = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+
+class UserShard(db.Model):
+    """A user placed on a shard other than the default (see sharding.py)."""
+
+    __tablename__ = 'user_shards'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    shard = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+
+class Recommendation(db.Model):
+    """A precomputed "who to follow" suggestion.
+
+    Rows are rewritten in bulk by the recommendation job; the primary key
+    (user_id, rank) lets a user's suggestions be read in one index scan.
+    """
+
+    __tablename__ = 'recommendations'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    rank = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    recommended_user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    score = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
+    recommended_user = db.relationship(
+        'User', foreign_keys=[recommended_user_id])
+
+
+class Job(db.Model):
+    """A unit of background work, queued in the database.
+
+    Workers claim queued jobs whose `run_at` has passed; see jobs.py.
+    """
+
+    __tablename__ = 'jobs'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=True,
+    )
+
+    kind = db.Column(
+        db.String(50),
+        nullable=False,
+    )
+
+    payload = db.Column(
+        db.JSON,
+        nullable=False,
+        default=dict,
+    )
+
+    idempotency_key = db.Column(
+        db.String(100),
+        unique=True,
+    )
+
+    status = db.Column(
+        db.String(10),
+        nullable=False,
+        default='queued',
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    max_attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=5,
+    )
+
+    last_error = db.Column(
+        db.Text,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    run_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    started_at = db.Column(
+        db.DateTime,
+    )
+
+    finished_at = db.Column(
+        db.DateTime,
+    )
+
+    duration_ms = db.Column(
+        db.Float,
+    )
+
+    __table_args__ = (
+        db.Index('ix_jobs_status_run_at', 'status', 'run_at'),
+    )
+
+    def __repr__(self):
+        return f"<Job #{self.id}: {self.kind} {self.status}>"
+
+
+class Deletion(db.Model):
+    """Progress of purging a deleted (tombstoned) user's rows.
+
+    See deletion.py. Not a foreign key: the row outlives the user.
+    """
+
+    __tablename__ = 'deletions'
+
+    user_id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    phase = db.Column(
+        db.String(30),
+        nullable=False,
+    )
+
+    rows_deleted = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    started_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    finished_at = db.Column(
+        db.DateTime,
+    )
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def hide_deleted_users(orm_execute_state):
+    """Leave tombstoned users and their messages out of every ORM query.
+
+    Pass execution_options(include_deleted=True) to see them anyway.
+    """
+
+    if (not orm_execute_state.is_select or
+            orm_execute_state.execution_options.get('include_deleted')):
+        return
+
+    orm_execute_state.statement = orm_execute_state.statement.options(
+        with_loader_criteria(
+            User,
+            lambda cls: cls.deleted_at.is_(None),
+            include_aliases=True,
+        ),
+        with_loader_criteria(
+            Message,
+            lambda cls: cls.user_id.not_in(
+                db.select(User.__table__.c.id)
+                .where(User.__table__.c.deleted_at.is_not(None))),
+            include_aliases=True,
+        ),
+    )
+
+
 def connect_db(app):
     """Connect this database to provided Flask app.
 
-    You should call this in your Flask app.
+    You should call this in your Flask app. Engines are created here but
+    connect lazily, on first use.
     """
 
-    app.app_context().push()
-    db.app = app
     db.init_app(app)
+    # BCRYPT_LOG_ROUNDS is process-wide: the last app connected sets it.
+    bcrypt.init_app(app)
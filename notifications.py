@@ -0,0 +1,242 @@
+"""Notifications: likes, follows and mentions, coalesced per user.
+
+The like, follow and new message routes call `liked()`, `followed()` and
+`mentioned()`. Events of the same kind about the same thing are folded
+into one unread notification (its `group_key`): "u2 and 41 others liked
+your warble" is one row with the latest actor and a count, not 42. The
+count is of different actors: `notification_actors` records who has been
+folded in, so someone liking, unliking and liking again counts once.
+Once read, the next event starts a new one.
+
+Each inbox keeps at most MAX_NOTIFICATIONS, newest first. Starting a new
+notification trims the oldest ones past that, and the
+`prune_notifications` job deletes read notifications older than
+RETENTION every day.
+
+The unread count for the navbar badge is kept in `inboxes`, one row per
+user, so showing it is one primary key lookup
+(`User.count_unread_notifications()`) rather than a count. It counts
+notifications, not events: coalesced events don't add to it.
+"""
+
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.exc import IntegrityError
+
+import tags
+from models import Inbox, Notification, NotificationActor, User
+from read_models import Author
+
+inboxes = Inbox.__table__
+notifications = Notification.__table__
+notification_actors = NotificationActor.__table__
+users = User.__table__
+
+LIKE = 'like'
+FOLLOW = 'follow'
+MENTION = 'mention'
+
+MAX_NOTIFICATIONS = 100
+RETENTION = timedelta(days=30)
+
+
+@dataclass(frozen=True, slots=True)
+class InboxItem:
+    """A notification as shown in the inbox.
+
+    `actor` is None if the latest actor has been deleted since.
+    """
+
+    kind: str
+    message_id: int | None
+    actor: Author | None
+    others: int
+    updated_at: datetime
+    unread: bool
+
+
+def _add_unread(session, user_id, count):
+    where = inboxes.c.user_id == user_id
+    if session.execute(update(inboxes).where(where).values(
+            unread=inboxes.c.unread + count)).rowcount:
+        return
+
+    try:
+        with session.begin_nested():
+            session.execute(insert(inboxes).values(
+                user_id=user_id, unread=max(count, 0)))
+    except IntegrityError:
+        # Another request made the row first.
+        session.execute(update(inboxes).where(where).values(
+            unread=inboxes.c.unread + count))
+
+
+def _trim(session, user_id):
+    """Delete `user_id`'s notifications past the newest MAX_NOTIFICATIONS."""
+
+    stale = session.execute(
+        select(notifications.c.id, notifications.c.read_at)
+        .where(notifications.c.user_id == user_id)
+        .order_by(notifications.c.updated_at.desc(),
+                  notifications.c.id.desc())
+        .offset(MAX_NOTIFICATIONS)).all()
+    if not stale:
+        return
+
+    stale_ids = [id for id, _ in stale]
+    session.execute(delete(notification_actors).where(
+        notification_actors.c.notification_id.in_(stale_ids)))
+    session.execute(delete(notifications).where(
+        notifications.c.id.in_(stale_ids)))
+
+    unread = sum(1 for _, read_at in stale if read_at is None)
+    if unread:
+        _add_unread(session, user_id, -unread)
+
+
+def _new_actor(session, notification_id, actor_id):
+    """Record `actor_id` on the notification. Returns whether they're new."""
+
+    try:
+        with session.begin_nested():
+            session.execute(insert(notification_actors).values(
+                notification_id=notification_id, actor_id=actor_id))
+    except IntegrityError:
+        return False
+    return True
+
+
+def notify(session, user_id, kind, actor_id, message_id=None, now=None):
+    """Tell `user_id` that `actor_id` did `kind` (about `message_id`).
+
+    Folds into the matching unread notification if there is one, counting
+    each actor once. Nothing happens for users acting on themselves. The
+    caller commits.
+    """
+
+    if user_id == actor_id:
+        return
+
+    now = now or datetime.utcnow()
+    group_key = kind if message_id is None else f"{kind}:{message_id}"
+
+    unread_group = select(notifications.c.id).where(
+        notifications.c.user_id == user_id,
+        notifications.c.group_key == group_key,
+        notifications.c.read_at.is_(None),
+    )
+
+    def fold(notification_id):
+        new = _new_actor(session, notification_id, actor_id)
+        session.execute(
+            update(notifications)
+            .where(notifications.c.id == notification_id)
+            .values(
+                actor_id=actor_id,
+                actor_count=notifications.c.actor_count + int(new),
+                updated_at=now,
+            ))
+
+    notification_id = session.execute(unread_group).scalar()
+    if notification_id is not None:
+        fold(notification_id)
+        return
+
+    try:
+        with session.begin_nested():
+            notification_id = session.execute(
+                insert(notifications).values(
+                    user_id=user_id,
+                    kind=kind,
+                    group_key=group_key,
+                    message_id=message_id,
+                    actor_id=actor_id,
+                    actor_count=1,
+                    created_at=now,
+                    updated_at=now,
+                )).inserted_primary_key[0]
+    except IntegrityError:
+        # Another request started the notification first.
+        fold(session.execute(unread_group).scalar_one())
+        return
+
+    _new_actor(session, notification_id, actor_id)
+    _add_unread(session, user_id, 1)
+    _trim(session, user_id)
+
+
+def liked(session, author_id, actor_id, message_id):
+    notify(session, author_id, LIKE, actor_id, message_id)
+
+
+def followed(session, user_id, actor_id):
+    notify(session, user_id, FOLLOW, actor_id)
+
+
+def mentioned(session, author_id, message_id, text):
+    """Notify the users @mentioned in a new message."""
+
+    _, usernames = tags.extract(text)
+    if not usernames:
+        return
+
+    for user_id in session.execute(
+            select(users.c.id).where(users.c.username.in_(usernames))
+            ).scalars():
+        notify(session, user_id, MENTION, author_id, message_id)
+
+
+def inbox(session, user_id, limit=MAX_NOTIFICATIONS):
+    """`user_id`'s newest `limit` notifications, as InboxItems."""
+
+    rows = session.execute(
+        select(notifications.c.kind,
+               notifications.c.message_id,
+               notifications.c.actor_id,
+               notifications.c.actor_count,
+               notifications.c.updated_at,
+               notifications.c.read_at)
+        .where(notifications.c.user_id == user_id)
+        .order_by(notifications.c.updated_at.desc(),
+                  notifications.c.id.desc())
+        .limit(limit)).all()
+
+    actor_ids = {row.actor_id for row in rows if row.actor_id is not None}
+    actors = {id: Author(id, username, image_url)
+              for id, username, image_url in session.execute(
+                  select(users.c.id, users.c.username, users.c.image_url)
+                  .where(users.c.id.in_(actor_ids))
+                  .where(users.c.deleted_at.is_(None)))} if actor_ids else {}
+
+    return [InboxItem(row.kind, row.message_id, actors.get(row.actor_id),
+                      row.actor_count - 1, row.updated_at,
+                      row.read_at is None)
+            for row in rows]
+
+
+def mark_read(session, user_id, now=None):
+    """Mark all of `user_id`'s notifications read. The caller commits."""
+
+    session.execute(
+        update(notifications)
+        .where(notifications.c.user_id == user_id,
+               notifications.c.read_at.is_(None))
+        .values(read_at=now or datetime.utcnow()))
+    session.execute(
+        update(inboxes)
+        .where(inboxes.c.user_id == user_id, inboxes.c.unread != 0)
+        .values(unread=0))
+
+
+def prune(session, now=None):
+    """Delete read notifications older than RETENTION. Returns how many."""
+
+    cutoff = (now or datetime.utcnow()) - RETENTION
+    old = (notifications.c.read_at.is_not(None),
+           notifications.c.updated_at < cutoff)
+    session.execute(delete(notification_actors).where(
+        notification_actors.c.notification_id.in_(
+            select(notifications.c.id).where(*old))))
+    return session.execute(delete(notifications).where(*old)).rowcount
@@ -0,0 +1,238 @@
+"""Monthly range partitions of the messages table (Postgres only).
+
+Message ids are time-ordered snowflakes (see snowflake.py), so a calendar
+month of messages is a contiguous range of ids. On Postgres `messages` is
+partitioned BY RANGE (id) into one table per month, named
+messages_YYYY_MM, keeping `id` as the primary key. Recent pages only touch
+the newest partitions and their small indexes; vacuum works a month at a
+time; and an old month can be archived (archive.py) by detaching and
+dropping its partition instead of a huge DELETE.
+
+messages_default catches any id no monthly partition covers, so inserts
+never fail for want of a partition. It should stay empty:
+`ensure_partitions()` creates partitions MONTHS_AHEAD months into the
+future, and the `maintain_partitions` job runs it daily.
+
+Fresh databases get a partitioned table from `db.create_all()` (see
+`create_initial_partitions`); `partition_messages()` converts an existing
+one in place. Other databases (SQLite) keep one plain table and every
+function here except `month_bounds` and `month_of` is a no-op on them.
+"""
+
+import logging
+from datetime import datetime
+
+import snowflake
+
+logger = logging.getLogger(__name__)
+
+MONTHS_AHEAD = 3
+DEFAULT_PARTITION = 'messages_default'
+
+
+def month_start(when):
+    """Midnight on the first of `when`'s month."""
+
+    return datetime(when.year, when.month, 1)
+
+
+def add_months(month, months):
+    """The first of the month `months` after `month` (a month start)."""
+
+    index = month.year * 12 + month.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def month_bounds(month):
+    """(lowest id, id just past the highest) for messages made in `month`."""
+
+    return (snowflake.compose(snowflake.to_ms(month), 0, 0),
+            snowflake.compose(snowflake.to_ms(add_months(month, 1)), 0, 0))
+
+
+def month_of(message_id):
+    """The start of the month message `message_id` was made in."""
+
+    ms, _, _ = snowflake.decompose(message_id)
+    return month_start(
+        datetime.utcfromtimestamp((ms + snowflake.EPOCH_MS) / 1000))
+
+
+def partition_name(month):
+    return f"messages_{month:%Y_%m}"
+
+
+def is_partitioned(conn):
+    """Is `messages` a partitioned table on this connection's database?"""
+
+    if conn.dialect.name != 'postgresql':
+        return False
+
+    return conn.exec_driver_sql(
+        "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table "
+        "WHERE partrelid = 'messages'::regclass)").scalar()
+
+
+def list_partitions(conn):
+    """{month start: partition name} for the monthly partitions."""
+
+    if not is_partitioned(conn):
+        return {}
+
+    names = conn.exec_driver_sql(
+        "SELECT child.relname FROM pg_inherits "
+        "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+        "WHERE pg_inherits.inhparent = 'messages'::regclass").scalars()
+
+    return {datetime.strptime(name, "messages_%Y_%m"): name
+            for name in names if name != DEFAULT_PARTITION}
+
+
+def ensure_partitions(conn, since=None, months_ahead=MONTHS_AHEAD, now=None):
+    """Create monthly partitions from `since` to `months_ahead` from now.
+
+    `since` defaults to the current month. Returns the names of the
+    partitions created. A month is skipped, with a warning, if the default
+    partition holds rows in it: they'd have to be moved by hand first.
+    """
+
+    if not is_partitioned(conn):
+        return []
+
+    this_month = month_start(now or datetime.utcnow())
+    month = month_start(since) if since else this_month
+    last = add_months(this_month, months_ahead)
+    existing = list_partitions(conn)
+
+    created = []
+    while month <= last:
+        if month not in existing:
+            low, high = month_bounds(month)
+            stranded = conn.exec_driver_sql(
+                f"SELECT EXISTS (SELECT 1 FROM {DEFAULT_PARTITION} "
+                "WHERE id >= %(low)s AND id < %(high)s)",
+                dict(low=low, high=high)).scalar()
+
+            if stranded:
+                logger.warning("%s has rows for %s; not creating it",
+                               DEFAULT_PARTITION, partition_name(month))
+            else:
+                conn.exec_driver_sql(
+                    f"CREATE TABLE {partition_name(month)} "
+                    f"PARTITION OF messages FOR VALUES FROM ({low}) TO ({high})")
+                created.append(partition_name(month))
+
+        month = add_months(month, 1)
+
+    return created
+
+
+def create_initial_partitions(target, connection, **kw):
+    """After `messages` is created: the default and upcoming partitions."""
+
+    if connection.dialect.name != 'postgresql':
+        return
+
+    connection.exec_driver_sql(
+        f"CREATE TABLE IF NOT EXISTS {DEFAULT_PARTITION} "
+        "PARTITION OF messages DEFAULT")
+    ensure_partitions(connection)
+
+
+def message_foreign_keys(conn, table='messages'):
+    """(table, constraint, column, ON DELETE action) of each foreign key
+    referencing `table`.id, read from the catalog."""
+
+    return conn.exec_driver_sql(
+        "SELECT con.conrelid::regclass::text, con.conname, att.attname, "
+        "CASE con.confdeltype WHEN 'c' THEN 'CASCADE' "
+        "WHEN 'n' THEN 'SET NULL' WHEN 'd' THEN 'SET DEFAULT' "
+        "WHEN 'r' THEN 'RESTRICT' ELSE 'NO ACTION' END "
+        "FROM pg_constraint con "
+        "JOIN pg_attribute att ON att.attrelid = con.conrelid "
+        "AND att.attnum = con.conkey[1] "
+        "WHERE con.contype = 'f' AND con.conparentid = 0 "
+        f"AND con.confrelid = '{table}'::regclass "
+        "ORDER BY 1, 2").all()
+
+
+def drop_foreign_keys(conn, keys):
+    """Drop `keys`, as listed by `message_foreign_keys`."""
+
+    for table, name, _, _ in keys:
+        conn.exec_driver_sql(f"ALTER TABLE {table} DROP CONSTRAINT {name}")
+
+
+def add_foreign_keys(conn, keys):
+    """Recreate `keys`, as listed by `message_foreign_keys`, against
+    `messages`."""
+
+    for table, name, column, on_delete in keys:
+        conn.exec_driver_sql(
+            f"ALTER TABLE {table} ADD CONSTRAINT {name} "
+            f"FOREIGN KEY ({column}) REFERENCES messages (id) "
+            f"ON DELETE {on_delete}")
+
+
+def partition_messages(session):
+    """Convert an unpartitioned `messages` table to monthly partitions.
+
+    Copies every row into the new table in one transaction, so stop the
+    app while it runs. Message ids must be snowflakes already (run
+    `flask migrate-message-ids` first). Returns the number of partitions
+    created, or 0 if there was nothing to do.
+    """
+
+    conn = session.connection()
+    if conn.dialect.name != 'postgresql' or is_partitioned(conn):
+        return 0
+
+    oldest = conn.exec_driver_sql("SELECT min(id) FROM messages").scalar()
+    if oldest is not None and oldest < snowflake.MIN_SNOWFLAKE:
+        raise ValueError("messages has pre-snowflake ids; migrate them first")
+
+    # Likes, tags, mentions...: moved over to the new table once it's full.
+    foreign_keys = message_foreign_keys(conn)
+
+    for statement in (
+        "ALTER TABLE messages RENAME TO messages_unpartitioned",
+        "ALTER INDEX messages_pkey RENAME TO messages_unpartitioned_pkey",
+        "ALTER INDEX ix_messages_user_id_id "
+        "RENAME TO ix_messages_unpartitioned_user_id_id",
+        "CREATE TABLE messages (LIKE messages_unpartitioned INCLUDING DEFAULTS) "
+        "PARTITION BY RANGE (id)",
+        "ALTER TABLE messages ADD CONSTRAINT messages_pkey PRIMARY KEY (id)",
+        "ALTER TABLE messages ADD CONSTRAINT messages_user_id_fkey "
+        "FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE",
+        "CREATE INDEX ix_messages_user_id_id ON messages (user_id, id)",
+    ):
+        conn.exec_driver_sql(statement)
+
+    create_initial_partitions(None, conn)
+    created = ensure_partitions(
+        conn, since=month_of(oldest) if oldest is not None else None)
+
+    conn.exec_driver_sql(
+        "INSERT INTO messages SELECT * FROM messages_unpartitioned")
+    drop_foreign_keys(conn, foreign_keys)
+    add_foreign_keys(conn, foreign_keys)
+    conn.exec_driver_sql("DROP TABLE messages_unpartitioned")
+
+    session.commit()
+    return len(created)
+
+
+def drop_partition(conn, month):
+    """Detach and drop `month`'s partition. Returns whether there was one.
+
+    Rows referencing its messages (likes, tags, mentions) must be gone
+    first.
+    """
+
+    name = list_partitions(conn).get(month)
+    if name is None:
+        return False
+
+    conn.exec_driver_sql(f"ALTER TABLE messages DETACH PARTITION {name}")
+    conn.exec_driver_sql(f"DROP TABLE {name}")
+    return True
@@ -0,0 +1,322 @@
+"""Opt-in stack-sampling profiler for individual requests.
+
+A request is profiled when it carries the `X-Warbler-Profile` header set to
+PROFILER_TOKEN, or when it is picked at random with probability
+PROFILER_SAMPLE_RATE. While it runs, a background thread records the
+request thread's Python stack every PROFILER_INTERVAL seconds, and the
+SQL statements it executes are counted and timed.
+
+Each capture is written to PROFILER_DIR as three files named after the
+capture id: `<id>.json` (route, status, duration and SQL stats),
+`<id>.collapsed` (one "frame;frame;frame count" line per distinct stack,
+for flamegraph.pl and friends) and `<id>.speedscope.json` (for
+https://www.speedscope.app). Only the PROFILER_KEEP slowest captures are
+kept.
+
+With both settings off, `init_app()` installs nothing, so requests pay
+nothing for it.
+"""
+
+import hmac
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+
+from flask import current_app, g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+PROFILE_HEADER = 'X-Warbler-Profile'
+
+DEFAULT_INTERVAL = 0.005
+DEFAULT_KEEP = 200
+
+SPEEDSCOPE_SCHEMA = "https://www.speedscope.app/file-format-schema.json"
+
+# The capture for the request running on this thread, if it is profiled.
+_local = threading.local()
+_listening = False
+
+
+class Sampler:
+    """Records one thread's Python stack every `interval` seconds.
+
+    `stacks` counts each distinct stack, root first, as a tuple of
+    (function, file, first line) frames.
+    """
+
+    def __init__(self, thread_id, interval=DEFAULT_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="profiler-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(
+                    (code.co_qualname, code.co_filename, code.co_firstlineno))
+                frame = frame.f_back
+            if stack:
+                stack.reverse()
+                self.stacks[tuple(stack)] += 1
+
+
+class Capture:
+    """Profile of one request in progress."""
+
+    def __init__(self, interval=DEFAULT_INTERVAL):
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.duration = None
+        self.status = None
+        self.sql_count = 0
+        self.sql_seconds = 0.0
+        self.sampler = Sampler(threading.get_ident(), interval).start()
+
+    def stop(self):
+        self.sampler.stop()
+        self.duration = time.perf_counter() - self.start
+
+
+def frame_name(frame):
+    function, filename, line = frame
+    return f"{function} ({os.path.basename(filename)}:{line})"
+
+
+def collapsed(stacks):
+    """`stacks` in collapsed-stack format, one line per distinct stack."""
+
+    return "".join(
+        ";".join(frame_name(frame) for frame in stack) + f" {count}\n"
+        for stack, count in sorted(stacks.items()))
+
+
+def speedscope(stacks, name, interval):
+    """`stacks` as a speedscope "sampled" profile (a JSON-ready dict)."""
+
+    frames = {}
+    samples = []
+    weights = []
+    for stack, count in stacks.items():
+        samples.append([frames.setdefault(frame, len(frames))
+                        for frame in stack])
+        weights.append(count * interval * 1000)
+
+    return {
+        "$schema": SPEEDSCOPE_SCHEMA,
+        "name": name,
+        "exporter": "warbler",
+        "shared": {
+            "frames": [
+                {"name": function, "file": filename, "line": line}
+                for function, filename, line in frames
+            ],
+        },
+        "profiles": [{
+            "type": "sampled",
+            "name": name,
+            "unit": "milliseconds",
+            "startValue": 0,
+            "endValue": sum(weights),
+            "samples": samples,
+            "weights": weights,
+        }],
+    }
+
+
+def save(directory, capture, info, keep=DEFAULT_KEEP):
+    """Write `capture`'s files to `directory` and return its summary.
+
+    `info` (method, path, route and so on) is merged into the summary.
+    """
+
+    profile_id = (time.strftime("%Y%m%d-%H%M%S", time.gmtime()) +
+                  f"-{uuid.uuid4().hex[:8]}")
+    stacks = capture.sampler.stacks
+    interval = capture.sampler.interval
+
+    summary = dict(
+        info,
+        id=profile_id,
+        started_at=capture.started_at,
+        status=capture.status,
+        duration_ms=capture.duration * 1000,
+        sql_count=capture.sql_count,
+        sql_ms=capture.sql_seconds * 1000,
+        samples=sum(stacks.values()),
+    )
+    name = f"{summary.get('method', '')} {summary.get('route', '')}".strip()
+
+    path = os.path.join(directory, profile_id)
+    with open(f"{path}.collapsed", "w") as f:
+        f.write(collapsed(stacks))
+    with open(f"{path}.speedscope.json", "w") as f:
+        json.dump(speedscope(stacks, name, interval), f)
+
+    # The summary goes last, and atomically, so listings only ever see
+    # captures whose files are all there.
+    with open(f"{path}.json.tmp", "w") as f:
+        json.dump(summary, f)
+    os.replace(f"{path}.json.tmp", f"{path}.json")
+
+    _prune(directory, keep)
+    return summary
+
+
+def _summaries(directory):
+    found = []
+    for filename in os.listdir(directory):
+        if filename.endswith(".json") and \
+                not filename.endswith(".speedscope.json"):
+            try:
+                with open(os.path.join(directory, filename)) as f:
+                    found.append(json.load(f))
+            except (OSError, ValueError):
+                # Pruned by another process while we were listing.
+                continue
+    return found
+
+
+def _prune(directory, keep):
+    """Delete all but the `keep` slowest captures."""
+
+    summaries = _summaries(directory)
+    if len(summaries) <= keep:
+        return
+
+    summaries.sort(key=lambda summary: summary['duration_ms'], reverse=True)
+    for summary in summaries[keep:]:
+        for suffix in (".json", ".collapsed", ".speedscope.json"):
+            try:
+                os.remove(os.path.join(directory, summary['id'] + suffix))
+            except FileNotFoundError:
+                pass
+
+
+def slowest(directory, limit=50):
+    """Summaries of the `limit` slowest captures in `directory`."""
+
+    if not os.path.isdir(directory):
+        return []
+
+    summaries = _summaries(directory)
+    summaries.sort(key=lambda summary: summary['duration_ms'], reverse=True)
+    return summaries[:limit]
+
+
+##############################################################################
+# Flask and SQLAlchemy hooks
+
+
+def init_app(app):
+    """Profile requests to `app` as configured. Does nothing when disabled.
+
+    Call this before registering blueprints, so the profile covers their
+    before-request hooks too.
+    """
+
+    if not (app.config['PROFILER_SAMPLE_RATE'] or app.config['PROFILER_TOKEN']):
+        return
+
+    app.config['PROFILER_DIR'] = os.path.abspath(app.config['PROFILER_DIR'])
+    os.makedirs(app.config['PROFILER_DIR'], exist_ok=True)
+
+    _listen_for_sql()
+    app.before_request(_start)
+    app.after_request(_record_status)
+    # Teardown runs after a streamed body has been sent, so streamed pages
+    # are profiled to the end.
+    app.teardown_request(_finish)
+
+
+def _wanted():
+    config = current_app.config
+
+    token = config['PROFILER_TOKEN']
+    header = request.headers.get(PROFILE_HEADER)
+    if token and header and hmac.compare_digest(header, token):
+        return True
+
+    rate = config['PROFILER_SAMPLE_RATE']
+    return rate > 0 and random.random() < rate
+
+
+def _start():
+    if request.endpoint == 'static' or not _wanted():
+        return
+
+    g.profile = _local.capture = Capture(
+        current_app.config['PROFILER_INTERVAL'])
+
+
+def _record_status(response):
+    capture = g.get('profile')
+    if capture is not None:
+        capture.status = response.status_code
+    return response
+
+
+def _finish(exc):
+    capture = g.pop('profile', None)
+    if capture is None:
+        return
+
+    _local.capture = None
+    capture.stop()
+    if capture.status is None and exc is not None:
+        capture.status = 500
+
+    save(
+        current_app.config['PROFILER_DIR'],
+        capture,
+        dict(
+            method=request.method,
+            path=request.full_path.rstrip('?'),
+            route=request.url_rule.rule if request.url_rule else None,
+            endpoint=request.endpoint,
+        ),
+        keep=current_app.config['PROFILER_KEEP'],
+    )
+
+
+def _listen_for_sql():
+    global _listening
+
+    if not _listening:
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        _listening = True
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    if getattr(_local, 'capture', None) is not None:
+        conn.info['profiler_query_start'] = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    start = conn.info.pop('profiler_query_start', None)
+    capture = getattr(_local, 'capture', None)
+    if capture is not None and start is not None:
+        capture.sql_count += 1
+        capture.sql_seconds += time.perf_counter() - start
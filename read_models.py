@@ -0,0 +1,314 @@
+"""Read-only message rows for the timeline pages.
+
+The homepage, profile, likes and message pages only print a username,
+avatar, timestamp and text per message. Loading full ORM entities for that
+means an identity-map entry, relationship state and change tracking for
+every row, all thrown away at the end of the request. The queries here use
+SQLAlchemy Core on the underlying tables and return small slotted
+dataclasses instead.
+
+A profile's header, cached by the profile page, is a `Profile` snapshot
+of the User and its counts.
+
+Message ids are time-ordered (see snowflake.py), so lists are newest
+first by id and paged with `before`, the last id of the previous page.
+
+Months moved to cold storage (archive.py) are read through the `archive`
+argument of `user_messages()` and `liked_messages()`: once the database
+has no older messages, the page is filled from the archive.
+
+Core statements don't go through the ORM, so `models.hide_deleted_users`
+doesn't apply to them; every query here leaves out tombstoned users itself.
+"""
+
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+from sqlalchemy import or_, select
+
+import snowflake
+from models import Follow, Likes, Mention, Message, MessageTag, User
+
+follows = Follow.__table__
+likes = Likes.__table__
+mentions = Mention.__table__
+message_tags = MessageTag.__table__
+messages = Message.__table__
+users = User.__table__
+
+DEFAULT_CHUNK_SIZE = 100
+DEFAULT_PAGE_SIZE = 100
+
+# How far back the first query for a page looks; see `_newest()`.
+RECENT_WINDOW = timedelta(days=31)
+
+
+@dataclass(frozen=True, slots=True)
+class Author:
+    """The parts of a user shown next to their messages."""
+
+    id: int
+    username: str
+    image_url: str
+
+
+@dataclass(frozen=True, slots=True)
+class TimelineMessage:
+    """A message as shown in a list, with its author."""
+
+    id: int
+    text: str
+    timestamp: datetime
+    user: Author
+
+
+@dataclass(frozen=True, slots=True)
+class Profile:
+    """A user's profile header: their details and counts.
+
+    What the profile page caches (see cache.py) in place of the User. It
+    has User's count methods, so the templates take either.
+    """
+
+    id: int
+    username: str
+    image_url: str
+    header_image_url: str
+    bio: str
+    location: str
+    message_count: int
+    following_count: int
+    follower_count: int
+    like_count: int
+
+    @classmethod
+    def of(cls, user):
+        return cls(user.id, user.username, user.image_url,
+                   user.header_image_url, user.bio, user.location,
+                   user.count_messages(), user.count_following(),
+                   user.count_followers(), user.count_likes())
+
+    def count_messages(self):
+        return self.message_count
+
+    def count_following(self):
+        return self.following_count
+
+    def count_followers(self):
+        return self.follower_count
+
+    def count_likes(self):
+        return self.like_count
+
+
+def _select_messages():
+    return (select(messages.c.id,
+                   messages.c.text,
+                   messages.c.timestamp,
+                   users.c.id,
+                   users.c.username,
+                   users.c.image_url)
+            .join_from(messages, users, messages.c.user_id == users.c.id)
+            .where(users.c.deleted_at.is_(None)))
+
+
+def _to_messages(rows):
+    """Build TimelineMessages from rows, one Author per distinct user."""
+
+    authors = {}
+    for id, text, timestamp, user_id, username, image_url in rows:
+        author = authors.get(user_id)
+        if author is None:
+            author = authors[user_id] = Author(user_id, username, image_url)
+        yield TimelineMessage(id, text, timestamp, author)
+
+
+def with_authors(session, rows):
+    """TimelineMessages for (id, text, timestamp, user_id) rows.
+
+    For messages read from somewhere without the users table (archive
+    files, shards): authors are looked up in one query, and rows by
+    tombstoned or purged users are left out.
+    """
+
+    if not rows:
+        return []
+
+    stmt = (select(users.c.id, users.c.username, users.c.image_url)
+            .where(users.c.id.in_({row[3] for row in rows}))
+            .where(users.c.deleted_at.is_(None)))
+    authors = {id: Author(id, username, image_url)
+               for id, username, image_url
+               in session.connection().execute(stmt)}
+
+    return [TimelineMessage(id, text, timestamp, authors[user_id])
+            for id, text, timestamp, user_id in rows
+            if user_id in authors]
+
+
+def _newest(session, stmt, limit, before):
+    """The first `limit` messages from `stmt`, newest first.
+
+    Looks in the last RECENT_WINDOW first, since that's usually enough
+    to fill a page: bounding the id lets Postgres skip all but the newest
+    monthly partitions (see partitions.py). Only a short page goes on to
+    query older messages.
+    """
+
+    stmt = stmt.order_by(messages.c.id.desc())
+    if before is not None:
+        stmt = stmt.where(messages.c.id < before)
+
+    conn = session.connection()
+    recent = snowflake.compose(
+        snowflake.to_ms(datetime.utcnow() - RECENT_WINDOW), 0, 0)
+
+    if before is not None and before <= recent:
+        return list(_to_messages(conn.execute(stmt.limit(limit))))
+
+    found = list(_to_messages(conn.execute(
+        stmt.where(messages.c.id >= recent).limit(limit))))
+    if len(found) < limit:
+        found += _to_messages(conn.execute(
+            stmt.where(messages.c.id < recent).limit(limit - len(found))))
+
+    return found
+
+
+def timeline(session, user_id, limit=DEFAULT_PAGE_SIZE, before=None):
+    """The `limit` newest messages by `user_id` and the users they follow.
+
+    With `before`, only messages older than that message id.
+    """
+
+    followed = (select(follows.c.user_being_followed_id)
+                .where(follows.c.user_following_id == user_id))
+
+    stmt = (_select_messages()
+            .where(or_(messages.c.user_id == user_id,
+                       messages.c.user_id.in_(followed))))
+
+    return _newest(session, stmt, limit, before)
+
+
+def user_messages(session, user_id, limit=DEFAULT_PAGE_SIZE, before=None,
+                  archive=None):
+    """The `limit` newest messages written by `user_id`.
+
+    With `before`, only messages older than that message id. With an
+    `archive` (an `archive.MessageArchive`), archived messages follow the
+    ones still in the database.
+    """
+
+    stmt = _select_messages().where(messages.c.user_id == user_id)
+    found = _newest(session, stmt, limit, before)
+
+    if archive is not None and len(found) < limit:
+        found += archive.user_messages(
+            session, user_id, limit - len(found),
+            before=found[-1].id if found else before)
+
+    return found
+
+
+def liked_messages(session, user_id, chunk_size=DEFAULT_CHUNK_SIZE,
+                   limit=None, before=None, archive=None):
+    """Messages liked by `user_id`, streamed `chunk_size` rows at a time.
+
+    Newest first, paged by message id with `limit` and `before` like the
+    others, and followed by archived ones if given an `archive`.
+    """
+
+    stmt = (_select_messages()
+            .join(likes, likes.c.message_id == messages.c.id)
+            .where(likes.c.user_id == user_id)
+            .order_by(likes.c.message_id.desc())
+            .limit(limit))
+    if before is not None:
+        stmt = stmt.where(likes.c.message_id < before)
+
+    rows = session.connection().execute(
+        stmt, execution_options={'yield_per': chunk_size})
+    if archive is None:
+        return _to_messages(rows)
+
+    return _then_archived(_to_messages(rows), session, user_id, limit,
+                          before, archive)
+
+
+def _then_archived(found, session, user_id, limit, before, archive):
+    """Yield from `found`, then archived liked messages up to `limit`."""
+
+    count = 0
+    for msg in found:
+        yield msg
+        count += 1
+        before = msg.id
+
+    if limit is None or count < limit:
+        yield from archive.liked_messages(
+            session, user_id, None if limit is None else limit - count,
+            before=before)
+
+
+def _linked(session, link, condition, limit, before):
+    """The `limit` newest messages with a `link` row matching `condition`."""
+
+    stmt = (_select_messages()
+            .join(link, link.c.message_id == messages.c.id)
+            .where(condition)
+            .order_by(link.c.message_id.desc())
+            .limit(limit))
+    if before is not None:
+        stmt = stmt.where(link.c.message_id < before)
+
+    return list(_to_messages(session.connection().execute(stmt)))
+
+
+def tagged_messages(session, tag, limit=DEFAULT_PAGE_SIZE, before=None):
+    """The `limit` newest messages tagged #`tag` (see tags.py)."""
+
+    return _linked(session, message_tags, message_tags.c.tag == tag.lower(),
+                   limit, before)
+
+
+def mentioning_messages(session, user_id, limit=DEFAULT_PAGE_SIZE,
+                        before=None):
+    """The `limit` newest messages that @mention `user_id`."""
+
+    return _linked(session, mentions, mentions.c.user_id == user_id,
+                   limit, before)
+
+
+def message(session, message_id):
+    """The message with `message_id`, or None."""
+
+    stmt = _select_messages().where(messages.c.id == message_id)
+    found = list(_to_messages(session.connection().execute(stmt)))
+    return found[0] if found else None
+
+
+def following_among(session, user_id, user_ids):
+    """The subset of `user_ids` that `user_id` follows."""
+
+    if not user_ids:
+        return set()
+
+    stmt = (select(follows.c.user_being_followed_id)
+            .where(follows.c.user_following_id == user_id)
+            .where(follows.c.user_being_followed_id.in_(user_ids)))
+
+    return set(session.connection().execute(stmt).scalars())
+
+
+def liked_among(session, user_id, message_ids):
+    """The subset of `message_ids` that `user_id` has liked."""
+
+    if not message_ids:
+        return set()
+
+    stmt = (select(likes.c.message_id)
+            .where(likes.c.user_id == user_id)
+            .where(likes.c.message_id.in_(message_ids)))
+
+    return set(session.connection().execute(stmt).scalars())
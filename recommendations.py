@@ -0,0 +1,186 @@
+"""Batch "who to follow" recommendation job.
+
+Loads the follow graph and the likes graph into sparse matrices and scores
+candidate users for everyone at once:
+
+- friends-of-friends: F @ F, where F[a, b] = 1 if a follows b, counts the
+  paths a -> x -> b;
+- co-likes: L @ L.T, where L[u, m] = 1 if u liked message m, counts the
+  messages two users both liked.
+
+Rows are processed in user-id ranges across a process pool. The top K
+suggestions per user are written to the `recommendations` table.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy import sparse
+from sqlalchemy import insert
+
+from models import Follow, Likes, Recommendation
+
+DEFAULT_TOP_K = 10
+DEFAULT_CHUNK_SIZE = 5_000
+FRIENDS_OF_FRIENDS_WEIGHT = 1.0
+CO_LIKE_WEIGHT = 0.5
+
+INSERT_BATCH_SIZE = 10_000
+
+
+def build_matrix(rows, cols, shape):
+    """Return a CSR 0/1 matrix with ones at (rows[i], cols[i])."""
+
+    data = np.ones(len(rows), dtype=np.float32)
+    matrix = sparse.csr_matrix((data, (rows, cols)), shape=shape)
+    matrix.sum_duplicates()
+    return matrix
+
+
+def load_matrices(session):
+    """Load (follows, likes) as CSR matrices indexed by raw ids."""
+
+    follows = np.array(
+        session.query(Follow.user_following_id,
+                      Follow.user_being_followed_id).all(),
+        dtype=np.int64,
+    ).reshape(-1, 2)
+    likes = np.array(
+        session.query(Likes.user_id, Likes.message_id).all(),
+        dtype=np.int64,
+    ).reshape(-1, 2)
+
+    num_users = int(max(follows.max(initial=0), likes[:, 0].max(initial=0))) + 1
+    num_messages = int(likes[:, 1].max(initial=0)) + 1
+
+    return (
+        build_matrix(follows[:, 0], follows[:, 1], (num_users, num_users)),
+        build_matrix(likes[:, 0], likes[:, 1], (num_users, num_messages)),
+    )
+
+
+def top_k_per_row(rows, cols, scores, k):
+    """Keep the `k` highest-scoring entries of each row.
+
+    Ties are broken by lower column. Returns (rows, cols, scores, ranks),
+    ordered by row then rank; ranks start at 0.
+    """
+
+    order = np.lexsort((cols, -scores, rows))
+    rows, cols, scores = rows[order], cols[order], scores[order]
+
+    first = np.searchsorted(rows, rows, side='left')
+    ranks = np.arange(len(rows)) - first
+    keep = ranks < k
+
+    return rows[keep], cols[keep], scores[keep], ranks[keep]
+
+
+# Matrices for pool workers, set once per process by `_init_worker`.
+_worker_state = {}
+
+
+def _init_worker(follows, likes, k, weights):
+    _worker_state.update(
+        follows=follows,
+        likes=likes,
+        likes_t=likes.T.tocsr(),
+        k=k,
+        weights=weights,
+    )
+
+
+def _score_range(start, stop):
+    """Score candidates for users [start, stop) and keep the top K."""
+
+    follows = _worker_state['follows']
+    fof_weight, co_like_weight = _worker_state['weights']
+
+    follows_rows = follows[start:stop]
+    scores = (follows_rows @ follows) * fof_weight
+    scores = scores + (_worker_state['likes'][start:stop] @
+                       _worker_state['likes_t']) * co_like_weight
+    scores = scores.tocoo()
+
+    rows = scores.row.astype(np.int64)
+    cols = scores.col.astype(np.int64)
+    values = scores.data
+
+    # Drop self-suggestions and users who are already followed.
+    width = follows.shape[1]
+    followed = follows_rows.tocoo()
+    followed_keys = followed.row.astype(np.int64) * width + followed.col
+    keep = ((cols != rows + start) &
+            (values > 0) &
+            ~np.isin(rows * width + cols, followed_keys))
+
+    rows, cols, values, ranks = top_k_per_row(
+        rows[keep], cols[keep], values[keep], _worker_state['k'])
+
+    return rows + start, cols, values, ranks
+
+
+def compute_recommendations(
+        follows,
+        likes,
+        k=DEFAULT_TOP_K,
+        chunk_size=DEFAULT_CHUNK_SIZE,
+        workers=None,
+        weights=(FRIENDS_OF_FRIENDS_WEIGHT, CO_LIKE_WEIGHT)):
+    """Compute the top `k` suggestions for every user.
+
+    `follows` and `likes` are CSR matrices as returned by `load_matrices`.
+    With `workers=1` everything runs in this process; otherwise user ranges
+    of `chunk_size` rows are spread over a process pool.
+
+    Yields (user_ids, recommended_ids, scores, ranks) arrays per chunk.
+    """
+
+    num_users = follows.shape[0]
+    ranges = [(start, min(start + chunk_size, num_users))
+              for start in range(0, num_users, chunk_size)]
+    init_args = (follows, likes, k, weights)
+
+    if workers == 1:
+        _init_worker(*init_args)
+        for start, stop in ranges:
+            yield _score_range(start, stop)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=_init_worker,
+                             initargs=init_args) as pool:
+        starts, stops = zip(*ranges) if ranges else ((), ())
+        yield from pool.map(_score_range, starts, stops)
+
+
+def run_job(session, k=DEFAULT_TOP_K, chunk_size=DEFAULT_CHUNK_SIZE,
+            workers=None):
+    """Recompute all recommendations and replace the table's contents.
+
+    Returns the number of rows written.
+    """
+
+    follows, likes = load_matrices(session)
+
+    session.query(Recommendation).delete()
+    written = 0
+
+    for user_ids, rec_ids, scores, ranks in compute_recommendations(
+            follows, likes, k=k, chunk_size=chunk_size, workers=workers):
+        for i in range(0, len(user_ids), INSERT_BATCH_SIZE):
+            batch = slice(i, i + INSERT_BATCH_SIZE)
+            session.execute(
+                insert(Recommendation),
+                [
+                    dict(user_id=u, recommended_user_id=r, score=s, rank=n)
+                    for u, r, s, n in zip(user_ids[batch].tolist(),
+                                          rec_ids[batch].tolist(),
+                                          scores[batch].tolist(),
+                                          ranks[batch].tolist())
+                ],
+            )
+            written += len(user_ids[batch])
+
+    session.commit()
+    return written
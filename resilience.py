@@ -0,0 +1,426 @@
+"""Statement timeouts, a database circuit breaker and read-route fallbacks.
+
+Every request runs its SQL under a statement timeout looked up by endpoint
+(STATEMENT_TIMEOUTS, else STATEMENT_TIMEOUT_MS). On Postgres it is set
+with SET LOCAL when the session begins a transaction; on SQLite a progress
+handler interrupts statements that run past it.
+
+Database errors (timeouts, refused or dropped connections, pool
+timeouts) are counted by a `CircuitBreaker`. After BREAKER_THRESHOLD in a
+row it opens: requests stop going to the database at all for
+BREAKER_RESET_SECONDS, then a single request is let through to probe it.
+
+While the database is failing, the read routes in FALLBACK_ENDPOINTS
+serve the last page rendered for the same user and URL, and the homepage
+falls back to a truncated timeline: the newest messages from that user's
+own timeline as last seen. Everything else gets a 503 with Retry-After.
+
+For testing, FAULT_SLOW_QUERY_SECONDS makes every statement run during a
+request that much slower, inside the database (pg_sleep on Postgres, a
+stalled progress handler on SQLite), so the real timeout path fires.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+from flask import (
+    Response, current_app, g, make_response, render_template, request,
+    session)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError, TimeoutError
+from sqlalchemy.orm import Session
+
+from models import db
+
+DEFAULT_STATEMENT_TIMEOUT_MS = 10_000
+
+DEFAULT_STATEMENT_TIMEOUTS = {
+    'warbler.homepage': 2_000,
+    'warbler.show_user': 2_000,
+    'warbler.show_message': 1_000,
+}
+
+DEFAULT_FALLBACK_ENDPOINTS = {
+    'warbler.homepage',
+    'warbler.show_user',
+    'warbler.show_message',
+}
+
+DEFAULT_BREAKER_THRESHOLD = 5
+DEFAULT_BREAKER_RESET_SECONDS = 10
+
+# Rendered pages kept for fallback, and messages kept per user (for as
+# many users) for the truncated timeline.
+DEFAULT_RENDER_CACHE_SIZE = 1_000
+TRUNCATED_TIMELINE_SIZE = 20
+
+# VM instructions between statement timeout checks on SQLite.
+SQLITE_PROGRESS_STEPS = 100
+
+DB_ERRORS = (OperationalError, TimeoutError)
+
+# Timeout and fault for the request running on this thread.
+_local = threading.local()
+
+
+class CircuitBreaker:
+    """Closed, open or half-open, by consecutive database failures."""
+
+    def __init__(self, threshold=DEFAULT_BREAKER_THRESHOLD,
+                 reset_seconds=DEFAULT_BREAKER_RESET_SECONDS):
+        self.threshold = threshold
+        self.reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self.state = 'closed'
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.probe_at = None
+        self.times_opened = 0
+        self.failures = 0
+
+    def allow(self, now=None):
+        """May a request go to the database now?
+
+        Once an open breaker has waited `reset_seconds`, the next caller is
+        let through as a probe; others keep being refused until it reports
+        (or, if it never does, for another `reset_seconds`).
+        """
+
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if self.state == 'closed':
+                return True
+
+            last_try = self.opened_at if self.state == 'open' \
+                else self.probe_at
+            if now - last_try >= self.reset_seconds:
+                self.state = 'half_open'
+                self.probe_at = now
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = 'closed'
+            self.consecutive_failures = 0
+
+    def record_failure(self, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self.failures += 1
+            self.consecutive_failures += 1
+            if (self.state == 'half_open' or
+                    self.consecutive_failures >= self.threshold):
+                if self.state != 'open':
+                    self.times_opened += 1
+                self.state = 'open'
+                self.opened_at = now
+
+    def retry_after(self, now=None):
+        """Seconds until the breaker will let a probe through."""
+
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if self.state != 'open':
+                return 1
+            return max(1, round(self.opened_at + self.reset_seconds - now))
+
+    def snapshot(self):
+        with self._lock:
+            return dict(
+                state=self.state,
+                consecutive_failures=self.consecutive_failures,
+                failures=self.failures,
+                times_opened=self.times_opened,
+            )
+
+
+class RenderCache:
+    """The last good rendering of each page, least recently used dropped."""
+
+    def __init__(self, max_entries=DEFAULT_RENDER_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._pages = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            page = self._pages.get(key)
+            if page is not None:
+                self._pages.move_to_end(key)
+            return page
+
+    def put(self, key, body, mimetype):
+        with self._lock:
+            self._pages[key] = (body, mimetype)
+            self._pages.move_to_end(key)
+            while len(self._pages) > self.max_entries:
+                self._pages.popitem(last=False)
+
+    def __len__(self):
+        return len(self._pages)
+
+
+class RecentTimelines:
+    """Each user's newest timeline messages, least recent users dropped."""
+
+    def __init__(self, max_users=DEFAULT_RENDER_CACHE_SIZE):
+        self.max_users = max_users
+        self._lock = threading.Lock()
+        self._timelines = OrderedDict()
+
+    def get(self, user_id):
+        with self._lock:
+            return list(self._timelines.get(user_id, ()))
+
+    def add(self, user_id, messages):
+        with self._lock:
+            recent = sorted(
+                {msg.id: msg for msg in
+                 [*self._timelines.get(user_id, ()), *messages]}.values(),
+                key=lambda msg: msg.timestamp, reverse=True)
+            self._timelines[user_id] = tuple(
+                recent[:TRUNCATED_TIMELINE_SIZE])
+            self._timelines.move_to_end(user_id)
+            while len(self._timelines) > self.max_users:
+                self._timelines.popitem(last=False)
+
+    def __len__(self):
+        return len(self._timelines)
+
+
+class Resilience:
+    """Breaker, caches and fallback counters for one app."""
+
+    def __init__(self, threshold, reset_seconds, cache_size, user_key):
+        self.breaker = CircuitBreaker(threshold, reset_seconds)
+        self.pages = RenderCache(cache_size)
+        self.timelines = RecentTimelines(cache_size)
+        self.user_key = user_key
+        self.fallbacks = dict(cached=0, truncated=0, unavailable=0)
+        self._lock = threading.Lock()
+
+    def count_fallback(self, kind):
+        with self._lock:
+            self.fallbacks[kind] += 1
+
+    def snapshot(self):
+        with self._lock:
+            fallbacks = dict(self.fallbacks)
+        return dict(
+            breaker=self.breaker.snapshot(),
+            fallbacks=fallbacks,
+            cached_pages=len(self.pages),
+            recent_timelines=len(self.timelines),
+        )
+
+
+def remember_timeline(user_id, messages):
+    """Keep the newest of `user_id`'s timeline `messages` for fallback."""
+
+    resilience = current_app.extensions.get('resilience')
+    if resilience is not None:
+        resilience.timelines.add(user_id, messages)
+
+
+##############################################################################
+# Flask hooks
+
+
+def init_app(app, user_key):
+    """Install timeouts, the breaker and fallbacks on `app`.
+
+    `user_key` is the session key holding the logged-in user's id, used to
+    keep each user's cached pages apart.
+    """
+
+    app.extensions['resilience'] = Resilience(
+        app.config['BREAKER_THRESHOLD'],
+        app.config['BREAKER_RESET_SECONDS'],
+        app.config['RENDER_CACHE_SIZE'],
+        user_key,
+    )
+
+    _listen_for_statements()
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+    for error in DB_ERRORS:
+        app.register_error_handler(error, _database_error)
+
+
+def _page_key(resilience):
+    return (request.full_path, session.get(resilience.user_key))
+
+
+def _before_request():
+    config = current_app.config
+    resilience = current_app.extensions['resilience']
+
+    if request.endpoint in ('static', 'warbler.show_health'):
+        return None
+
+    if not resilience.breaker.allow():
+        return _fallback(resilience)
+
+    _local.timeout_ms = config['STATEMENT_TIMEOUTS'].get(
+        request.endpoint, config['STATEMENT_TIMEOUT_MS'])
+    _local.fault_seconds = config['FAULT_SLOW_QUERY_SECONDS']
+    _local.statements = 0
+    g.resilience_tracked = True
+    return None
+
+
+def _after_request(response):
+    if not g.get('resilience_tracked'):
+        return response
+
+    resilience = current_app.extensions['resilience']
+    if response.status_code < 500 and getattr(_local, 'statements', 0):
+        resilience.breaker.record_success()
+
+    if (request.endpoint in current_app.config['FALLBACK_ENDPOINTS'] and
+            request.method == 'GET' and
+            response.status_code == 200 and
+            not response.is_streamed):
+        resilience.pages.put(
+            _page_key(resilience), response.get_data(), response.mimetype)
+
+    return response
+
+
+def _teardown_request(exc):
+    _local.timeout_ms = None
+    _local.fault_seconds = 0
+
+
+def _database_error(exc):
+    """A database error escaped a view: count it and fall back."""
+
+    db.session.rollback()
+    resilience = current_app.extensions['resilience']
+    resilience.breaker.record_failure()
+    current_app.logger.warning(
+        "Database error on %s: %s", request.endpoint, exc)
+
+    g.resilience_tracked = False
+    return _fallback(resilience)
+
+
+def _fallback(resilience):
+    """The best response we can give for this request without the DB."""
+
+    # The logged-in user can't be loaded, so pages render as anonymous.
+    g.user = None
+
+    if (request.endpoint in current_app.config['FALLBACK_ENDPOINTS'] and
+            request.method == 'GET'):
+        page = resilience.pages.get(_page_key(resilience))
+        if page is not None:
+            resilience.count_fallback('cached')
+            body, mimetype = page
+            response = make_response(body)
+            response.mimetype = mimetype
+            response.headers['Warning'] = '110 - "Response is Stale"'
+            return response
+
+        user_id = session.get(resilience.user_key)
+        recent = resilience.timelines.get(user_id) if user_id else []
+        if request.endpoint == 'warbler.homepage' and recent:
+            resilience.count_fallback('truncated')
+            return render_template('home-degraded.html', messages=recent)
+
+    resilience.count_fallback('unavailable')
+    return Response(
+        "Warbler is having trouble reaching its database. "
+        "Please try again shortly.",
+        status=503,
+        mimetype='text/plain',
+        headers={'Retry-After': str(resilience.breaker.retry_after())},
+    )
+
+
+##############################################################################
+# SQLAlchemy hooks
+
+
+@event.listens_for(Session, 'after_begin')
+def _set_statement_timeout(session, transaction, connection):
+    """SET LOCAL statement_timeout for request transactions on Postgres."""
+
+    timeout_ms = getattr(_local, 'timeout_ms', None)
+    if timeout_ms and connection.dialect.name == 'postgresql':
+        connection.exec_driver_sql(
+            f"SET LOCAL statement_timeout = {int(timeout_ms)}")
+
+
+_listening = False
+
+
+def _listen_for_statements():
+    global _listening
+
+    if not _listening:
+        event.listen(Engine, 'do_execute', _do_execute)
+        event.listen(Engine, 'do_execute_no_params', _do_execute_no_params)
+        event.listen(Engine, 'after_cursor_execute', _count_statement)
+        _listening = True
+
+
+def _do_execute(cursor, statement, parameters, context):
+    return _execute(cursor, context.dialect.name, statement, parameters)
+
+
+def _do_execute_no_params(cursor, statement, context):
+    return _execute(cursor, context.dialect.name, statement)
+
+
+def _execute(cursor, dialect_name, statement, parameters=None):
+    """Apply the request's fault, and timeout on SQLite, to a statement.
+
+    Returns True if the statement was run here, False to leave it to the
+    dialect as usual.
+    """
+
+    timeout_ms = getattr(_local, 'timeout_ms', None)
+    fault = getattr(_local, 'fault_seconds', 0)
+
+    if dialect_name == 'postgresql':
+        if fault:
+            cursor.execute("SELECT pg_sleep(%s)", (fault,))
+        return False
+
+    if dialect_name != 'sqlite' or not (timeout_ms or fault):
+        return False
+
+    deadline = time.monotonic() + timeout_ms / 1000 if timeout_ms else None
+    stall = [fault]
+
+    def progress():
+        if stall[0]:
+            time.sleep(stall[0])
+            stall[0] = 0
+        return deadline is not None and time.monotonic() > deadline
+
+    # Check every instruction while a fault is pending, so even the
+    # shortest statement gets stalled.
+    connection = cursor.connection
+    connection.set_progress_handler(
+        progress, 1 if fault else SQLITE_PROGRESS_STEPS)
+    try:
+        if parameters is None:
+            cursor.execute(statement)
+        else:
+            cursor.execute(statement, parameters)
+    finally:
+        connection.set_progress_handler(None, 0)
+
+    return True
+
+
+def _count_statement(conn, cursor, statement, parameters, context,
+                     executemany):
+    if getattr(_local, 'timeout_ms', None) is not None:
+        _local.statements = getattr(_local, 'statements', 0) + 1
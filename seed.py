@@ -1,8 +1,15 @@
 """Seed database with sample data from CSV Files."""
 
 from csv import DictReader
-from app import db
-from models import User, Message, Follow
+from datetime import datetime
+
+from app import create_app
+from models import db, User, Message, Follow
+from partitions import ensure_partitions
+from snowflake import BackfillIds
+import tags
+
+create_app().app_context().push()
 
 db.drop_all()
 db.create_all()
@@ -10,10 +17,23 @@ db.create_all()
 with open('generator/users.csv') as users:
     db.session.bulk_insert_mappings(User, DictReader(users))
 
+# Message ids are time-ordered, so they're made from the timestamps, oldest
+# first.
 with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+    rows = sorted(
+        (dict(row, timestamp=datetime.fromisoformat(row['timestamp']))
+         for row in DictReader(messages)),
+        key=lambda row: row['timestamp'])
+    message_id = BackfillIds()
+    for row in rows:
+        row['id'] = message_id(row['timestamp'])
+    if rows:
+        ensure_partitions(db.session.connection(), since=rows[0]['timestamp'])
+    db.session.bulk_insert_mappings(Message, rows)
 
 with open('generator/follows.csv') as follows:
     db.session.bulk_insert_mappings(Follow, DictReader(follows))
 
 db.session.commit()
+
+tags.backfill(db.session, workers=1)
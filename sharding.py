@@ -0,0 +1,840 @@
+"""Spread messages, likes and follows over several databases by user.
+
+With SHARD_URLS set (database URLs, comma-separated in the environment),
+every user is placed on one shard, and the messages they write, the likes
+they make and the follows they start live in that shard's database. The
+main database (DATABASE_URL) keeps everything else: users, the shard
+directory, jobs, recommendations and so on. Shard engines are Flask-
+SQLAlchemy binds named shard_0, shard_1, ..., so they are pooled, and
+disposed after a fork (gunicorn.conf.py), like the main one.
+
+A user's shard is `user_id % len(SHARD_URLS)` unless the `user_shards`
+directory table says otherwise; `ShardSet.move_user()` (`flask
+move-user`) moves a user's rows to another shard and records it there.
+
+Reads about one user (their profile, likes, who they follow) go to that
+user's shard. Reads across users go to every shard that may have rows,
+concurrently on a thread pool, and the results are merged: the home
+timeline (the shards of the user and everyone they follow), followers
+(every shard, since a follow lives with the follower), tag and mention
+pages (a message's tags and mentions live with it) and looking up a
+message by id. Authors are then looked up in the main database, which
+also leaves out tombstoned users.
+
+Without SHARD_URLS there is one shard, the main database, and every
+method here runs on the request's session as the app always has.
+
+Purging a deleted account (`ShardSet.purge_user()`) clears their rows
+from every shard. Not shard-aware yet: trending, suggestions and
+recommendations (the follow graph), archiving, partitioning and the tag
+backfill, which only see the main database. init_app() refuses to start
+with shards unless TRENDING_ENABLED and SUGGESTIONS_ENABLED are off and
+MESSAGE_ARCHIVE_DIR is unset, and the partition and backfill commands
+refuse to run.
+"""
+
+import csv
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from heapq import merge
+from itertools import islice
+
+from flask import current_app
+from sqlalchemy import (
+    BigInteger, Column, DateTime, Index, Integer, MetaData, String, Table,
+    delete, func, insert, select, tuple_)
+
+import cache
+import read_models
+import snowflake
+import tags
+from models import db, Follow, User, UserShard
+
+DEFAULT_BATCH_SIZE = 1_000
+
+# Settings for what only reads the main database so far, and must be off
+# with SHARD_URLS set.
+MAIN_DATABASE_ONLY = [
+    'TRENDING_ENABLED',
+    'SUGGESTIONS_ENABLED',
+    'MESSAGE_ARCHIVE_DIR',
+]
+
+user_shards = UserShard.__table__
+
+# Each shard has these three tables. They match the main database's, less
+# the foreign keys: users live in the main database, and a like's message
+# may be on another shard.
+metadata = MetaData()
+
+messages = Table(
+    'messages', metadata,
+    Column('id', BigInteger, primary_key=True, autoincrement=False),
+    Column('text', String(140), nullable=False),
+    Column('timestamp', DateTime, nullable=False),
+    Column('user_id', Integer, nullable=False),
+    Index('ix_messages_user_id_id', 'user_id', 'id'),
+)
+
+likes = Table(
+    'likes', metadata,
+    Column('user_id', Integer, primary_key=True),
+    Column('message_id', BigInteger, primary_key=True),
+    Column('timestamp', DateTime, nullable=False, index=True),
+    Index('ix_likes_message_id', 'message_id'),
+)
+
+follows = Table(
+    'follows', metadata,
+    Column('user_following_id', Integer, primary_key=True),
+    Column('user_being_followed_id', Integer, primary_key=True),
+    Index('ix_follows_user_being_followed_id', 'user_being_followed_id'),
+)
+
+# A message's tags and mentions live with the message (see tags.py).
+message_tags = Table(
+    'message_tags', metadata,
+    Column('tag', String(100), primary_key=True),
+    Column('message_id', BigInteger, primary_key=True, index=True),
+)
+
+mentions = Table(
+    'mentions', metadata,
+    Column('user_id', Integer, primary_key=True),
+    Column('message_id', BigInteger, primary_key=True, index=True),
+)
+
+
+def _owned(user_id):
+    """(table, condition) for the rows on `user_id`'s shard.
+
+    Messages come last: the link tables find their rows through them.
+    """
+
+    written = select(messages.c.id).where(messages.c.user_id == user_id)
+    return [
+        (message_tags, message_tags.c.message_id.in_(written)),
+        (mentions, mentions.c.message_id.in_(written)),
+        (likes, likes.c.user_id == user_id),
+        (follows, follows.c.user_following_id == user_id),
+        (messages, messages.c.user_id == user_id),
+    ]
+
+
+def _insert_messages(conn, rows):
+    """Insert message rows (dicts) on `conn`, with COPY on Postgres."""
+
+    if conn.dialect.name != 'postgresql':
+        conn.execute(insert(messages), rows)
+        return
+
+    data = io.StringIO()
+    writer = csv.writer(data)
+    for row in rows:
+        writer.writerow((row['id'], row['text'],
+                         row['timestamp'].isoformat(), row['user_id']))
+    data.seek(0)
+
+    # The session's transaction, through the driver's own connection.
+    with conn.connection.driver_connection.cursor() as cursor:
+        cursor.copy_expert(
+            "COPY messages (id, text, timestamp, user_id) "
+            "FROM STDIN WITH (FORMAT csv)", data)
+
+
+def _message_rows(conn, stmt):
+    return [tuple(row) for row in conn.execute(stmt)]
+
+
+def _users_by_id(user_ids, chunk_size):
+    """Yield the users with `user_ids` by id, `chunk_size` per query."""
+
+    user_ids = sorted(user_ids)
+    for start in range(0, len(user_ids), chunk_size):
+        yield from (User.query
+                    .filter(User.id.in_(user_ids[start:start + chunk_size]))
+                    .order_by(User.id))
+
+
+def _delete_batches(engine, table, condition, batch_size):
+    """Delete rows matching `condition`, committing every `batch_size`.
+
+    Returns how many were deleted.
+    """
+
+    key = list(table.primary_key.columns)
+    deleted = 0
+    while True:
+        with engine.begin() as conn:
+            keys = conn.execute(
+                select(*key).where(condition).limit(batch_size)).all()
+            if not keys:
+                return deleted
+            deleted += conn.execute(
+                delete(table).where(tuple_(*key).in_(keys))).rowcount
+
+
+def _select_messages():
+    return select(messages.c.id, messages.c.text, messages.c.timestamp,
+                  messages.c.user_id)
+
+
+class ShardSet:
+    """Routes message, like and follow rows to their owner's shard.
+
+    `bind_keys` name the shards' engines in `db.engines`; with none, the
+    only shard is the main database.
+    """
+
+    def __init__(self, bind_keys=()):
+        self.bind_keys = list(bind_keys)
+        self._executor = None
+        self._executor_pid = None
+
+    @property
+    def sharded(self):
+        return bool(self.bind_keys)
+
+    def __len__(self):
+        return max(1, len(self.bind_keys))
+
+    def engine(self, shard):
+        return db.engines[self.bind_keys[shard]]
+
+    def create_all(self):
+        """Create the shard tables on every shard that lacks them."""
+
+        for key in self.bind_keys:
+            metadata.create_all(db.engines[key])
+
+    def drop_all(self):
+        for key in self.bind_keys:
+            metadata.drop_all(db.engines[key])
+
+    ##########################################################################
+    # Routing
+
+    def shards_for(self, session, user_ids):
+        """{user id: shard} for each of `user_ids`."""
+
+        user_ids = set(user_ids)
+        if not self.sharded:
+            return dict.fromkeys(user_ids, 0)
+
+        placed = dict(session.execute(
+            select(user_shards.c.user_id, user_shards.c.shard)
+            .where(user_shards.c.user_id.in_(user_ids))).all())
+
+        return {user_id: placed.get(user_id, user_id % len(self))
+                for user_id in user_ids}
+
+    def shard_for(self, session, user_id):
+        return self.shards_for(session, [user_id])[user_id]
+
+    def _group(self, session, user_ids):
+        """{shard: [user ids on it]} for `user_ids`."""
+
+        grouped = {}
+        for user_id, shard in self.shards_for(session, user_ids).items():
+            grouped.setdefault(shard, []).append(user_id)
+        return grouped
+
+    @contextmanager
+    def begin(self, session, shard):
+        """A connection to write to `shard` with, in a transaction.
+
+        On the main database it's the session's own, and the caller
+        commits; a shard's commits when the block ends.
+        """
+
+        if not self.sharded:
+            yield session.connection()
+        else:
+            with self.engine(shard).begin() as conn:
+                yield conn
+
+    def _executor_for_process(self):
+        # Worker threads don't survive a fork; start new ones in the child.
+        if self._executor is None or self._executor_pid != os.getpid():
+            self._executor = ThreadPoolExecutor(
+                max_workers=len(self), thread_name_prefix='shard')
+            self._executor_pid = os.getpid()
+        return self._executor
+
+    def scatter(self, session, calls):
+        """Run `calls`, {shard: fn(conn)}, concurrently; {shard: result}."""
+
+        if not self.sharded:
+            return {shard: fn(session.connection())
+                    for shard, fn in calls.items()}
+
+        def run(engine, fn):
+            with engine.connect() as conn:
+                return fn(conn)
+
+        if len(calls) == 1:
+            [(shard, fn)] = calls.items()
+            return {shard: run(self.engine(shard), fn)}
+
+        # Engines are looked up here: the pool threads have no app context.
+        executor = self._executor_for_process()
+        futures = {shard: executor.submit(run, self.engine(shard), fn)
+                   for shard, fn in calls.items()}
+        return {shard: future.result() for shard, future in futures.items()}
+
+    def _on_owner(self, session, user_id, fn):
+        shard = self.shard_for(session, user_id)
+        return self.scatter(session, {shard: fn})[shard]
+
+    def _everywhere(self, session, fn):
+        return self.scatter(session, dict.fromkeys(range(len(self)), fn))
+
+    ##########################################################################
+    # Writes
+    #
+    # Each notes the cache tags it changes (see cache.py), invalidated when
+    # the session commits; callers commit even when the write went to a
+    # shard.
+
+    def add_message(self, session, user_id, text):
+        """Write a message by `user_id`. Returns its id."""
+
+        message_id = snowflake.next_id()
+        with self.begin(session, self.shard_for(session, user_id)) as conn:
+            conn.execute(insert(messages).values(
+                id=message_id,
+                text=text,
+                timestamp=datetime.utcnow(),
+                user_id=user_id,
+            ))
+            tags.index_messages(session, [(message_id, text)], conn)
+        cache.changed(session, f"posts:{user_id}")
+        return message_id
+
+    def delete_message(self, session, message_id, user_id):
+        """Delete message `message_id`, written by `user_id`, and its likes."""
+
+        for shard in range(len(self)):
+            with self.begin(session, shard) as conn:
+                conn.execute(
+                    delete(likes).where(likes.c.message_id == message_id))
+
+        with self.begin(session, self.shard_for(session, user_id)) as conn:
+            for table in (message_tags, mentions):
+                conn.execute(
+                    delete(table).where(table.c.message_id == message_id))
+            conn.execute(delete(messages).where(
+                messages.c.id == message_id, messages.c.user_id == user_id))
+        cache.changed(session, f"message:{message_id}", f"posts:{user_id}")
+
+    def add_messages(self, session, user_id, rows):
+        """Write many messages by `user_id` at once: (id, timestamp, text).
+
+        One bulk insert, then one pass indexing their tags and mentions.
+        """
+
+        with self.begin(session, self.shard_for(session, user_id)) as conn:
+            _insert_messages(conn, [
+                dict(id=id, text=text, timestamp=timestamp, user_id=user_id)
+                for id, timestamp, text in rows])
+            tags.index_messages(
+                session, [(id, text) for id, _, text in rows], conn)
+        cache.changed(session, f"posts:{user_id}")
+
+    def like(self, session, user_id, message_id):
+        """Record that `user_id` likes `message_id`. Returns when."""
+
+        liked_at = datetime.utcnow()
+        with self.begin(session, self.shard_for(session, user_id)) as conn:
+            conn.execute(insert(likes).values(
+                user_id=user_id, message_id=message_id, timestamp=liked_at))
+        cache.changed(session, f"likes:{user_id}")
+        return liked_at
+
+    def unlike(self, session, user_id, message_id):
+        """Remove `user_id`'s like of `message_id`.
+
+        Returns when it was made, or None if there was no such like.
+        """
+
+        where = (likes.c.user_id == user_id, likes.c.message_id == message_id)
+        with self.begin(session, self.shard_for(session, user_id)) as conn:
+            liked_at = conn.execute(
+                select(likes.c.timestamp).where(*where)).scalar()
+            conn.execute(delete(likes).where(*where))
+        cache.changed(session, f"likes:{user_id}")
+        return liked_at
+
+    def follow(self, session, user_id, followed_id):
+        with self.begin(session, self.shard_for(session, user_id)) as conn:
+            conn.execute(insert(follows).values(
+                user_following_id=user_id,
+                user_being_followed_id=followed_id,
+            ))
+        cache.changed(
+            session, f"follows:{user_id}", f"followers:{followed_id}")
+
+    def unfollow(self, session, user_id, followed_id):
+        with self.begin(session, self.shard_for(session, user_id)) as conn:
+            conn.execute(delete(follows).where(
+                follows.c.user_following_id == user_id,
+                follows.c.user_being_followed_id == followed_id,
+            ))
+        cache.changed(
+            session, f"follows:{user_id}", f"followers:{followed_id}")
+
+    ##########################################################################
+    # Reads
+
+    def following_ids(self, session, user_id):
+        """Set of ids of the users `user_id` follows."""
+
+        stmt = (select(follows.c.user_being_followed_id)
+                .where(follows.c.user_following_id == user_id))
+        return self._on_owner(
+            session, user_id, lambda conn: set(conn.execute(stmt).scalars()))
+
+    def follower_ids(self, session, user_id):
+        """Set of ids of the users following `user_id`, from every shard."""
+
+        stmt = (select(follows.c.user_following_id)
+                .where(follows.c.user_being_followed_id == user_id))
+        found = self._everywhere(
+            session, lambda conn: set(conn.execute(stmt).scalars()))
+        return set().union(*found.values())
+
+    def following_users(self, session, user_id,
+                        chunk_size=DEFAULT_BATCH_SIZE):
+        """The users `user_id` follows, by id, fetched a chunk at a time."""
+
+        if not self.sharded:
+            return (User.query
+                    .join(Follow, Follow.user_being_followed_id == User.id)
+                    .filter(Follow.user_following_id == user_id)
+                    .order_by(User.id)
+                    .yield_per(chunk_size))
+
+        return _users_by_id(self.following_ids(session, user_id), chunk_size)
+
+    def follower_users(self, session, user_id, chunk_size=DEFAULT_BATCH_SIZE):
+        """The users following `user_id`, by id, fetched a chunk at a time."""
+
+        if not self.sharded:
+            return (User.query
+                    .join(Follow, Follow.user_following_id == User.id)
+                    .filter(Follow.user_being_followed_id == user_id)
+                    .order_by(User.id)
+                    .yield_per(chunk_size))
+
+        return _users_by_id(self.follower_ids(session, user_id), chunk_size)
+
+    def liked_message_ids(self, session, user_id):
+        """Set of ids of the messages `user_id` has liked."""
+
+        stmt = select(likes.c.message_id).where(likes.c.user_id == user_id)
+        return self._on_owner(
+            session, user_id, lambda conn: set(conn.execute(stmt).scalars()))
+
+    def following_among(self, session, user_id, user_ids):
+        """The subset of `user_ids` that `user_id` follows."""
+
+        if not self.sharded:
+            return read_models.following_among(session, user_id, user_ids)
+        if not user_ids:
+            return set()
+
+        stmt = (select(follows.c.user_being_followed_id)
+                .where(follows.c.user_following_id == user_id)
+                .where(follows.c.user_being_followed_id.in_(user_ids)))
+        return self._on_owner(
+            session, user_id, lambda conn: set(conn.execute(stmt).scalars()))
+
+    def liked_among(self, session, user_id, message_ids):
+        """The subset of `message_ids` that `user_id` has liked."""
+
+        if not self.sharded:
+            return read_models.liked_among(session, user_id, message_ids)
+        if not message_ids:
+            return set()
+
+        stmt = (select(likes.c.message_id)
+                .where(likes.c.user_id == user_id)
+                .where(likes.c.message_id.in_(message_ids)))
+        return self._on_owner(
+            session, user_id, lambda conn: set(conn.execute(stmt).scalars()))
+
+    def _count(self, session, table, condition, user_id=None):
+        """Rows of `table` matching `condition`, summed over the shards.
+
+        With `user_id`, only that user's shard is counted.
+        """
+
+        stmt = select(func.count()).select_from(table).where(condition)
+
+        def count(conn):
+            return conn.execute(stmt).scalar()
+
+        if user_id is not None:
+            return self._on_owner(session, user_id, count)
+        return sum(self._everywhere(session, count).values())
+
+    def count_messages(self, session, user_id):
+        return self._count(session, messages, messages.c.user_id == user_id,
+                           user_id)
+
+    def count_following(self, session, user_id):
+        return self._count(session, follows,
+                           follows.c.user_following_id == user_id, user_id)
+
+    def count_followers(self, session, user_id):
+        return self._count(session, follows,
+                           follows.c.user_being_followed_id == user_id)
+
+    def count_likes(self, session, user_id):
+        return self._count(session, likes, likes.c.user_id == user_id,
+                           user_id)
+
+    def timeline(self, session, user_id,
+                 limit=read_models.DEFAULT_PAGE_SIZE, before=None):
+        """Like `read_models.timeline()`, gathered from every shard involved.
+
+        Each shard returns its newest `limit`; the pages are merged by id.
+        """
+
+        if not self.sharded:
+            return read_models.timeline(session, user_id, limit, before)
+
+        user_ids = self.following_ids(session, user_id) | {user_id}
+
+        def newest(ids):
+            stmt = (_select_messages()
+                    .where(messages.c.user_id.in_(ids))
+                    .order_by(messages.c.id.desc())
+                    .limit(limit))
+            if before is not None:
+                stmt = stmt.where(messages.c.id < before)
+            return lambda conn: _message_rows(conn, stmt)
+
+        pages = self.scatter(
+            session,
+            {shard: newest(ids)
+             for shard, ids in self._group(session, user_ids).items()})
+
+        return self._merged(session, pages, limit)
+
+    def _merged(self, session, pages, limit):
+        """The newest `limit` of {shard: rows newest first}, with authors."""
+
+        rows = merge(*pages.values(), key=lambda row: row[0], reverse=True)
+        return read_models.with_authors(session, list(islice(rows, limit)))
+
+    def _linked(self, session, link, condition, limit, before):
+        """Like `read_models._linked()`, gathered from every shard."""
+
+        stmt = (_select_messages()
+                .join(link, link.c.message_id == messages.c.id)
+                .where(condition)
+                .order_by(link.c.message_id.desc())
+                .limit(limit))
+        if before is not None:
+            stmt = stmt.where(link.c.message_id < before)
+
+        pages = self._everywhere(
+            session, lambda conn: _message_rows(conn, stmt))
+        return self._merged(session, pages, limit)
+
+    def tagged_messages(self, session, tag,
+                        limit=read_models.DEFAULT_PAGE_SIZE, before=None):
+        """Like `read_models.tagged_messages()`."""
+
+        if not self.sharded:
+            return read_models.tagged_messages(session, tag, limit, before)
+
+        return self._linked(session, message_tags,
+                            message_tags.c.tag == tag.lower(), limit, before)
+
+    def mentioning_messages(self, session, user_id,
+                            limit=read_models.DEFAULT_PAGE_SIZE, before=None):
+        """Like `read_models.mentioning_messages()`."""
+
+        if not self.sharded:
+            return read_models.mentioning_messages(
+                session, user_id, limit, before)
+
+        return self._linked(session, mentions, mentions.c.user_id == user_id,
+                            limit, before)
+
+    def user_messages(self, session, user_id,
+                      limit=read_models.DEFAULT_PAGE_SIZE, before=None,
+                      archive=None):
+        """Like `read_models.user_messages()`, from the user's shard."""
+
+        if not self.sharded:
+            return read_models.user_messages(
+                session, user_id, limit, before, archive)
+
+        stmt = (_select_messages()
+                .where(messages.c.user_id == user_id)
+                .order_by(messages.c.id.desc())
+                .limit(limit))
+        if before is not None:
+            stmt = stmt.where(messages.c.id < before)
+
+        found = read_models.with_authors(session, self._on_owner(
+            session, user_id, lambda conn: _message_rows(conn, stmt)))
+
+        if archive is not None and len(found) < limit:
+            found += archive.user_messages(
+                session, user_id, limit - len(found),
+                before=found[-1].id if found else before)
+
+        return found
+
+    def liked_messages(self, session, user_id,
+                       chunk_size=read_models.DEFAULT_CHUNK_SIZE,
+                       limit=None, before=None, archive=None):
+        """Like `read_models.liked_messages()`.
+
+        The likes come from the user's shard, the messages from every
+        shard.
+        """
+
+        if not self.sharded:
+            return read_models.liked_messages(
+                session, user_id, chunk_size, limit, before, archive)
+
+        stmt = (select(likes.c.message_id)
+                .where(likes.c.user_id == user_id)
+                .order_by(likes.c.message_id.desc())
+                .limit(limit))
+        if before is not None:
+            stmt = stmt.where(likes.c.message_id < before)
+
+        liked_ids = self._on_owner(
+            session, user_id, lambda conn: list(conn.execute(stmt).scalars()))
+        found = self._find_messages(session, liked_ids)
+
+        if archive is not None and (limit is None or len(found) < limit):
+            found += archive.liked_messages(
+                session, user_id,
+                None if limit is None else limit - len(found),
+                before=liked_ids[-1] if liked_ids else before)
+
+        return found
+
+    def message_texts(self, session, after, limit):
+        """(id, text) of the newest `limit` messages after id `after`.
+
+        Newest first, from every shard.
+        """
+
+        stmt = (select(messages.c.id, messages.c.text)
+                .where(messages.c.id > after)
+                .order_by(messages.c.id.desc())
+                .limit(limit))
+
+        pages = self.scatter(
+            session, dict.fromkeys(
+                range(len(self)), lambda conn: _message_rows(conn, stmt)))
+        rows = merge(*pages.values(), key=lambda row: row[0], reverse=True)
+        return list(islice(rows, limit))
+
+    def existing_message_ids(self, session, message_ids):
+        """The set of `message_ids` already used, on any shard."""
+
+        stmt = select(messages.c.id).where(messages.c.id.in_(message_ids))
+        found = self._everywhere(
+            session, lambda conn: set(conn.execute(stmt).scalars()))
+        return set().union(*found.values())
+
+    def _find_messages(self, session, message_ids):
+        """The messages with `message_ids`, in that order, from every shard."""
+
+        if not message_ids:
+            return []
+
+        stmt = _select_messages().where(messages.c.id.in_(message_ids))
+        found = {}
+        for rows in self._everywhere(
+                session, lambda conn: _message_rows(conn, stmt)).values():
+            found.update((row[0], row) for row in rows)
+
+        return read_models.with_authors(
+            session, [found[id] for id in message_ids if id in found])
+
+    def message(self, session, message_id):
+        """The message with `message_id`, or None."""
+
+        if not self.sharded:
+            return read_models.message(session, message_id)
+
+        found = self._find_messages(session, [message_id])
+        return found[0] if found else None
+
+    def stream(self, session, shard, stmt, chunk_size):
+        """Yield lists of up to `chunk_size` rows of `stmt` on `shard`.
+
+        Rows come through a server-side cursor where the driver has one,
+        so however many there are, only a chunk is held at a time.
+        """
+
+        stmt = stmt.execution_options(yield_per=chunk_size)
+        if not self.sharded:
+            yield from session.connection().execute(stmt).partitions()
+        else:
+            with self.engine(shard).connect() as conn:
+                yield from conn.execute(stmt).partitions()
+
+    ##########################################################################
+    # Rebalancing
+
+    def _copy_user(self, source, target, user_id, batch_size):
+        """Copy `user_id`'s rows the target doesn't have yet. Returns count."""
+
+        copied = 0
+        with source.connect() as src, target.begin() as dst:
+            for table, owned in _owned(user_id):
+                key = list(table.primary_key.columns)
+                have = {tuple(row) for row in dst.execute(
+                    select(*key).where(owned))}
+
+                rows = src.execute(
+                    select(table).where(owned),
+                    execution_options={'yield_per': batch_size})
+                for batch in rows.mappings().partitions():
+                    missing = [dict(row) for row in batch
+                               if tuple(row[col.key] for col in key)
+                               not in have]
+                    if missing:
+                        dst.execute(insert(table), missing)
+                        copied += len(missing)
+
+        return copied
+
+    def move_user(self, session, user_id, to_shard,
+                  batch_size=DEFAULT_BATCH_SIZE):
+        """Move `user_id`'s messages, likes and follows to `to_shard`.
+
+        Copies them over, points the directory at the new shard, copies
+        anything written to the old one meanwhile, then deletes the old
+        copies. A write that picked its shard before the switch and lands
+        after the second copy is lost, so move users while they're idle.
+        Returns the number of rows moved.
+        """
+
+        if not self.sharded:
+            raise ValueError("SHARD_URLS is not set: there is one shard.")
+        if not 0 <= to_shard < len(self):
+            raise ValueError(f"shard must be 0-{len(self) - 1}")
+
+        from_shard = self.shard_for(session, user_id)
+        if from_shard == to_shard:
+            return 0
+
+        source, target = self.engine(from_shard), self.engine(to_shard)
+        moved = self._copy_user(source, target, user_id, batch_size)
+
+        placed = session.get(UserShard, user_id)
+        if placed is None:
+            session.add(UserShard(user_id=user_id, shard=to_shard))
+        else:
+            placed.shard = to_shard
+        session.commit()
+
+        moved += self._copy_user(source, target, user_id, batch_size)
+
+        with source.begin() as conn:
+            for table, owned in _owned(user_id):
+                conn.execute(delete(table).where(owned))
+
+        return moved
+
+    def purge_user(self, session, user_id, batch_size=DEFAULT_BATCH_SIZE):
+        """Delete `user_id`'s rows from every shard, a batch at a time.
+
+        Their own rows are on their shard; likes of their messages,
+        follows of them and mentions of them may be on any. Returns the
+        number of rows deleted.
+        """
+
+        if not self.sharded:
+            return 0
+
+        engines = [self.engine(shard) for shard in range(len(self))]
+        home = self.shard_for(session, user_id)
+        deleted = 0
+
+        # Their message ids a page at a time, with nothing left open on
+        # the home shard while its likes are deleted.
+        after = 0
+        while True:
+            with engines[home].connect() as conn:
+                message_ids = list(conn.execute(
+                    select(messages.c.id)
+                    .where(messages.c.user_id == user_id,
+                           messages.c.id > after)
+                    .order_by(messages.c.id)
+                    .limit(batch_size)).scalars())
+            if not message_ids:
+                break
+            after = message_ids[-1]
+            for engine in engines:
+                deleted += _delete_batches(
+                    engine, likes, likes.c.message_id.in_(message_ids),
+                    batch_size)
+
+        for engine in engines:
+            deleted += _delete_batches(
+                engine, follows, follows.c.user_being_followed_id == user_id,
+                batch_size)
+            deleted += _delete_batches(
+                engine, mentions, mentions.c.user_id == user_id, batch_size)
+
+        for table, owned in _owned(user_id):
+            deleted += _delete_batches(
+                engines[home], table, owned, batch_size)
+
+        return deleted
+
+    def counts(self):
+        """Rows per table on each shard, for checking the balance."""
+
+        if not self.sharded:
+            return []
+
+        def count(conn):
+            return {table.name: conn.execute(
+                select(func.count()).select_from(table)).scalar()
+                for table, _ in _owned(0)}
+
+        found = self.scatter(None, dict.fromkeys(range(len(self)), count))
+        return [found[shard] for shard in range(len(self))]
+
+
+def current():
+    """The ShardSet of the current app."""
+
+    return current_app.extensions['shards']
+
+
+def init_app(app):
+    """Register SHARD_URLS as binds and set up routing. Before connect_db."""
+
+    binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+    keys = []
+    for shard, url in enumerate(app.config['SHARD_URLS']):
+        key = f"shard_{shard}"
+        binds[key] = url
+        keys.append(key)
+
+    unsupported = [key for key in MAIN_DATABASE_ONLY if app.config.get(key)]
+    if keys and unsupported:
+        raise ValueError(
+            "These only see the main database; turn them off to use "
+            f"SHARD_URLS: {', '.join(unsupported)}")
+
+    app.config['SQLALCHEMY_BINDS'] = binds
+    app.extensions['shards'] = ShardSet(keys)
@@ -0,0 +1,159 @@
+"""Time-ordered 64-bit ids ("snowflakes") for messages.
+
+An id packs, from the high bits down:
+
+- 41 bits: milliseconds since EPOCH_MS (2020-01-01 UTC), good until 2089
+- 10 bits: worker id, unique among the processes making ids at once
+- 12 bits: sequence number within the millisecond
+
+so ids sort by creation time and `ORDER BY id` is chronological, with no
+ties. Pages can be fetched with `WHERE id < :before ORDER BY id DESC`
+straight off the primary key.
+
+Worker ids: gunicorn.conf.py gives each worker process the lowest slot no
+live worker is using, offset by SNOWFLAKE_WORKER_BASE (so separate hosts
+can be given separate ranges), below PID_WORKER_BASE. Other processes
+(flask run, the CLI, job workers) use one derived from their pid, from
+PID_WORKER_BASE up, so they never share an id with a gunicorn worker.
+Worker id BACKFILL_WORKER_ID is kept for ids made from stored timestamps
+(migration, seeding, imports).
+"""
+
+import os
+import threading
+import time
+from datetime import timezone
+
+EPOCH_MS = 1_577_836_800_000
+
+TIMESTAMP_BITS = 41
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+
+MAX_WORKER_ID = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+BACKFILL_WORKER_ID = MAX_WORKER_ID
+
+# Worker ids from here to BACKFILL_WORKER_ID - 1 are derived from pids;
+# gunicorn slots (plus SNOWFLAKE_WORKER_BASE) must stay below it.
+PID_WORKER_BASE = 512
+
+# Ids from the old autoincrement sequence are far below this; any
+# snowflake made after the first few minutes of EPOCH_MS is above it.
+MIN_SNOWFLAKE = 1 << 40
+
+# The first millisecond whose ids are all at least MIN_SNOWFLAKE.
+MIN_SNOWFLAKE_MS = MIN_SNOWFLAKE >> (WORKER_BITS + SEQUENCE_BITS)
+
+
+def compose(ms, worker_id, sequence):
+    """The id for `ms` since EPOCH_MS, `worker_id` and `sequence`."""
+
+    return ((ms << (WORKER_BITS + SEQUENCE_BITS)) |
+            (worker_id << SEQUENCE_BITS) |
+            sequence)
+
+
+def decompose(snowflake):
+    """(ms since EPOCH_MS, worker id, sequence) for `snowflake`."""
+
+    return (snowflake >> (WORKER_BITS + SEQUENCE_BITS),
+            (snowflake >> SEQUENCE_BITS) & MAX_WORKER_ID,
+            snowflake & MAX_SEQUENCE)
+
+
+def to_ms(timestamp):
+    """Milliseconds since EPOCH_MS for a naive UTC datetime (as stored)."""
+
+    epoch_seconds = timestamp.replace(tzinfo=timezone.utc).timestamp()
+    return round(epoch_seconds * 1000) - EPOCH_MS
+
+
+def _pid_worker_id():
+    return PID_WORKER_BASE + os.getpid() % (
+        BACKFILL_WORKER_ID - PID_WORKER_BASE)
+
+
+class IdGenerator:
+    """Makes unique, increasing ids for one process."""
+
+    def __init__(self, worker_id=None, clock=time.time):
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.set_worker_id(worker_id)
+
+    def set_worker_id(self, worker_id=None):
+        """Use `worker_id` from now on (default: derived from the pid)."""
+
+        if worker_id is None:
+            worker_id = _pid_worker_id()
+        if not 0 <= worker_id <= MAX_WORKER_ID:
+            raise ValueError(f"worker id must be 0-{MAX_WORKER_ID}")
+
+        with self._lock:
+            self.worker_id = worker_id
+            self._last_ms = -1
+            self._sequence = 0
+
+    def next_id(self):
+        with self._lock:
+            ms = int(self._clock() * 1000) - EPOCH_MS
+
+            # If the clock steps back, keep counting from where we were
+            # rather than risk reusing ids.
+            if ms <= self._last_ms:
+                ms = self._last_ms
+                self._sequence += 1
+                if self._sequence > MAX_SEQUENCE:
+                    # Out of ids for this millisecond: borrow the next.
+                    ms += 1
+                    self._sequence = 0
+            else:
+                self._sequence = 0
+
+            self._last_ms = ms
+            return compose(ms, self.worker_id, self._sequence)
+
+    def _after_fork(self):
+        # The lock may have been held by another thread at the fork.
+        self._lock = threading.Lock()
+        self.set_worker_id()
+
+
+class BackfillIds:
+    """Ids for stored timestamps, fed in nondecreasing order.
+
+    Uses BACKFILL_WORKER_ID, so the ids can't collide with ones made by
+    running app processes; only one backfill should run at a time.
+    """
+
+    def __init__(self):
+        self._last_ms = -1
+        self._sequence = 0
+
+    def __call__(self, timestamp):
+        ms = to_ms(timestamp)
+        if ms <= self._last_ms:
+            ms = self._last_ms
+            self._sequence += 1
+            if self._sequence > MAX_SEQUENCE:
+                ms += 1
+                self._sequence = 0
+        else:
+            self._sequence = 0
+
+        self._last_ms = ms
+        return compose(ms, BACKFILL_WORKER_ID, self._sequence)
+
+
+generator = IdGenerator()
+
+# A forked child must not keep making its parent's ids. gunicorn workers
+# are given their own slot afterwards, in post_fork.
+os.register_at_fork(after_in_child=generator._after_fork)
+
+
+def next_id():
+    """A new id from this process's generator."""
+
+    return generator.next_id()
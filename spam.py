@@ -0,0 +1,334 @@
+"""Near-duplicate screening for new messages: MinHash with an LSH index.
+
+Bot accounts post slight variations of one text. Comparing a new message
+with each recent one is linear per post, quadratic overall; instead each
+message gets a MinHash signature, and similar signatures are found through
+locality-sensitive hashing:
+
+- Text is lowercased with whitespace collapsed, and cut into overlapping
+  4-byte shingles, each read as a 32-bit integer x. A signature is the
+  minimum over the shingles of each of NUM_PERM random hash functions,
+  ((a * x + b) mod 2**64) >> 32 (multiply-add-shift, 2-universal on
+  32-bit keys); two texts agree at each position with probability equal
+  to the Jaccard similarity of their shingle sets.
+- The signature is cut into `bands` bands of `rows` values. Texts that
+  agree on a whole band land in the same bucket of that band's table, so
+  candidates are found with one lookup per band. Pairs with similarity s
+  share at least one band with probability 1 - (1 - s**rows)**bands.
+- Candidates are confirmed by comparing signatures: the share of equal
+  positions estimates the similarity, and those at or above `threshold`
+  count as near-duplicates.
+
+`NearDuplicateIndex` keeps the newest `window` messages (rounded up to a
+power of two) in fixed numpy arrays, so memory doesn't grow: per message,
+NUM_PERM bytes of signature (the low 8 bits of each value, a "b-bit"
+MinHash; the estimate is corrected for chance matches) and 4 bytes per
+band. Each band's table is a direct-mapped array of bucket heads, with a
+chain through the messages in the bucket, newest first. Messages carry a
+sequence number, and anything `window` or more posts old is treated as
+gone, so old messages fall out of the window without any bookkeeping.
+
+`SpamFilter` is an app's index. It is built from the messages table
+the first time it is used, then kept up to date with the posts of this
+process and, every `refresh_seconds`, the posts of other processes: the
+messages with ids after the newest one read from the database so far.
+Ids are snowflakes, made before their transaction commits, so each
+refresh looks back `lookback_seconds` past that id, skipping messages
+already indexed; a post that takes longer than that to commit, or an
+import (whose ids are backdated), is only seen by other processes after
+a restart.
+
+add_message() refuses a message with `max_duplicates` or more
+near-duplicates in the window. Texts shorter than `min_length` are let
+through unscreened: short replies repeat innocently.
+"""
+
+import math
+import threading
+import time
+
+import numpy as np
+from flask import current_app
+
+import sharding
+import snowflake
+
+NUM_PERM = 64
+SHINGLE_SIZE = 4
+
+DEFAULT_WINDOW = 100_000
+DEFAULT_BANDS = 16
+DEFAULT_ROWS = 4
+DEFAULT_THRESHOLD = 0.8
+DEFAULT_MAX_DUPLICATES = 3
+DEFAULT_MIN_LENGTH = 20
+DEFAULT_REFRESH_SECONDS = 5
+DEFAULT_LOOKBACK_SECONDS = 10
+
+# Bucket entries followed per band when looking for candidates.
+MAX_CHAIN = 32
+
+SEED = 1
+
+# Chance that two different hash values agree in their low 8 bits.
+BYTE_COLLISION = 1 / 256
+
+
+def normalize(text):
+    return " ".join(text.lower().split())
+
+
+class MinHasher:
+    """MinHash signatures of `num_perm` 32-bit values."""
+
+    def __init__(self, num_perm=NUM_PERM, seed=SEED):
+        rng = np.random.default_rng(seed)
+        self.num_perm = num_perm
+        self._a = rng.integers(
+            0, 1 << 63, num_perm, dtype=np.uint64) << np.uint64(1) | \
+            np.uint64(1)
+        self._b = rng.integers(0, 1 << 63, num_perm, dtype=np.uint64)
+
+    def shingles(self, text):
+        """The text's 4-byte shingles, each as one big-endian integer."""
+
+        data = normalize(text).encode()
+        if len(data) < SHINGLE_SIZE:
+            data = data.ljust(SHINGLE_SIZE, b"\0")
+
+        # Overlapping 4-byte reads: a view with a 1-byte stride.
+        count = len(data) - SHINGLE_SIZE + 1
+        return np.ndarray((count,), dtype='>u4', buffer=data,
+                          strides=(1,)).astype(np.uint64)
+
+    def signature(self, text):
+        # uint64 arithmetic wraps around: the mod 2**64 is free.
+        hashes = (self.shingles(text)[:, None] * self._a + self._b) >> \
+            np.uint64(32)
+        return hashes.min(axis=0).astype(np.uint32)
+
+
+class NearDuplicateIndex:
+    """The newest `window` messages' signatures, in an LSH band index."""
+
+    def __init__(self, window=DEFAULT_WINDOW, bands=DEFAULT_BANDS,
+                 rows=DEFAULT_ROWS, threshold=DEFAULT_THRESHOLD):
+        if bands * rows != NUM_PERM:
+            raise ValueError(f"bands * rows must be {NUM_PERM}")
+
+        self.window = 1 << max(window - 1, 1).bit_length()
+        self.bands = bands
+        self.rows = rows
+        self.threshold = threshold
+        self.hasher = MinHasher()
+
+        # The threshold as equal positions, undoing the correction.
+        self._min_matches = math.ceil(
+            NUM_PERM * (threshold * (1 - BYTE_COLLISION) + BYTE_COLLISION))
+        self._mask = self.window - 1
+        self._shift = np.uint64(64 - self.window.bit_length() + 1)
+        self._band_numbers = np.arange(bands)
+        rng = np.random.default_rng(SEED + 1)
+        self._band_mix = np.tile(rng.integers(
+            1, 1 << 63, rows, dtype=np.uint64) | np.uint64(1), bands)
+
+        # Sequence numbers start at 1; 0 is an empty bucket.
+        self._signatures = np.zeros((self.window, NUM_PERM), dtype=np.uint8)
+        self._heads = np.zeros((bands, self.window), dtype=np.uint32)
+        self._next = np.zeros((self.window, bands), dtype=np.uint32)
+        # Python-level views: the chain walk touches a few entries, each
+        # faster to read through these than through numpy indexing.
+        self._head_view = memoryview(self._heads)
+        self._next_view = memoryview(self._next)
+        self.seq = 0
+
+    def __len__(self):
+        return min(self.seq, self.window)
+
+    @property
+    def nbytes(self):
+        return (self._signatures.nbytes + self._heads.nbytes +
+                self._next.nbytes)
+
+    def signature(self, text):
+        return self.hasher.signature(text)
+
+    def _buckets(self, signature):
+        """The bucket in each band's table for `signature`."""
+
+        # uint64 arithmetic wraps around, as a hash should.
+        keys = (signature.astype(np.uint64) * self._band_mix).reshape(
+            self.bands, self.rows).sum(axis=1)
+        return (keys >> self._shift).astype(np.intp)
+
+    def candidates(self, signature):
+        """Sequence numbers of messages sharing a band with `signature`.
+
+        Chains hold every message in a bucket, not just the ones agreeing
+        on the band, so a few unrelated candidates come along; comparing
+        signatures weeds them out.
+        """
+
+        heads, links = self._head_view, self._next_view
+        newest, window, mask = self.seq, self.window, self._mask
+        found = set()
+
+        for band, bucket in enumerate(self._buckets(signature).tolist()):
+            seq = heads[band, bucket]
+            for _ in range(MAX_CHAIN):
+                if not seq or (newest - seq) & 0xFFFFFFFF >= window:
+                    break
+                found.add(seq)
+                seq = links[seq & mask, band]
+
+        return np.fromiter(found, dtype=np.uint32, count=len(found))
+
+    def _matches(self, signature):
+        """Equal signature positions of each candidate."""
+
+        seqs = self.candidates(signature)
+        if not len(seqs):
+            return np.empty(0, dtype=np.intp)
+
+        return (self._signatures[seqs & self._mask] ==
+                signature.astype(np.uint8)).sum(axis=1)
+
+    def similarities(self, signature):
+        """Estimated similarity of `signature` to each candidate."""
+
+        matches = self._matches(signature) / NUM_PERM
+        return (matches - BYTE_COLLISION) / (1 - BYTE_COLLISION)
+
+    def duplicates(self, signature):
+        """How many messages in the window are near-duplicates."""
+
+        return int((self._matches(signature) >= self._min_matches).sum())
+
+    def add(self, signature):
+        seq = self.seq = (self.seq + 1) & 0xFFFFFFFF
+        slot = seq & self._mask
+        buckets = self._buckets(signature)
+
+        self._signatures[slot] = signature.astype(np.uint8)
+        self._next[slot] = self._heads[self._band_numbers, buckets]
+        self._heads[self._band_numbers, buckets] = seq
+
+    def add_texts(self, texts):
+        """Add texts, oldest first. Returns how many."""
+
+        count = 0
+        for text in texts:
+            self.add(self.signature(text))
+            count += 1
+        return count
+
+
+class SpamFilter:
+    """An app's near-duplicate index, kept up to date with the database."""
+
+    def __init__(self, max_duplicates=DEFAULT_MAX_DUPLICATES,
+                 min_length=DEFAULT_MIN_LENGTH,
+                 refresh_seconds=DEFAULT_REFRESH_SECONDS,
+                 lookback_seconds=DEFAULT_LOOKBACK_SECONDS, **index_kwargs):
+        self.max_duplicates = max_duplicates
+        self.min_length = min_length
+        self.refresh_seconds = refresh_seconds
+        self._lookback = snowflake.compose(
+            int(lookback_seconds * 1000), 0, 0)
+        self._index_kwargs = index_kwargs
+        self._index = None
+        self._refreshed_at = 0
+        # The newest id read from the database, and the ids indexed since
+        # `_lookback` before it, which later refreshes skip.
+        self._cursor = 0
+        self._recent = set()
+        self._lock = threading.Lock()
+        self.screened = 0
+        self.rejected = 0
+
+    def _load(self, session, index):
+        rows = sharding.current().message_texts(
+            session, max(self._cursor - self._lookback, 0), index.window)
+        new = [(message_id, text) for message_id, text in reversed(rows)
+               if message_id not in self._recent]
+        index.add_texts(text for _, text in new)
+
+        if rows:
+            self._cursor = max(self._cursor, rows[0][0])
+        self._recent.update(message_id for message_id, _ in new)
+        self._recent = {message_id for message_id in self._recent
+                        if message_id > self._cursor - self._lookback}
+        self._refreshed_at = time.monotonic()
+
+    def get(self, session):
+        """The index: built on first use, then refreshed when due.
+
+        Call with the lock held.
+        """
+
+        if self._index is None:
+            index = NearDuplicateIndex(**self._index_kwargs)
+            self._load(session, index)
+            self._index = index
+        elif time.monotonic() - self._refreshed_at > self.refresh_seconds:
+            self._load(session, self._index)
+
+        return self._index
+
+    def is_spam(self, session, text):
+        """Would `text` be one near-duplicate too many?"""
+
+        if len(normalize(text)) < self.min_length:
+            return False
+
+        with self._lock:
+            index = self.get(session)
+            duplicates = index.duplicates(index.signature(text))
+            self.screened += 1
+            if duplicates >= self.max_duplicates:
+                self.rejected += 1
+                return True
+
+        return False
+
+    def add(self, message_id, text):
+        """Add a message just posted by this process.
+
+        Refreshes skip it; they still read past it for other processes'.
+        """
+
+        with self._lock:
+            if self._index is not None:
+                self._index.add(self._index.signature(text))
+                self._recent.add(message_id)
+
+    def snapshot(self):
+        index = self._index
+        return {
+            'screened': self.screened,
+            'rejected': self.rejected,
+            'indexed': len(index) if index is not None else 0,
+            'window': index.window if index is not None else None,
+            'bytes': index.nbytes if index is not None else 0,
+        }
+
+
+def current():
+    """The current app's SpamFilter, or None if screening is off."""
+
+    return current_app.extensions.get('spam')
+
+
+def init_app(app):
+    if not app.config['SPAM_FILTER_ENABLED']:
+        return
+
+    app.extensions['spam'] = SpamFilter(
+        max_duplicates=app.config['SPAM_MAX_DUPLICATES'],
+        min_length=app.config['SPAM_MIN_LENGTH'],
+        refresh_seconds=app.config['SPAM_REFRESH_SECONDS'],
+        window=app.config['SPAM_WINDOW'],
+        bands=app.config['SPAM_BANDS'],
+        rows=app.config['SPAM_ROWS'],
+        threshold=app.config['SPAM_THRESHOLD'],
+    )
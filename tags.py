@@ -0,0 +1,173 @@
+"""Hashtags and @mentions, indexed for the tag and mentions pages.
+
+Finding the messages about #something, or mentioning @someone, in the
+text itself would mean a LIKE scan over every message. Instead, when a
+message is written its tags and mentions are extracted into two link
+tables, `message_tags` (tag, message_id) and `mentions` (user_id,
+message_id). Their primary keys are the indexes the pages read: newest
+first by message id, paged with `before` like the other lists (see
+read_models.py).
+
+Tags are case-insensitive and stored lowercased. A mention counts if the
+username exists when the message is indexed.
+
+Messages written some other way (seed.py, older rows) are indexed by
+`backfill()`, the `backfill_tags` job and `flask backfill-tags`. It reads
+messages in id order a batch at a time, extracts tags on a process pool,
+and replaces each batch's links in its own transaction. It can be
+restarted from the last id it got to.
+"""
+
+import os
+import re
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from sqlalchemy import delete, insert, select
+
+from models import Mention, Message, MessageTag, User
+
+message_tags = MessageTag.__table__
+mentions = Mention.__table__
+messages = Message.__table__
+users = User.__table__
+
+MAX_TAG_LENGTH = message_tags.c.tag.type.length
+
+# Not preceded by a word character, so "a#b" and "me@example.com" are
+# neither tags nor mentions.
+TAG_RE = re.compile(r'(?<![\w#])#(\w+)')
+MENTION_RE = re.compile(r'(?<![\w@])@(\w+)')
+
+DEFAULT_BATCH_SIZE = 5_000
+
+# Batches handed to the pool ahead of the one being written, per worker.
+BATCHES_AHEAD = 2
+
+
+def extract(text):
+    """(tags, usernames) in `text`, each sorted and without duplicates."""
+
+    tags = {tag.lower() for tag in TAG_RE.findall(text)
+            if len(tag) <= MAX_TAG_LENGTH}
+    return sorted(tags), sorted(set(MENTION_RE.findall(text)))
+
+
+def _extract_batch(rows):
+    """[(id, tags, usernames)] for (id, text) rows."""
+
+    return [(id, *extract(text)) for id, text in rows]
+
+
+def _write_links(session, conn, extracted):
+    """Insert link rows for [(id, tags, usernames)] on `conn`.
+
+    Usernames are looked up in one query on `session`, which has the users
+    table. Returns the number of rows inserted.
+    """
+
+    usernames = {name for _, _, names in extracted for name in names}
+    user_ids = dict(session.execute(
+        select(users.c.username, users.c.id)
+        .where(users.c.username.in_(usernames))).all()) if usernames else {}
+
+    tag_rows = [dict(tag=tag, message_id=id)
+                for id, tags, _ in extracted for tag in tags]
+    mention_rows = [dict(user_id=user_ids[name], message_id=id)
+                    for id, _, names in extracted for name in names
+                    if name in user_ids]
+
+    if tag_rows:
+        conn.execute(insert(message_tags), tag_rows)
+    if mention_rows:
+        conn.execute(insert(mentions), mention_rows)
+
+    return len(tag_rows) + len(mention_rows)
+
+
+def index_messages(session, rows, conn=None):
+    """Index the tags and mentions of new messages, (id, text) rows.
+
+    `conn` is where the messages are, if not the session's database (a
+    shard). The caller commits. Returns the number of links written.
+    """
+
+    return _write_links(session, conn or session.connection(),
+                        _extract_batch(rows))
+
+
+def _batches(session, after, batch_size):
+    """Lists of (id, text) for messages with ids after `after`, in order.
+
+    Each batch is its own keyset query, so committing in between is fine.
+    """
+
+    while True:
+        rows = session.execute(
+            select(messages.c.id, messages.c.text)
+            .where(messages.c.id > after)
+            .order_by(messages.c.id)
+            .limit(batch_size)).all()
+        if not rows:
+            return
+
+        yield [tuple(row) for row in rows]
+        after = rows[-1][0]
+
+
+def _in_order(pool, fn, batches, ahead):
+    """`pool.map(fn, batches)`, but with at most `ahead` batches submitted.
+
+    Executor.map would read every batch up front.
+    """
+
+    pending = deque()
+    for batch in batches:
+        pending.append(pool.submit(fn, batch))
+        if len(pending) >= ahead:
+            yield pending.popleft().result()
+
+    while pending:
+        yield pending.popleft().result()
+
+
+def backfill(session, after=0, batch_size=DEFAULT_BATCH_SIZE, workers=None,
+             progress=None):
+    """Rebuild the tags and mentions of every message with id > `after`.
+
+    With `workers=1` everything runs in this process. Each batch's links
+    are replaced and committed together; `progress(count, last_id)` is
+    called after each. Returns (messages indexed, last id).
+    """
+
+    batches = _batches(session, after, batch_size)
+    count, last_id = 0, after
+
+    pool = None
+    if workers == 1:
+        extracted_batches = map(_extract_batch, batches)
+    else:
+        workers = workers or os.cpu_count()
+        pool = ProcessPoolExecutor(max_workers=workers)
+        extracted_batches = _in_order(
+            pool, _extract_batch, batches, workers * BATCHES_AHEAD)
+
+    try:
+        for extracted in extracted_batches:
+            first_id, last_id = extracted[0][0], extracted[-1][0]
+
+            conn = session.connection()
+            for table in (message_tags, mentions):
+                conn.execute(delete(table).where(
+                    table.c.message_id.between(first_id, last_id)))
+            _write_links(session, conn, extracted)
+            session.commit()
+
+            count += len(extracted)
+            if progress:
+                progress(count, last_id)
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+
+    return count, last_id
@@ -0,0 +1,118 @@
+"""Background job handlers.
+
+Each handler is registered with `jobs.job_handler` under the kind that
+routes pass to `jobs.enqueue`, and is run by `flask worker`.
+"""
+
+from datetime import datetime, time, timedelta
+
+from flask import current_app
+
+from deletion import purge_user
+import export
+from jobs import enqueue, job_handler
+import notifications
+from partitions import ensure_partitions
+import tags
+
+
+@job_handler('delete_user')
+def delete_user(session, user_id):
+    """Purge a tombstoned user's rows in batches, then the user.
+
+    Their prepared export is deleted too. Web processes' availability
+    filters drop their username and email at the next rebuild.
+    """
+
+    purge_user(session, user_id)
+    export.remove(current_app.config['EXPORT_DIR'], user_id)
+
+
+@job_handler('export_user')
+def export_user(session, user_id):
+    """Write `user_id`'s data export to EXPORT_DIR. Returns the path.
+
+    Queues its deletion for when it expires.
+    """
+
+    path = export.write(
+        session, user_id, current_app.config['EXPORT_DIR'],
+        current_app.extensions.get('message_archive'))
+
+    expire_seconds = current_app.config['EXPORT_EXPIRE_SECONDS']
+    enqueue(
+        session,
+        'expire_export',
+        {'user_id': user_id},
+        run_at=datetime.utcnow() + timedelta(seconds=expire_seconds),
+    )
+    session.commit()
+
+    return path
+
+
+@job_handler('expire_export')
+def expire_export(session, user_id):
+    """Delete `user_id`'s prepared export once it has expired.
+
+    A newer export written since is left for its own job. Returns whether
+    the file was deleted.
+    """
+
+    return export.expire(current_app.config['EXPORT_DIR'], user_id,
+                         current_app.config['EXPORT_EXPIRE_SECONDS'])
+
+
+@job_handler('backfill_tags')
+def backfill_tags(session, after=0, batch_size=tags.DEFAULT_BATCH_SIZE,
+                  workers=None):
+    """Index the tags and mentions of messages with ids after `after`.
+
+    Returns (messages indexed, last id).
+    """
+
+    return tags.backfill(session, after, batch_size, workers)
+
+
+@job_handler('maintain_partitions')
+def maintain_partitions(session):
+    """Create upcoming monthly message partitions, then run again tomorrow.
+
+    Returns the names of the partitions created.
+    """
+
+    created = ensure_partitions(session.connection())
+    session.commit()
+
+    tomorrow = datetime.utcnow().date() + timedelta(days=1)
+    enqueue(
+        session,
+        'maintain_partitions',
+        idempotency_key=f"maintain_partitions:{tomorrow}",
+        run_at=datetime.combine(tomorrow, time()),
+    )
+    session.commit()
+
+    return created
+
+
+@job_handler('prune_notifications')
+def prune_notifications(session):
+    """Delete old read notifications, then run again tomorrow.
+
+    Returns the number deleted.
+    """
+
+    pruned = notifications.prune(session)
+    session.commit()
+
+    tomorrow = datetime.utcnow().date() + timedelta(days=1)
+    enqueue(
+        session,
+        'prune_notifications',
+        idempotency_key=f"prune_notifications:{tomorrow}",
+        run_at=datetime.combine(tomorrow, time()),
+    )
+    session.commit()
+
+    return pruned
@@ -0,0 +1,151 @@
+"""Admission control tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_admission.py
+
+
+import multiprocessing
+import threading
+from unittest import TestCase
+
+from admission import ConcurrencyLimiter, TokenBuckets
+from app import CURR_USER_KEY
+from testing import create_test_app
+from models import db, User, Message
+
+
+class ConcurrencyLimiterTestCase(TestCase):
+    """Tests for ConcurrencyLimiter"""
+
+    def test_sheds_when_queue_full(self):
+        """Tests that requests over the limit with no queue are shed"""
+
+        limiter = ConcurrencyLimiter(limit=1, queue_size=0)
+
+        self.assertTrue(limiter.acquire())
+        self.assertFalse(limiter.acquire())
+        limiter.release()
+        self.assertTrue(limiter.acquire())
+
+        snapshot = limiter.snapshot()
+        self.assertEqual(snapshot['in_flight'], 1)
+        self.assertEqual(snapshot['admitted'], 2)
+        self.assertEqual(snapshot['shed'], 1)
+
+    def test_waits_in_queue(self):
+        """Tests that a queued request gets the slot when it is freed"""
+
+        limiter = ConcurrencyLimiter(limit=1, queue_size=1, timeout=5)
+        limiter.acquire()
+
+        timer = threading.Timer(0.05, limiter.release)
+        timer.start()
+        self.assertTrue(limiter.acquire())
+        timer.join()
+
+        self.assertEqual(limiter.snapshot()['queued'], 1)
+
+    def test_queue_timeout(self):
+        """Tests that a queued request is shed when its wait runs out"""
+
+        limiter = ConcurrencyLimiter(limit=1, queue_size=1, timeout=0.01)
+        limiter.acquire()
+
+        self.assertFalse(limiter.acquire())
+        self.assertEqual(limiter.snapshot()['waiting'], 0)
+
+
+    def test_reclaims_dead_holder(self):
+        """Tests that a slot held by a process that died is taken back"""
+
+        limiter = ConcurrencyLimiter(limit=1, queue_size=0)
+        context = multiprocessing.get_context('fork')
+        holder = context.Process(target=limiter.acquire)
+        holder.start()
+        holder.join()
+
+        self.assertTrue(limiter.acquire())
+        self.assertEqual(limiter.snapshot()['reclaimed'], 1)
+        self.assertFalse(limiter.acquire())
+
+
+class TokenBucketsTestCase(TestCase):
+    """Tests for TokenBuckets"""
+
+    def test_burst_then_refill(self):
+        """Tests that a key gets `burst` tokens, then `rate` per second"""
+
+        buckets = TokenBuckets(rate=2, burst=3)
+
+        self.assertEqual(
+            [buckets.take("u1", now=100) for _ in range(3)], [0, 0, 0])
+        self.assertAlmostEqual(buckets.take("u1", now=100), 0.5)
+        self.assertEqual(buckets.take("u1", now=100.5), 0)
+
+        self.assertEqual(buckets.take("u2", now=100), 0)
+
+        snapshot = buckets.snapshot()
+        self.assertEqual(snapshot['allowed'], 5)
+        self.assertEqual(snapshot['limited'], 1)
+
+
+class AdmissionViewsTestCase(TestCase):
+    """Tests for shedding and rate limiting in the app"""
+
+    def setUp(self):
+        """Set up that runs before every test"""
+
+        self.app = create_test_app({
+            'SQLALCHEMY_DATABASE_URI': "sqlite://",
+            'ADMISSION_GROUPS': {
+                'lists': dict(endpoints=['warbler.list_users'],
+                              limit=1, queue_size=0, timeout=0),
+            },
+            'RATE_LIMITS': {'warbler.like_add': (0.001, 1)},
+        })
+
+        with self.app.app_context():
+            db.create_all()
+            user = User.signup("u1", "u1@email.com", "password", None)
+            db.session.flush()
+            messages = [Message(text=f"m{i}", user_id=user.id)
+                        for i in range(2)]
+            db.session.add_all(messages)
+            db.session.commit()
+            self.user_id = user.id
+            self.message_ids = [msg.id for msg in messages]
+
+        self.client = self.app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+    def test_shed(self):
+        """Tests that a full group sheds with 503 and Retry-After"""
+
+        limiter = self.app.extensions['admission'].groups['lists']
+
+        resp = self.client.get("/users")
+        self.assertEqual(resp.status_code, 200)
+
+        limiter.acquire()
+        resp = self.client.get("/users")
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(resp.headers['Retry-After'], "1")
+
+        # Routes outside the group are unaffected
+        resp = self.client.get(f"/messages/{self.message_ids[0]}")
+        self.assertEqual(resp.status_code, 200)
+
+        limiter.release()
+        self.assertEqual(limiter.snapshot()['in_flight'], 0)
+
+    def test_rate_limited(self):
+        """Tests that a user over their write rate gets 429"""
+
+        resp = self.client.post(f"/users/like/{self.message_ids[0]}")
+        self.assertEqual(resp.status_code, 302)
+
+        resp = self.client.post(f"/users/like/{self.message_ids[1]}")
+        self.assertEqual(resp.status_code, 429)
+        self.assertGreater(int(resp.headers['Retry-After']), 1)
@@ -0,0 +1,108 @@
+"""App factory tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_app.py
+
+
+import os
+import tempfile
+from types import SimpleNamespace
+from unittest import TestCase
+
+from app import checked_in_chunks, create_app, warm_up_templates
+from forms import LazyCsrfForm
+
+
+class AppFactoryTestCase(TestCase):
+    """Tests for create_app and template warm-up"""
+
+    def test_create_app_config(self):
+        """Tests that config overrides win and the toolbar stays off"""
+
+        app = create_app({
+            'SQLALCHEMY_DATABASE_URI': "sqlite://",
+            'SECRET_KEY': "test",
+            'WARM_UP_TEMPLATES': False,
+        })
+
+        self.assertEqual(app.config['SECRET_KEY'], "test")
+        self.assertNotIn('debugtoolbar', app.extensions)
+
+    def test_bytecode_cache(self):
+        """Tests that compiling templates fills the bytecode cache"""
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            app = create_app({
+                'SQLALCHEMY_DATABASE_URI': "sqlite://",
+                'SECRET_KEY': "test",
+                'WARM_UP_TEMPLATES': False,
+                'JINJA_BYTECODE_CACHE_DIR': cache_dir,
+            })
+
+            self.assertEqual(os.listdir(cache_dir), [])
+
+            count = warm_up_templates(app)
+
+            self.assertEqual(count, len(app.jinja_env.list_templates()))
+            self.assertEqual(len(os.listdir(cache_dir)), count)
+
+
+class LazyCsrfFormTestCase(TestCase):
+    """Tests for the per-request lazy CSRF helper"""
+
+    def setUp(self):
+        """Set up that runs before every test"""
+
+        self.app = create_app({
+            'SQLALCHEMY_DATABASE_URI': "sqlite://",
+            'SECRET_KEY': "test",
+            'WARM_UP_TEMPLATES': False,
+        })
+
+    def test_get_builds_nothing(self):
+        """Tests that a GET neither builds nor validates the form"""
+
+        with self.app.test_request_context('/', method="GET"):
+            csrf = LazyCsrfForm()
+
+            self.assertFalse(csrf.validate_on_submit())
+            self.assertIsNone(csrf._form)
+
+    def test_hidden_tag_cached(self):
+        """Tests that the hidden field is rendered once per request"""
+
+        with self.app.test_request_context('/', method="GET"):
+            csrf = LazyCsrfForm()
+            first = csrf.hidden_tag()
+
+            self.assertIn('name="csrf_token"', first)
+            self.assertIs(csrf.hidden_tag(), first)
+
+    def test_post_validates_token(self):
+        """Tests that a POST is checked against the CSRF token"""
+
+        with self.app.test_request_context('/', method="POST"):
+            self.assertFalse(LazyCsrfForm().validate_on_submit())
+
+
+
+class CheckedInChunksTestCase(TestCase):
+    """Tests for checking membership a chunk of rows at a time"""
+
+    def test_chunks(self):
+        """Tests that each chunk is checked just before it is yielded"""
+
+        rows = [SimpleNamespace(id=id) for id in range(5)]
+        asked = []
+
+        def among(ids):
+            asked.append(ids)
+            return {id for id in ids if id % 2}
+
+        checked, found = checked_in_chunks(rows, among, chunk_size=2)
+        seen = [(row.id, row.id in found) for row in checked]
+
+        self.assertEqual(seen, [(0, False), (1, True), (2, False),
+                                (3, True), (4, False)])
+        self.assertEqual(asked, [[0, 1], [2, 3], [4]])
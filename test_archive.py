@@ -0,0 +1,185 @@
+"""Message archive tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_archive.py
+
+
+import io
+import json
+import os
+import shutil
+import tempfile
+import zipfile
+from datetime import datetime
+
+from models import db, User, Message, Likes
+
+# Create our app on the test database (see testing.py: Postgres by
+# default, or in memory; and how to run the tests in parallel)
+
+from app import CURR_USER_KEY
+from testing import DatabaseTestCase, create_test_app
+
+app = create_test_app()
+app.app_context().push()
+
+import export
+import read_models
+from archive import MessageArchive, archive_months
+from deletion import tombstone_user
+from snowflake import BackfillIds
+
+NOW = datetime(2024, 6, 15)
+
+
+class ArchiveTestCase(DatabaseTestCase):
+    """Tests for archiving old months and reading them back"""
+
+    def setUp(self):
+        """Set up that runs before every test"""
+
+        super().setUp()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.flush()
+
+        make_id = BackfillIds()
+        rows = [
+            ("jan", u1.id, datetime(2023, 1, 10)),
+            ("jan-u2", u2.id, datetime(2023, 1, 11)),
+            ("feb", u1.id, datetime(2023, 2, 10)),
+            ("may", u1.id, datetime(2024, 5, 10)),
+        ]
+        messages = {
+            text: Message(id=make_id(timestamp), text=text, user_id=user_id,
+                          timestamp=timestamp)
+            for text, user_id, timestamp in rows
+        }
+        db.session.add_all(messages.values())
+        db.session.flush()
+
+        db.session.add_all([
+            Likes(user_id=u2.id, message_id=messages["jan"].id),
+            Likes(user_id=u2.id, message_id=messages["may"].id),
+            Likes(user_id=u1.id, message_id=messages["jan-u2"].id),
+        ])
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+        self.may_id = messages["may"].id
+
+        self.directory = tempfile.mkdtemp()
+        self.archive = MessageArchive(self.directory)
+
+    def tearDown(self):
+        """Tear down that runs after every test"""
+
+        db.session.rollback()
+        shutil.rmtree(self.directory)
+
+    def test_archive_months(self):
+        """Tests that old months move to files and out of the database"""
+
+        archived = archive_months(
+            db.session, self.directory, keep_months=12, now=NOW)
+
+        self.assertEqual(
+            archived, {datetime(2023, 1, 1): 2, datetime(2023, 2, 1): 1})
+        self.assertEqual(
+            sorted(os.listdir(self.directory)),
+            ["messages-2023-01.npz", "messages-2023-02.npz"])
+        self.assertEqual(
+            [msg.text for msg in Message.query], ["may"])
+        self.assertEqual(
+            [like.message_id for like in Likes.query], [self.may_id])
+
+        # Nothing left to do the second time
+        self.assertEqual(
+            archive_months(db.session, self.directory, keep_months=12,
+                           now=NOW),
+            {})
+
+    def test_user_messages(self):
+        """Tests that profile pages carry on into the archive"""
+
+        archive_months(db.session, self.directory, keep_months=12, now=NOW)
+
+        messages = read_models.user_messages(
+            db.session, self.u1_id, limit=2, archive=self.archive)
+        self.assertEqual([msg.text for msg in messages], ["may", "feb"])
+        self.assertEqual(messages[1].user.username, "u1")
+        self.assertEqual(messages[1].timestamp, datetime(2023, 2, 10))
+
+        older = read_models.user_messages(
+            db.session, self.u1_id, limit=2, before=messages[-1].id,
+            archive=self.archive)
+        self.assertEqual([msg.text for msg in older], ["jan"])
+
+        # Without the archive, only what's in the database
+        self.assertEqual(
+            [msg.text for msg in read_models.user_messages(
+                db.session, self.u1_id)],
+            ["may"])
+
+    def test_liked_messages(self):
+        """Tests that likes pages carry on into the archive"""
+
+        archive_months(db.session, self.directory, keep_months=12, now=NOW)
+
+        messages = list(read_models.liked_messages(
+            db.session, self.u2_id, archive=self.archive))
+        self.assertEqual(
+            [(msg.text, msg.user.username) for msg in messages],
+            [("may", "u1"), ("jan", "u1")])
+
+        messages = list(read_models.liked_messages(
+            db.session, self.u1_id, limit=1, archive=self.archive))
+        self.assertEqual([msg.text for msg in messages], ["jan-u2"])
+
+    def test_hides_deleted_users(self):
+        """Tests that tombstoned users' archived messages are left out"""
+
+        archive_months(db.session, self.directory, keep_months=12, now=NOW)
+        tombstone_user(db.session, self.u2_id)
+        db.session.commit()
+
+        self.assertEqual(
+            list(read_models.liked_messages(
+                db.session, self.u1_id, archive=self.archive)),
+            [])
+
+    def test_profile_page(self):
+        """Tests that the profile page shows archived messages"""
+
+        app.extensions['message_archive'] = self.archive
+        self.addCleanup(app.extensions.pop, 'message_archive')
+
+        archive_months(db.session, self.directory, keep_months=12, now=NOW)
+
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.u2_id
+
+            resp = client.get(f"/users/{self.u1_id}")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("feb", html)
+            self.assertIn("jan", html)
+
+    def test_export(self):
+        """Tests that exports include archived messages and likes, in order"""
+
+        archive_months(db.session, self.directory, keep_months=12, now=NOW)
+
+        data = b"".join(export.stream(db.session, self.u1_id, self.archive))
+        with zipfile.ZipFile(io.BytesIO(data)) as zip_file:
+            texts = [json.loads(line)['text'] for line in
+                     zip_file.read('messages.ndjson').splitlines()]
+            liked = zip_file.read('likes.ndjson').splitlines()
+
+        self.assertEqual(texts, ["jan", "feb", "may"])
+        self.assertEqual(len(liked), 1)
@@ -0,0 +1,188 @@
+"""Username and email availability tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_availability.py
+
+
+from unittest import TestCase, mock
+
+from sqlalchemy import event
+
+from models import db, bcrypt, User
+
+# Create our app on the test database (see testing.py: Postgres by
+# default, or in memory; and how to run the tests in parallel)
+
+from app import CURR_USER_KEY
+from testing import DatabaseTestCase, create_test_app
+
+app = create_test_app()
+app.app_context().push()
+
+import availability
+from deletion import tombstone_user
+import tasks
+
+
+class BloomFilterTestCase(TestCase):
+    """Tests for the counting Bloom filter"""
+
+    def test_add_remove(self):
+        """Tests that keys are found until they are taken out"""
+
+        bloom = availability.CountingBloomFilter(capacity=100)
+        bloom.add("u:alice")
+        bloom.add("u:bob")
+
+        self.assertIn("u:alice", bloom)
+        self.assertNotIn("u:carol", bloom)
+
+        bloom.remove("u:alice")
+        self.assertNotIn("u:alice", bloom)
+        self.assertIn("u:bob", bloom)
+        self.assertEqual(len(bloom), 1)
+
+    def test_add_many(self):
+        """Tests that adding at once sets the same counters as one by one"""
+
+        keys = [f"u:user{i}" for i in range(500)]
+        one_by_one = availability.CountingBloomFilter(capacity=500)
+        for key in keys:
+            one_by_one.add(key)
+        at_once = availability.CountingBloomFilter(capacity=500)
+        at_once.add_many(keys)
+
+        self.assertEqual(one_by_one._counters.tolist(),
+                         at_once._counters.tolist())
+
+    def test_error_rate(self):
+        """Tests that false positives stay near the error rate"""
+
+        bloom = availability.CountingBloomFilter(
+            capacity=5_000, error_rate=0.01)
+        bloom.add_many(f"u:taken{i}" for i in range(5_000))
+
+        false_positives = sum(
+            f"u:free{i}" in bloom for i in range(10_000))
+        self.assertLess(false_positives, 200)
+
+
+class AvailabilityTestCase(DatabaseTestCase):
+    """Tests for checking, and keeping the filter current"""
+
+    def setUp(self):
+        """Set up that runs before every test"""
+
+        super().setUp()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        db.session.commit()
+        self.u1_id = u1.id
+
+        self.available = availability.Availability(refresh_seconds=3600)
+        extensions = app.extensions
+        self.addCleanup(
+            extensions.__setitem__, 'availability',
+            extensions['availability'])
+        extensions['availability'] = self.available
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        """Tear down that runs after every test"""
+
+        db.session.rollback()
+
+    def taken(self, username=None, email=None):
+        return self.available.taken(db.session, username, email)
+
+    def test_taken(self):
+        """Tests answers, and that free names don't query the database"""
+
+        self.assertEqual(self.taken("u1", "u1@email.com"),
+                         {'username', 'email'})
+        self.assertEqual(self.taken("u1", "new@email.com"), {'username'})
+
+        statements = []
+
+        def count(*args):
+            statements.append(args)
+
+        event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            self.assertEqual(self.taken("nobody", "nobody@email.com"),
+                             set())
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count)
+
+        self.assertEqual(statements, [])
+        self.assertEqual(self.available.snapshot()['keys'], 2)
+
+    def test_signup(self):
+        """Tests that a taken name is refused without hashing a password"""
+
+        with mock.patch.object(bcrypt, 'generate_password_hash',
+                               wraps=bcrypt.generate_password_hash) as hash:
+            resp = self.client.post("/signup", data={
+                "username": "u1",
+                "email": "other@email.com",
+                "password": "password",
+            })
+
+            self.assertIn("Username already taken", resp.text)
+            hash.assert_not_called()
+
+            self.client.post("/signup", data={
+                "username": "u2",
+                "email": "u2@email.com",
+                "password": "password",
+            })
+            hash.assert_called_once()
+
+        self.assertEqual(self.taken("u2"), {'username'})
+        self.assertEqual(self.available.snapshot()['keys'], 4)
+
+    def test_endpoint(self):
+        """Tests the availability endpoint"""
+
+        resp = self.client.get(
+            "/users/available?username=u1&email=free@email.com")
+        self.assertEqual(resp.json, {"username": False, "email": True})
+
+        resp = self.client.get("/users/available?username=free")
+        self.assertEqual(resp.json, {"username": True})
+
+    def test_profile_and_delete(self):
+        """Tests that renames and purges free the old names"""
+
+        self.taken("u1")
+        with self.client.session_transaction() as session:
+            session[CURR_USER_KEY] = self.u1_id
+
+        self.client.post("/users/profile", data={
+            "username": "renamed",
+            "email": "u1@email.com",
+            "password": "password",
+        })
+
+        bloom = self.available.get(db.session)
+        self.assertNotIn("u:u1", bloom)
+        self.assertIn("u:renamed", bloom)
+        self.assertEqual(self.taken("u1", "u1@email.com"), {'email'})
+
+        tombstone_user(db.session, self.u1_id)
+        db.session.commit()
+        self.assertEqual(self.taken("renamed"), {'username'})
+
+        # The job worker's purge reaches this filter at the next rebuild;
+        # until then the query finds the names free.
+        with app.app_context():
+            tasks.delete_user(db.session, self.u1_id)
+        self.assertIn("u:renamed", bloom)
+        self.assertEqual(self.taken("renamed", "u1@email.com"), set())
+
+        self.available.rebuild(db.session)
+        bloom = self.available.get(db.session)
+        self.assertEqual(len(bloom), 0)
+        self.assertNotIn("u:renamed", bloom)
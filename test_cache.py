@@ -0,0 +1,351 @@
+"""Two-level cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_cache.py
+
+
+import tempfile
+import threading
+import time
+from dataclasses import replace
+from unittest import TestCase
+
+from models import db, User, Message
+
+# Create our app on the test database (see testing.py: Postgres by
+# default, or in memory; and how to run the tests in parallel)
+
+from app import CURR_USER_KEY
+from testing import DatabaseTestCase, create_test_app
+
+app = create_test_app()
+app.app_context().push()
+
+import sharding
+from cache import Cache, DirectoryCache, LocalCache, TagVersions
+
+
+class Loader:
+    """A load function that counts its calls."""
+
+    def __init__(self, value="value"):
+        self.value = value
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return self.value
+
+
+class CacheTestCase(TestCase):
+    """Tests for Cache on its own"""
+
+    def setUp(self):
+        """Set up that runs before every test"""
+
+        self.now = [1000.0]
+        # A random() of 0 never refreshes early.
+        self.roll = [0.0]
+        self.cache = self.make_cache()
+
+    def make_cache(self, **kwargs):
+        return Cache(ttl=10, clock=lambda: self.now[0],
+                     random=lambda: self.roll[0], **kwargs)
+
+    def test_lru(self):
+        """Tests that the least recently used entry is dropped"""
+
+        lru = LocalCache(max_entries=2)
+        lru.put('a', 1)
+        lru.put('b', 2)
+        lru.get('a')
+        lru.put('c', 3)
+
+        self.assertEqual((lru.get('a'), lru.get('b'), lru.get('c')),
+                         (1, None, 3))
+
+    def test_hit_and_expiry(self):
+        """Tests that values are kept until they expire"""
+
+        load = Loader()
+        self.assertEqual(self.cache.get(('thing', 1), load), "value")
+        self.assertEqual(self.cache.get(('thing', 1), load), "value")
+        self.assertEqual(load.calls, 1)
+
+        self.now[0] += 10
+        self.cache.get(('thing', 1), load)
+        self.assertEqual(load.calls, 2)
+
+        stats = self.cache.snapshot()['kinds']['thing']
+        self.assertEqual((stats['requests'], stats['l1_hits'],
+                          stats['loads']), (3, 1, 2))
+        self.assertAlmostEqual(stats['hit_ratio'], 1 / 3)
+        self.assertEqual(stats['latency_ms']['load']['count'], 2)
+        self.assertEqual(stats['latency_ms']['hit']['count'], 1)
+
+    def test_early_refresh(self):
+        """Tests that a hit near expiry may refresh the entry"""
+
+        load = Loader()
+        self.cache.get(('thing', 1), load)
+        entry = self.cache.local.get(('thing', 1))
+        self.cache.local.put(('thing', 1), replace(entry, delta=1.0))
+
+        # Loading took a second: 5s before expiry, a roll this high
+        # (-log(1 - r) > 5) refreshes, and a low one doesn't.
+        self.now[0] += 5
+        self.roll[0] = 0.5
+        self.cache.get(('thing', 1), load)
+        self.assertEqual(load.calls, 1)
+
+        self.roll[0] = 0.999
+        self.cache.get(('thing', 1), load)
+        self.assertEqual(load.calls, 2)
+        self.assertEqual(
+            self.cache.snapshot()['kinds']['thing']['early_refreshes'], 1)
+
+    def test_stale_while_refreshing(self):
+        """Tests that an expired entry is served while another refreshes"""
+
+        load = Loader()
+        self.cache.get(('thing', 1), load)
+        self.now[0] += 20
+
+        self.assertTrue(self.cache.leases.claim(
+            repr(('thing', 1)), self.now[0], 5))
+        self.assertEqual(self.cache.get(('thing', 1), Loader("new")),
+                         "value")
+
+        self.cache.leases.release(repr(('thing', 1)))
+        self.assertEqual(self.cache.get(('thing', 1), Loader("new")), "new")
+        self.assertEqual(
+            self.cache.snapshot()['kinds']['thing']['stale_hits'], 1)
+
+    def test_single_flight(self):
+        """Tests that concurrent misses share one load"""
+
+        started, finish = threading.Event(), threading.Event()
+        calls = []
+
+        def load():
+            calls.append(1)
+            started.set()
+            finish.wait(5)
+            return "value"
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(
+            self.cache.get(('thing', 1), load))) for _ in range(5)]
+        threads[0].start()
+        started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        while self.cache.snapshot()['kinds']['thing']['requests'] < 5:
+            time.sleep(0.001)
+        finish.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(calls, [1])
+        self.assertEqual(results, ["value"] * 5)
+
+    def test_errors_not_kept(self):
+        """Tests that a failed load raises and keeps nothing"""
+
+        def fail():
+            raise RuntimeError("boom")
+
+        with self.assertRaises(RuntimeError):
+            self.cache.get(('thing', 1), fail)
+
+        load = Loader()
+        self.cache.get(('thing', 1), load)
+        self.assertEqual(load.calls, 1)
+
+    def test_tags(self):
+        """Tests that invalidating a tag only drops entries with it"""
+
+        first, second = Loader(), Loader()
+        self.cache.get(('thing', 1), first, tags=["user:1"])
+        self.cache.get(('thing', 2), second, tags=lambda: ["user:2"])
+
+        self.cache.invalidate(["user:1"])
+        self.cache.get(('thing', 1), first, tags=["user:1"])
+        self.cache.get(('thing', 2), second, tags=["user:2"])
+
+        self.assertEqual((first.calls, second.calls), (2, 1))
+
+    def test_value_tags(self):
+        """Tests tags taken from the value, and changes during the load"""
+
+        def load():
+            self.cache.invalidate(["other"])
+            return 7
+
+        self.cache.get(('thing', 1), load,
+                       value_tags=lambda value: [f"user:{value}"])
+        self.assertIsNone(self.cache.local.get(('thing', 1)))
+
+        load = Loader(7)
+        self.cache.get(('thing', 1), load,
+                       value_tags=lambda value: [f"user:{value}"])
+        self.cache.invalidate(["user:7"])
+        self.cache.get(('thing', 1), load,
+                       value_tags=lambda value: [f"user:{value}"])
+        self.assertEqual(load.calls, 2)
+
+    def test_shared(self):
+        """Tests that workers share L2, and its entries are invalidated"""
+
+        with tempfile.TemporaryDirectory() as directory:
+            versions = TagVersions(slots=64)
+            one = self.make_cache(l2=DirectoryCache(directory),
+                                  versions=versions)
+            two = self.make_cache(l2=DirectoryCache(directory),
+                                  versions=versions)
+
+            load = Loader()
+            one.get(('thing', 1), load, tags=["user:1"])
+            self.assertEqual(two.get(('thing', 1), load), "value")
+            self.assertEqual(load.calls, 1)
+            self.assertEqual(two.snapshot()['kinds']['thing']['l2_hits'], 1)
+
+            one.invalidate(["user:1"])
+            two.local.clear()
+            two.get(('thing', 1), load)
+            self.assertEqual(load.calls, 2)
+
+            # A restarted server's table doesn't trust the old entries.
+            three = self.make_cache(l2=DirectoryCache(directory),
+                                    versions=TagVersions(slots=64))
+            three.get(('thing', 1), load)
+            self.assertEqual(load.calls, 3)
+
+    def test_directory_expiry(self):
+        """Tests that expired files are misses, and swept"""
+
+        with tempfile.TemporaryDirectory() as directory:
+            shared = DirectoryCache(directory)
+            shared.set("a", b"1", ex=60)
+            shared.set("b", b"2", ex=60)
+            self.assertEqual(shared.get("a"), b"1")
+
+            shared.delete("a")
+            self.assertIsNone(shared.get("a"))
+            self.assertEqual(shared.sweep(now=2 ** 40), 1)
+            self.assertIsNone(shared.get("b"))
+
+
+class CacheInvalidationTestCase(DatabaseTestCase):
+    """Tests for invalidation by commits, and the cached pages"""
+
+    def setUp(self):
+        """Set up that runs before every test"""
+
+        super().setUp()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.commit()
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+
+        self.cache = app.extensions['cache']
+        self.cache.clear()
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as session:
+            session[CURR_USER_KEY] = self.u1_id
+
+    def tearDown(self):
+        """Tear down that runs after every test"""
+
+        db.session.rollback()
+
+    def assert_invalidated(self, tag, change, invalidated=True):
+        load = Loader()
+        self.cache.get(('test', tag), load, tags=[tag])
+        with app.app_context():
+            change()
+        self.cache.get(('test', tag), load, tags=[tag])
+        self.assertEqual(load.calls, 2 if invalidated else 1)
+
+    def test_orm_changes(self):
+        """Tests that flushed objects invalidate their tags at commit"""
+
+        def edit():
+            User.query.get(self.u1_id).bio = "edited"
+            db.session.commit()
+
+        def follow():
+            u1 = User.query.get(self.u1_id)
+            u1.following.append(User.query.get(self.u2_id))
+            db.session.commit()
+
+        def post():
+            db.session.add(Message(text="hi", user_id=self.u2_id))
+            db.session.commit()
+
+        self.assert_invalidated(f"user:{self.u1_id}", edit)
+        self.assert_invalidated(f"followers:{self.u2_id}", follow)
+        self.assert_invalidated(f"posts:{self.u2_id}", post)
+
+    def test_rollback(self):
+        """Tests that changes rolled back invalidate nothing"""
+
+        def edit():
+            User.query.get(self.u1_id).bio = "edited"
+            db.session.flush()
+            db.session.rollback()
+            db.session.commit()
+
+        self.assert_invalidated(f"user:{self.u1_id}", edit,
+                                invalidated=False)
+
+    def test_shard_writes(self):
+        """Tests that Core writes through the shards invalidate too"""
+
+        shards = sharding.current()
+
+        def follow():
+            shards.follow(db.session, self.u1_id, self.u2_id)
+            db.session.commit()
+
+        def like():
+            message_id = shards.add_message(db.session, self.u2_id, "hi")
+            shards.like(db.session, self.u1_id, message_id)
+            db.session.commit()
+
+        self.assert_invalidated(f"follows:{self.u1_id}", follow)
+        self.assert_invalidated(f"likes:{self.u1_id}", like)
+
+    def test_pages(self):
+        """Tests that cached pages show changes once committed"""
+
+        resp = self.client.get(f"/users/{self.u2_id}")
+        self.assertIn("@u2", resp.text)
+        self.client.get(f"/users/{self.u2_id}")
+        stats = self.cache.snapshot()['kinds']['profile']
+        self.assertEqual((stats['loads'], stats['l1_hits']), (1, 1))
+
+        with app.app_context():
+            User.query.get(self.u2_id).bio = "a new bio"
+            db.session.commit()
+        self.assertIn("a new bio", self.client.get(
+            f"/users/{self.u2_id}").text)
+
+        self.client.get("/")
+        self.client.post(f"/users/follow/{self.u2_id}")
+        with app.app_context():
+            message_id = sharding.current().add_message(
+                db.session, self.u2_id, "followed and seen")
+            db.session.commit()
+        self.assertIn("followed and seen", self.client.get("/").text)
+
+        resp = self.client.get(f"/messages/{message_id}")
+        self.assertIn("followed and seen", resp.text)
+        self.assertEqual(
+            self.client.get("/messages/1").status_code, 404)
+        self.assertEqual(
+            self.client.get("/users/999999").status_code, 404)
@@ -0,0 +1,135 @@
+"""Compression middleware tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_compression.py
+
+
+import gzip
+from unittest import TestCase, skipIf
+
+from werkzeug.test import Client
+from werkzeug.wrappers import Response
+
+import compression
+from compression import CompressionMiddleware, CompressionStats
+
+PAGE = "<li>a warble</li>\n" * 500
+
+
+def make_client(response, **kwargs):
+    """A test client for an app that always returns `response`."""
+
+    stats = CompressionStats()
+    app = CompressionMiddleware(response, stats=stats, **kwargs)
+    return Client(app), stats
+
+
+class CompressionMiddlewareTestCase(TestCase):
+    """Tests for CompressionMiddleware"""
+
+    def test_gzip(self):
+        """Tests that a large HTML page is gzipped"""
+
+        client, stats = make_client(Response(PAGE, mimetype="text/html"))
+
+        resp = client.get("/", headers={"Accept-Encoding": "gzip"})
+
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        self.assertEqual(resp.headers["Vary"], "Accept-Encoding")
+        self.assertNotIn("Content-Length", resp.headers)
+        self.assertEqual(gzip.decompress(resp.data).decode(), PAGE)
+
+        snapshot = stats.snapshot()
+        self.assertEqual(snapshot["compressed"], {"gzip": 1})
+        self.assertEqual(snapshot["bytes_in"], len(PAGE))
+        self.assertEqual(snapshot["bytes_out"], len(resp.data))
+        self.assertGreater(snapshot["bytes_saved"], 0)
+
+    @skipIf(compression.brotli is None, "brotli is not installed")
+    def test_brotli(self):
+        """Tests that brotli is preferred when the client accepts it"""
+
+        client, _ = make_client(Response(PAGE, mimetype="text/html"))
+
+        resp = client.get("/", headers={"Accept-Encoding": "gzip, br"})
+
+        self.assertEqual(resp.headers["Content-Encoding"], "br")
+        self.assertEqual(
+            compression.brotli.decompress(resp.data).decode(), PAGE)
+
+    @skipIf(compression.brotli is None, "brotli is not installed")
+    def test_q_values(self):
+        """Tests that the client's q-values pick the encoding"""
+
+        choose = CompressionMiddleware(None).choose_encoding
+
+        self.assertEqual(choose("gzip, br;q=0"), "gzip")
+        self.assertEqual(choose("gzip;q=1, br;q=0.5"), "gzip")
+        self.assertEqual(choose("gzip;q=0.5, br"), "br")
+        self.assertEqual(choose("*;q=0.5, br;q=0"), "gzip")
+        self.assertIsNone(choose("br;q=0, gzip;q=0"))
+        self.assertIsNone(choose("identity"))
+
+    def test_skips(self):
+        """Tests that small, binary, encoded and unasked-for bodies pass"""
+
+        cases = [
+            (Response("<p>hi</p>", mimetype="text/html"), "gzip"),
+            (Response(b"\x89PNG" * 1000, mimetype="image/png"), "gzip"),
+            (Response(PAGE, mimetype="text/html",
+                      headers={"Content-Encoding": "identity"}), "gzip"),
+            (Response(PAGE, mimetype="text/html"), "identity"),
+            (Response(PAGE, mimetype="text/html"), "gzip;q=0"),
+        ]
+
+        for response, accept in cases:
+            client, _ = make_client(response)
+            resp = client.get("/", headers={"Accept-Encoding": accept})
+
+            self.assertNotEqual(
+                resp.headers.get("Content-Encoding"), "gzip", accept)
+            self.assertEqual(resp.data, response.get_data())
+
+    def test_streaming(self):
+        """Tests that a streamed body is compressed chunk by chunk"""
+
+        def generate():
+            for _ in range(10):
+                yield PAGE
+
+        client, stats = make_client(
+            Response(generate(), mimetype="text/html"), min_size=1000)
+
+        resp = client.get("/", headers={"Accept-Encoding": "gzip"})
+
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        self.assertEqual(gzip.decompress(resp.data).decode(), PAGE * 10)
+        self.assertEqual(stats.snapshot()["bytes_in"], len(PAGE) * 10)
+
+    def test_short_stream(self):
+        """Tests that a stream shorter than min_size goes out unchanged"""
+
+        client, stats = make_client(
+            Response(iter(["<p>", "hi", "</p>"]), mimetype="text/html"))
+
+        resp = client.get("/", headers={"Accept-Encoding": "gzip"})
+
+        self.assertNotIn("Content-Encoding", resp.headers)
+        self.assertEqual(resp.text, "<p>hi</p>")
+        self.assertEqual(stats.snapshot()["skipped"], 1)
+
+    def test_level(self):
+        """Tests that the gzip level is used"""
+
+        fast, _ = make_client(
+            Response(PAGE, mimetype="text/html"), gzip_level=1)
+        best, _ = make_client(
+            Response(PAGE, mimetype="text/html"), gzip_level=9)
+
+        fast_size = len(fast.get(
+            "/", headers={"Accept-Encoding": "gzip"}).data)
+        best_size = len(best.get(
+            "/", headers={"Accept-Encoding": "gzip"}).data)
+
+        self.assertLessEqual(best_size, fast_size)
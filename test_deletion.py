@@ -0,0 +1,101 @@
+"""Account deletion tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_deletion.py
+
+
+from models import db, User, Message, Follow, Likes, Deletion, Job
+
+# Create our app on the test database (see testing.py: Postgres by
+# default, or in memory; and how to run the tests in parallel)
+
+from testing import DatabaseTestCase, create_test_app
+
+app = create_test_app()
+app.app_context().push()
+
+from deletion import tombstone_user, purge_user
+
+
+class DeletionTestCase(DatabaseTestCase):
+    """Tests for tombstoning and batched purging of users"""
+
+    def setUp(self):
+        """Set up that runs before every test"""
+
+        super().setUp()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.flush()
+
+        messages = [Message(text=f"m{i}", user_id=u1.id) for i in range(5)]
+        db.session.add_all(messages)
+        m2 = Message(text="u2-message", user_id=u2.id)
+        db.session.add(m2)
+        db.session.flush()
+
+        u1.following.append(u2)
+        u2.following.append(u1)
+        u1.liked_messages.append(m2)
+        u2.liked_messages.extend(messages)
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+
+    def tearDown(self):
+        """Tear down that runs after every test"""
+
+        db.session.rollback()
+
+    def test_tombstone_hides_user(self):
+        """Tests that a tombstoned user and their messages vanish at once"""
+
+        tombstone_user(db.session, self.u1_id)
+        db.session.commit()
+        db.session.expire_all()
+
+        self.assertIsNone(User.query.get(self.u1_id))
+        self.assertEqual(
+            [m.text for m in Message.query.all()], ["u2-message"])
+
+        u2 = User.query.get(self.u2_id)
+        self.assertEqual(u2.followers, [])
+        self.assertEqual(u2.liked_messages, [])
+
+        self.assertEqual(Job.query.one().kind, 'delete_user')
+
+    def test_purge_in_batches(self):
+        """Tests that purging removes every row owned by the user"""
+
+        tombstone_user(db.session, self.u1_id)
+        db.session.commit()
+
+        progress = purge_user(db.session, self.u1_id, batch_size=2)
+
+        self.assertEqual(progress.phase, 'done')
+        # 2 follows, 1 like, 5 likes on their messages, 5 messages, the user
+        self.assertEqual(progress.rows_deleted, 14)
+        self.assertIsNone(db.session.get(
+            User, self.u1_id, execution_options={'include_deleted': True}))
+        self.assertEqual(Follow.query.count(), 0)
+        self.assertEqual(Likes.query.count(), 0)
+        self.assertEqual(
+            Message.query.execution_options(include_deleted=True).count(), 1)
+
+    def test_purge_resumes(self):
+        """Tests that an interrupted purge picks up where it left off"""
+
+        tombstone_user(db.session, self.u1_id)
+        db.session.add(Deletion(user_id=self.u1_id, phase='messages'))
+        db.session.commit()
+
+        purge_user(db.session, self.u1_id)
+
+        # Earlier phases were skipped, so their rows went with the
+        # database's own cascades when the user row was deleted
+        self.assertEqual(
+            Message.query.execution_options(include_deleted=True).count(), 1)
+        self.assertEqual(Deletion.query.get(self.u1_id).phase, 'done')
@@ -0,0 +1,200 @@
+"""Data export tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_export.py
+
+
+import csv
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+import zipfile
+from datetime import datetime
+
+from models import db, User, Message, Likes, Follow, Job
+
+# Create our app on the test database (see testing.py: Postgres by
+# default, or in memory; and how to run the tests in parallel)
+
+from app import CURR_USER_KEY
+from testing import DatabaseTestCase, create_test_app
+
+app = create_test_app()
+app.app_context().push()
+
+from deletion import tombstone_user
+import export
+import jobs
+import tasks  # registers the job handlers
+
+
+class ExportTestCase(DatabaseTestCase):
+    """Tests for streaming and preparing exports"""
+
+    def setUp(self):
+        """Set up that runs before every test"""
+
+        super().setUp()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        u3 = User.signup("u3", "u3@email.com", "password", None)
+        db.session.flush()
+
+        msgs = [Message(text=f"message {i}", user_id=u1.id)
+                for i in range(5)]
+        theirs = Message(text="theirs", user_id=u2.id)
+        db.session.add_all(msgs + [theirs])
+        db.session.flush()
+
+        db.session.add_all([
+            Likes(user_id=u1.id, message_id=theirs.id),
+            Follow(user_following_id=u1.id, user_being_followed_id=u2.id),
+            Follow(user_following_id=u2.id, user_being_followed_id=u1.id),
+            Follow(user_following_id=u3.id, user_being_followed_id=u1.id),
+        ])
+        db.session.commit()
+
+        self.ids = [u1.id, u2.id, u3.id]
+        self.theirs_id = theirs.id
+
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        app.config['EXPORT_DIR'] = self.directory
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as session:
+            session[CURR_USER_KEY] = self.ids[0]
+
+    def tearDown(self):
+        """Tear down that runs after every test"""
+
+        db.session.rollback()
+
+    def check_export(self, data):
+        with zipfile.ZipFile(io.BytesIO(data)) as zip_file:
+            self.assertEqual(
+                zip_file.namelist(),
+                ['profile.json', 'messages.ndjson', 'likes.ndjson',
+                 'following.csv', 'followers.csv'])
+
+            profile = json.loads(zip_file.read('profile.json'))
+            self.assertEqual(profile['username'], "u1")
+            self.assertNotIn('password', profile)
+
+            texts = [json.loads(line)['text'] for line in
+                     zip_file.read('messages.ndjson').splitlines()]
+            self.assertEqual(texts, [f"message {i}" for i in range(5)])
+
+            [like] = zip_file.read('likes.ndjson').splitlines()
+            self.assertEqual(json.loads(like)['message_id'], self.theirs_id)
+
+            def rows(name):
+                text = zip_file.read(name).decode()
+                return list(csv.reader(io.StringIO(text)))
+
+            self.assertEqual(rows('following.csv'),
+                             [['user_id', 'username'],
+                              [str(self.ids[1]), 'u2']])
+            self.assertEqual(rows('followers.csv'),
+                             [['user_id', 'username'],
+                              [str(self.ids[1]), 'u2'],
+                              [str(self.ids[2]), 'u3']])
+
+    def test_stream(self):
+        """Tests downloading the export as it's built"""
+
+        resp = self.client.get("/users/export")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, "application/zip")
+        self.assertEqual(resp.headers['Content-Disposition'],
+                         'attachment; filename=warbler-u1.zip')
+        self.check_export(resp.data)
+
+    def test_stream_filename(self):
+        """Tests the download name is quoted and encoded like send_file's"""
+
+        user = db.session.get(User, self.ids[0])
+        user.username = 'u"\u00e9'
+        db.session.commit()
+
+        resp = self.client.get("/users/export")
+
+        self.assertEqual(
+            resp.headers['Content-Disposition'],
+            'attachment; filename="warbler-u\\"e.zip"; '
+            "filename*=UTF-8''warbler-u%22%C3%A9.zip")
+        # Headers a WSGI server can write: latin-1 only.
+        for name, value in resp.headers.to_wsgi_list():
+            value.encode('latin-1')
+
+    def test_chunks(self):
+        """Tests that a big export comes out in pieces"""
+
+        db.session.add_all(Message(text=os.urandom(70).hex(),
+                                   user_id=self.ids[1])
+                           for _ in range(3_000))
+        db.session.commit()
+
+        pieces = list(export.stream(db.session, self.ids[1], chunk_size=100))
+        self.assertGreater(len(pieces), 2)
+        self.assertLess(max(map(len, pieces)), 2 * export.BUFFER_SIZE)
+
+    def test_prepared(self):
+        """Tests the export job and resuming its download with Range"""
+
+        resp = self.client.get("/users/export/download")
+        self.assertEqual(resp.status_code, 404)
+
+        self.client.post("/users/export")
+        with app.app_context():
+            job = jobs.run_one(db.session)
+        self.assertEqual((job.kind, job.status), ('export_user', 'done'))
+
+        resp = self.client.get("/users/profile")
+        self.assertIn("Download prepared export", resp.text)
+
+        full = self.client.get("/users/export/download").data
+        self.check_export(full)
+
+        resp = self.client.get("/users/export/download",
+                               headers={"Range": "bytes=100-"})
+        self.assertEqual(resp.status_code, 206)
+        self.assertEqual(resp.data, full[100:])
+
+    def test_expiry(self):
+        """Tests that prepared exports expire and go with the account"""
+
+        with app.app_context():
+            path = tasks.export_user(db.session, self.ids[0])
+            self.assertFalse(tasks.expire_export(db.session, self.ids[0]))
+        self.assertEqual(os.stat(self.directory).st_mode & 0o777, 0o700)
+        expiring = Job.query.filter_by(kind='expire_export').one()
+        self.assertGreater(expiring.run_at, datetime.utcnow())
+        self.assertEqual(
+            self.client.get("/users/export/download").status_code, 200)
+
+        old = time.time() - app.config['EXPORT_EXPIRE_SECONDS'] - 1
+        os.utime(path, (old, old))
+        self.assertEqual(
+            self.client.get("/users/export/download").status_code, 404)
+        self.assertFalse(os.path.exists(path))
+
+        with app.app_context():
+            tasks.export_user(db.session, self.ids[0])
+            tombstone_user(db.session, self.ids[0])
+            db.session.commit()
+            tasks.delete_user(db.session, self.ids[0])
+        self.assertFalse(os.path.exists(path))
+
+    def test_anonymous(self):
+        """Tests that logged out users can't export"""
+
+        with app.test_client() as client:
+            resp = client.get("/users/export")
+            self.assertEqual(resp.status_code, 302)
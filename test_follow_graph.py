@@ -0,0 +1,134 @@
+"""Follow graph tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_follow_graph.py
+
+
+import threading
+from unittest import TestCase
+
+import follow_graph
+from follow_graph import FollowGraph, FollowGraphCache, intersect_sorted
+
+
+class FollowGraphTestCase(TestCase):
+    """Tests for the CSR follow graph"""
+
+    def setUp(self):
+        """Set up that runs before every test"""
+
+        # 1 follows 2, 3; 2 follows 1, 3, 4; 3 follows 4; 4 follows 1
+        edges = [(1, 2), (1, 3), (2, 1), (2, 3), (2, 4), (3, 4), (4, 1)]
+        self.graph = FollowGraph(
+            followers=[a for a, _ in edges],
+            followed=[b for _, b in edges],
+        )
+
+    def test_rows_are_sorted(self):
+        """Tests that following and followers lists come back sorted"""
+
+        self.assertEqual(list(self.graph.following(2)), [1, 3, 4])
+        self.assertEqual(list(self.graph.followers(1)), [2, 4])
+        self.assertEqual(list(self.graph.followers(4)), [2, 3])
+        self.assertEqual(list(self.graph.following(99)), [])
+
+    def test_intersect_sorted(self):
+        """Tests the linear merge intersection"""
+
+        self.assertEqual(intersect_sorted([1, 3, 5, 7], [2, 3, 7, 8]), [3, 7])
+        self.assertEqual(intersect_sorted([], [1, 2]), [])
+
+    def test_mutual_and_known(self):
+        """Tests mutual follows and followers-you-know queries"""
+
+        self.assertEqual(self.graph.mutual_follows(1), [2])
+        # 1 follows 2 and 3; of those, 2 and 3 follow 4
+        self.assertEqual(self.graph.followers_you_know(1, 4), [2, 3])
+
+    def test_suggestions(self):
+        """Tests friends-of-friends suggestions skip already-followed users"""
+
+        # 1 follows 2 and 3; both follow 4, 2 also follows 1 and 3
+        self.assertEqual(self.graph.suggestions(1), [(4, 2)])
+        self.assertEqual(self.graph.suggestions(3), [(1, 1)])
+
+    def test_incremental_updates(self):
+        """Tests follows and unfollows applied after the snapshot was built"""
+
+        self.graph.add_follow(3, 1)
+        self.graph.add_follow(5, 1)
+        self.graph.remove_follow(2, 3)
+
+        self.assertTrue(self.graph.is_following(3, 1))
+        self.assertFalse(self.graph.is_following(2, 3))
+        self.assertEqual(list(self.graph.followers(1)), [2, 3, 4, 5])
+        self.assertEqual(list(self.graph.following(2)), [1, 4])
+
+        self.graph.compact()
+
+        self.assertEqual(self.graph.num_edges, 8)
+        self.assertEqual(list(self.graph.followers(1)), [2, 3, 4, 5])
+        self.assertEqual(list(self.graph.following(5)), [1])
+
+    def test_memory_per_edge(self):
+        """Tests the CSR arrays stay well under 100 bytes per edge"""
+
+        n = 2000
+        followers = [i % n for i in range(20 * n)]
+        followed = [(i + 1 + i // n) % n for i in range(20 * n)]
+        graph = FollowGraph(followers, followed)
+
+        self.assertLess(graph.nbytes() / len(followers), 100)
+
+
+class FollowGraphCacheTestCase(TestCase):
+    """Tests for the process-wide follow graph cache"""
+
+    def setUp(self):
+        """Set up that runs before every test"""
+
+        self.cache = FollowGraphCache()
+        self.cache._graph = FollowGraph(followers=[1, 2], followed=[2, 1])
+
+        threshold = follow_graph.COMPACT_THRESHOLD
+        follow_graph.COMPACT_THRESHOLD = 3
+        self.addCleanup(setattr, follow_graph, 'COMPACT_THRESHOLD', threshold)
+
+    def test_background_compaction(self):
+        """Tests pending changes are compacted off the calling thread"""
+
+        graph = self.cache._graph
+        for follower_id in range(3, 6):
+            self.cache.add_follow(follower_id, 1)
+        self.cache.wait()
+
+        compacted = self.cache._graph
+        self.assertIsNot(compacted, graph)
+        self.assertEqual(compacted.pending, 0)
+        self.assertEqual(compacted.num_edges, 5)
+        self.assertEqual(list(compacted.followers(1)), [2, 3, 4, 5])
+        self.assertEqual(compacted.built_at, graph.built_at)
+
+    def test_replays_changes_made_while_rebuilding(self):
+        """Tests changes made during a rebuild reach the new graph"""
+
+        started, finish = threading.Event(), threading.Event()
+
+        def build():
+            started.set()
+            finish.wait()
+            return FollowGraph(followers=[1, 2], followed=[2, 1])
+
+        self.cache._rebuild(lambda: build)
+        started.wait()
+        self.cache.add_follow(3, 1)
+        self.cache.remove_follow(1, 2)
+        # Still the old graph, with the changes applied.
+        self.assertEqual(list(self.cache._graph.followers(1)), [2, 3])
+
+        finish.set()
+        self.cache.wait()
+
+        self.assertEqual(list(self.cache._graph.followers(1)), [2, 3])
+        self.assertEqual(list(self.cache._graph.following(1)), [])
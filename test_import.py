@@ -0,0 +1,207 @@
+"""Bulk message import tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_import.py
+
+
+import io
+import json
+from datetime import datetime
+
+from models import db, User, Message
+
+# Create our app on the test database (see testing.py: Postgres by
+# default, or in memory; and how to run the tests in parallel)
+
+from app import CURR_USER_KEY
+from testing import DatabaseTestCase, create_test_app
+
+app = create_test_app()
+app.app_context().push()
+
+import bulk_import
+import sharding
+import snowflake
+
+NOW = datetime(2024, 6, 1)
+
+
+def ndjson(*records):
+    return io.BytesIO(b"".join(json.dumps(record).encode() + b"\n"
+                               for record in records))
+
+
+class ImportTestCase(DatabaseTestCase):
+    """Tests for validating and importing message files"""
+
+    def setUp(self):
+        """Set up that runs before every test"""
+
+        super().setUp()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.commit()
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as session:
+            session[CURR_USER_KEY] = self.u1_id
+
+    def tearDown(self):
+        """Tear down that runs after every test"""
+
+        db.session.rollback()
+
+    def run_import(self, file, format, **kwargs):
+        count, oldest, errors = bulk_import.validate(file, format, now=NOW)
+        self.assertEqual(errors, [])
+        file.seek(0)
+        with app.app_context():
+            imported = bulk_import.import_messages(
+                db.session, self.u1_id, file, format, oldest, now=NOW,
+                **kwargs)
+        self.assertEqual(imported, count)
+        return count
+
+    def test_validate(self):
+        """Tests that every bad row is reported, with its line"""
+
+        file = io.BytesIO(b'\n'.join([
+            b'{"text": "fine", "timestamp": "2023-01-01T00:00:00"}',
+            b'not json',
+            b'{"text": "", "timestamp": "2023-01-01T00:00:00"}',
+            b'{"text": "' + b'x' * 141 + b'", "timestamp": "2023-01-01"}',
+            b'{"text": "when?", "timestamp": "last tuesday"}',
+            b'{"text": "later", "timestamp": "2030-01-01T00:00:00"}',
+            b'{"text": "today", "timestamp": "2024-05-31T12:00:00"}',
+            b'{"text": "earlier", "timestamp": "2019-12-31T00:00:00"}',
+            b'',
+            b'{"text": "oldest", "timestamp": "2020-01-02T00:00:00+01:00"}',
+        ]))
+
+        count, oldest, errors = bulk_import.validate(
+            file, bulk_import.NDJSON, now=NOW)
+
+        self.assertEqual(count, 2)
+        self.assertEqual(oldest, datetime(2020, 1, 1, 23))
+        self.assertEqual([number for number, _ in errors],
+                         [2, 3, 4, 5, 6, 7, 8])
+        self.assertIn("future", errors[4][1])
+        self.assertIn("less than a day old", errors[5][1])
+
+    def test_not_before(self):
+        """Tests that months already archived are refused"""
+
+        file = ndjson({'text': "old", 'timestamp': "2023-01-31T23:59:59"},
+                      {'text': "new", 'timestamp': "2023-02-01T00:00:00"})
+
+        count, _, errors = bulk_import.validate(
+            file, bulk_import.NDJSON, not_before=datetime(2023, 2, 1),
+            now=NOW)
+
+        self.assertEqual(count, 1)
+        self.assertEqual([number for number, _ in errors], [1])
+
+    def test_ndjson(self):
+        """Tests importing keeps timestamps and indexes tags and mentions"""
+
+        file = ndjson(
+            {'text': "second #moved", 'timestamp': "2023-03-02T12:00:00Z"},
+            {'text': "first, hi @u2", 'timestamp': "2023-03-01T12:00:00Z"},
+            {'text': "third #moved", 'timestamp': "2023-03-03T12:00:00Z"})
+
+        self.assertEqual(self.run_import(file, bulk_import.NDJSON), 3)
+
+        msgs = (Message.query.filter_by(user_id=self.u1_id)
+                .order_by(Message.id).all())
+        self.assertEqual([msg.text for msg in msgs],
+                         ["first, hi @u2", "second #moved", "third #moved"])
+        self.assertEqual(msgs[0].timestamp, datetime(2023, 3, 1, 12))
+        self.assertEqual(snowflake.decompose(msgs[0].id)[1],
+                         snowflake.BACKFILL_WORKER_ID)
+
+        shards = sharding.current()
+        tagged = shards.tagged_messages(db.session, "moved")
+        self.assertEqual([msg.text for msg in tagged],
+                         ["third #moved", "second #moved"])
+        [mention] = shards.mentioning_messages(db.session, self.u2_id)
+        self.assertEqual(mention.text, "first, hi @u2")
+
+    def test_csv(self):
+        """Tests importing a CSV file in several chunks"""
+
+        lines = ["timestamp,text"] + [
+            f'2023-04-01T00:00:{i:02},"message {i}, with a comma"'
+            for i in range(25)]
+        file = io.BytesIO("\r\n".join(lines).encode())
+
+        done = []
+        count = self.run_import(file, bulk_import.CSV, chunk_size=10,
+                                progress=done.append)
+
+        self.assertEqual(count, 25)
+        self.assertEqual(done, [10, 20, 25])
+        self.assertEqual(
+            Message.query.filter_by(user_id=self.u1_id).count(), 25)
+
+    def test_spam_index(self):
+        """Tests that imported messages are added to the spam index"""
+
+        spam_filter = app.extensions['spam']
+        text = "join my totally legit giveaway at example.com now"
+        with spam_filter._lock:
+            spam_filter.get(db.session)
+
+        self.run_import(ndjson(*[
+            {'text': text, 'timestamp': f"2023-06-0{i}T00:00:00"}
+            for i in range(1, 4)]), bulk_import.NDJSON)
+
+        with app.app_context():
+            self.assertTrue(spam_filter.is_spam(db.session, text))
+
+    def test_same_millisecond(self):
+        """Tests that ids already taken are moved along, not reused"""
+
+        records = [{'text': f"message {i}",
+                    'timestamp': "2023-05-01T00:00:00"} for i in range(3)]
+        self.run_import(ndjson(*records), bulk_import.NDJSON)
+        self.run_import(ndjson(*records), bulk_import.NDJSON,
+                        chunk_size=2)
+
+        ids = [id for (id,) in
+               db.session.query(Message.id).filter_by(user_id=self.u1_id)]
+        self.assertEqual(len(set(ids)), 6)
+        self.assertEqual({snowflake.decompose(id)[0] for id in ids},
+                         {snowflake.to_ms(datetime(2023, 5, 1))})
+
+    def test_route(self):
+        """Tests uploading a file, and the errors for a bad one"""
+
+        resp = self.client.post("/messages/import", data={
+            'file': (io.BytesIO(b'{"text": "hi"}\n'), "mine.ndjson"),
+        })
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("Line 1: timestamp", resp.text)
+        self.assertEqual(Message.query.count(), 0)
+
+        resp = self.client.post("/messages/import", data={
+            'file': (ndjson({'text': "hi", 'timestamp': "2023-01-01"}),
+                     "mine.ndjson"),
+        }, follow_redirects=True)
+        self.assertIn("Imported 1 messages.", resp.text)
+        self.assertEqual(Message.query.one().text, "hi")
+
+        resp = self.client.post("/messages/import", data={
+            'file': (io.BytesIO(b'hi'), "mine.txt"),
+        })
+        self.assertIn("NDJSON or CSV files only", resp.text)
+
+    def test_anonymous(self):
+        """Tests that logged out users can't import"""
+
+        with app.test_client() as client:
+            resp = client.get("/messages/import")
+            self.assertEqual(resp.status_code, 302)
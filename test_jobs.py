@@ -0,0 +1,106 @@
+"""Job queue tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_jobs.py
+
+
+from models import db, Job
+
+# Create our app on the test database (see testing.py: Postgres by
+# default, or in memory; and how to run the tests in parallel)
+
+from testing import DatabaseTestCase, create_test_app
+
+app = create_test_app()
+app.app_context().push()
+
+import jobs
+
+calls = []
+
+
+@jobs.job_handler('test_record')
+def record(session, value):
+    calls.append(value)
+
+
+@jobs.job_handler('test_fail')
+def fail(session):
+    raise RuntimeError("boom")
+
+
+class JobQueueTestCase(DatabaseTestCase):
+    """Tests for the database-backed job queue"""
+
+    def setUp(self):
+        """Set up that runs before every test"""
+
+        super().setUp()
+        calls.clear()
+
+    def tearDown(self):
+        """Tear down that runs after every test"""
+
+        db.session.rollback()
+
+    def test_enqueue_and_run(self):
+        """Tests that a queued job runs once and records its timing"""
+
+        jobs.enqueue(db.session, 'test_record', {'value': 1})
+        db.session.commit()
+
+        self.assertEqual(jobs.work(db.session, burst=True), 1)
+        self.assertEqual(calls, [1])
+
+        job = Job.query.one()
+        self.assertEqual(job.status, 'done')
+        self.assertEqual(job.attempts, 1)
+        self.assertIsNotNone(job.duration_ms)
+
+    def test_idempotency_key(self):
+        """Tests that a repeated idempotency key does not queue twice"""
+
+        first = jobs.enqueue(db.session, 'test_record', {'value': 1},
+                             idempotency_key="k")
+        db.session.commit()
+        second = jobs.enqueue(db.session, 'test_record', {'value': 2},
+                              idempotency_key="k")
+        db.session.commit()
+
+        self.assertEqual(first.id, second.id)
+        self.assertEqual(Job.query.count(), 1)
+
+    def test_retry_then_fail(self):
+        """Tests that failing jobs back off, then stop at max_attempts"""
+
+        jobs.enqueue(db.session, 'test_fail', max_attempts=2)
+        db.session.commit()
+
+        jobs.work(db.session, burst=True)
+        job = Job.query.one()
+        self.assertEqual(job.status, 'queued')
+        self.assertIn("boom", job.last_error)
+
+        # Not due yet: the retry is scheduled in the future
+        self.assertEqual(jobs.work(db.session, burst=True), 0)
+
+        job.run_at = job.created_at
+        db.session.commit()
+        jobs.work(db.session, burst=True)
+
+        job = Job.query.one()
+        self.assertEqual(job.status, 'failed')
+        self.assertEqual(job.attempts, 2)
+
+    def test_stats(self):
+        """Tests per-kind job stats"""
+
+        jobs.enqueue(db.session, 'test_record', {'value': 1})
+        jobs.enqueue(db.session, 'test_record', {'value': 2})
+        db.session.commit()
+        jobs.work(db.session, burst=True)
+
+        [row] = jobs.stats(db.session)
+        self.assertEqual((row['kind'], row['status'], row['count']),
+                         ('test_record', 'done', 2))
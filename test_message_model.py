@@ -5,37 +5,24 @@
 #    python -m unittest test_user_model.py
 
 
-import os
-from unittest import TestCase
-
 from models import db, User, Message
 
-# BEFORE we import our app, let's set an environmental variable
-# to use a different database for tests (we need to do this
-# before we import our app, since that will have already
-# connected to the database
-
-os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
-
-# Now we can import app
-
-from app import app
+# Create our app on the test database (see testing.py: Postgres by
+# default, or in memory; and how to run the tests in parallel)
 
-# Create our tables (we do this here, so we only create the tables
-# once for all tests --- in each test, we'll delete the data
-# and create fresh new clean test data
+from testing import DatabaseTestCase, create_test_app
 
-db.drop_all()
-db.create_all()
+app = create_test_app()
+app.app_context().push()
 
 
-class UserModelTestCase(TestCase):
+class UserModelTestCase(DatabaseTestCase):
     """Model to test our models"""
 
     def setUp(self):
         """Set up that runs before every test"""
 
-        User.query.delete()
+        super().setUp()
 
         u1 = User.signup("u1", "u1@email.com", "password", None)
         u2 = User.signup("u2", "u2@email.com", "password", None)
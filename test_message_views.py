@@ -5,21 +5,17 @@
 #    FLASK_DEBUG=False python -m unittest test_message_views.py
 
 
-import os
-from unittest import TestCase
-
 from models import db, Message, User, Likes
+from trending import trending
 
-# BEFORE we import our app, let's set an environmental variable
-# to use a different database for tests (we need to do this
-# before we import our app, since that will have already
-# connected to the database
-
-os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+# Create our app on the test database (see testing.py: Postgres by
+# default, or in memory; and how to run the tests in parallel)
 
-# Now we can import app
+from app import CURR_USER_KEY
+from testing import DatabaseTestCase, create_test_app
 
-from app import app, CURR_USER_KEY
+app = create_test_app()
+app.app_context().push()
 
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 
@@ -27,21 +23,10 @@ app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 
 app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
 
-# Create our tables (we do this here, so we only create the tables
-# once for all tests --- in each test, we'll delete the data
-# and create fresh new clean test data
-
-db.drop_all()
-db.create_all()
-
-# Don't have WTForms use CSRF at all, since it's a pain to test
 
-app.config['WTF_CSRF_ENABLED'] = False
-
-
-class MessageBaseViewTestCase(TestCase):
+class MessageBaseViewTestCase(DatabaseTestCase):
     def setUp(self):
-        User.query.delete()
+        super().setUp()
 
         u1 = User.signup("u1", "u1@email.com", "password", None)
         db.session.flush()
@@ -132,6 +117,31 @@ class MessageDeleteViewTestCase(MessageBaseViewTestCase):
 
             self.assertEqual(len(result), 1)
 
+class MessageShowViewTestCase(MessageBaseViewTestCase):
+    """Message detail view tests"""
+
+    def test_follow_button(self):
+        """Tests the follow button reflects whether the author is followed"""
+
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.commit()
+        u2_id = u2.id
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u2_id
+
+            resp = c.get(f"/messages/{self.m1_id}")
+            self.assertIn(b"/users/follow/", resp.data)
+
+            u2 = db.session.get(User, u2_id)
+            u2.following.append(db.session.get(User, self.u1_id))
+            db.session.commit()
+
+            resp = c.get(f"/messages/{self.m1_id}")
+            self.assertIn(b"/users/stop-following/", resp.data)
+
+
 class MessageLikeViewTestCase(MessageBaseViewTestCase):
     """Message like view tests"""
 
@@ -164,7 +174,7 @@ class MessageLikeViewTestCase(MessageBaseViewTestCase):
             u1 = User.query.get(self.u1_id)
             liked_message = Message.query.get(self.m1_id)
             u1.liked_messages.append(liked_message)
-
+            db.session.commit()
 
             resp = c.post(f'/users/unlike/{self.m1_id}', follow_redirects=True)
 
@@ -175,3 +185,23 @@ class MessageLikeViewTestCase(MessageBaseViewTestCase):
 
             num_likes = len(Likes.query.all())
             self.assertEqual(num_likes, 0)
+
+
+class MessageTrendingViewTestCase(MessageBaseViewTestCase):
+    """Trending view tests"""
+
+    def test_trending(self):
+        """Tests a liked message shows up on the trending page"""
+
+        trending.clear()
+
+        with app.test_client() as c:
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post(f'/users/like/{self.m1_id}')
+
+            resp = c.get('/trending')
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("m1-text", resp.get_data(as_text=True))
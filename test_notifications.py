@@ -0,0 +1,181 @@
+"""Notification tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_notifications.py
+
+
+from datetime import datetime, timedelta
+
+from sqlalchemy import event
+
+from models import db, User, Message, Notification, Inbox
+
+# Create our app on the test database (see testing.py: Postgres by
+# default, or in memory; and how to run the tests in parallel)
+
+from app import CURR_USER_KEY
+from testing import DatabaseTestCase, create_test_app
+
+app = create_test_app()
+app.app_context().push()
+
+import notifications
+
+
+class NotificationTestCase(DatabaseTestCase):
+    """Tests for coalescing notifications and the unread count"""
+
+    def setUp(self):
+        """Set up that runs before every test"""
+
+        super().setUp()
+
+        self.users = [
+            User.signup(f"u{i}", f"u{i}@email.com", "password", None)
+            for i in range(5)]
+        db.session.flush()
+
+        msg = Message(text="hello", user_id=self.users[0].id)
+        db.session.add(msg)
+        db.session.commit()
+
+        self.ids = [user.id for user in self.users]
+        self.message_id = msg.id
+
+    def tearDown(self):
+        """Tear down that runs after every test"""
+
+        db.session.rollback()
+
+    def unread(self, index=0):
+        user = db.session.get(User, self.ids[index])
+        return user.count_unread_notifications()
+
+    def test_coalesce(self):
+        """Tests that likes of one message fold into one notification"""
+
+        author = self.ids[0]
+        for actor in self.ids[1:]:
+            notifications.liked(db.session, author, actor, self.message_id)
+        notifications.followed(db.session, author, self.ids[1])
+        db.session.commit()
+
+        [follow, like] = notifications.inbox(db.session, author)
+        self.assertEqual((like.kind, like.actor.username, like.others),
+                         (notifications.LIKE, "u4", 3))
+        self.assertEqual((follow.kind, follow.others),
+                         (notifications.FOLLOW, 0))
+        self.assertEqual(self.unread(), 2)
+
+        # Once read, the next like starts a new notification
+        notifications.mark_read(db.session, author)
+        notifications.liked(db.session, author, self.ids[1], self.message_id)
+        db.session.commit()
+
+        self.assertEqual(self.unread(), 1)
+        self.assertEqual(Notification.query.count(), 3)
+        self.assertEqual(
+            [item.unread for item in notifications.inbox(db.session, author)],
+            [True, False, False])
+
+    def test_distinct_actors(self):
+        """Tests that someone acting again isn't counted twice"""
+
+        author = self.ids[0]
+        for actor in (self.ids[1], self.ids[2], self.ids[1], self.ids[1]):
+            notifications.liked(db.session, author, actor, self.message_id)
+        db.session.commit()
+
+        [like] = notifications.inbox(db.session, author)
+        self.assertEqual((like.actor.username, like.others), ("u1", 1))
+
+    def test_self(self):
+        """Tests that liking your own message doesn't notify you"""
+
+        notifications.liked(
+            db.session, self.ids[0], self.ids[0], self.message_id)
+        db.session.commit()
+
+        self.assertEqual(Notification.query.count(), 0)
+        self.assertEqual(self.unread(), 0)
+
+    def test_trim(self):
+        """Tests that inboxes keep only the newest notifications"""
+
+        limit = notifications.MAX_NOTIFICATIONS
+        notifications.MAX_NOTIFICATIONS = 2
+        self.addCleanup(setattr, notifications, 'MAX_NOTIFICATIONS', limit)
+
+        start = datetime(2024, 1, 1)
+        for i, actor in enumerate(self.ids[1:]):
+            notifications.notify(
+                db.session, self.ids[0], notifications.MENTION, actor,
+                message_id=i, now=start + timedelta(minutes=i))
+        db.session.commit()
+
+        items = notifications.inbox(db.session, self.ids[0])
+        self.assertEqual([item.message_id for item in items], [3, 2])
+        self.assertEqual(self.unread(), 2)
+
+    def test_prune(self):
+        """Tests that old read notifications are deleted"""
+
+        old = datetime.utcnow() - notifications.RETENTION - timedelta(days=1)
+        notifications.notify(db.session, self.ids[0], notifications.FOLLOW,
+                             self.ids[1], now=old)
+        notifications.mark_read(db.session, self.ids[0])
+        notifications.notify(db.session, self.ids[0], notifications.FOLLOW,
+                             self.ids[2], now=old)
+        db.session.commit()
+
+        self.assertEqual(notifications.prune(db.session), 1)
+        self.assertEqual(Notification.query.count(), 1)
+
+    def test_badge_is_one_lookup(self):
+        """Tests that reading the unread count is a single statement"""
+
+        notifications.followed(db.session, self.ids[0], self.ids[1])
+        db.session.commit()
+        user = db.session.get(User, self.ids[0])
+
+        statements = []
+
+        def count(*args):
+            statements.append(args)
+
+        event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            self.assertEqual(user.count_unread_notifications(), 1)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count)
+
+        self.assertEqual(len(statements), 1)
+        self.assertIsNotNone(db.session.get(Inbox, self.ids[0]))
+
+    def test_views(self):
+        """Tests notifying from the routes and reading the inbox"""
+
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.ids[1]
+
+            client.post(f"/users/like/{self.message_id}")
+            client.post(f"/users/follow/{self.ids[0]}")
+            client.post("/messages/new", data={"text": "hi @u0 and @u2"})
+
+            self.assertEqual(self.unread(0), 3)
+            self.assertEqual(self.unread(2), 1)
+
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = self.ids[0]
+
+            resp = client.get("/")
+            self.assertIn('<span class="badge bg-danger">3</span>', resp.text)
+
+            resp = client.get("/notifications")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("liked your", resp.text)
+            self.assertIn("followed you", resp.text)
+            self.assertIn("mentioned you", resp.text)
+            self.assertEqual(self.unread(0), 0)
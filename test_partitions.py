@@ -0,0 +1,243 @@
+"""Message partition tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_partitions.py
+
+
+from datetime import datetime
+from unittest import TestCase, skipUnless
+
+from models import (
+    db, User, Message, Likes, Job, MessageTag, Mention)
+
+# Create our app on the test database (see testing.py: Postgres by
+# default, or in memory; and how to run the tests in parallel)
+
+from testing import DatabaseTestCase, create_test_app
+
+app = create_test_app()
+app.app_context().push()
+
+import partitions
+import snowflake
+from id_migration import migrate_message_ids
+from snowflake import BackfillIds
+import tasks
+
+on_postgres = skipUnless(
+    db.engine.dialect.name == 'postgresql', "partitions are Postgres-only")
+
+
+class MonthTestCase(TestCase):
+    """Tests for month arithmetic on snowflake ids"""
+
+    def test_add_months(self):
+        """Tests stepping across year ends both ways"""
+
+        self.assertEqual(partitions.add_months(datetime(2023, 11, 1), 3),
+                         datetime(2024, 2, 1))
+        self.assertEqual(partitions.add_months(datetime(2024, 1, 1), -13),
+                         datetime(2022, 12, 1))
+
+    def test_month_bounds(self):
+        """Tests that a month's ids fall between its bounds"""
+
+        month = datetime(2024, 2, 1)
+        low, high = partitions.month_bounds(month)
+        make_id = BackfillIds()
+
+        first = make_id(month)
+        last = make_id(datetime(2024, 2, 29, 23, 59, 59, 999000))
+
+        self.assertLessEqual(low, first)
+        self.assertLess(last, high)
+        self.assertEqual(high, partitions.month_bounds(
+            datetime(2024, 3, 1))[0])
+        self.assertEqual(partitions.month_of(last), month)
+        self.assertEqual(partitions.month_of(snowflake.next_id()),
+                         partitions.month_start(datetime.utcnow()))
+
+
+@on_postgres
+class PartitionTestCase(DatabaseTestCase):
+    """Tests for creating and dropping monthly partitions"""
+
+    def setUp(self):
+        """Set up that runs before every test"""
+
+        super().setUp()
+
+        self.conn = db.session.connection()
+
+    def tearDown(self):
+        """Tear down that runs after every test"""
+
+        db.session.rollback()
+
+    def partition_of(self, message_id):
+        return self.conn.exec_driver_sql(
+            "SELECT tableoid::regclass::text FROM messages WHERE id = %s",
+            (message_id,)).scalar()
+
+    def test_created_with_table(self):
+        """Tests that create_all makes this month's and later partitions"""
+
+        self.assertTrue(partitions.is_partitioned(self.conn))
+
+        this_month = partitions.month_start(datetime.utcnow())
+        months = partitions.list_partitions(self.conn)
+        for ahead in range(partitions.MONTHS_AHEAD + 1):
+            self.assertIn(partitions.add_months(this_month, ahead), months)
+
+        user = User.signup("u1", "u1@email.com", "password", None)
+        db.session.flush()
+        msg = Message(text="now", user_id=user.id)
+        db.session.add(msg)
+        db.session.flush()
+
+        self.assertEqual(self.partition_of(msg.id),
+                         partitions.partition_name(this_month))
+
+    def test_ensure_and_drop(self):
+        """Tests creating past partitions and dropping one"""
+
+        month = datetime(2022, 3, 1)
+        created = partitions.ensure_partitions(self.conn, since=month)
+        self.assertIn("messages_2022_03", created)
+        self.assertEqual(partitions.ensure_partitions(self.conn, since=month),
+                         [])
+
+        user = User.signup("u1", "u1@email.com", "password", None)
+        db.session.flush()
+        msg = Message(id=BackfillIds()(datetime(2022, 3, 5)), text="old",
+                      user_id=user.id, timestamp=datetime(2022, 3, 5))
+        db.session.add(msg)
+        db.session.flush()
+        self.assertEqual(self.partition_of(msg.id), "messages_2022_03")
+
+        self.assertTrue(partitions.drop_partition(self.conn, month))
+        self.assertFalse(partitions.drop_partition(self.conn, month))
+        self.assertIsNone(db.session.get(Message, msg.id,
+                                         populate_existing=True))
+
+    def test_stranded_rows(self):
+        """Tests that months with rows in the default partition are skipped"""
+
+        user = User.signup("u1", "u1@email.com", "password", None)
+        db.session.flush()
+        msg = Message(id=BackfillIds()(datetime(2021, 6, 5)), text="old",
+                      user_id=user.id, timestamp=datetime(2021, 6, 5))
+        db.session.add(msg)
+        db.session.flush()
+        self.assertEqual(self.partition_of(msg.id),
+                         partitions.DEFAULT_PARTITION)
+
+        created = partitions.ensure_partitions(
+            self.conn, since=datetime(2021, 5, 1))
+        self.assertIn("messages_2021_05", created)
+        self.assertNotIn("messages_2021_06", created)
+        self.assertIn("messages_2021_07", created)
+
+    def test_maintain_job(self):
+        """Tests that the maintenance job queues its next run"""
+
+        tasks.maintain_partitions(db.session)
+
+        job = Job.query.filter_by(kind='maintain_partitions').one()
+        self.assertGreater(job.run_at, datetime.utcnow())
+
+
+@on_postgres
+class PartitionMessagesTestCase(DatabaseTestCase):
+    """Tests for converting an existing messages table"""
+
+    def setUp(self):
+        """Set up that runs before every test"""
+
+        # Postgres rolls DDL back too: the table is partitioned again after.
+        super().setUp()
+
+        conn = db.session.connection()
+        conn.exec_driver_sql("DROP TABLE messages CASCADE")
+        conn.exec_driver_sql(
+            "CREATE TABLE messages ("
+            "id BIGINT PRIMARY KEY, text VARCHAR(140) NOT NULL, "
+            "timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL, "
+            "user_id INTEGER NOT NULL "
+            "REFERENCES users (id) ON DELETE CASCADE)")
+        conn.exec_driver_sql(
+            "CREATE INDEX ix_messages_user_id_id ON messages (user_id, id)")
+        # The CASCADE dropped every foreign key to messages.
+        for table in ('likes', 'message_tags', 'mentions'):
+            conn.exec_driver_sql(
+                f"ALTER TABLE {table} ADD CONSTRAINT {table}_message_id_fkey "
+                "FOREIGN KEY (message_id) REFERENCES messages (id) "
+                "ON DELETE CASCADE")
+
+        user = User.signup("u1", "u1@email.com", "password", None)
+        db.session.flush()
+        self.old_id = BackfillIds()(datetime(2023, 4, 1))
+        db.session.add(Message(id=self.old_id, text="old", user_id=user.id,
+                               timestamp=datetime(2023, 4, 1)))
+        db.session.add(Message(text="new", user_id=user.id))
+        db.session.flush()
+        self.add_references(user.id, self.old_id)
+        db.session.commit()
+
+        self.user_id = user.id
+
+    def tearDown(self):
+        """Tear down that runs after every test"""
+
+        db.session.rollback()
+
+    def add_references(self, user_id, message_id):
+        db.session.add_all([
+            Likes(user_id=user_id, message_id=message_id),
+            MessageTag(tag="old", message_id=message_id),
+            Mention(user_id=user_id, message_id=message_id),
+        ])
+
+    def assert_references(self, message_id):
+        for model in (Likes, MessageTag, Mention):
+            self.assertEqual(
+                [row.message_id for row in model.query], [message_id])
+
+    def test_partition_messages(self):
+        """Tests that rows, likes, tags and mentions survive partitioning"""
+
+        self.assertGreater(partitions.partition_messages(db.session), 0)
+
+        conn = db.session.connection()
+        self.assertTrue(partitions.is_partitioned(conn))
+        self.assertIn(datetime(2023, 4, 1), partitions.list_partitions(conn))
+        self.assertEqual(
+            sorted(msg.text for msg in Message.query), ["new", "old"])
+
+        self.assert_references(self.old_id)
+
+        # The foreign keys now point at the partitioned table
+        db.session.delete(db.session.get(Message, self.old_id))
+        db.session.commit()
+        for model in (Likes, MessageTag, Mention):
+            self.assertEqual(model.query.count(), 0)
+
+        self.assertEqual(partitions.partition_messages(db.session), 0)
+
+    def test_migrate_then_partition(self):
+        """Tests that tags and mentions follow migrated ids into partitions"""
+
+        db.session.delete(db.session.get(Message, self.old_id))
+        db.session.add(Message(id=7, text="older", user_id=self.user_id,
+                               timestamp=datetime(2023, 4, 1)))
+        db.session.flush()
+        self.add_references(self.user_id, 7)
+        db.session.commit()
+
+        self.assertEqual(migrate_message_ids(db.session), 1)
+        new_id = Message.query.filter_by(text="older").one().id
+        self.assert_references(new_id)
+
+        self.assertGreater(partitions.partition_messages(db.session), 0)
+        self.assert_references(new_id)
@@ -0,0 +1,177 @@
+"""Request profiler tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_profiler.py
+
+
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import Counter
+from unittest import TestCase
+
+import profiler
+from app import create_app, CURR_USER_KEY
+from testing import create_test_app
+from models import db, User
+
+
+def busy_loop(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+class ProfileFormatTestCase(TestCase):
+    """Tests for sampling and the output formats"""
+
+    def test_sampler(self):
+        """Tests that the sampler sees the sampled thread's stack"""
+
+        sampler = profiler.Sampler(
+            threading.get_ident(), interval=0.001).start()
+        busy_loop(0.05)
+        sampler.stop()
+
+        self.assertTrue(sampler.stacks)
+        self.assertTrue(any(frame[0] == 'busy_loop'
+                            for stack in sampler.stacks
+                            for frame in stack))
+
+    def test_collapsed(self):
+        """Tests collapsed-stack output"""
+
+        stacks = Counter({
+            (("main", "/src/app.py", 1), ("work", "/src/app.py", 10)): 3,
+        })
+
+        self.assertEqual(
+            profiler.collapsed(stacks),
+            "main (app.py:1);work (app.py:10) 3\n")
+
+    def test_speedscope(self):
+        """Tests that frames are shared and samples weighted by count"""
+
+        main = ("main", "/src/app.py", 1)
+        stacks = Counter({
+            (main, ("a", "/src/app.py", 10)): 2,
+            (main, ("b", "/src/app.py", 20)): 1,
+        })
+
+        doc = profiler.speedscope(stacks, "GET /", interval=0.005)
+
+        self.assertEqual(len(doc["shared"]["frames"]), 3)
+        sampled = doc["profiles"][0]
+        self.assertEqual(sampled["samples"], [[0, 1], [0, 2]])
+        self.assertEqual(sampled["weights"], [10.0, 5.0])
+        self.assertEqual(sampled["endValue"], 15.0)
+
+
+class ProfilerViewsTestCase(TestCase):
+    """Tests for profiling requests and the admin page"""
+
+    def setUp(self):
+        """Set up that runs before every test"""
+
+        self.profile_dir = tempfile.TemporaryDirectory()
+        self.app = create_test_app({
+            'SQLALCHEMY_DATABASE_URI': "sqlite://",
+            'PROFILER_TOKEN': "secret",
+            'PROFILER_DIR': self.profile_dir.name,
+        })
+
+        with self.app.app_context():
+            db.create_all()
+            admin = User.signup("admin", "admin@email.com", "password", None)
+            admin.is_admin = True
+            user = User.signup("u1", "u1@email.com", "password", None)
+            db.session.commit()
+            self.admin_id = admin.id
+            self.user_id = user.id
+
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        """Tear down that runs after every test"""
+
+        self.profile_dir.cleanup()
+
+    def login(self, user_id):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def test_not_profiled_without_header(self):
+        """Tests that requests are left alone unless asked for"""
+
+        self.login(self.user_id)
+        self.client.get("/users")
+        self.client.get(
+            "/users", headers={profiler.PROFILE_HEADER: "wrong"})
+
+        self.assertEqual(os.listdir(self.profile_dir.name), [])
+
+    def test_profiled_with_header(self):
+        """Tests that a profiled request writes its files and SQL stats"""
+
+        self.login(self.user_id)
+        resp = self.client.get(
+            "/users", headers={profiler.PROFILE_HEADER: "secret"})
+        self.assertEqual(resp.status_code, 200)
+
+        [summary] = profiler.slowest(self.profile_dir.name)
+        self.assertEqual(summary['route'], "/users")
+        self.assertEqual(summary['status'], 200)
+        self.assertGreater(summary['sql_count'], 0)
+
+        base = os.path.join(self.profile_dir.name, summary['id'])
+        self.assertTrue(os.path.exists(base + ".collapsed"))
+        with open(base + ".speedscope.json") as f:
+            self.assertEqual(json.load(f)["name"], "GET /users")
+
+    def test_keeps_slowest(self):
+        """Tests that only the slowest captures are kept"""
+
+        self.app.config['PROFILER_KEEP'] = 2
+        self.login(self.user_id)
+        for _ in range(4):
+            self.client.get(
+                "/login", headers={profiler.PROFILE_HEADER: "secret"})
+
+        self.assertEqual(len(profiler.slowest(self.profile_dir.name)), 2)
+        self.assertEqual(len(os.listdir(self.profile_dir.name)), 6)
+
+    def test_admin_page(self):
+        """Tests that admins see the captures and others are turned away"""
+
+        self.login(self.user_id)
+        self.client.get(
+            "/users", headers={profiler.PROFILE_HEADER: "secret"})
+
+        resp = self.client.get("/admin/profiles", follow_redirects=True)
+        self.assertIn("Access unauthorized", resp.text)
+
+        self.login(self.admin_id)
+        resp = self.client.get("/admin/profiles")
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("GET /users", resp.text)
+
+        [summary] = profiler.slowest(self.profile_dir.name)
+        resp = self.client.get(
+            f"/admin/profiles/{summary['id']}.collapsed")
+        self.assertEqual(resp.status_code, 200)
+        resp = self.client.get(f"/admin/profiles/{summary['id']}.json")
+        self.assertEqual(resp.status_code, 404)
+
+    def test_disabled(self):
+        """Tests that nothing is installed when profiling is off"""
+
+        app = create_app({
+            'SQLALCHEMY_DATABASE_URI': "sqlite://",
+            'SECRET_KEY': "test",
+            'WARM_UP_TEMPLATES': False,
+        })
+
+        self.assertNotIn(profiler._start, app.before_request_funcs[None])
@@ -0,0 +1,137 @@
+"""Timeline read model tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_read_models.py
+
+
+from models import db, User, Message
+
+# Create our app on the test database (see testing.py: Postgres by
+# default, or in memory; and how to run the tests in parallel)
+
+from testing import DatabaseTestCase, create_test_app
+
+app = create_test_app()
+app.app_context().push()
+
+import read_models
+from deletion import tombstone_user
+
+
+class ReadModelsTestCase(DatabaseTestCase):
+    """Tests for the Core timeline queries"""
+
+    def setUp(self):
+        """Set up that runs before every test"""
+
+        super().setUp()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        u3 = User.signup("u3", "u3@email.com", "password", None)
+        db.session.flush()
+
+        m1 = Message(text="m1", user_id=u1.id)
+        m2a = Message(text="m2a", user_id=u2.id)
+        m2b = Message(text="m2b", user_id=u2.id)
+        m3 = Message(text="m3", user_id=u3.id)
+        db.session.add_all([m1, m2a, m2b, m3])
+        db.session.flush()
+
+        u1.following.append(u2)
+        u1.liked_messages.extend([m2a, m3])
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+        self.u3_id = u3.id
+        self.m2a_id = m2a.id
+        self.m3_id = m3.id
+
+    def tearDown(self):
+        """Tear down that runs after every test"""
+
+        db.session.rollback()
+
+    def test_timeline(self):
+        """Tests that the timeline has own and followed users' messages"""
+
+        messages = read_models.timeline(db.session, self.u1_id)
+
+        self.assertEqual(
+            sorted(msg.text for msg in messages), ["m1", "m2a", "m2b"])
+
+        by_u2 = [msg.user for msg in messages if msg.user.id == self.u2_id]
+        self.assertEqual(by_u2[0].username, "u2")
+        self.assertIs(by_u2[0], by_u2[1])
+
+    def test_timeline_limit(self):
+        """Tests that the timeline returns at most `limit` messages"""
+
+        self.assertEqual(
+            len(read_models.timeline(db.session, self.u1_id, limit=2)), 2)
+
+    def test_timeline_pages(self):
+        """Tests paging the timeline newest first by message id"""
+
+        first = read_models.timeline(db.session, self.u1_id, limit=2)
+        rest = read_models.timeline(
+            db.session, self.u1_id, limit=2, before=first[-1].id)
+
+        self.assertEqual(
+            [msg.text for msg in first + rest], ["m2b", "m2a", "m1"])
+
+    def test_user_messages(self):
+        """Tests that a user's messages come back newest first"""
+
+        messages = read_models.user_messages(db.session, self.u2_id)
+        self.assertEqual([msg.text for msg in messages], ["m2b", "m2a"])
+
+        older = read_models.user_messages(
+            db.session, self.u2_id, before=messages[0].id)
+        self.assertEqual([msg.text for msg in older], ["m2a"])
+
+    def test_liked_messages(self):
+        """Tests that liked messages are streamed with their authors"""
+
+        messages = list(read_models.liked_messages(
+            db.session, self.u1_id, chunk_size=1))
+
+        self.assertEqual(
+            [(msg.text, msg.user.username) for msg in messages],
+            [("m3", "u3"), ("m2a", "u2")])
+
+    def test_message(self):
+        """Tests looking up a single message"""
+
+        msg = read_models.message(db.session, self.m3_id)
+        self.assertEqual(msg.text, "m3")
+        self.assertEqual(msg.user.id, self.u3_id)
+
+        self.assertIsNone(read_models.message(db.session, 99999))
+
+    def test_liked_among(self):
+        """Tests that only the liked ids of those asked about come back"""
+
+        self.assertEqual(
+            read_models.liked_among(
+                db.session, self.u1_id, [self.m2a_id, 99999]),
+            {self.m2a_id})
+        self.assertEqual(
+            read_models.liked_among(db.session, self.u1_id, []), set())
+
+    def test_hides_deleted_users(self):
+        """Tests that tombstoned users' messages are left out"""
+
+        tombstone_user(db.session, self.u2_id)
+        db.session.commit()
+
+        self.assertEqual(
+            [msg.text for msg in read_models.timeline(db.session, self.u1_id)],
+            ["m1"])
+        self.assertIsNone(read_models.message(db.session, self.m2a_id))
+        self.assertEqual(
+            [msg.text for msg in read_models.liked_messages(
+                db.session, self.u1_id)],
+            ["m3"])
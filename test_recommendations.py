@@ -0,0 +1,75 @@
+"""Recommendation job tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_recommendations.py
+
+
+from unittest import TestCase
+
+import numpy as np
+
+from recommendations import build_matrix, compute_recommendations, top_k_per_row
+
+
+class RecommendationJobTestCase(TestCase):
+    """Tests for the sparse-matrix recommendation job"""
+
+    def setUp(self):
+        """Set up that runs before every test"""
+
+        # 1 follows 2; 2 follows 3 and 4; 5 and 1 both liked message 7
+        follows = np.array([[1, 2], [2, 3], [2, 4]])
+        likes = np.array([[1, 7], [5, 7]])
+
+        self.follows = build_matrix(follows[:, 0], follows[:, 1], (6, 6))
+        self.likes = build_matrix(likes[:, 0], likes[:, 1], (6, 8))
+
+    def recommendations_for(self, user_id, **kwargs):
+        results = {}
+        for users, recs, scores, ranks in compute_recommendations(
+                self.follows, self.likes, workers=1, **kwargs):
+            for u, r, s, n in zip(users, recs, scores, ranks):
+                results.setdefault(int(u), []).append((int(n), int(r), float(s)))
+        return sorted(results.get(user_id, []))
+
+    def test_friends_of_friends_and_co_likes(self):
+        """Tests that both signals are scored and followed users skipped"""
+
+        self.assertEqual(
+            self.recommendations_for(1),
+            [(0, 3, 1.0), (1, 4, 1.0), (2, 5, 0.5)],
+        )
+
+    def test_top_k(self):
+        """Tests that only the top K suggestions per user are kept"""
+
+        self.assertEqual(
+            self.recommendations_for(1, k=1, chunk_size=2),
+            [(0, 3, 1.0)],
+        )
+
+    def test_top_k_per_row(self):
+        """Tests vectorized per-row ranking with tie-breaking on column"""
+
+        rows, cols, scores, ranks = top_k_per_row(
+            np.array([0, 0, 0, 1]),
+            np.array([5, 3, 4, 2]),
+            np.array([1.0, 2.0, 2.0, 1.0]),
+            2,
+        )
+
+        self.assertEqual(cols.tolist(), [3, 4, 2])
+        self.assertEqual(ranks.tolist(), [0, 1, 0])
+
+    def test_process_pool(self):
+        """Tests that the pooled job gives the same answer as in-process"""
+
+        pooled = {}
+        for users, recs, _, ranks in compute_recommendations(
+                self.follows, self.likes, workers=2, chunk_size=2):
+            for u, r, n in zip(users, recs, ranks):
+                pooled[(int(u), int(n))] = int(r)
+
+        self.assertEqual(pooled[(1, 0)], 3)
+        self.assertEqual(pooled[(5, 0)], 1)
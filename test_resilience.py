@@ -0,0 +1,186 @@
+"""Statement timeout, circuit breaker and fallback tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_resilience.py
+
+
+from unittest import TestCase
+
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+import resilience
+from app import CURR_USER_KEY
+from testing import create_test_app
+from models import db, User, Message
+from resilience import CircuitBreaker, RenderCache
+
+
+class CircuitBreakerTestCase(TestCase):
+    """Tests for CircuitBreaker"""
+
+    def test_opens_after_threshold(self):
+        """Tests that consecutive failures open the breaker"""
+
+        breaker = CircuitBreaker(threshold=2, reset_seconds=10)
+
+        breaker.record_failure(now=0)
+        self.assertTrue(breaker.allow(now=0))
+        breaker.record_failure(now=0)
+        self.assertFalse(breaker.allow(now=1))
+        self.assertEqual(breaker.retry_after(now=1), 9)
+
+    def test_success_resets_count(self):
+        """Tests that a success in between starts the count again"""
+
+        breaker = CircuitBreaker(threshold=2)
+
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+
+        self.assertEqual(breaker.state, 'closed')
+
+    def test_half_open_probe(self):
+        """Tests that one probe is let through after the reset time"""
+
+        breaker = CircuitBreaker(threshold=1, reset_seconds=10)
+        breaker.record_failure(now=0)
+
+        self.assertTrue(breaker.allow(now=10))
+        self.assertEqual(breaker.state, 'half_open')
+        self.assertFalse(breaker.allow(now=11))
+
+        breaker.record_failure(now=11)
+        self.assertEqual(breaker.state, 'open')
+        self.assertFalse(breaker.allow(now=12))
+
+        self.assertTrue(breaker.allow(now=21))
+        breaker.record_success()
+        self.assertEqual(breaker.state, 'closed')
+        self.assertEqual(breaker.snapshot()['times_opened'], 2)
+
+
+class RenderCacheTestCase(TestCase):
+    """Tests for RenderCache"""
+
+    def test_evicts_least_recently_used(self):
+        """Tests that the oldest unused page goes first"""
+
+        cache = RenderCache(max_entries=2)
+        cache.put("a", b"A", "text/html")
+        cache.put("b", b"B", "text/html")
+        cache.get("a")
+        cache.put("c", b"C", "text/html")
+
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), (b"A", "text/html"))
+
+
+class DegradedModeTestCase(TestCase):
+    """Tests for timeouts and fallbacks with an injected slow-query fault"""
+
+    def setUp(self):
+        """Set up that runs before every test"""
+
+        self.app = create_test_app({
+            'SQLALCHEMY_DATABASE_URI': "sqlite://",
+            'STATEMENT_TIMEOUTS': {'warbler.homepage': 20},
+            'BREAKER_THRESHOLD': 2,
+        })
+
+        with self.app.app_context():
+            db.create_all()
+            u1 = User.signup("u1", "u1@email.com", "password", None)
+            u2 = User.signup("u2", "u2@email.com", "password", None)
+            db.session.flush()
+            db.session.add(Message(text="hello from u1", user_id=u1.id))
+            db.session.commit()
+            self.u1_id = u1.id
+            self.u2_id = u2.id
+
+        self.client = self.app.test_client()
+        self.login(self.u1_id)
+
+    def login(self, user_id):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def inject_fault(self, seconds=0.05):
+        self.app.config['FAULT_SLOW_QUERY_SECONDS'] = seconds
+
+    def test_statement_timeout(self):
+        """Tests that a statement past its timeout is interrupted"""
+
+        with self.app.test_request_context("/"):
+            resilience._local.timeout_ms = 20
+            resilience._local.fault_seconds = 0.05
+            try:
+                with self.assertRaises(OperationalError):
+                    db.session.execute(text("SELECT 1"))
+            finally:
+                resilience._teardown_request(None)
+                db.session.rollback()
+
+            self.assertEqual(db.session.execute(text("SELECT 1")).scalar(), 1)
+
+    def test_cached_page(self):
+        """Tests that the last good rendering is served on a timeout"""
+
+        good = self.client.get("/")
+        self.assertEqual(good.status_code, 200)
+
+        self.inject_fault()
+        resp = self.client.get("/")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data, good.data)
+        self.assertIn("Stale", resp.headers['Warning'])
+
+        snapshot = self.app.extensions['resilience'].snapshot()
+        self.assertEqual(snapshot['breaker']['failures'], 1)
+        self.assertEqual(snapshot['fallbacks']['cached'], 1)
+
+    def test_breaker_opens(self):
+        """Tests that the breaker opens and short-circuits requests"""
+
+        self.client.get("/")
+        self.inject_fault()
+        self.client.get("/")
+        self.client.get("/")
+
+        resp = self.client.get("/health")
+        self.assertEqual(resp.json['breaker']['state'], 'open')
+
+        # No statements run while open, even with the fault cleared
+        self.inject_fault(0)
+        resp = self.client.get("/")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(
+            self.app.extensions['resilience'].breaker.failures, 2)
+
+        # Pages with nothing cached are refused
+        resp = self.client.get(f"/users/{self.u2_id}")
+        self.assertEqual(resp.status_code, 503)
+        self.assertIn('Retry-After', resp.headers)
+
+    def test_truncated_timeline(self):
+        """Tests the truncated timeline for pages with nothing cached"""
+
+        self.client.get("/")
+        self.inject_fault()
+
+        # Not the page that was cached, so the user's own recent timeline
+        resp = self.client.get("/?before=999999999999999999")
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("trouble reaching its database", resp.text)
+        self.assertIn("hello from u1", resp.text)
+        self.assertEqual(
+            self.app.extensions['resilience'].fallbacks['truncated'], 1)
+
+        # Nobody else's
+        self.login(self.u2_id)
+        resp = self.client.get("/")
+        self.assertEqual(resp.status_code, 503)
+        self.assertNotIn("hello from u1", resp.text)
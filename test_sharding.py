@@ -0,0 +1,327 @@
+"""User-id sharding tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_sharding.py
+
+
+import io
+import json
+import os
+import shutil
+import tempfile
+import zipfile
+from unittest import TestCase
+
+from sqlalchemy import select
+
+import bulk_import
+from deletion import purge_user, tombstone_user
+import export
+import sharding
+from app import CURR_USER_KEY
+from testing import create_test_app
+from models import db, User, UserShard
+from sharding import ShardSet
+
+NUM_SHARDS = 2
+
+
+class ShardSetTestCase(TestCase):
+    """Tests for routing rows to shards and reading them back"""
+
+    def setUp(self):
+        """Set up that runs before every test"""
+
+        self.directory = tempfile.mkdtemp()
+        self.app = create_test_app({
+            'SQLALCHEMY_DATABASE_URI': "sqlite://",
+            'SHARD_URLS': [
+                f"sqlite:///{os.path.join(self.directory, f'shard{i}.db')}"
+                for i in range(NUM_SHARDS)],
+            'TRENDING_ENABLED': False,
+            'SUGGESTIONS_ENABLED': False,
+        })
+
+        self.context = self.app.app_context()
+        self.context.push()
+
+        db.create_all()
+        self.shards = sharding.current()
+        self.shards.create_all()
+
+        # Ids 1, 2, 3: shards 1, 0, 1
+        users = [User.signup(f"u{i}", f"u{i}@email.com", "password", None)
+                 for i in (1, 2, 3)]
+        db.session.commit()
+        self.u1, self.u2, self.u3 = (user.id for user in users)
+
+    def tearDown(self):
+        """Tear down that runs after every test"""
+
+        db.session.rollback()
+        for engine in db.engines.values():
+            engine.dispose()
+        self.context.pop()
+        shutil.rmtree(self.directory)
+
+    def rows(self, shard, table):
+        with self.shards.engine(shard).connect() as conn:
+            return conn.execute(select(table)).all()
+
+    def test_unsharded(self):
+        """Tests that without SHARD_URLS everything is on one shard"""
+
+        shards = ShardSet()
+
+        self.assertFalse(shards.sharded)
+        self.assertEqual(len(shards), 1)
+        self.assertEqual(shards.shards_for(db.session, [self.u1, self.u2]),
+                         {self.u1: 0, self.u2: 0})
+
+    def test_routing(self):
+        """Tests that users go by id unless the directory says otherwise"""
+
+        self.assertEqual(
+            self.shards.shards_for(db.session, [self.u1, self.u2]),
+            {self.u1: self.u1 % NUM_SHARDS, self.u2: self.u2 % NUM_SHARDS})
+
+        db.session.add(UserShard(user_id=self.u1, shard=0))
+        db.session.commit()
+        self.assertEqual(self.shards.shard_for(db.session, self.u1), 0)
+
+    def test_owner_rows(self):
+        """Tests that rows are written to their owner's shard only"""
+
+        home = self.shards.shard_for(db.session, self.u2)
+        message_id = self.shards.add_message(db.session, self.u2, "hi")
+        self.shards.follow(db.session, self.u2, self.u1)
+        self.shards.like(db.session, self.u2, message_id)
+
+        for table in (sharding.messages, sharding.follows, sharding.likes):
+            self.assertEqual(len(self.rows(home, table)), 1)
+            self.assertEqual(len(self.rows(1 - home, table)), 0)
+
+        # Nothing in the main database
+        self.assertEqual(
+            db.session.execute(select(sharding.messages)).all(), [])
+
+        user = db.session.get(User, self.u2)
+        self.assertEqual(user.count_messages(), 1)
+        self.assertEqual(user.count_following(), 1)
+        self.assertEqual(user.count_likes(), 1)
+        self.assertTrue(user.is_following(db.session.get(User, self.u1)))
+
+    def test_timeline(self):
+        """Tests that the timeline merges every followed user's shard"""
+
+        self.shards.follow(db.session, self.u1, self.u2)
+        self.shards.follow(db.session, self.u1, self.u3)
+
+        ids = [self.shards.add_message(db.session, user_id, f"m{i}")
+               for i, user_id in enumerate(
+                   [self.u1, self.u2, self.u3, self.u2, self.u1])]
+
+        timeline = self.shards.timeline(db.session, self.u1, limit=4)
+        self.assertEqual([msg.id for msg in timeline], ids[:0:-1])
+        self.assertEqual([msg.text for msg in timeline],
+                         ["m4", "m3", "m2", "m1"])
+        self.assertEqual(timeline[1].user.username, "u2")
+
+        older = self.shards.timeline(
+            db.session, self.u1, limit=4, before=timeline[-1].id)
+        self.assertEqual([msg.text for msg in older], ["m0"])
+
+    def test_followers_and_likes(self):
+        """Tests gathering followers and liked messages from every shard"""
+
+        self.shards.follow(db.session, self.u2, self.u1)
+        self.shards.follow(db.session, self.u3, self.u1)
+        self.assertEqual(self.shards.follower_ids(db.session, self.u1),
+                         {self.u2, self.u3})
+        self.assertEqual(
+            [user.id for user in self.shards.follower_users(
+                db.session, self.u1, chunk_size=1)],
+            [self.u2, self.u3])
+        self.assertEqual(
+            db.session.get(User, self.u1).count_followers(), 2)
+
+        first = self.shards.add_message(db.session, self.u1, "on shard 1")
+        second = self.shards.add_message(db.session, self.u2, "on shard 0")
+        self.shards.like(db.session, self.u3, first)
+        self.shards.like(db.session, self.u3, second)
+
+        self.assertEqual(
+            [msg.text for msg in
+             self.shards.liked_messages(db.session, self.u3)],
+            ["on shard 0", "on shard 1"])
+        self.assertEqual(
+            self.shards.liked_among(db.session, self.u3, [first]), {first})
+
+    def test_delete_message(self):
+        """Tests that deleting a message removes likes on other shards"""
+
+        message_id = self.shards.add_message(db.session, self.u1, "bye")
+        self.shards.like(db.session, self.u2, message_id)
+        self.shards.like(db.session, self.u3, message_id)
+
+        self.shards.delete_message(db.session, message_id, self.u1)
+
+        self.assertIsNone(self.shards.message(db.session, message_id))
+        for shard in range(NUM_SHARDS):
+            self.assertEqual(self.rows(shard, sharding.likes), [])
+
+    def test_purge(self):
+        """Tests that purging a user clears their rows on every shard"""
+
+        written = [self.shards.add_message(db.session, self.u1, f"m{i}")
+                   for i in range(3)]
+        kept = self.shards.add_message(db.session, self.u2, "hi @u1")
+        self.shards.follow(db.session, self.u1, self.u2)
+        self.shards.follow(db.session, self.u2, self.u1)
+        self.shards.like(db.session, self.u1, kept)
+        for message_id in written:
+            self.shards.like(db.session, self.u2, message_id)
+            self.shards.like(db.session, self.u3, message_id)
+
+        tombstone_user(db.session, self.u1)
+        db.session.commit()
+        progress = purge_user(db.session, self.u1, batch_size=2)
+
+        self.assertEqual(progress.phase, 'done')
+        for shard in range(NUM_SHARDS):
+            for table in (sharding.likes, sharding.follows,
+                          sharding.mentions):
+                self.assertEqual(self.rows(shard, table), [])
+        self.assertEqual(
+            [row.id for row in self.rows(
+                self.shards.shard_for(db.session, self.u2),
+                sharding.messages)],
+            [kept])
+        self.assertEqual(self.rows(
+            self.shards.shard_for(db.session, self.u1), sharding.messages),
+            [])
+
+    def test_main_database_only(self):
+        """Tests that features without shard support must be turned off"""
+
+        with self.assertRaisesRegex(ValueError, "TRENDING_ENABLED"):
+            create_test_app({
+                'SQLALCHEMY_DATABASE_URI': "sqlite://",
+                'SHARD_URLS': ["sqlite://"],
+                'SUGGESTIONS_ENABLED': False,
+            })
+
+    def test_move_user(self):
+        """Tests moving a user's rows to another shard"""
+
+        message_id = self.shards.add_message(db.session, self.u1, "moving")
+        self.shards.follow(db.session, self.u1, self.u2)
+        self.shards.like(db.session, self.u1, message_id)
+        self.shards.add_message(db.session, self.u3, "staying")
+
+        self.assertEqual(self.shards.move_user(db.session, self.u1, 0), 3)
+
+        self.assertEqual(self.shards.shard_for(db.session, self.u1), 0)
+        self.assertEqual(len(self.rows(0, sharding.messages)), 1)
+        self.assertEqual(
+            [row.text for row in self.rows(1, sharding.messages)],
+            ["staying"])
+
+        messages = self.shards.user_messages(db.session, self.u1)
+        self.assertEqual([msg.text for msg in messages], ["moving"])
+        self.assertEqual(self.shards.following_ids(db.session, self.u1),
+                         {self.u2})
+        self.assertEqual(self.shards.liked_message_ids(db.session, self.u1),
+                         {message_id})
+
+        self.assertEqual(self.shards.move_user(db.session, self.u1, 0), 0)
+        with self.assertRaises(ValueError):
+            self.shards.move_user(db.session, self.u1, NUM_SHARDS)
+
+    def test_tags(self):
+        """Tests that tags and mentions live with their message"""
+
+        self.shards.add_message(db.session, self.u1, "#news from @u2")
+        self.shards.add_message(db.session, self.u2, "more #News")
+
+        self.assertEqual(
+            [msg.text for msg in
+             self.shards.tagged_messages(db.session, "news")],
+            ["more #News", "#news from @u2"])
+        self.assertEqual(
+            [msg.text for msg in
+             self.shards.mentioning_messages(db.session, self.u2)],
+            ["#news from @u2"])
+
+        self.shards.move_user(db.session, self.u1, 0)
+        self.assertEqual(self.rows(1, sharding.message_tags), [])
+        self.assertEqual(len(self.rows(0, sharding.message_tags)), 2)
+        self.assertEqual(len(self.rows(0, sharding.mentions)), 1)
+
+    def test_import(self):
+        """Tests that imports go to the owner's shard, ids checked on all"""
+
+        self.shards.add_message(db.session, self.u2, "on shard 0")
+        file = io.BytesIO(b'{"text": "#old", "timestamp": "2023-01-01"}\n')
+        count, oldest, _ = bulk_import.validate(file, bulk_import.NDJSON)
+        file.seek(0)
+        bulk_import.import_messages(
+            db.session, self.u1, file, bulk_import.NDJSON, oldest)
+
+        self.assertEqual(len(self.rows(1, sharding.messages)), 1)
+        self.assertEqual(len(self.rows(1, sharding.message_tags)), 1)
+        [message_id] = [row.id for row in self.rows(1, sharding.messages)]
+        self.assertEqual(
+            self.shards.existing_message_ids(db.session, [message_id, 1]),
+            {message_id})
+
+    def test_export(self):
+        """Tests that exports read the owner's shard and every follower's"""
+
+        self.shards.add_message(db.session, self.u2, "mine")
+        self.shards.follow(db.session, self.u1, self.u2)
+        self.shards.follow(db.session, self.u3, self.u2)
+        self.shards.follow(db.session, self.u2, self.u1)
+
+        data = b"".join(export.stream(db.session, self.u2))
+        with zipfile.ZipFile(io.BytesIO(data)) as zip_file:
+            self.assertEqual(
+                [json.loads(line)['text'] for line in
+                 zip_file.read('messages.ndjson').splitlines()],
+                ["mine"])
+            self.assertEqual(
+                zip_file.read('following.csv').decode().splitlines(),
+                ["user_id,username", f"{self.u1},u1"])
+            self.assertEqual(
+                zip_file.read('followers.csv').decode().splitlines(),
+                ["user_id,username", f"{self.u1},u1", f"{self.u3},u3"])
+
+    def test_views(self):
+        """Tests posting, following and reading through the routes"""
+
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session[CURR_USER_KEY] = self.u2
+
+        message_id = self.shards.add_message(db.session, self.u1, "from u1")
+
+        client.post("/messages/new", data={"text": "from u2"})
+        client.post(f"/users/follow/{self.u1}")
+        client.post(f"/users/like/{message_id}")
+
+        resp = client.get("/")
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("from u2", resp.text)
+        self.assertIn("from u1", resp.text)
+
+        resp = client.get(f"/users/{self.u1}/followers")
+        self.assertIn("@u2", resp.text)
+
+        resp = client.get(f"/users/{self.u2}/likes")
+        self.assertIn("from u1", resp.text)
+
+        resp = client.get(f"/messages/{message_id}")
+        self.assertEqual(resp.status_code, 200)
+
+        self.assertEqual(client.get("/trending").status_code, 404)
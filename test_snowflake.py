@@ -0,0 +1,190 @@
+"""Snowflake message id tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_snowflake.py
+
+
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, User, Message, Likes, MessageTag, Mention
+
+# Create our app on the test database (see testing.py: Postgres by
+# default, or in memory; and how to run the tests in parallel)
+
+from testing import DatabaseTestCase, create_test_app
+
+app = create_test_app()
+app.app_context().push()
+
+import snowflake
+from id_migration import migrate_message_ids
+import notifications
+from snowflake import BackfillIds, IdGenerator, MIN_SNOWFLAKE
+
+# 2024-01-01 00:00:00 UTC
+NOW = 1_704_067_200.0
+
+
+class IdGeneratorTestCase(TestCase):
+    """Tests for IdGenerator and BackfillIds"""
+
+    def test_layout(self):
+        """Tests that ids pack time, worker and sequence"""
+
+        clock = [NOW]
+        generator = IdGenerator(worker_id=5, clock=lambda: clock[0])
+
+        first = generator.next_id()
+        second = generator.next_id()
+
+        ms = int(NOW * 1000) - snowflake.EPOCH_MS
+        self.assertEqual(snowflake.decompose(first), (ms, 5, 0))
+        self.assertEqual(snowflake.decompose(second), (ms, 5, 1))
+        self.assertGreater(first, MIN_SNOWFLAKE)
+
+    def test_increasing(self):
+        """Tests that ids keep increasing when the clock steps back"""
+
+        clock = [NOW]
+        generator = IdGenerator(worker_id=1, clock=lambda: clock[0])
+
+        ids = [generator.next_id()]
+        clock[0] = NOW - 5
+        ids.append(generator.next_id())
+        clock[0] = NOW + 1
+        ids.append(generator.next_id())
+
+        self.assertEqual(ids, sorted(set(ids)))
+
+    def test_sequence_overflow(self):
+        """Tests that running out of sequence numbers borrows the next ms"""
+
+        generator = IdGenerator(worker_id=1, clock=lambda: NOW)
+
+        ids = [generator.next_id()
+               for _ in range(snowflake.MAX_SEQUENCE + 2)]
+
+        self.assertEqual(len(set(ids)), len(ids))
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual(snowflake.decompose(ids[-1])[2], 0)
+
+    def test_workers_differ(self):
+        """Tests that two workers never make the same id"""
+
+        a = IdGenerator(worker_id=1, clock=lambda: NOW)
+        b = IdGenerator(worker_id=2, clock=lambda: NOW)
+
+        self.assertNotEqual(a.next_id(), b.next_id())
+
+    def test_bad_worker_id(self):
+        """Tests that worker ids out of range are refused"""
+
+        with self.assertRaises(ValueError):
+            IdGenerator(worker_id=snowflake.MAX_WORKER_ID + 1)
+
+    def test_pid_worker_ids(self):
+        """Tests that pid-derived worker ids stay clear of gunicorn slots"""
+
+        generator = IdGenerator(clock=lambda: NOW)
+
+        self.assertGreaterEqual(generator.worker_id, snowflake.PID_WORKER_BASE)
+        self.assertLess(generator.worker_id, snowflake.BACKFILL_WORKER_ID)
+
+    def test_backfill(self):
+        """Tests ids made from stored timestamps"""
+
+        when = datetime(2024, 1, 1)
+        make_id = BackfillIds()
+
+        ids = [make_id(when), make_id(when),
+               make_id(when + timedelta(seconds=1))]
+
+        self.assertEqual(ids, sorted(set(ids)))
+        ms, worker_id, _ = snowflake.decompose(ids[0])
+        self.assertEqual(ms, int(NOW * 1000) - snowflake.EPOCH_MS)
+        self.assertEqual(worker_id, snowflake.BACKFILL_WORKER_ID)
+
+
+class MigrateMessageIdsTestCase(DatabaseTestCase):
+    """Tests for renumbering pre-snowflake messages"""
+
+    def setUp(self):
+        """Set up that runs before every test"""
+
+        super().setUp()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        db.session.flush()
+
+        # Old-style ids, out of step with the timestamps
+        db.session.add_all([
+            Message(id=1, text="newest", user_id=u1.id,
+                    timestamp=datetime(2023, 3, 1)),
+            Message(id=2, text="oldest", user_id=u1.id,
+                    timestamp=datetime(2023, 1, 1)),
+            Message(id=3, text="middle", user_id=u1.id,
+                    timestamp=datetime(2023, 2, 1)),
+        ])
+        db.session.flush()
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.flush()
+        db.session.add_all([
+            Likes(user_id=u1.id, message_id=3),
+            MessageTag(tag="middle", message_id=3),
+            Mention(user_id=u2.id, message_id=3),
+        ])
+        notifications.liked(db.session, u1.id, u2.id, 3)
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+
+    def tearDown(self):
+        """Tear down that runs after every test"""
+
+        db.session.rollback()
+
+    def test_migrate(self):
+        """Tests that ids follow timestamps and references follow their ids"""
+
+        self.assertEqual(migrate_message_ids(db.session, batch_size=2), 3)
+
+        messages = Message.query.order_by(Message.id).all()
+        self.assertEqual(
+            [msg.text for msg in messages], ["oldest", "middle", "newest"])
+        self.assertTrue(all(msg.id >= MIN_SNOWFLAKE for msg in messages))
+
+        middle = messages[1].id
+        self.assertEqual(Likes.query.one().message_id, middle)
+        self.assertEqual(MessageTag.query.one().message_id, middle)
+        self.assertEqual(Mention.query.one().message_id, middle)
+
+        # Another like of the message still folds into the notification
+        notifications.liked(db.session, self.u1_id, self.u2_id, middle)
+        db.session.commit()
+        [item] = notifications.inbox(db.session, self.u1_id)
+        self.assertEqual(item.message_id, middle)
+
+        # Running it again changes nothing
+        self.assertEqual(migrate_message_ids(db.session), 0)
+
+    def test_before_epoch(self):
+        """Tests that messages older than the epoch still get snowflakes"""
+
+        db.session.add_all([
+            Message(id=4, text="older", user_id=self.u1_id,
+                    timestamp=datetime(2019, 5, 1)),
+            Message(id=5, text="much older", user_id=self.u1_id,
+                    timestamp=datetime(2001, 1, 1)),
+        ])
+        db.session.commit()
+
+        self.assertEqual(migrate_message_ids(db.session), 5)
+
+        messages = Message.query.order_by(Message.id).all()
+        self.assertEqual(
+            [msg.text for msg in messages],
+            ["much older", "older", "oldest", "middle", "newest"])
+        self.assertTrue(all(msg.id >= MIN_SNOWFLAKE for msg in messages))
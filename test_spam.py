@@ -0,0 +1,159 @@
+"""Near-duplicate screening tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_spam.py
+
+
+from unittest import TestCase
+
+from models import db, User, Message
+
+# Create our app on the test database (see testing.py: Postgres by
+# default, or in memory; and how to run the tests in parallel)
+
+from app import CURR_USER_KEY
+from testing import DatabaseTestCase, create_test_app
+
+app = create_test_app()
+app.app_context().push()
+
+import sharding
+import snowflake
+import spam
+
+SPAM = "Cheap watches at example dot com, best prices for everyone today"
+
+
+class IndexTestCase(TestCase):
+    """Tests for the MinHash/LSH index"""
+
+    def setUp(self):
+        self.index = spam.NearDuplicateIndex(window=1000)
+
+    def add(self, text):
+        self.index.add(self.index.signature(text))
+
+    def duplicates(self, text):
+        return self.index.duplicates(self.index.signature(text))
+
+    def test_duplicates(self):
+        """Tests that variations count, and different texts don't"""
+
+        self.assertEqual(self.index.window, 1024)
+
+        for i in range(3):
+            self.add(f"{SPAM} {'!' * i}")
+            self.add(f"unrelated message number {i} about my cat")
+
+        self.assertEqual(self.duplicates(SPAM.upper() + "  ?"), 3)
+        self.assertEqual(self.duplicates("What a lovely day at the beach"),
+                         0)
+
+        similarities = self.index.similarities(self.index.signature(
+            "unrelated message number 1 about my cat"))
+        self.assertAlmostEqual(max(similarities), 1.0)
+
+    def test_window(self):
+        """Tests that messages fall out of the window as others arrive"""
+
+        index = self.index = spam.NearDuplicateIndex(window=4)
+        self.add(SPAM)
+        self.add(SPAM)
+        self.assertEqual(self.duplicates(SPAM), 2)
+        self.assertEqual(len(index), 2)
+
+        for i in range(3):
+            self.add(f"filler message number {i} for the window")
+        self.assertEqual(self.duplicates(SPAM), 1)
+
+        self.add("one more filler message for the window")
+        self.assertEqual(self.duplicates(SPAM), 0)
+        self.assertEqual(len(index), 4)
+
+    def test_bands(self):
+        """Tests that the bands have to cover the signature"""
+
+        with self.assertRaises(ValueError):
+            spam.NearDuplicateIndex(bands=10, rows=4)
+
+
+class SpamFilterTestCase(DatabaseTestCase):
+    """Tests for screening new messages against the database"""
+
+    def setUp(self):
+        """Set up that runs before every test"""
+
+        super().setUp()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        db.session.commit()
+        self.u1_id = u1.id
+
+        self.filter = spam.SpamFilter(max_duplicates=2, window=1000)
+        filters = app.extensions
+        self.addCleanup(filters.__setitem__, 'spam', filters['spam'])
+        filters['spam'] = self.filter
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as session:
+            session[CURR_USER_KEY] = self.u1_id
+
+    def tearDown(self):
+        """Tear down that runs after every test"""
+
+        db.session.rollback()
+
+    def test_rebuild(self):
+        """Tests that the index is built from the messages table"""
+
+        db.session.add_all(Message(text=f"{SPAM} {i}", user_id=self.u1_id)
+                           for i in range(2))
+        db.session.commit()
+
+        self.assertTrue(self.filter.is_spam(db.session, SPAM))
+        self.assertFalse(self.filter.is_spam(
+            db.session, "Nothing like the others, honestly"))
+        self.assertEqual(self.filter.snapshot()['indexed'], 2)
+        self.assertEqual(self.filter.snapshot()['rejected'], 1)
+
+    def test_refresh(self):
+        """Tests that refreshes find other processes' posts, once each"""
+
+        self.filter.refresh_seconds = 0
+        self.assertFalse(self.filter.is_spam(db.session, SPAM))
+
+        # Posted here, then by another process, whose id is older and
+        # commits later.
+        shards = sharding.current()
+        mine = shards.add_message(db.session, self.u1_id, f"{SPAM} mine")
+        theirs = mine - snowflake.compose(1000, 0, 0)
+        self.filter.add(mine, f"{SPAM} mine")
+        db.session.add(Message(id=theirs, text=f"{SPAM} theirs",
+                               user_id=self.u1_id))
+        db.session.commit()
+
+        self.assertTrue(self.filter.is_spam(db.session, SPAM))
+        self.assertEqual(self.filter.snapshot()['indexed'], 2)
+        self.filter.is_spam(db.session, SPAM)
+        self.assertEqual(self.filter.snapshot()['indexed'], 2)
+
+    def test_add_message(self):
+        """Tests that posting refuses one near-duplicate too many"""
+
+        for i in range(3):
+            resp = self.client.post("/messages/new",
+                                    data={"text": f"{SPAM} {i}"})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("too much like ones posted recently", resp.text)
+        self.assertEqual(Message.query.count(), 2)
+
+    def test_short(self):
+        """Tests that short texts aren't screened"""
+
+        for i in range(3):
+            self.client.post("/messages/new", data={"text": "lol"})
+
+        self.assertEqual(Message.query.count(), 3)
+        self.assertEqual(self.filter.snapshot()['screened'], 0)
@@ -0,0 +1,142 @@
+"""Hashtag and mention tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_tags.py
+
+
+from unittest import TestCase
+
+from models import db, User, Message, MessageTag, Mention
+
+# Create our app on the test database (see testing.py: Postgres by
+# default, or in memory; and how to run the tests in parallel)
+
+from app import CURR_USER_KEY
+from testing import DatabaseTestCase, create_test_app
+
+app = create_test_app()
+app.app_context().push()
+
+import read_models
+import tags
+
+
+class ExtractTestCase(TestCase):
+    """Tests for finding tags and mentions in text"""
+
+    def test_extract(self):
+        """Tests tags, mentions and the things that are neither"""
+
+        self.assertEqual(
+            tags.extract("#Flask and #flask, @u1 @u2 @u1 hi#not a@b.com ##x"),
+            (["flask"], ["u1", "u2"]))
+        self.assertEqual(tags.extract("no tags here"), ([], []))
+        self.assertEqual(tags.extract("#" + "a" * 101), ([], []))
+
+
+class TagsTestCase(DatabaseTestCase):
+    """Tests for indexing messages and reading the tag and mention pages"""
+
+    def setUp(self):
+        """Set up that runs before every test"""
+
+        super().setUp()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as session:
+            session[CURR_USER_KEY] = self.u1_id
+
+    def tearDown(self):
+        """Tear down that runs after every test"""
+
+        db.session.rollback()
+
+    def test_add_message(self):
+        """Tests that posting a message indexes its tags and mentions"""
+
+        self.client.post("/messages/new",
+                         data={"text": "#Python with @u2 and @nobody"})
+
+        msg = Message.query.one()
+        self.assertEqual(
+            [(row.tag, row.message_id) for row in MessageTag.query],
+            [("python", msg.id)])
+        self.assertEqual(
+            [(row.user_id, row.message_id) for row in Mention.query],
+            [(self.u2_id, msg.id)])
+
+    def test_pages(self):
+        """Tests the tag and mentions pages and their paging"""
+
+        for i in range(3):
+            self.client.post("/messages/new", data={"text": f"#a @u2 {i}"})
+
+        found = read_models.tagged_messages(db.session, "A", limit=2)
+        self.assertEqual([msg.text for msg in found],
+                         ["#a @u2 2", "#a @u2 1"])
+        older = read_models.tagged_messages(
+            db.session, "a", limit=2, before=found[-1].id)
+        self.assertEqual([msg.text for msg in older], ["#a @u2 0"])
+
+        resp = self.client.get("/tags/A")
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("#a @u2 1", resp.text)
+
+        resp = self.client.get(f"/users/{self.u2_id}/mentions")
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("#a @u2 0", resp.text)
+
+        resp = self.client.get(f"/users/{self.u1_id}/mentions")
+        self.assertNotIn("#a @u2", resp.text)
+
+    def test_deleted(self):
+        """Tests that deleting a message removes its links"""
+
+        self.client.post("/messages/new", data={"text": "#gone @u2"})
+        msg = Message.query.one()
+
+        self.client.post(f"/messages/{msg.id}/delete")
+
+        self.assertEqual(MessageTag.query.count(), 0)
+        self.assertEqual(Mention.query.count(), 0)
+
+    def test_backfill(self):
+        """Tests indexing existing messages in batches, then again"""
+
+        texts = ["#one @u2", "plain", "#two #one", "@u1 #three"]
+        db.session.add_all(
+            Message(text=text, user_id=self.u1_id) for text in texts)
+        db.session.commit()
+        last = max(msg.id for msg in Message.query)
+
+        seen = []
+        self.assertEqual(
+            tags.backfill(db.session, batch_size=3, workers=1,
+                          progress=lambda *args: seen.append(args)),
+            (4, last))
+        self.assertEqual([count for count, _ in seen], [3, 4])
+
+        def index():
+            return (sorted((row.tag, row.message_id)
+                           for row in MessageTag.query),
+                    sorted((row.user_id, row.message_id)
+                           for row in Mention.query))
+
+        indexed = index()
+        self.assertEqual(len(indexed[0]), 4)
+        self.assertEqual(len(indexed[1]), 2)
+
+        # Across a process pool, replacing what's there
+        self.assertEqual(
+            tags.backfill(db.session, batch_size=1, workers=2), (4, last))
+        self.assertEqual(index(), indexed)
+
+        self.assertEqual(tags.backfill(db.session, after=last), (0, last))
@@ -0,0 +1,67 @@
+"""Trending index tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_trending.py
+
+
+from unittest import TestCase
+
+from trending import TrendingIndex
+
+HOUR = 60 * 60
+NOW = 1_700_000_000 - 1_700_000_000 % HOUR
+
+
+class TrendingIndexTestCase(TestCase):
+    """Tests for the ring-buffer trending index"""
+
+    def setUp(self):
+        """Set up that runs before every test"""
+
+        self.index = TrendingIndex(
+            num_buckets=24, bucket_seconds=HOUR, half_life_seconds=HOUR)
+
+    def test_score_decays_with_age(self):
+        """Tests that a like counts half as much one half-life later"""
+
+        self.index.add_like(1, NOW)
+
+        self.assertEqual(self.index.score(1, NOW), 1.0)
+        self.assertEqual(self.index.score(1, NOW + HOUR), 0.5)
+        self.assertEqual(self.index.score(1, NOW + 24 * HOUR), 0.0)
+
+    def test_remove_like(self):
+        """Tests that unliking takes the like out of its original bucket"""
+
+        self.index.add_like(1, NOW - 3 * HOUR)
+        self.index.add_like(1, NOW)
+        self.index.remove_like(1, NOW - 3 * HOUR)
+
+        self.assertEqual(self.index.score(1, NOW), 1.0)
+
+        # Removing more than was added never goes negative
+        self.index.remove_like(1, NOW - 3 * HOUR)
+        self.assertEqual(self.index.score(1, NOW), 1.0)
+
+    def test_ring_wraps(self):
+        """Tests that slots reused after the ring wraps start from zero"""
+
+        self.index.add_like(1, NOW)
+        self.index.add_like(1, NOW + 24 * HOUR)
+
+        self.assertEqual(self.index.score(1, NOW + 24 * HOUR), 1.0)
+
+    def test_top(self):
+        """Tests top-k ranking and eviction of stale messages"""
+
+        self.index.add_like(1, NOW)
+        for _ in range(3):
+            self.index.add_like(2, NOW)
+        self.index.add_like(3, NOW - 2 * HOUR)
+        self.index.add_like(4, NOW - 30 * HOUR)
+
+        top = self.index.top(2, now=NOW)
+
+        self.assertEqual([message_id for message_id, _ in top], [2, 1])
+        self.assertEqual(len(self.index), 3)
@@ -5,21 +5,21 @@
 #    FLASK_DEBUG=False python -m unittest test_user_views.py
 
 
-from app import app, CURR_USER_KEY, session
-import os
-from unittest import TestCase
+from flask import session
 
 from models import db, User
+from follow_graph import follow_graph
+import jobs
+import tasks
 
-# BEFORE we import our app, let's set an environmental variable
-# to use a different database for tests (we need to do this
-# before we import our app, since that will have already
-# connected to the database
+# Create our app on the test database (see testing.py: Postgres by
+# default, or in memory; and how to run the tests in parallel)
 
-os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
-
-# Now we can import app
+from app import CURR_USER_KEY
+from testing import DatabaseTestCase, create_test_app
 
+app = create_test_app()
+app.app_context().push()
 
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 
@@ -27,21 +27,10 @@ app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 
 app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
 
-# Create our tables (we do this here, so we only create the tables
-# once for all tests --- in each test, we'll delete the data
-# and create fresh new clean test data
-
-db.drop_all()
-db.create_all()
-
-# Don't have WTForms use CSRF at all, since it's a pain to test
-
-app.config['WTF_CSRF_ENABLED'] = False
-
 
-class UserBaseViewTestCase(TestCase):
+class UserBaseViewTestCase(DatabaseTestCase):
     def setUp(self):
-        User.query.delete()
+        super().setUp()
 
         u1 = User.signup("u1", "u1@email.com", "password", None)
         u2 = User.signup("u2", "u2@email.com", "password", None)
@@ -84,6 +73,23 @@ class UserDisplayViewTestCase(UserBaseViewTestCase):
             self.assertIn('Edit Profile', html)
 
 
+    def test_list_users_following(self):
+        """Tests that the user list marks who the viewer follows"""
+
+        u1 = db.session.get(User, self.u1_id)
+        u1.following.append(db.session.get(User, self.u2_id))
+        db.session.commit()
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            html = c.get('/users').get_data(as_text=True)
+
+        self.assertIn(f'action="/users/stop-following/{self.u2_id}"', html)
+        self.assertIn(f'action="/users/follow/{self.u1_id}"', html)
+
+
 class UserFollowerViewTestCase(UserBaseViewTestCase):
     def test_logged_in_follower_page(self):
         """Tests if logged in user can see followers page"""
@@ -184,6 +190,41 @@ class UserFollowingViewTestCase(UserBaseViewTestCase):
             self.assertIn('Access unauthorized.', html)
 
 
+class UserSuggestionsViewTestCase(UserBaseViewTestCase):
+
+    def test_suggestions(self):
+        """Tests friends-of-friends show up as suggestions after follows"""
+
+        follow_graph.clear()
+        u3 = User.signup("u3", "u3@email.com", "password", None)
+        db.session.commit()
+        u3_id = u3.id
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+            c.post(f'/users/follow/{u3_id}')
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+            c.post(f'/users/follow/{self.u2_id}')
+
+            resp = c.get(f'/users/{self.u1_id}/suggestions')
+            self.assertEqual(resp.status_code, 200)
+            html = resp.get_data(as_text=True)
+            self.assertIn('<p>@u3</p>', html)
+            self.assertNotIn('<p>@u2</p>', html)
+
+    def test_logged_out_suggestions(self):
+        """Tests if logged out user cannot see suggestions"""
+
+        with app.test_client() as c:
+            resp = c.get(f'/users/{self.u1_id}/suggestions',
+                         follow_redirects=True)
+            html = resp.get_data(as_text=True)
+            self.assertIn('Access unauthorized.', html)
+
+
 class UserDeleteViewTestCase(UserBaseViewTestCase):
 
     def test_delete_user(self):
@@ -196,6 +237,8 @@ class UserDeleteViewTestCase(UserBaseViewTestCase):
             resp = c.post('/users/delete', follow_redirects=True)
             self.assertEqual(resp.status_code, 200)
 
+            # The route only queues the deletion; run the worker
+            jobs.work(db.session, burst=True)
             self.assertIsNone(User.query.get(self.u1_id))
 
             html = resp.get_data(as_text=True)
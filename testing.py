@@ -0,0 +1,287 @@
+"""Test-suite support: test apps, a database per worker, rollback per test.
+
+Test modules make their app with `create_test_app()` and put their
+database tests in `DatabaseTestCase`s:
+
+- Each test runs in one transaction on one connection, rolled back when
+  it ends. The sessions it uses, and those of the requests it makes, join
+  that transaction: their commits only release a SAVEPOINT. So a setUp
+  needn't delete the last test's rows, and nothing is left behind.
+- Tables are created once per process, not once per module.
+- Passwords are hashed at bcrypt cost BCRYPT_LOG_ROUNDS, not 12.
+
+TEST_DATABASE_URL picks the database (default DEFAULT_DATABASE_URL).
+"sqlite://" runs the suite in memory: every app in the process shares one
+in-memory database, so nothing needs to be running.
+
+When tests run in parallel, each worker has a database of its own: its
+TEST_WORKER (or pytest-xdist's PYTEST_XDIST_WORKER) is appended to the
+database's name. `python -m testing` runs the test modules on a worker per
+CPU like that, creating the Postgres databases the first time:
+
+    python -m testing [-j workers] [test_module.py ...]
+"""
+
+import argparse
+import glob
+import os
+import re
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from unittest import TestCase
+
+from flask_sqlalchemy.session import Session
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine import make_url
+
+from models import db
+
+DEFAULT_DATABASE_URL = "postgresql:///warbler_test"
+BCRYPT_LOG_ROUNDS = 4
+
+# The in-memory database: named and shared, so every app's engine (each
+# test module makes its own app) sees the same one.
+MEMORY_DATABASE_URL = (
+    "sqlite:///file:/warbler_test?mode=memory&cache=shared&uri=true")
+
+# Apps tests make with create_app() itself hash cheaply too.
+os.environ.setdefault('BCRYPT_LOG_ROUNDS', str(BCRYPT_LOG_ROUNDS))
+
+
+def worker_id():
+    """This process's test worker, or None if tests aren't parallel."""
+
+    return (os.environ.get('TEST_WORKER') or
+            os.environ.get('PYTEST_XDIST_WORKER'))
+
+
+def database_url(worker=None):
+    """The test database for `worker` (default: this process's)."""
+
+    url = make_url(os.environ.get('TEST_DATABASE_URL', DEFAULT_DATABASE_URL))
+    worker = worker if worker is not None else worker_id()
+
+    if url.get_backend_name() == 'sqlite':
+        if url.database in (None, '', ':memory:'):
+            # Each process has its own memory, so workers are apart already.
+            return MEMORY_DATABASE_URL
+        if worker is not None:
+            root, extension = os.path.splitext(url.database)
+            url = url.set(database=f"{root}_{worker}{extension}")
+    elif worker is not None:
+        url = url.set(database=f"{url.database}_{worker}")
+
+    return url.render_as_string(hide_password=False)
+
+
+def ensure_database(url):
+    """Create Postgres database `url` if it doesn't exist yet."""
+
+    url = make_url(url)
+    if url.get_backend_name() != 'postgresql':
+        return
+
+    engine = create_engine(url.set(database='postgres'),
+                           isolation_level='AUTOCOMMIT')
+    try:
+        with engine.connect() as conn:
+            exists = conn.execute(
+                text("SELECT 1 FROM pg_database WHERE datname = :name"),
+                {'name': url.database}).scalar()
+            if not exists:
+                conn.exec_driver_sql(f'CREATE DATABASE "{url.database}"')
+    finally:
+        engine.dispose()
+
+
+def _begin_explicitly(engine):
+    """Let SQLite connections on `engine` hold SAVEPOINTs in a transaction.
+
+    The sqlite3 module starts transactions itself, only just before it
+    writes, so a SAVEPOINT would start (and its RELEASE commit) one of its
+    own. Turn that off and BEGIN when SQLAlchemy does.
+    """
+
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, 'begin')
+    def begin(conn):
+        conn.exec_driver_sql("BEGIN")
+
+
+def create_test_app(config=None):
+    """A Warbler app for tests, on this worker's test database.
+
+    `config` overrides the test settings, as create_app()'s does. An app
+    given a database of its own there is left to manage it.
+    """
+
+    from app import create_app
+
+    settings = {
+        'SQLALCHEMY_DATABASE_URI': database_url(),
+        'SECRET_KEY': "test",
+        'WTF_CSRF_ENABLED': False,
+        'WARM_UP_TEMPLATES': False,
+        'BCRYPT_LOG_ROUNDS': BCRYPT_LOG_ROUNDS,
+    }
+    settings.update(config or {})
+
+    on_test_database = 'SQLALCHEMY_DATABASE_URI' not in (config or {})
+    if on_test_database and worker_id() is not None:
+        ensure_database(settings['SQLALCHEMY_DATABASE_URI'])
+
+    app = create_app(settings)
+    if on_test_database:
+        with app.app_context():
+            if db.engine.dialect.name == 'sqlite':
+                _begin_explicitly(db.engine)
+
+    return app
+
+
+class _JoiningSession(Session):
+    """Uses the connection it's bound to, when it is, for every table.
+
+    Flask-SQLAlchemy's sessions pick an engine by table; the test's
+    transaction is on one connection.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and self.bind is not None:
+            return self.bind
+        return super().get_bind(mapper, clause, bind, **kwargs)
+
+
+db.session.session_factory.class_ = _JoiningSession
+db.session.session_factory.configure(join_transaction_mode='create_savepoint')
+
+# The database URLs whose tables this process has created.
+_created = set()
+
+
+def create_tables():
+    """Drop and create the current app's tables, once per process."""
+
+    url = db.engine.url.render_as_string(hide_password=False)
+    if url not in _created:
+        db.drop_all()
+        db.create_all()
+        _created.add(url)
+
+
+class DatabaseTestCase(TestCase):
+    """A test case whose database changes are rolled back after each test.
+
+    Subclasses' setUp calls super().setUp() first. Tests that need
+    their own transactions (several connections at once, threads) don't
+    belong here.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        create_tables()
+
+    def setUp(self):
+        super().setUp()
+
+        connection = db.engine.connect()
+        transaction = connection.begin()
+        db.session.remove()
+        db.session.session_factory.configure(bind=connection)
+
+        def roll_back():
+            db.session.remove()
+            db.session.session_factory.configure(bind=None)
+            transaction.rollback()
+            connection.close()
+
+        self.addCleanup(roll_back)
+
+
+##############################################################################
+# Running the suite in parallel
+
+RAN_PATTERN = re.compile(r"^Ran (\d+) tests?", re.MULTILINE)
+
+
+def _groups(paths, count):
+    """Split test module `paths` into `count` groups of about equal size.
+
+    Size is bytes of test code, which tracks running time well enough.
+    """
+
+    groups = [[] for _ in range(count)]
+    sizes = [0] * count
+    for path in sorted(paths, key=os.path.getsize, reverse=True):
+        smallest = sizes.index(min(sizes))
+        groups[smallest].append(path)
+        sizes[smallest] += os.path.getsize(path)
+    return [sorted(group) for group in groups if group]
+
+
+def _run(worker, paths):
+    """Run test modules `paths` as `worker`: (process result, seconds)."""
+
+    modules = [os.path.splitext(os.path.basename(path))[0] for path in paths]
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, '-m', 'unittest', *modules],
+        cwd=os.path.dirname(os.path.abspath(paths[0])),
+        env={**os.environ, 'TEST_WORKER': str(worker)},
+        capture_output=True, text=True)
+    return result, time.perf_counter() - start
+
+
+def main(argv=None):
+    """Run test modules in parallel; exit status 1 if any failed."""
+
+    parser = argparse.ArgumentParser(
+        prog="python -m testing", description=main.__doc__)
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count(),
+                        help="Processes to run (default: one per CPU).")
+    parser.add_argument('paths', nargs='*',
+                        help="Test modules (default: every test_*.py).")
+    args = parser.parse_args(argv)
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    paths = args.paths or glob.glob(os.path.join(here, 'test_*.py'))
+    groups = _groups(paths, max(1, min(args.workers, len(paths))))
+
+    # One at a time: Postgres won't copy its template to two at once.
+    for worker in range(len(groups)):
+        ensure_database(database_url(worker))
+
+    start = time.perf_counter()
+    tests = 0
+    failed = []
+    with ThreadPoolExecutor(len(groups)) as executor:
+        futures = {executor.submit(_run, worker, group): worker
+                   for worker, group in enumerate(groups)}
+        for future in as_completed(futures):
+            worker = futures[future]
+            result, elapsed = future.result()
+            ran = RAN_PATTERN.search(result.stderr)
+            tests += int(ran[1]) if ran else 0
+
+            status = "ok" if result.returncode == 0 else "FAILED"
+            print(f"worker {worker}: {len(groups[worker])} modules, "
+                  f"{ran[1] if ran else '?'} tests, {elapsed:.1f}s, "
+                  f"{status}", flush=True)
+            if result.returncode:
+                failed.append(worker)
+                print(result.stderr, file=sys.stderr, flush=True)
+
+    print(f"Ran {tests} tests on {len(groups)} workers in "
+          f"{time.perf_counter() - start:.1f}s: "
+          + ("FAILED" if failed else "OK"))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,210 @@
+"""Trending messages, ranked by recent like activity.
+
+Each message with recent likes gets a ring buffer of like counts, one slot
+per time bucket (an hour by default, a day's worth of slots). Likes and
+unlikes bump the slot for the time the like was made; slots that fall out
+of the window are zeroed lazily as the ring advances. A message's score is
+the sum of its slots, each weighted by an exponential decay on its age.
+"""
+
+import threading
+import time
+from array import array
+from datetime import datetime, timedelta, timezone
+from heapq import nlargest
+
+from models import Likes
+
+DEFAULT_NUM_BUCKETS = 24
+DEFAULT_BUCKET_SECONDS = 60 * 60
+DEFAULT_HALF_LIFE_SECONDS = 6 * 60 * 60
+
+# How long a computed top list is served before it is recomputed.
+TOP_REFRESH_SECONDS = 10
+
+
+def to_epoch(timestamp):
+    """Seconds since the epoch for a naive UTC datetime (as stored)."""
+
+    return timestamp.replace(tzinfo=timezone.utc).timestamp()
+
+
+class TrendingIndex:
+    """Time-bucketed like counts per message with a decayed score."""
+
+    def __init__(
+            self,
+            num_buckets=DEFAULT_NUM_BUCKETS,
+            bucket_seconds=DEFAULT_BUCKET_SECONDS,
+            half_life_seconds=DEFAULT_HALF_LIFE_SECONDS):
+        self.num_buckets = num_buckets
+        self.bucket_seconds = bucket_seconds
+        self._weights = [
+            0.5 ** (age * bucket_seconds / half_life_seconds)
+            for age in range(num_buckets)
+        ]
+        # message id -> [newest bucket number seen, array of counts]
+        self._windows = {}
+        self._top = None
+        self._top_at = 0
+        self.built_at = time.monotonic()
+
+    def _bucket(self, when):
+        return int(when // self.bucket_seconds)
+
+    def _advance(self, window, bucket):
+        """Move `window`'s newest bucket up to `bucket`, zeroing the gap."""
+
+        last, counts = window
+        if bucket <= last:
+            return
+        for b in range(max(last + 1, bucket - self.num_buckets + 1),
+                       bucket + 1):
+            counts[b % self.num_buckets] = 0
+        window[0] = bucket
+
+    def add_like(self, message_id, when=None, count=1):
+        """Count `count` likes of `message_id` made at `when` (epoch secs)."""
+
+        when = time.time() if when is None else when
+        bucket = self._bucket(when)
+
+        window = self._windows.get(message_id)
+        if window is None:
+            window = self._windows[message_id] = [
+                bucket, array('i', bytes(4 * self.num_buckets))]
+
+        self._advance(window, bucket)
+        if bucket > window[0] - self.num_buckets:
+            slot = bucket % self.num_buckets
+            window[1][slot] = max(window[1][slot] + count, 0)
+
+    def remove_like(self, message_id, when=None):
+        """Take back a like of `message_id` that was made at `when`."""
+
+        if message_id in self._windows:
+            self.add_like(message_id, when, count=-1)
+
+    def discard(self, message_id):
+        """Forget `message_id` entirely, e.g. when it is deleted."""
+
+        self._windows.pop(message_id, None)
+
+    def _score(self, window, current):
+        last, counts = window
+        gap = current - last
+        if gap >= self.num_buckets:
+            return 0.0
+
+        total = 0.0
+        for age in range(max(gap, 0), self.num_buckets):
+            total += counts[(current - age) % self.num_buckets] * \
+                self._weights[age]
+        return total
+
+    def score(self, message_id, now=None):
+        """Decayed like score for `message_id` as of `now` (epoch secs)."""
+
+        window = self._windows.get(message_id)
+        if window is None:
+            return 0.0
+        now = time.time() if now is None else now
+        return self._score(window, self._bucket(now))
+
+    def top(self, k=20, now=None):
+        """The `k` highest-scoring message ids with their scores.
+
+        Messages whose likes have all aged out of the window are dropped
+        from the index along the way, so memory tracks recent activity.
+        """
+
+        now = time.time() if now is None else now
+        current = self._bucket(now)
+        scored = []
+
+        for message_id, window in list(self._windows.items()):
+            score = self._score(window, current)
+            if score > 0:
+                scored.append((score, message_id))
+            elif current - window[0] >= self.num_buckets:
+                del self._windows[message_id]
+
+        return [(message_id, score)
+                for score, message_id in nlargest(k, scored)]
+
+    def cached_top(self, k=20):
+        """`top(k)`, recomputed at most every TOP_REFRESH_SECONDS."""
+
+        now = time.monotonic()
+        if (self._top is None or self._top[0] != k or
+                now - self._top_at > TOP_REFRESH_SECONDS):
+            self._top = (k, self.top(k))
+            self._top_at = now
+        return self._top[1]
+
+    def __len__(self):
+        return len(self._windows)
+
+    @classmethod
+    def from_db(cls, session, **kwargs):
+        """Rebuild from the likes made within the window."""
+
+        index = cls(**kwargs)
+        since = (datetime.now(timezone.utc).replace(tzinfo=None) -
+                 timedelta(seconds=index.num_buckets * index.bucket_seconds))
+
+        rows = (session
+                .query(Likes.message_id, Likes.timestamp)
+                .filter(Likes.timestamp >= since)
+                .yield_per(10_000))
+
+        for message_id, timestamp in rows:
+            index.add_like(message_id, to_epoch(timestamp))
+
+        return index
+
+
+class TrendingCache:
+    """Process-wide, lazily built trending index.
+
+    Each worker process applies its own likes and unlikes as they happen;
+    activity from other workers is picked up when the index is rebuilt from
+    the likes table, at most `max_age` seconds after the last build.
+    """
+
+    def __init__(self, max_age=300):
+        self.max_age = max_age
+        self._index = None
+        self._lock = threading.Lock()
+
+    def get(self, session):
+        """Return the current index, rebuilding it from `session` if stale."""
+
+        index = self._index
+        if index is None or time.monotonic() - index.built_at > self.max_age:
+            with self._lock:
+                index = self._index
+                if (index is None or
+                        time.monotonic() - index.built_at > self.max_age):
+                    index = self._index = TrendingIndex.from_db(session)
+        return index
+
+    def add_like(self, message_id, timestamp):
+        if self._index is not None:
+            self._index.add_like(message_id, to_epoch(timestamp))
+
+    def remove_like(self, message_id, timestamp):
+        if self._index is not None:
+            self._index.remove_like(message_id, to_epoch(timestamp))
+
+    def discard(self, message_id):
+        if self._index is not None:
+            self._index.discard(message_id)
+
+    def clear(self):
+        """Drop the index; the next `get()` rebuilds it."""
+
+        self._index = None
+
+
+trending = TrendingCache()